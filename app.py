@@ -6,68 +6,130 @@ st.set_page_config(
     initial_sidebar_state="auto" # 또는 "expanded", "collapsed"
 )
 
+from startup_timing import STARTUP_TIMINGS, TIMING_KIND_IMPORT, TIMING_KIND_INIT, BackgroundWarmup, lazy_import
 import os
 import io
-import fitz # PyMuPDF
-import pandas as pd
-import docx
-from pptx import Presentation
-import faiss
-import openai
-import numpy as np
+# fitz(PyMuPDF), pandas, docx, pptx, faiss, numpy, tiktoken은 처음 필요할 때 lazy_import()로 불러옴 (콜드 스타트 단축)
 import json
 import time
-from datetime import datetime
+from datetime import datetime, timedelta
 import uuid # 고유 ID 생성을 위해 추가
-from openai import AzureOpenAI, APIConnectionError, APITimeoutError, RateLimitError, APIStatusError
-from azure.core.exceptions import AzureError
-from azure.storage.blob import BlobServiceClient
+with STARTUP_TIMINGS.measure(TIMING_KIND_IMPORT, "openai"):
+    import openai
+    from openai import AzureOpenAI
+with STARTUP_TIMINGS.measure(TIMING_KIND_IMPORT, "azure.storage.blob"): # 로그인(사용자 정보 조회)에 필요하므로 바로 불러옴
+    from azure.core.exceptions import AzureError, ResourceNotFoundError
+    from azure.storage.blob import BlobServiceClient
 import tempfile
 from werkzeug.security import check_password_hash, generate_password_hash
 import traceback
 import base64
-import tiktoken
 import re # 주석 제거 또는 다른 정규식 사용을 위해
+import threading
+import atexit
+import random
+from long_document import (
+    LONG_DOC_MODE_TRANSLATE, LONG_DOC_MODE_SUMMARIZE, LONG_DOC_MODE_INSTRUCTIONS, LONG_DOC_REDUCE_INSTRUCTION,
+    detect_long_document_mode, split_text_into_token_sections, make_section_cache_key,
+    SectionResultCache, run_sections_in_order, assemble_section_outputs
+)
+from conversation_memory import (
+    empty_memory_state, select_recent_turns, update_rolling_summary, build_history_messages, count_summary_tokens, prune_message_token_counts
+)
+from prompt_builder import PromptBuilder, ensure_item_token_count, load_prompt_rules
+from app_common import (
+    CHAT_HISTORY_BASE_PATH, CHAT_TEMPERATURE, EMBEDDING_BATCH_SIZE, LOG_FLUSH_INTERVAL_SECONDS, MODEL_MAX_INPUT_TOKENS, MODEL_MAX_OUTPUT_TOKENS,
+    RETRIEVAL_K_RESULTS, RULES_PATH, TARGET_INPUT_TOKENS_FOR_PROMPT, USAGE_LOG_PREFIX, USAGE_ROLLUP_PREFIX, USERS_BLOB_NAME,
+    make_usage_log_entry
+)
+from text_chunking import PAGE_BREAK, chunk_text_into_pieces
+from chunk_dedup import strip_repeated_page_lines
+from vector_shards import COMMON_SHARD_NAME, ShardedVectorStore, department_shard_name, VectorIngestPausedError, load_migration_state, migration_progress
+from pipeline_stages import StageTimings, run_concurrent_stages
+from llm_client import ResilientLLMClient, RetryPolicy, LLMUnavailableError, LLMQueueFullError
+from llm_scheduler import FairLLMScheduler
+from retrieval_client import RetrievalServiceClient, RetrievalServiceError
+from token_quota import QUOTA_PERIOD_DAY, QUOTA_PERIOD_MINUTE, QUOTA_SCOPE_DEPARTMENT, QUOTA_SCOPE_USER, QuotaExceededError, TokenQuotaLimiter, TokenUsageMeter, UsageCaller
+from log_writer import BackgroundLogWriter, parse_jsonl_bytes, read_log_stream
+from usage_rollups import UsageRollupStore, read_recent_log_entries
+from blob_cache import BlobDocumentCache, BLOB_NOT_FOUND
+from blob_io import append_blob_lines, update_json_blob, upload_json_blob
+from storage_backends import DiskCachedContainerClient, LocalContainerClient
+from blob_browser import BlobListingCache, make_blob_change_entry
+from conversation_autosave import ConversationAutosaver
+from faq_cache import FAQAnswerCache, format_cached_answer, index_fingerprint, resolve_scope
+from tracing import (
+    RequestTrace, activate_trace, bind_trace, current_trace, current_span_id, trace_span, start_trace_span,
+    summarize_span_durations, format_trace_breakdown, iter_trace_spans
+)
 
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from streamlit_cookies_manager import EncryptedCookieManager
 print("Imported streamlit_cookies_manager (EncryptedCookieManager only).")
 
+# 이번 실행(rerun) 전체를 하나의 trace로 기록. 끝나는 지점(로그인 화면 중지, 답변 후 rerun, 스크립트 끝)에서 finish_rerun_trace() 호출
+rerun_trace = RequestTrace("rerun")
+activate_trace(rerun_trace)
 
-try:
-    tokenizer = tiktoken.get_encoding("o200k_base") # 최신 모델용 인코더
-    print("Tiktoken 'o200k_base' encoder loaded successfully.")
-except Exception as e:
-    st.error(f"Tiktoken encoder 'o200k_base' load failed: {e}. Token-based length limit may not work.")
-    print(f"ERROR: Failed to load tiktoken 'o200k_base' encoder: {e}")
-    try:
-        tokenizer = tiktoken.get_encoding("cl100k_base") # 대체 인코더
-        print("Tiktoken 'cl100k_base' encoder loaded successfully as a fallback.")
-    except Exception as e2:
-        st.error(f"Tiktoken encoder 'cl100k_base' (fallback) load failed: {e2}. Token-based length limit may not work.")
-        print(f"ERROR: Failed to load tiktoken 'cl100k_base' (fallback) encoder: {e2}")
-        tokenizer = None
 
+tokenizer = None # 백그라운드에서 준비 (로그인 이후 startup_warmup에서 가져옴)
 
 APP_VERSION = "1.0.7 (Chat History Deletion)" 
 
 # --- 파일 경로 및 상수 정의 ---
-RULES_PATH_REPO = ".streamlit/prompt_rules.txt"
 COMPANY_LOGO_PATH_REPO = "company_logo.png" # 앱 루트 디렉토리에 로고 파일 위치 가정
-INDEX_BLOB_NAME = "vector_db/vector.index"
-METADATA_BLOB_NAME = "vector_db/metadata.json"
-USERS_BLOB_NAME = "app_data/users.json"
-UPLOAD_LOG_BLOB_NAME = "app_logs/upload_log.json"
-USAGE_LOG_BLOB_NAME = "app_logs/usage_log.json"
-CHAT_HISTORY_BASE_PATH = "chat_histories/" # 사용자별 대화 내역 저장 기본 경로
+UPLOAD_LOG_BLOB_NAME = "app_logs/upload_log.json" # 이전 형식 (단일 JSON). 신규 항목은 UPLOAD_LOG_PREFIX 아래 날짜별 JSONL에 기록
+USAGE_LOG_BLOB_NAME = "app_logs/usage_log.json" # 이전 형식 (단일 JSON). 신규 항목은 USAGE_LOG_PREFIX 아래 날짜별 JSONL에 기록
+UPLOAD_LOG_PREFIX = "app_logs/uploads/"
+CHANGES_LOG_PREFIX = "app_logs/changes/" # Blob 쓰기/삭제 기록 (관리자 Blob 탐색기의 최신순 보기)
+TRACES_LOG_PREFIX = "app_logs/traces/" # rerun별 단계 추적 (span 목록 포함 JSONL)
+SLOW_TRACES_LOG_PREFIX = "app_logs/slow_traces/" # SLOW_TRACE_THRESHOLD_MS 이상 걸린 요청만 따로 기록
+SLOW_TRACE_THRESHOLD_MS = 5000.0
+TRACE_SAMPLE_RATE = 0.05 # 채팅 답변/관리자 작업이 아닌 일반 rerun(위젯 클릭 등) 중 trace를 기록할 비율 (느린 요청은 항상 기록)
+TRACE_VIEW_DAY_OPTIONS = [1, 3, 7] # 관리자 화면 단계별 소요 시간 조회 기간 (일)
+TRACE_VIEW_CACHE_TTL_SECONDS = 60
+SLOW_TRACE_VIEW_LIMIT = 200 # 관리자 화면 느린 요청 목록 최대 표시 수 (최신순)
+BLOB_BROWSER_PAGE_SIZE = 100
+BLOB_LISTING_CACHE_TTL_SECONDS = 30.0
+USAGE_RECENT_PAGE_SIZE = 50 # 관리자 화면 최근 원본 로그 페이지 크기
+BLOB_CACHE_TTL_SECONDS = 10.0 # Blob JSON 문서 캐시 유효 시간. 지나면 ETag로 변경 여부만 확인
+BLOB_CACHE_MAX_ENTRIES = 256
+LARGE_JSON_COMPRESSION = "gzip" # 대화/메타데이터처럼 큰 JSON 문서 압축 ("zstd"는 zstandard 설치 시 사용 가능)
+STORAGE_BACKEND_AZURE = "azure"
+STORAGE_BACKEND_LOCAL = "local"
+DEFAULT_LOCAL_STORAGE_DIR = "local_storage" # STORAGE_BACKEND="local"일 때 기본 저장 경로
+DISK_CACHE_EXCLUDED_PREFIXES = ("app_logs/", "original_files/") # 계속 덧붙여지는 로그, 다시 읽지 않는 원본 파일
+AUTOSAVE_DEBOUNCE_SECONDS = 1.5 # 답변 후 자동 저장까지 기다리는 시간 (그 사이 예약은 한 번으로 합침)
+AUTOSAVE_COMPACT_AFTER_MESSAGES = 40 # tail 파일에 쌓인 메시지가 이보다 많으면 전체 스냅샷으로 합침
+AUTOSAVE_FLUSH_TIMEOUT_SECONDS = 10.0
 
 # --- API 및 모델 설정 ---
-AZURE_OPENAI_TIMEOUT = 60.0 # Azure OpenAI API 호출 타임아웃 (초)
-MODEL_MAX_INPUT_TOKENS = 128000 # 사용하는 LLM의 최대 입력 토큰 수 (예: gpt-4-turbo)
-MODEL_MAX_OUTPUT_TOKENS = 4096 # LLM의 최대 출력 토큰 수 (조정 가능)
-BUFFER_TOKENS = 500 # 프롬프트 구성 시 여유 토큰
-TARGET_INPUT_TOKENS_FOR_PROMPT = MODEL_MAX_INPUT_TOKENS - MODEL_MAX_OUTPUT_TOKENS - BUFFER_TOKENS
+AZURE_OPENAI_TIMEOUT = 60.0 # Azure OpenAI 클라이언트 기본 타임아웃 (초). 실제 호출은 llm_client의 작업별 타임아웃(DEFAULT_OPERATION_TIMEOUTS) 사용
+LLM_MAX_ATTEMPTS = 3 # 재시도 가능한 오류(연결/타임아웃/429/5xx) 시 최대 시도 횟수
+EMBEDDING_HEDGE_AFTER_SECONDS = 1.5 # 검색용 임베딩 요청이 이 시간 안에 오지 않으면 동일 요청을 한 번 더 보냄
+CIRCUIT_BREAKER_FAILURE_THRESHOLD = 5 # 연속 실패가 이 횟수에 도달하면 해당 배포 호출을 일시 차단
+CIRCUIT_BREAKER_RESET_SECONDS = 30.0 # 차단 후 시험 요청을 다시 허용하기까지의 시간
+QUOTA_SECRET_NAMES = { # 사용자/부서별 토큰 쿼터 secrets (0 또는 없으면 제한 없음)
+    "user_tokens_per_minute": "QUOTA_USER_TOKENS_PER_MINUTE", "department_tokens_per_minute": "QUOTA_DEPARTMENT_TOKENS_PER_MINUTE",
+    "user_tokens_per_day": "QUOTA_USER_TOKENS_PER_DAY", "department_tokens_per_day": "QUOTA_DEPARTMENT_TOKENS_PER_DAY"
+}
+QUOTA_MAX_WAIT_SECONDS = 20.0 # 분당 쿼터를 넘은 요청이 토큰이 다시 찰 때까지 기다리는 최대 시간 (넘으면 한도 초과 안내)
+USER_FACING_LLM_ERRORS = (QuotaExceededError, LLMQueueFullError) # 빈 결과로 숨기지 않고 채팅 화면까지 전달해 안내할 오류
+LLM_SCHEDULER_SECRET_NAMES = { # 채팅 모델 호출 스케줄러 secrets (토큰 한도는 0 또는 없으면 제한 없음)
+    "max_concurrent_requests": "LLM_MAX_CONCURRENT_REQUESTS", "max_inflight_tokens": "LLM_MAX_INFLIGHT_TOKENS",
+    "tokens_per_minute": "LLM_DEPLOYMENT_TOKENS_PER_MINUTE"
+}
+LLM_SCHEDULER_DEFAULTS = {"max_concurrent_requests": 8, "max_inflight_tokens": 0, "tokens_per_minute": 0}
+LLM_QUEUE_MAX_WAIT_SECONDS = 180.0 # 대기열에서 이보다 오래 기다리면 지연 안내 (LLMQueueFullError)
+RETRIEVAL_SERVICE_TIMEOUT = 30.0 # 검색 사이드카(RETRIEVAL_SERVICE_URL) 검색 요청 타임아웃 (초). 학습 요청은 retrieval_client 기본값 사용
+VECTOR_LAYOUT_REFRESH_INTERVAL_SECONDS = 30.0 # 임베딩 모델 전환(embedding_migration.py) 확인 주기. 학습 직전에는 항상 확인
 IMAGE_DESCRIPTION_MAX_TOKENS = 500 # 이미지 설명 생성 시 최대 토큰
-EMBEDDING_BATCH_SIZE = 16 # 임베딩 배치 크기
+LONG_DOC_SECTION_TOKENS = 2500 # 전체 번역/요약 시 섹션당 최대 입력 토큰 (출력 한도 내에 들어오도록 설정)
+LONG_DOC_MAX_WORKERS = 4 # 전체 번역/요약 시 동시에 처리할 섹션 수
+MEMORY_RECENT_TURNS_TOKENS = 6000 # 질문에 원문 그대로 포함할 최근 대화 턴의 토큰 예산
+MEMORY_SUMMARY_MAX_TOKENS = 800 # 오래된 턴을 압축한 누적 요약의 최대 토큰
+MEMORY_SUMMARY_TURN_INPUT_TOKENS = 1500 # 요약 생성 시 턴 하나당 입력으로 넘길 최대 토큰
+LONG_DOC_MODE_LABELS = {"일반 질문": None, "전체 번역": LONG_DOC_MODE_TRANSLATE, "전체 요약": LONG_DOC_MODE_SUMMARIZE}
 
 # --- 대화 내역 관련 함수 ---
 def get_current_user_login_id():
@@ -75,55 +137,209 @@ def get_current_user_login_id():
     return user_info.get("uid")
 
 def get_user_chat_history_blob_name(user_login_id):
+    # 이전 형식: 모든 대화를 하나의 파일에 저장 (색인이 없을 때 한 번만 읽어 대화별 파일로 이관)
     if not user_login_id:
         return None
     return f"{CHAT_HISTORY_BASE_PATH}{user_login_id}_history.json"
 
+def get_user_chat_index_blob_name(user_login_id):
+    # 사용자별 대화 색인 (id, 제목, 시간, 메시지 수만 저장. 사이드바는 이 파일만 읽음)
+    if not user_login_id:
+        return None
+    return f"{CHAT_HISTORY_BASE_PATH}{user_login_id}/index.json"
+
+def get_conversation_blob_name(user_login_id, conv_id):
+    # 대화 하나의 전체 메시지 (대화를 열 때만 읽음)
+    if not user_login_id or not conv_id:
+        return None
+    return f"{CHAT_HISTORY_BASE_PATH}{user_login_id}/conversations/{conv_id}.json"
+
+def make_conversation_index_entry(conv):
+    return {
+        "id": conv["id"], "title": conv.get("title", ""), "timestamp": conv.get("timestamp", ""),
+        "last_updated": conv.get("last_updated", conv.get("timestamp", "")), "message_count": len(conv.get("messages", []))
+    }
+
+def sort_conversation_index(index_entries):
+    try:
+        # last_updated가 없는 경우를 대비하여 get의 두 번째 인자로 기본값 제공
+        index_entries.sort(key=lambda x: x.get("last_updated", x.get("timestamp", "1970-01-01T00:00:00")), reverse=True)
+    except Exception as e_sort:
+        print(f"Error sorting conversation index: {e_sort}")
+    return index_entries
+
+def migrate_legacy_chat_history(user_login_id):
+    # 이전 형식 파일이 있으면 대화별 파일 + 색인으로 나누어 저장 (이전 파일은 백업으로 남겨 둠)
+    legacy_blob_name = get_user_chat_history_blob_name(user_login_id)
+    try:
+        if not container_client.get_blob_client(legacy_blob_name).exists():
+            return None
+    except Exception as e_legacy_check:
+        print(f"ERROR checking legacy chat history for user '{user_login_id}': {e_legacy_check}")
+        return None
+    legacy_data = load_data_from_blob(legacy_blob_name, container_client, f"legacy chat history for {user_login_id}", default_value={"conversations": []})
+    legacy_conversations = legacy_data.get("conversations", []) if isinstance(legacy_data, dict) else (legacy_data if isinstance(legacy_data, list) else [])
+    index_entries = []
+    for conv in legacy_conversations:
+        if not isinstance(conv, dict) or not conv.get("id"):
+            continue
+        if not save_data_to_blob(conv, get_conversation_blob_name(user_login_id, conv["id"]), container_client, f"conversation {conv['id']} (migration)", compression=LARGE_JSON_COMPRESSION):
+            print(f"ERROR: Migration of chat history for user '{user_login_id}' aborted. Legacy file kept as-is.")
+            return None
+        index_entries.append(make_conversation_index_entry(conv))
+    sort_conversation_index(index_entries)
+    if not save_data_to_blob({"conversations": index_entries}, get_user_chat_index_blob_name(user_login_id), container_client, f"chat index for {user_login_id} (migration)"):
+        return None
+    print(f"Migrated {len(index_entries)} conversations for user '{user_login_id}' to per-conversation storage.")
+    return index_entries
+
 def load_user_conversations_from_blob():
+    # 대화 색인만 불러옴 (메시지는 load_conversation_from_blob으로 대화를 열 때 불러옴)
     user_login_id = get_current_user_login_id()
     if not user_login_id or not container_client:
         print(f"Cannot load chat history: User ID ('{user_login_id}') or container_client is missing.")
         return []
-    blob_name = get_user_chat_history_blob_name(user_login_id)
-    # load_data_from_blob 함수는 default_value로 {"conversations": []}와 유사한 구조를 반환하도록 수정 필요
-    history_data_container = load_data_from_blob(blob_name, container_client, f"chat history for {user_login_id}", default_value={"conversations": []})
-    
-    # history_data_container가 None일 경우를 대비 (load_data_from_blob이 None을 반환할 수 있으므로)
-    if history_data_container is None:
-        loaded_conversations = []
-    elif isinstance(history_data_container, dict):
-        loaded_conversations = history_data_container.get("conversations", [])
-    elif isinstance(history_data_container, list): # 이전 버전 호환 (list 자체를 저장한 경우)
-        loaded_conversations = history_data_container
-        print(f"Warning: Loaded chat history for user '{user_login_id}' as a direct list. ควรจะเป็น dict {{'conversations': [...]}}.")
-    else:
-        loaded_conversations = []
-        print(f"Warning: Unexpected data type for chat history for user '{user_login_id}': {type(history_data_container)}")
+    index_blob_name = get_user_chat_index_blob_name(user_login_id)
+    try: index_exists = get_blob_document_cache_cached(container_client).get(index_blob_name) is not BLOB_NOT_FOUND
+    except Exception as e_index_check:
+        print(f"ERROR checking chat index for user '{user_login_id}': {e_index_check}"); index_exists = True
+    if not index_exists:
+        migrated_entries = migrate_legacy_chat_history(user_login_id)
+        if migrated_entries is not None:
+            return migrated_entries
+    index_data = load_data_from_blob(index_blob_name, container_client, f"chat index for {user_login_id}", default_value={"conversations": []})
+    index_entries = index_data.get("conversations", []) if isinstance(index_data, dict) else []
+    print(f"Loaded chat index with {len(index_entries)} conversations for user '{user_login_id}'.")
+    return sort_conversation_index(index_entries)
+
+def get_conversation_tail_blob_name(user_login_id, conv_id):
+    # 자동 저장이 새 메시지만 덧붙이는 파일 (JSONL, 줄마다 {"i": 메시지 위치, "m": 메시지, "memory": 누적 요약})
+    if not user_login_id or not conv_id:
+        return None
+    return f"{CHAT_HISTORY_BASE_PATH}{user_login_id}/conversations/{conv_id}.tail.jsonl"
 
-    print(f"Loaded {len(loaded_conversations)} conversations for user '{user_login_id}'.")
+def read_conversation_tail_lines(user_login_id, conv_id):
     try:
-        # last_updated가 없는 경우를 대비하여 get의 두 번째 인자로 기본값 제공
-        loaded_conversations.sort(key=lambda x: x.get("last_updated", x.get("timestamp", "1970-01-01T00:00:00")), reverse=True)
-    except Exception as e_sort:
-        print(f"Error sorting conversations for user '{user_login_id}': {e_sort}")
-    return loaded_conversations
-
+        raw_bytes = container_client.get_blob_client(get_conversation_tail_blob_name(user_login_id, conv_id)).download_blob(timeout=60).readall()
+    except ResourceNotFoundError:
+        return []
+    return parse_jsonl_bytes(raw_bytes, f"conversation tail {conv_id}")
+
+def merge_conversation_tail(conv_data, tail_lines):
+    # 스냅샷 이후에 덧붙여진 메시지 반영. 이미 스냅샷에 포함된 위치(합치기 도중 중단된 경우 등)는 건너뜀
+    for tail_line in tail_lines:
+        if tail_line.get("i") == len(conv_data["messages"]) and isinstance(tail_line.get("m"), dict):
+            conv_data["messages"].append(tail_line["m"])
+        if isinstance(tail_line.get("memory"), dict):
+            conv_data.update(tail_line["memory"])
+    return conv_data
+
+def load_conversation_from_blob(conv_id):
+    user_login_id = get_current_user_login_id()
+    if not user_login_id or not container_client:
+        print(f"Cannot load conversation '{conv_id}': User ID ('{user_login_id}') or container_client is missing.")
+        return None
+    conversation_key = (user_login_id, conv_id)
+    conversation_autosaver = get_conversation_autosaver_cached(container_client)
+    conversation_autosaver.flush(conversation_key, timeout=AUTOSAVE_FLUSH_TIMEOUT_SECONDS) # 다른 세션에서 예약된 저장이 있으면 먼저 반영
+    conv_data = load_data_from_blob(get_conversation_blob_name(user_login_id, conv_id), container_client, f"conversation {conv_id}", default_value={})
+    if not isinstance(conv_data, dict) or not isinstance(conv_data.get("messages"), list):
+        conv_data = {"id": conv_id, "messages": []} # 아직 스냅샷 없이 자동 저장(tail)만 된 대화일 수 있음
+    try: tail_lines = read_conversation_tail_lines(user_login_id, conv_id)
+    except Exception as e_tail:
+        print(f"ERROR reading conversation tail '{conv_id}' for user '{user_login_id}': {e_tail}"); tail_lines = []
+    merge_conversation_tail(conv_data, tail_lines)
+    if not conv_data["messages"]:
+        print(f"ERROR: Conversation '{conv_id}' for user '{user_login_id}' is missing or invalid.")
+        return None
+    conversation_autosaver.register_saved_state(conversation_key, {"message_count": len(conv_data["messages"]), "tail_count": len(tail_lines)})
+    return conv_data
+
+def persist_conversation_snapshot(conversation_key, snapshot, saved_state, _container_client, document_cache):
+    # 자동 저장 스레드에서 실행 (st.* 사용 불가). 저장된 이후의 새 메시지만 tail 파일에 덧붙이고,
+    # tail이 AUTOSAVE_COMPACT_AFTER_MESSAGES를 넘으면 전체 스냅샷으로 합친 뒤 tail 삭제. 마지막으로 색인 갱신
+    user_login_id, conv_id = conversation_key
+    messages = snapshot["messages"]
+    saved_count, tail_count = saved_state.get("message_count", 0), saved_state.get("tail_count", 0)
+    memory_fields = {"memory_summary": snapshot.get("memory_summary", ""), "memory_summarized_upto": snapshot.get("memory_summarized_upto", 0)}
+    new_positions = range(min(saved_count, len(messages)), len(messages))
+    if tail_count + len(new_positions) > AUTOSAVE_COMPACT_AFTER_MESSAGES:
+        conv_blob_name = get_conversation_blob_name(user_login_id, conv_id)
+        new_etag = upload_json_blob(_container_client, conv_blob_name, snapshot, compression=LARGE_JSON_COMPRESSION)
+        document_cache.put(conv_blob_name, snapshot, new_etag)
+        try: _container_client.delete_blob(get_conversation_tail_blob_name(user_login_id, conv_id))
+        except ResourceNotFoundError: pass
+        tail_count = 0
+    elif new_positions:
+        tail_lines = [json.dumps({"i": pos, "m": messages[pos]}, ensure_ascii=False) + "\n" for pos in new_positions]
+        tail_lines[-1] = json.dumps({"i": new_positions[-1], "m": messages[new_positions[-1]], "memory": memory_fields}, ensure_ascii=False) + "\n"
+        append_blob_lines(_container_client, get_conversation_tail_blob_name(user_login_id, conv_id), tail_lines)
+        tail_count += len(tail_lines)
+
+    index_entry = make_conversation_index_entry(snapshot)
+    def upsert_index_entry(index_data):
+        index_entries = [e for e in (index_data or {}).get("conversations", []) if e.get("id") != conv_id]
+        return {"conversations": sort_conversation_index([index_entry] + index_entries)}
+    index_blob_name = get_user_chat_index_blob_name(user_login_id)
+    def read_index_from_cache(name):
+        cached_data, cached_etag = document_cache.get_with_etag(name)
+        return (None, None) if cached_data is BLOB_NOT_FOUND else (cached_data, cached_etag)
+    updated_index, index_etag = update_json_blob(_container_client, index_blob_name, upsert_index_entry, default_value={"conversations": []}, read_fn=read_index_from_cache)
+    document_cache.put(index_blob_name, updated_index, index_etag)
+    print(f"Autosaved conversation {conv_id} for user '{user_login_id}' ({len(messages)} messages, tail {tail_count}).")
+    return {"message_count": len(messages), "tail_count": tail_count}
 
-def save_user_conversations_to_blob():
+@st.cache_resource
+def get_conversation_autosaver_cached(_container_client):
+    # 프로세스당 하나의 자동 저장기를 모든 세션이 공유 (키: (사용자 ID, 대화 ID))
+    document_cache = get_blob_document_cache_cached(_container_client)
+    conversation_autosaver = ConversationAutosaver(
+        lambda key, snapshot, saved_state: persist_conversation_snapshot(key, snapshot, saved_state, _container_client, document_cache),
+        debounce_seconds=AUTOSAVE_DEBOUNCE_SECONDS)
+    atexit.register(conversation_autosaver.flush, None, AUTOSAVE_FLUSH_TIMEOUT_SECONDS) # 프로세스 종료 시 예약된 저장 마무리
+    return conversation_autosaver
+
+def schedule_active_conversation_autosave():
+    # 현재 대화를 자동 저장 예약 (네트워크 요청 없음). 새 대화면 이때 ID를 부여하고 사이드바 색인에 추가
+    # 반환: 예약한 대화의 키 (저장할 내용이 없으면 None)
     user_login_id = get_current_user_login_id()
-    if not user_login_id or not container_client or "all_user_conversations" not in st.session_state:
-        print(f"Cannot save chat history: User ID ('{user_login_id}'), container_client, or all_user_conversations missing.")
-        return False
-    
-    # 저장 전 최신순으로 다시 정렬 (last_updated 기준)
-    try:
-        st.session_state.all_user_conversations.sort(key=lambda x: x.get("last_updated", x.get("timestamp", "1970-01-01T00:00:00")), reverse=True)
-    except Exception as e_sort_save:
-        print(f"Error sorting conversations before saving for user '{user_login_id}': {e_sort_save}")
+    current_messages = st.session_state.get("current_chat_messages") or []
+    if not user_login_id or not container_client or not current_messages:
+        return None
+    if not st.session_state.get("active_conversation_id"):
+        st.session_state.active_conversation_id = str(uuid.uuid4()) # 고유 ID 생성
+    active_id = st.session_state.active_conversation_id
+    index_entry = next((e for e in st.session_state.all_user_conversations if e.get("id") == active_id), None)
+    conversation_key = (user_login_id, active_id)
+    if index_entry and index_entry.get("message_count") == len(current_messages):
+        return conversation_key # 메시지는 추가만 되므로 메시지 수가 같으면 변경 없음
+    snapshot = {
+        "id": active_id,
+        "title": index_entry.get("title") if index_entry else generate_conversation_title(current_messages),
+        # 첫 메시지 시간 또는 현재 시간으로 대표 시간 설정
+        "timestamp": index_entry.get("timestamp") if index_entry else (current_messages[0].get("time") or datetime.now().strftime("%Y-%m-%d %H:%M")),
+        "messages": [dict(message) for message in current_messages], # 복사본 (저장 스레드가 직렬화하는 동안 원본 메시지가 바뀌어도 안전)
+        "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+        **get_conversation_memory_fields()
+    }
+    st.session_state.all_user_conversations = [make_conversation_index_entry(snapshot)] + [e for e in st.session_state.all_user_conversations if e.get("id") != active_id]
+    get_conversation_autosaver_cached(container_client).schedule(conversation_key, snapshot)
+    return conversation_key
 
-    blob_name = get_user_chat_history_blob_name(user_login_id)
-    print(f"Saving {len(st.session_state.all_user_conversations)} conversations for user '{user_login_id}' to {blob_name}.")
-    return save_data_to_blob({"conversations": st.session_state.all_user_conversations}, blob_name, container_client, f"chat history for {user_login_id}")
+def delete_conversation_from_blob(conv_id):
+    user_login_id = get_current_user_login_id()
+    if container_client: get_conversation_autosaver_cached(container_client).cancel((user_login_id, conv_id))
+    st.session_state.all_user_conversations = [c for c in st.session_state.all_user_conversations if c.get("id") != conv_id]
+    def remove_index_entry(index_data): # 다른 탭에서 자동 저장된 항목은 유지하도록 최신 색인에서 제거
+        return {"conversations": [e for e in (index_data or {}).get("conversations", []) if e.get("id") != conv_id]}
+    index_saved = update_data_in_blob(get_user_chat_index_blob_name(user_login_id), container_client, remove_index_entry, f"chat index for {user_login_id}", default_value={"conversations": []}) is not None
+    if index_saved and container_client:
+        for conv_blob_name in (get_conversation_blob_name(user_login_id, conv_id), get_conversation_tail_blob_name(user_login_id, conv_id)):
+            get_blob_document_cache_cached(container_client).invalidate(conv_blob_name)
+            try: container_client.delete_blob(conv_blob_name); record_blob_change(conv_blob_name, "delete", container_client)
+            except ResourceNotFoundError: pass
+            except Exception as e_delete_conv: print(f"ERROR deleting conversation blob '{conv_blob_name}' for user '{user_login_id}': {e_delete_conv}")
+    return index_saved
 
 def generate_conversation_title(messages_list):
     if not messages_list:
@@ -136,69 +352,29 @@ def generate_conversation_title(messages_list):
             return title_candidate[:30] + "..." if len(title_candidate) > 30 else title_candidate
     return "대화 시작" # 사용자 메시지가 없는 경우
 
+def get_conversation_memory_fields():
+    # 대화와 함께 저장할 누적 요약 (다시 불러왔을 때 요약을 재생성하지 않도록)
+    memory_state = st.session_state.get("conversation_memory") or empty_memory_state()
+    return {"memory_summary": memory_state.get("summary", ""), "memory_summarized_upto": memory_state.get("summarized_upto", 0)}
+
+def get_memory_state_from_conversation(conv):
+    return {"summary": conv.get("memory_summary", ""), "summarized_upto": conv.get("memory_summarized_upto", 0)}
+
 def archive_current_chat_session_if_needed():
+    # 대화 전환/로그아웃 직전 호출. 답변마다 이미 자동 저장이 예약되므로, 남은 예약 저장을 즉시 마무리함
     user_login_id = get_current_user_login_id()
     # 현재 메시지가 없거나, 사용자가 없으면 아카이브할 필요 없음
     if not user_login_id or not st.session_state.get("current_chat_messages"):
         print("Archive check: No user ID or no current messages. Skipping archive.")
         return False # 변경 없음
-
-    active_id = st.session_state.get("active_conversation_id")
-    current_messages_copy = list(st.session_state.current_chat_messages) # 항상 복사본 사용
-    
-    archived_or_updated = False
-
-    if active_id: # 현재 불러온 대화가 있는 경우 (업데이트 시도)
-        found_and_updated = False
-        for i, conv in enumerate(st.session_state.all_user_conversations):
-            if conv["id"] == active_id:
-                # 메시지 내용이 실제로 변경되었는지 간단히 확인 (더 정교한 비교도 가능)
-                if conv["messages"] != current_messages_copy: # 메시지 목록 자체가 변경되었는지 확인
-                    conv["messages"] = current_messages_copy
-                    conv["last_updated"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                    # 제목은 첫 메시지 기준으로 생성되었으므로, 일반적으로는 업데이트하지 않음.
-                    # 필요하다면 여기서 conv["title"] = generate_conversation_title(current_messages_copy) 추가 가능
-                    st.session_state.all_user_conversations[i] = conv # 리스트 내 객체 직접 수정이 반영되도록
-                    print(f"Archived (updated) conversation ID: {active_id}, Title: '{conv.get('title', 'N/A')}'")
-                    archived_or_updated = True
-                else:
-                    print(f"Conversation ID: {active_id} has no changes to messages. No update to archive needed.")
-                found_and_updated = True
-                break
-        if not found_and_updated: # active_id가 있었지만 목록에 없는 이상한 경우 (새 대화로 처리)
-             print(f"Warning: active_conversation_id '{active_id}' not found in conversation log. Treating as new chat for archiving.")
-             active_id = None # 새 대화로 취급하도록 active_id 초기화
-    
-    # active_id가 None이거나, 위에서 None으로 바뀐 경우 (즉, 새 대화로 취급)
-    if not active_id : 
-        # current_chat_messages가 실제로 내용이 있어야 새 대화로 저장
-        if current_messages_copy: 
-            new_conv_id = str(uuid.uuid4()) # 고유 ID 생성
-            title = generate_conversation_title(current_messages_copy)
-            # 첫 메시지 시간 또는 현재 시간으로 대표 시간 설정
-            timestamp_str = current_messages_copy[0].get("time") if current_messages_copy and current_messages_copy[0].get("time") else datetime.now().strftime("%Y-%m-%d %H:%M")
-
-            new_conversation = {
-                "id": new_conv_id,
-                "title": title,
-                "timestamp": timestamp_str, # 대화 시작 시점 (첫 메시지 시간 또는 생성 시간)
-                "messages": current_messages_copy,
-                "last_updated": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            }
-            st.session_state.all_user_conversations.insert(0, new_conversation) # 최신 대화를 맨 앞에 추가
-            # 새 대화가 저장되었으므로, 이제 이 대화가 "활성" 대화가 됨 (ID를 부여받았음)
-            # 하지만 이 함수는 보통 컨텍스트 전환 직전에 호출되므로, 이 함수 내에서 active_id를 바꾸는 것은
-            # 호출한 쪽의 로직과 꼬일 수 있음. 호출한 쪽에서 active_id를 관리하도록 둠.
-            print(f"Archived (new) conversation ID: {new_conv_id}, Title: '{title}'")
-            archived_or_updated = True
-        else: # current_messages_copy가 비어있으면 새 대화로 저장할 내용 없음
-             print("Archive check: Current messages empty and no active_id. Skipping archive of new chat.")
-
-
-    if archived_or_updated: # 실제 변경/추가가 있었던 경우에만 저장
-        save_user_conversations_to_blob()
-    
-    return archived_or_updated # 변경이 있었는지 여부 반환
+    conversation_key = schedule_active_conversation_autosave()
+    if conversation_key is None:
+        return False
+    if not get_conversation_autosaver_cached(container_client).flush(conversation_key, timeout=AUTOSAVE_FLUSH_TIMEOUT_SECONDS):
+        print(f"WARNING: Autosave of conversation {conversation_key[1]} did not finish within {AUTOSAVE_FLUSH_TIMEOUT_SECONDS}s. It will keep retrying in the background.")
+        return False
+    print(f"Archived conversation ID: {conversation_key[1]}")
+    return True
 # --- END 대화 내역 관련 함수 ---
 
 def get_base64_of_bin_file(bin_file_path):
@@ -307,7 +483,8 @@ def get_azure_openai_client_cached():
             api_key=st.secrets["AZURE_OPENAI_KEY"],
             azure_endpoint=st.secrets["AZURE_OPENAI_ENDPOINT"],
             api_version=api_version_to_use,
-            timeout=AZURE_OPENAI_TIMEOUT
+            timeout=AZURE_OPENAI_TIMEOUT,
+            max_retries=0 # 재시도는 ResilientLLMClient에서 일괄 처리
         )
         print("Azure OpenAI client initialized successfully.")
         return client
@@ -322,6 +499,13 @@ def get_azure_openai_client_cached():
 
 @st.cache_resource
 def get_azure_blob_clients_cached():
+    # STORAGE_BACKEND: "azure"(기본) 또는 "local"(LOCAL_STORAGE_DIR 디렉터리를 Blob 컨테이너처럼 사용, Azure 없이 실행)
+    storage_backend = str(st.secrets.get("STORAGE_BACKEND", STORAGE_BACKEND_AZURE)).lower()
+    if storage_backend == STORAGE_BACKEND_LOCAL:
+        local_storage_dir = st.secrets.get("LOCAL_STORAGE_DIR", DEFAULT_LOCAL_STORAGE_DIR)
+        local_storage_latency_ms = float(st.secrets.get("LOCAL_STORAGE_LATENCY_MS", 0)) # 벤치마크용 요청당 지연
+        print(f"Using local filesystem storage backend at '{os.path.abspath(local_storage_dir)}' (simulated latency {local_storage_latency_ms:.0f}ms).")
+        return None, LocalContainerClient(local_storage_dir, simulated_latency_seconds=local_storage_latency_ms / 1000)
     print("Attempting to initialize Azure Blob Service client...")
     try:
         conn_str = st.secrets["AZURE_BLOB_CONN"]
@@ -329,6 +513,10 @@ def get_azure_blob_clients_cached():
         container_name = st.secrets["BLOB_CONTAINER"]
         container_client = blob_service_client.get_container_client(container_name)
         print(f"Azure Blob Service client and container client for '{container_name}' initialized successfully.")
+        disk_cache_dir = st.secrets.get("BLOB_DISK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "chatbot_blob_cache", container_name))
+        if disk_cache_dir: # 빈 문자열이면 디스크 캐시 사용 안 함
+            container_client = DiskCachedContainerClient(container_client, disk_cache_dir, uncached_prefixes=DISK_CACHE_EXCLUDED_PREFIXES)
+            print(f"Blob read-through disk cache enabled at '{disk_cache_dir}'.")
         return blob_service_client, container_client
     except KeyError as e:
         st.error(f"Azure Blob Storage config error: Missing key '{e.args[0]}' in secrets.")
@@ -339,8 +527,89 @@ def get_azure_blob_clients_cached():
         print(f"ERROR: Azure Blob client initialization failed: {e}\n{traceback.format_exc()}")
         return None, None
 
-openai_client = get_azure_openai_client_cached()
-blob_service, container_client = get_azure_blob_clients_cached()
+with STARTUP_TIMINGS.measure(TIMING_KIND_INIT, "azure_openai_client"): openai_client = get_azure_openai_client_cached()
+with STARTUP_TIMINGS.measure(TIMING_KIND_INIT, "blob_clients"): blob_service, container_client = get_azure_blob_clients_cached()
+
+def load_tokenizer():
+    # 백그라운드 준비 스레드에서 실행. 반환: (토크나이저 또는 None, 화면에 표시할 오류 목록)
+    tiktoken = lazy_import("tiktoken")
+    load_errors = []
+    try:
+        loaded_tokenizer = tiktoken.get_encoding("o200k_base") # 최신 모델용 인코더
+        print("Tiktoken 'o200k_base' encoder loaded successfully.")
+    except Exception as e:
+        load_errors.append(f"Tiktoken encoder 'o200k_base' load failed: {e}. Token-based length limit may not work.")
+        print(f"ERROR: Failed to load tiktoken 'o200k_base' encoder: {e}")
+        try:
+            loaded_tokenizer = tiktoken.get_encoding("cl100k_base") # 대체 인코더
+            print("Tiktoken 'cl100k_base' encoder loaded successfully as a fallback.")
+        except Exception as e2:
+            load_errors.append(f"Tiktoken encoder 'cl100k_base' (fallback) load failed: {e2}. Token-based length limit may not work.")
+            print(f"ERROR: Failed to load tiktoken 'cl100k_base' (fallback) encoder: {e2}")
+            loaded_tokenizer = None
+    return loaded_tokenizer, load_errors
+
+def make_warmup_token_counter(startup_warmup):
+    # cache_resource로 만든 객체에 넘길 토큰 계산 함수. rerun 전역 변수 tokenizer를 잡으면 처음 만든 실행(보통 로그인 화면,
+    # tokenizer 할당 전에 st.stop())의 값에 묶이므로 준비 작업 결과에서 직접 가져옴. 준비 전/실패 시 예외 (호출하는 쪽이 근사/보류)
+    def count_tokens(text):
+        if not startup_warmup.is_ready("tokenizer"): raise RuntimeError("Tokenizer is still loading.")
+        loaded_tokenizer = startup_warmup.result("tokenizer")[0]
+        if loaded_tokenizer is None: raise RuntimeError("Tokenizer is not available.")
+        return len(loaded_tokenizer.encode(text))
+    return count_tokens
+
+def load_vector_store(_container_client, count_tokens_fn):
+    # 백그라운드 준비 스레드에서 실행 (Streamlit 명령 사용 금지). 반환: (ShardedVectorStore, 화면에 표시할 오류 목록)
+    # 샤드 목록만 확인하고 공통 샤드만 미리 불러옴 (부서 샤드는 처음 검색/학습할 때)
+    store = ShardedVectorStore(_container_client, count_tokens_fn=count_tokens_fn) # 토크나이저 준비 전에는 계산을 미룸
+    print(f"Vector DB shards: {', '.join(store.discover())}")
+    store.get_shard(COMMON_SHARD_NAME)
+    return store, store.load_errors(COMMON_SHARD_NAME)
+
+@st.cache_resource
+def get_retrieval_client_cached():
+    # RETRIEVAL_SERVICE_URL이 있으면 인덱스를 앱 프로세스에 올리지 않고 같은 노드의 검색 사이드카(retrieval_service.py)를 사용
+    service_url = st.secrets.get("RETRIEVAL_SERVICE_URL")
+    if not service_url: return None
+    print(f"Using shared retrieval service at {service_url}. The vector DB is not loaded in this process.")
+    return RetrievalServiceClient(service_url, timeout=RETRIEVAL_SERVICE_TIMEOUT)
+
+retrieval_client = get_retrieval_client_cached()
+
+@st.cache_resource
+def get_startup_warmup_cached(_container_client):
+    # 프로세스당 한 번, 첫 화면(로그인)을 그리는 동안 백그라운드에서 토크나이저와 벡터 DB를 준비
+    startup_warmup = BackgroundWarmup()
+    startup_warmup.submit("tokenizer", load_tokenizer)
+    if _container_client and retrieval_client is None: startup_warmup.submit("vector_db", lambda: load_vector_store(_container_client, make_warmup_token_counter(startup_warmup)))
+    threading.Thread(target=print_startup_timing_report, args=(startup_warmup,), name="warmup-report", daemon=True).start()
+    return startup_warmup
+
+def print_startup_timing_report(startup_warmup):
+    # 모든 준비 작업이 끝나면 시작 시간 측정 결과를 로그에 한 번 출력
+    for task_name in startup_warmup.status():
+        try: startup_warmup.result(task_name)
+        except Exception: pass # 오류는 준비 작업에서 이미 기록
+    print(STARTUP_TIMINGS.format_report())
+
+def get_startup_warmup_result(task_name, spinner_text):
+    # 백그라운드 준비가 끝날 때까지 기다렸다가 결과 반환. 준비 중 발생한 오류는 세션당 한 번만 화면에 표시
+    startup_warmup = get_startup_warmup_cached(container_client)
+    try:
+        if startup_warmup.is_ready(task_name):
+            value, load_errors = startup_warmup.result(task_name)
+        else:
+            with st.spinner(spinner_text), trace_span(f"warmup_wait.{task_name}"): value, load_errors = startup_warmup.result(task_name)
+    except Exception as e_warmup:
+        value, load_errors = None, [f"Background initialization '{task_name}' failed: {e_warmup}"]
+    shown_errors = st.session_state.setdefault("shown_warmup_errors", set())
+    for load_error in load_errors:
+        if load_error not in shown_errors:
+            st.error(load_error); shown_errors.add(load_error)
+    return value
+
+get_startup_warmup_cached(container_client) # 로그인 화면과 별개로 바로 준비 시작
 
 EMBEDDING_MODEL = None
 if openai_client:
@@ -356,33 +625,128 @@ if openai_client:
         print(f"ERROR: Loading AZURE_OPENAI_EMBEDDING_DEPLOYMENT secret: {e}")
         openai_client = None # 클라이언트 사용 불가 처리
 
+@st.cache_resource
+def get_token_quota_limiter_cached():
+    # 버킷/일일 사용량을 모든 세션이 공유하도록 프로세스당 하나만 생성
+    quota_limits = {}
+    for limit_name, secret_name in QUOTA_SECRET_NAMES.items():
+        try: quota_limits[limit_name] = max(0, int(st.secrets.get(secret_name, 0) or 0))
+        except (TypeError, ValueError):
+            print(f"WARNING: Invalid '{secret_name}' secret. This quota is disabled."); quota_limits[limit_name] = 0
+    print(f"Token quotas (0 = unlimited): {quota_limits}")
+    return TokenQuotaLimiter(**quota_limits)
+
+def record_metered_api_usage(caller, model_name, usage):
+    # TokenUsageMeter 콜백: 채팅/요약/긴 문서/이미지 설명/임베딩 등 모든 API 호출의 사용량을 기록
+    if container_client:
+        log_openai_api_usage_to_blob(caller.user_name, model_name, usage, container_client, request_type=caller.request_type, department=caller.department)
+
+def get_usage_caller(request_type, enforce_quota=True):
+    # 현재 세션 사용자 기준 호출자 정보 (작업 스레드에서는 get_streamlit_thread_initializer로 연결된 세션의 사용자)
+    user_info = st.session_state.get("user") or {}
+    return UsageCaller(user_info.get("uid") or "anonymous", user_info.get("name", "anonymous_chat_user"), user_info.get("department"), request_type, enforce_quota)
+
+@st.cache_resource
+def get_llm_scheduler_cached():
+    # 모든 세션의 채팅 모델 호출이 같은 대기열을 쓰도록 프로세스당 하나만 생성
+    scheduler_settings = {}
+    for setting_name, secret_name in LLM_SCHEDULER_SECRET_NAMES.items():
+        try: scheduler_settings[setting_name] = max(0, int(st.secrets.get(secret_name, LLM_SCHEDULER_DEFAULTS[setting_name]) or 0))
+        except (TypeError, ValueError):
+            print(f"WARNING: Invalid '{secret_name}' secret. Using default {LLM_SCHEDULER_DEFAULTS[setting_name]}."); scheduler_settings[setting_name] = LLM_SCHEDULER_DEFAULTS[setting_name]
+    print(f"LLM scheduler settings (0 = unlimited): {scheduler_settings}")
+    return FairLLMScheduler(**scheduler_settings)
+
+@st.cache_resource
+def get_resilient_llm_client_cached(_raw_client):
+    # 서킷 브레이커 상태를 모든 세션이 공유하도록 프로세스당 하나만 생성
+    fallback_deployment = st.secrets.get("AZURE_OPENAI_FALLBACK_DEPLOYMENT")
+    print(f"Initializing resilient LLM client (fallback deployment: {fallback_deployment or 'None'}).")
+    usage_meter = TokenUsageMeter(
+        get_token_quota_limiter_cached(), on_usage=record_metered_api_usage, max_wait_seconds=QUOTA_MAX_WAIT_SECONDS,
+        count_tokens_fn=make_warmup_token_counter(get_startup_warmup_cached(container_client)) # 토크나이저 준비 전에는 예외 -> 글자 수 기준 근사
+    )
+    return ResilientLLMClient(
+        _raw_client, retry_policy=RetryPolicy(max_attempts=LLM_MAX_ATTEMPTS),
+        fallback_deployment=fallback_deployment, embedding_hedge_after=EMBEDDING_HEDGE_AFTER_SECONDS,
+        breaker_failure_threshold=CIRCUIT_BREAKER_FAILURE_THRESHOLD, breaker_reset_timeout=CIRCUIT_BREAKER_RESET_SECONDS,
+        usage_meter=usage_meter, scheduler=get_llm_scheduler_cached(), scheduler_max_wait_seconds=LLM_QUEUE_MAX_WAIT_SECONDS
+    )
+
+llm_client = get_resilient_llm_client_cached(openai_client) if openai_client else None
+
+
+@st.cache_resource
+def get_usage_rollup_store_cached(_container_client):
+    return UsageRollupStore(_container_client, rollup_prefix=USAGE_ROLLUP_PREFIX)
+
+@st.cache_resource
+def get_log_writer_cached(_container_client):
+    # 프로세스당 하나의 백그라운드 기록기를 모든 세션이 공유. 사용량 항목은 기록 직후 집계에도 반영
+    log_writer = BackgroundLogWriter(_container_client, {"usage": USAGE_LOG_PREFIX, "upload": UPLOAD_LOG_PREFIX, "changes": CHANGES_LOG_PREFIX,
+                                                         "traces": TRACES_LOG_PREFIX, "slow_traces": SLOW_TRACES_LOG_PREFIX}, flush_interval=LOG_FLUSH_INTERVAL_SECONDS,
+                                     on_entries_written={"usage": get_usage_rollup_store_cached(_container_client).apply_entries})
+    atexit.register(log_writer.close) # 프로세스 종료 시 남은 항목 기록
+    print(f"Background log writer started (flush every {LOG_FLUSH_INTERVAL_SECONDS}s).")
+    return log_writer
+
+def finish_rerun_trace(page, error=None, always_record=False):
+    # 이번 실행의 trace를 닫아 기록 (실행당 한 번). 느린 요청은 단계별 시간을 로그에도 출력
+    # 버튼 처리 등으로 중간에 st.rerun()된 실행은 끝 지점을 알 수 없어 기록하지 않음
+    # always_record: 채팅 답변/관리자 작업. 그 밖의 rerun은 TRACE_SAMPLE_RATE 비율만 기록 (위젯 클릭마다 Blob 덧붙이기를 하지 않도록)
+    if current_trace() is not rerun_trace: return
+    activate_trace(None)
+    try:
+        trace_record = rerun_trace.finish(error=error, page=page, user_id=(st.session_state.get("user") or {}).get("uid"))
+        if trace_record["duration_ms"] >= SLOW_TRACE_THRESHOLD_MS:
+            print(f"SLOW REQUEST ({trace_record['duration_ms']:.0f}ms >= {SLOW_TRACE_THRESHOLD_MS:.0f}ms)\n{format_trace_breakdown(trace_record)}")
+        is_slow_trace = trace_record["duration_ms"] >= SLOW_TRACE_THRESHOLD_MS
+        if container_client and (always_record or is_slow_trace or random.random() < TRACE_SAMPLE_RATE):
+            log_writer = get_log_writer_cached(container_client)
+            log_writer.log("traces", trace_record) # 큐에 넣기만 함
+            if is_slow_trace: log_writer.log("slow_traces", trace_record)
+    except Exception as e_trace:
+        print(f"ERROR recording rerun trace: {e_trace}\n{traceback.format_exc()}")
+
+@st.cache_data(ttl=TRACE_VIEW_CACHE_TTL_SECONDS, show_spinner=False)
+def load_trace_records_cached(stream_prefix, since_day):
+    # 관리자 화면용. 날짜별 trace 로그를 읽는 비용이 크므로 짧게 캐시 (아직 큐에 있는 최근 trace는 다음 기록 주기 후 반영)
+    return read_log_stream(container_client, stream_prefix, since_day=since_day)
+
+def record_blob_change(blob_name, action, _container_client, size=None):
+    # Blob 탐색기의 최신순 보기용 변경 기록 (전체 목록 조회 없이 최근 변경을 보여주기 위함)
+    try: get_log_writer_cached(_container_client).log("changes", make_blob_change_entry(blob_name, action, size))
+    except Exception as e_change_log: print(f"ERROR queueing blob change entry for '{blob_name}': {e_change_log}")
+
+@st.cache_resource
+def get_blob_listing_cache_cached():
+    return BlobListingCache(ttl_seconds=BLOB_LISTING_CACHE_TTL_SECONDS)
+
+@st.cache_resource
+def get_blob_document_cache_cached(_container_client):
+    # 모든 세션이 공유하는 JSON 문서 캐시 (rerun마다 exists()+다운로드 왕복을 하지 않도록)
+    return BlobDocumentCache(_container_client, ttl_seconds=BLOB_CACHE_TTL_SECONDS, max_entries=BLOB_CACHE_MAX_ENTRIES)
+
+@st.cache_resource
+def get_faq_cache_cached(_container_client):
+    # 자주 묻는 질문 답변 캐시 (faq_cache.py build로 생성). 모든 세션이 공유
+    return FAQAnswerCache(_container_client)
 
 def load_data_from_blob(blob_name, _container_client, data_description="data", default_value=None):
     if not _container_client:
         print(f"ERROR: Blob Container client is None for load_data_from_blob ('{data_description}'). Returning default.")
         return default_value if default_value is not None else ({} if not isinstance(default_value, list) else [])
     
-    print(f"Attempting to load '{data_description}' from Blob: '{blob_name}'")
     try:
-        blob_client_instance = _container_client.get_blob_client(blob_name)
-        if blob_client_instance.exists():
-            with tempfile.TemporaryDirectory() as tmpdir:
-                local_temp_path = os.path.join(tmpdir, os.path.basename(blob_name))
-                with open(local_temp_path, "wb") as download_file:
-                    download_stream = blob_client_instance.download_blob(timeout=60)
-                    download_file.write(download_stream.readall())
-                
-                if os.path.getsize(local_temp_path) > 0:
-                    with open(local_temp_path, "r", encoding="utf-8") as f:
-                        loaded_data = json.load(f)
-                    print(f"Successfully loaded '{data_description}' from Blob: '{blob_name}'")
-                    return loaded_data
-                else: # 파일은 존재하나 비어있는 경우
-                    print(f"WARNING: '{data_description}' file '{blob_name}' exists in Blob but is empty. Returning default.")
-                    return default_value if default_value is not None else ({} if not isinstance(default_value, list) else [])
-        else: # 파일이 존재하지 않는 경우
+        with trace_span("blob.load_json", blob=blob_name):
+            loaded_data = get_blob_document_cache_cached(_container_client).get(blob_name) # TTL 내면 캐시, 이후엔 ETag 조건부 GET
+        if loaded_data is BLOB_NOT_FOUND: # 파일이 존재하지 않는 경우
             print(f"WARNING: '{data_description}' file '{blob_name}' not found in Blob Storage. Returning default.")
             return default_value if default_value is not None else ({} if not isinstance(default_value, list) else [])
+        if loaded_data is None: # 파일은 존재하나 비어있는 경우
+            print(f"WARNING: '{data_description}' file '{blob_name}' exists in Blob but is empty. Returning default.")
+            return default_value if default_value is not None else ({} if not isinstance(default_value, list) else [])
+        return loaded_data
     except json.JSONDecodeError: # JSON 파싱 오류
         print(f"ERROR: Failed to decode JSON for '{data_description}' from Blob '{blob_name}'. Returning default.")
         st.warning(f"File '{data_description}' ({blob_name}) is corrupted or not valid JSON. Using default.")
@@ -396,7 +760,8 @@ def load_data_from_blob(blob_name, _container_client, data_description="data", d
         st.warning(f"Unknown error loading '{data_description}': {e}. Using default.")
         return default_value if default_value is not None else ({} if not isinstance(default_value, list) else [])
 
-def save_data_to_blob(data_to_save, blob_name, _container_client, data_description="data"):
+def save_data_to_blob(data_to_save, blob_name, _container_client, data_description="data", compression=None):
+    # 메모리에서 간결한 JSON으로 직렬화해 바로 업로드 (compression: None / "gzip" / "zstd")
     if not _container_client:
         # st.error(f"Cannot save '{data_description}': Azure Blob client not ready.") # UI 오류 최소화
         print(f"ERROR: Blob Container client is None, cannot save '{data_description}' to '{blob_name}'.")
@@ -407,16 +772,11 @@ def save_data_to_blob(data_to_save, blob_name, _container_client, data_descripti
             # st.error(f"Save failed for '{data_description}': Data is not JSON serializable (type: {type(data_to_save)}).")
             print(f"ERROR: Data for '{blob_name}' is not JSON serializable (type: {type(data_to_save)}).")
             return False
-            
-        with tempfile.TemporaryDirectory() as tmpdir:
-            local_temp_path = os.path.join(tmpdir, os.path.basename(blob_name))
-            with open(local_temp_path, "w", encoding="utf-8") as f:
-                json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-            
-            blob_client_instance = _container_client.get_blob_client(blob_name)
-            with open(local_temp_path, "rb") as data_stream:
-                blob_client_instance.upload_blob(data_stream, overwrite=True, timeout=60)
-            print(f"Successfully saved '{data_description}' to Blob: '{blob_name}'")
+        with trace_span("blob.save_json", blob=blob_name):
+            new_etag = upload_json_blob(_container_client, blob_name, data_to_save, compression=compression)
+        print(f"Successfully saved '{data_description}' to Blob: '{blob_name}'")
+        record_blob_change(blob_name, "upload", _container_client)
+        get_blob_document_cache_cached(_container_client).put(blob_name, data_to_save, new_etag)
         return True
     except AzureError as ae:
         # st.error(f"Azure service error saving '{data_description}' to Blob: {ae}")
@@ -427,20 +787,44 @@ def save_data_to_blob(data_to_save, blob_name, _container_client, data_descripti
         print(f"GENERAL ERROR saving '{data_description}' to Blob '{blob_name}': {e}\n{traceback.format_exc()}")
         return False
 
-def save_binary_data_to_blob(local_file_path, blob_name, _container_client, data_description="binary data"):
+def update_data_in_blob(blob_name, _container_client, update_fn, data_description="data", default_value=None, compression=None):
+    # 여러 사용자가 동시에 수정할 수 있는 문서(예: USERS)용. 최신 값에 update_fn을 적용해 ETag 조건부로 저장하고,
+    # 그 사이 다른 곳에서 수정했으면 최신 값을 다시 읽어 update_fn을 다시 적용 -> 서로의 변경을 덮어쓰지 않음
+    # 반환: 저장된 최신 데이터 (실패 시 None)
+    if not _container_client:
+        print(f"ERROR: Blob Container client is None, cannot update '{data_description}' in '{blob_name}'.")
+        return None
+    document_cache = get_blob_document_cache_cached(_container_client)
+    def read_from_cache(name):
+        cached_data, cached_etag = document_cache.get_with_etag(name)
+        return (None, None) if cached_data is BLOB_NOT_FOUND else (cached_data, cached_etag)
+    try:
+        updated_data, new_etag = update_json_blob(_container_client, blob_name, update_fn, compression=compression,
+                                                  default_value=default_value, read_fn=read_from_cache)
+        document_cache.put(blob_name, updated_data, new_etag)
+        print(f"Successfully updated '{data_description}' in Blob: '{blob_name}'")
+        record_blob_change(blob_name, "update", _container_client)
+        return updated_data
+    except Exception as e:
+        document_cache.invalidate(blob_name)
+        print(f"ERROR updating '{data_description}' in Blob '{blob_name}': {e}\n{traceback.format_exc()}")
+        return None
+
+def save_binary_data_to_blob(binary_data, blob_name, _container_client, data_description="binary data"):
+    # binary_data: 메모리의 bytes (임시 파일을 거치지 않음)
     if not _container_client:
         # st.error(f"Cannot save binary '{data_description}': Azure Blob client not ready.")
         print(f"ERROR: Blob Container client is None, cannot save binary '{blob_name}'.")
         return False
-    if not os.path.exists(local_file_path):
-        # st.error(f"Local file for binary '{data_description}' not found: '{local_file_path}'")
-        print(f"ERROR: Local file for binary data not found: '{local_file_path}'")
+    if not binary_data:
+        print(f"ERROR: No binary data to save for '{data_description}' ('{blob_name}').")
         return False
     try:
         blob_client_instance = _container_client.get_blob_client(blob_name)
-        with open(local_file_path, "rb") as data_stream:
-            blob_client_instance.upload_blob(data_stream, overwrite=True, timeout=120) # 바이너리 파일은 타임아웃 길게
-        print(f"Successfully saved binary '{data_description}' to Blob: '{blob_name}'")
+        with trace_span("blob.save_binary", blob=blob_name, size=len(binary_data)):
+            blob_client_instance.upload_blob(binary_data, overwrite=True, timeout=120) # 바이너리 파일은 타임아웃 길게
+        print(f"Successfully saved binary '{data_description}' to Blob: '{blob_name}' ({len(binary_data):,} bytes)")
+        record_blob_change(blob_name, "upload", _container_client, size=len(binary_data))
         return True
     except AzureError as ae:
         # st.error(f"Azure service error saving binary '{data_description}' to Blob: {ae}")
@@ -460,12 +844,19 @@ if container_client:
     if "admin" not in USERS: # admin 계정이 없으면 기본값으로 생성
         print(f"'{USERS_BLOB_NAME}' from Blob is empty or admin is missing. Creating default admin.")
         admin_password = st.secrets.get("ADMIN_PASSWORD", "diteam_fallback_secret") # ADMIN_PASSWORD secrets에서 가져오기
-        USERS["admin"] = {
+        default_admin_data = {
             "name": "관리자", "department": "품질보증팀", "uid": "admin", # uid 필드 추가
             "password_hash": generate_password_hash(admin_password),
             "approved": True, "role": "admin"
         }
-        if not save_data_to_blob(USERS, USERS_BLOB_NAME, container_client, "initial user info with default admin"):
+        def add_default_admin(users_data):
+            users_data = users_data if isinstance(users_data, dict) else {}
+            users_data.setdefault("admin", default_admin_data) # 그 사이 다른 프로세스가 만든 admin은 유지
+            return users_data
+        updated_users = update_data_in_blob(USERS_BLOB_NAME, container_client, add_default_admin, "initial user info with default admin", default_value={})
+        if updated_users is not None: USERS = updated_users
+        else:
+             USERS["admin"] = default_admin_data
              st.warning("Failed to save default admin info to Blob. Will retry on next user data save.") # UI 경고
 else: # Blob 클라이언트 연결 실패 시
     st.error("Azure Blob Storage connection failed. Cannot initialize user info. App may not function correctly.")
@@ -507,7 +898,11 @@ session_keys_defaults = {
     "authenticated": False, "user": {},
     "current_chat_messages": [], "all_user_conversations": [],
     "active_conversation_id": None, "show_uploader": False,
-    "pending_delete_conv_id": None # 대화 삭제 확인용 ID 저장
+    "pending_delete_conv_id": None, # 대화 삭제 확인용 ID 저장
+    "long_doc_last_result": None, # 최근 전체 번역/요약 결과 (다운로드용)
+    "long_doc_retry_job": None, # 실패한 섹션이 있는 전체 번역/요약 작업 (재시도용)
+    "conversation_memory": None, # 현재 대화의 누적 요약 상태 {"summary", "summarized_upto"}
+    "message_token_counts": {} # 현재 대화 메시지의 토큰 수 캐시 {내용: 토큰 수} (메시지 dict에는 저장하지 않음)
 }
 for key, default_value in session_keys_defaults.items():
     if key not in st.session_state:
@@ -541,6 +936,7 @@ if not st.session_state.get("authenticated", False) and cookies is not None:
                             st.session_state.all_user_conversations = load_user_conversations_from_blob() # user_id는 내부적으로 get_current_user_login_id() 사용
                             st.session_state.current_chat_messages = [] # 새 대화로 시작
                             st.session_state.active_conversation_id = None
+                            st.session_state.conversation_memory = None
                             print(f"User '{user_data_from_cookie.get('name')}' session restored from cookie. Chat history loaded.")
                             # 여기서 st.rerun()을 호출하면 쿠키 관련 컴포넌트가 아직 완전히 마운트되지 않아 오류 발생 가능성 있음
                         else:
@@ -608,6 +1004,7 @@ if not st.session_state.get("authenticated", False):
     if submit_button_form: # 폼 제출 시에만 아래 로직 실행
         if not uid_input_form or not pwd_form: st.error("ID와 비밀번호를 모두 입력해주세요.")
         elif mode == "회원가입" and (not name_form or not dept_form): st.error("회원가입 시 이름과 부서를 모두 입력해주세요.")
+        elif mode == "회원가입" and not department_shard_name(dept_form): st.error(f"'{dept_form}'은(는) 공통 검색 범위 이름이라 부서명으로 쓸 수 없습니다.")
         else:
             if mode == "로그인":
                 user_data_from_db = USERS.get(uid_input_form) # DB(USERS 딕셔너리)에서 사용자 정보 가져오기
@@ -626,6 +1023,7 @@ if not st.session_state.get("authenticated", False):
                     st.session_state.all_user_conversations = load_user_conversations_from_blob() # user_id는 내부적으로 get_current_user_login_id() 사용
                     st.session_state.current_chat_messages = [] # 새 대화로 시작
                     st.session_state.active_conversation_id = None
+                    st.session_state.conversation_memory = None
                     st.session_state.pending_delete_conv_id = None # 혹시 남아있을 수 있는 플래그 초기화
                     print(f"Login successful for user '{uid_input_form}'. Chat history loaded. Starting new chat session.")
 
@@ -649,20 +1047,32 @@ if not st.session_state.get("authenticated", False):
             elif mode == "회원가입":
                 if uid_input_form in USERS: st.error("이미 존재하는 ID입니다.")
                 else:
-                    USERS[uid_input_form] = {"name": name_form, "department": dept_form, "uid": uid_input_form, 
+                    new_user_data = {"name": name_form, "department": dept_form, "uid": uid_input_form, 
                                   "password_hash": generate_password_hash(pwd_form),
                                   "approved": False, "role": "user"}
-                    if not save_data_to_blob(USERS, USERS_BLOB_NAME, container_client, "user info (signup)"):
+                    signup_id_taken = []
+                    def add_signup_user(users_data):
+                        users_data = users_data if isinstance(users_data, dict) else {}
+                        if uid_input_form in users_data: signup_id_taken.append(True) # 다른 사용자가 동시에 같은 ID로 가입한 경우
+                        else: users_data[uid_input_form] = new_user_data
+                        return users_data
+                    updated_users = update_data_in_blob(USERS_BLOB_NAME, container_client, add_signup_user, "user info (signup)", default_value={})
+                    if updated_users is None:
                         st.error("회원 정보 저장에 실패했습니다. 관리자에게 문의하세요.")
-                        USERS.pop(uid_input_form, None) # 저장 실패 시 롤백
+                    elif signup_id_taken:
+                        USERS = updated_users; st.error("이미 존재하는 ID입니다.")
                     else:
+                        USERS = updated_users
                         st.success("회원가입 요청이 완료되었습니다. 관리자 승인 후 로그인 가능합니다.")
+    STARTUP_TIMINGS.mark("login_page_rendered") # 프로세스 시작 후 첫 로그인 화면까지 (처음 한 번만 기록)
+    finish_rerun_trace("login")
     st.stop() # 인증되지 않은 사용자는 여기서 실행 중지
 
 # --- 이하 코드는 인증된 사용자에게만 보임 ---
 current_user_info = st.session_state.get("user", {}) # uid 포함
 
 # --- 사이드바: 사용자 정보, 새 대화 버튼 및 대화 내역 ---
+sidebar_render_span = start_trace_span("render.sidebar")
 with st.sidebar:
     st.markdown(f"**{current_user_info.get('name', '사용자')}** (`{current_user_info.get('uid', 'ID없음')}`)")
     st.markdown(f"*{current_user_info.get('department', '부서정보없음')}*")
@@ -674,6 +1084,7 @@ with st.sidebar:
         
         st.session_state.current_chat_messages = [] # 현재 채팅 메시지 비우기
         st.session_state.active_conversation_id = None # 활성 대화 ID 없음 (새 대화 상태)
+        st.session_state.conversation_memory = None
         st.session_state.pending_delete_conv_id = None # 삭제 보류 ID 초기화
         print("New chat started by user via sidebar button.")
         st.rerun()
@@ -693,16 +1104,14 @@ with st.sidebar:
         st.sidebar.warning(f"'{conv_title_to_delete}' 대화를 정말 삭제하시겠습니까?")
         del_confirm_cols = st.sidebar.columns(2)
         if del_confirm_cols[0].button("✅ 예, 삭제", key=f"confirm_del_yes_{conv_id_to_delete}", use_container_width=True):
-            # all_user_conversations 리스트에서 해당 ID의 대화 제거
-            st.session_state.all_user_conversations = [
-                c for c in st.session_state.all_user_conversations if c['id'] != conv_id_to_delete
-            ]
-            save_user_conversations_to_blob() # 변경된 전체 목록 저장
+            # 색인에서 제거 후 저장, 대화 파일 삭제
+            delete_conversation_from_blob(conv_id_to_delete)
             
             # 만약 현재 활성 대화가 삭제된 대화였다면, 현재 채팅창 비우기
             if st.session_state.active_conversation_id == conv_id_to_delete:
                 st.session_state.current_chat_messages = []
                 st.session_state.active_conversation_id = None
+                st.session_state.conversation_memory = None
             
             st.session_state.pending_delete_conv_id = None # 삭제 보류 플래그 해제
             st.toast(f"'{conv_title_to_delete}' 대화가 삭제되었습니다.", icon="🗑️")
@@ -716,7 +1125,7 @@ with st.sidebar:
     if not st.session_state.all_user_conversations:
         st.sidebar.caption("이전 대화 내역이 없습니다.")
     
-    # all_user_conversations는 load/save 시 이미 last_updated 기준 내림차순 정렬됨
+    # all_user_conversations는 대화 색인(메시지 제외)이며 load/save 시 이미 last_updated 기준 내림차순 정렬됨
     # 화면에는 최근 20개 또는 설정한 개수만큼 표시
     for conv_idx, conv_data in enumerate(st.session_state.all_user_conversations[:20]): 
         # 각 대화 아이템을 가로로 배치 (제목/시간 버튼, 삭제 아이콘 버튼)
@@ -741,11 +1150,16 @@ with st.sidebar:
                 # 현재 진행중이던 대화(current_chat_messages)가 새 내용이면 저장
                 archive_current_chat_session_if_needed() 
                 
-                st.session_state.current_chat_messages = list(conv_data["messages"]) # 대화 내용 불러오기 (복사본)
-                st.session_state.active_conversation_id = conv_data["id"]
-                st.session_state.pending_delete_conv_id = None # 다른 대화 선택 시 삭제 보류 해제
-                print(f"Loaded conversation ID: {conv_data['id']}, Title: '{title_display}'")
-                st.rerun()
+                loaded_conversation = load_conversation_from_blob(conv_data["id"]) # 클릭한 대화의 메시지만 불러옴
+                if loaded_conversation is None:
+                    st.sidebar.error(f"'{title_display}' 대화를 불러오지 못했습니다.")
+                else:
+                    st.session_state.current_chat_messages = list(loaded_conversation["messages"]) # 대화 내용 불러오기 (복사본)
+                    st.session_state.active_conversation_id = conv_data["id"]
+                    st.session_state.conversation_memory = get_memory_state_from_conversation(loaded_conversation)
+                    st.session_state.pending_delete_conv_id = None # 다른 대화 선택 시 삭제 보류 해제
+                    print(f"Loaded conversation ID: {conv_data['id']}, Title: '{title_display}'")
+                    st.rerun()
         
         # 삭제 아이콘 버튼
         if item_cols[1].button("🗑️", key=f"delete_icon_btn_{conv_data['id']}", help="이 대화 삭제"):
@@ -754,6 +1168,7 @@ with st.sidebar:
 
     if len(st.session_state.all_user_conversations) > 20:
         st.sidebar.caption("더 많은 내역은 전체 보기 기능(추후 구현)을 이용해주세요.")
+sidebar_render_span.end()
 
 
 # --- 메인 화면 상단 로고 및 로그아웃 버튼 ---
@@ -802,102 +1217,19 @@ st.markdown("""
 
 
 # --- @st.cache_resource 및 @st.cache_data 함수들 ---
-@st.cache_resource
-def load_vector_db_from_blob_cached(_container_client):
-    if not _container_client:
-        print("ERROR: Blob Container client is None for load_vector_db_from_blob_cached.")
-        return faiss.IndexFlatL2(1536), []
-    current_embedding_dimension = 1536
-    idx, meta = faiss.IndexFlatL2(current_embedding_dimension), []
-    print(f"Attempting to load vector DB from Blob: '{INDEX_BLOB_NAME}', '{METADATA_BLOB_NAME}' with dimension {current_embedding_dimension}")
-    try:
-        with tempfile.TemporaryDirectory() as tmpdir:
-            local_index_path = os.path.join(tmpdir, os.path.basename(INDEX_BLOB_NAME))
-            local_metadata_path = os.path.join(tmpdir, os.path.basename(METADATA_BLOB_NAME))
-
-            index_blob_client = _container_client.get_blob_client(INDEX_BLOB_NAME)
-            if index_blob_client.exists():
-                print(f"Downloading '{INDEX_BLOB_NAME}'...")
-                with open(local_index_path, "wb") as download_file:
-                    download_stream = index_blob_client.download_blob(timeout=60)
-                    download_file.write(download_stream.readall())
-                if os.path.getsize(local_index_path) > 0:
-                    try:
-                        idx = faiss.read_index(local_index_path)
-                        if idx.d != current_embedding_dimension:
-                            print(f"WARNING: Loaded FAISS index dimension ({idx.d}) does not match expected dimension ({current_embedding_dimension}). Re-initializing.")
-                            idx = faiss.IndexFlatL2(current_embedding_dimension); meta = []
-                        else:
-                            print(f"'{INDEX_BLOB_NAME}' loaded successfully from Blob Storage. Dimension: {idx.d}")
-                    except Exception as e_faiss_read:
-                        print(f"ERROR reading FAISS index: {e_faiss_read}. Re-initializing index.")
-                        idx = faiss.IndexFlatL2(current_embedding_dimension); meta = []
-                else:
-                    print(f"WARNING: '{INDEX_BLOB_NAME}' is empty in Blob. Using new index."); idx = faiss.IndexFlatL2(current_embedding_dimension); meta = []
-            else:
-                print(f"WARNING: '{INDEX_BLOB_NAME}' not found in Blob Storage. New index will be used/created."); idx = faiss.IndexFlatL2(current_embedding_dimension); meta = []
-
-            if idx is not None: # idx가 성공적으로 초기화/로드 된 경우
-                metadata_blob_client = _container_client.get_blob_client(METADATA_BLOB_NAME)
-                # 메타데이터는 인덱스 파일이 실제로 존재하고 내용이 있거나, DB에 아이템이 있을 때만 로드 시도
-                if metadata_blob_client.exists() and (idx.ntotal > 0 or (index_blob_client.exists() and os.path.exists(local_index_path) and os.path.getsize(local_index_path) > 0) ):
-                    print(f"Downloading '{METADATA_BLOB_NAME}'...")
-                    with open(local_metadata_path, "wb") as download_file_meta:
-                        download_stream_meta = metadata_blob_client.download_blob(timeout=60)
-                        download_file_meta.write(download_stream_meta.readall())
-                    if os.path.getsize(local_metadata_path) > 0 :
-                        with open(local_metadata_path, "r", encoding="utf-8") as f_meta: meta = json.load(f_meta)
-                    else: meta = []; print(f"WARNING: '{METADATA_BLOB_NAME}' is empty in Blob.")
-                # 인덱스가 새롭고 비어있으며, 인덱스 파일도 없는 경우 (완전 초기 상태)
-                elif idx.ntotal == 0 and not (index_blob_client.exists() and os.path.exists(local_index_path) and os.path.getsize(local_index_path) > 0):
-                     print(f"INFO: Index is new and empty, and no existing index file in blob. Starting with empty metadata."); meta = []
-                else: # 메타데이터 파일이 없거나, 인덱스는 있지만 해당 인덱스 파일이 없는 등의 그 외 상황
-                    print(f"INFO: Metadata file '{METADATA_BLOB_NAME}' not found, or index is empty/inconsistent with file. Starting with empty metadata."); meta = []
-
-            # 데이터 일관성 최종 체크
-            if idx is not None and idx.ntotal == 0 and len(meta) > 0: # 인덱스는 비었는데 메타데이터만 있는 경우
-                print(f"INFO: FAISS index is empty (ntotal=0) but metadata is not. Clearing metadata for consistency."); meta = []
-            elif idx is not None and idx.ntotal > 0 and not meta and (index_blob_client.exists() and os.path.exists(local_index_path) and os.path.getsize(local_index_path) > 0) : # 인덱스는 있는데 메타데이터가 없는 경우 (파일은 존재)
-                print(f"CRITICAL WARNING: FAISS index has data (ntotal={idx.ntotal}) but metadata is empty, despite index file existing. This may lead to errors.")
-    except AzureError as ae:
-        st.error(f"Azure service error loading vector DB from Blob: {ae}"); print(f"AZURE ERROR loading vector DB: {ae}\n{traceback.format_exc()}"); idx = faiss.IndexFlatL2(current_embedding_dimension); meta = []
-    except Exception as e:
-        st.error(f"Unknown error loading vector DB from Blob: {e}"); print(f"GENERAL ERROR loading vector DB: {e}\n{traceback.format_exc()}"); idx = faiss.IndexFlatL2(current_embedding_dimension); meta = []
-    return idx, meta
-
-index, metadata = (faiss.IndexFlatL2(1536), []) # 기본값으로 초기화
-if container_client: # Blob 클라이언트가 성공적으로 초기화된 경우에만 로드 시도
-    index, metadata = load_vector_db_from_blob_cached(container_client)
-    print(f"DEBUG: FAISS index loaded after cache. ntotal: {index.ntotal if index else 'Index is None'}, dimension: {index.d if index else 'N/A'}")
-    print(f"DEBUG: Metadata loaded after cache. Length: {len(metadata) if metadata is not None else 'Metadata is None'}")
+tokenizer = get_startup_warmup_result("tokenizer", "토크나이저를 준비하는 중입니다...")
+vector_store = None # 부서/컬렉션별 샤드로 나눈 벡터 DB (검색 사이드카를 쓰면 None)
+if retrieval_client: print("Vector DB is served by the retrieval service. Skipping in-process load.")
+elif container_client: # Blob 클라이언트가 성공적으로 초기화된 경우에만 로드 시도
+    vector_store = get_startup_warmup_result("vector_db", "문서 검색 DB를 불러오는 중입니다...")
+    if vector_store: print(f"DEBUG: Vector DB ready after warm-up. Shards: {vector_store.stats()['shards']}")
 else:
     st.error("Azure Blob Storage connection failed. Cannot load vector DB. File learning/search will be limited.")
     print("CRITICAL: Cannot load vector DB due to Blob client initialization failure (main section).")
 
 @st.cache_data
 def load_prompt_rules_cached():
-    default_rules = """1. 제공된 '문서 내용'을 최우선으로 참고하여 답변합니다.
-2. 질문에 대한 정보가 문서 내용에 명확히 없는 경우, "제공된 문서에서 관련 정보를 찾을 수 없습니다."라고 답변합니다. 추측성 답변은 피합니다.
-3. 답변은 구체적이고 명확해야 하며, 가능하다면 관련 규정 번호나 절차 단계를 언급합니다.
-4. 답변은 항상 한국어로 정중하게 제공합니다.
-5. 계산이 필요한 경우, 정확한 계산 과정을 포함하여 답변합니다.
-6. 사용자가 업로드한 파일(이미지 포함)의 내용과 질문을 연관지어 답변해야 할 경우, 해당 파일의 내용을 분석하여 답변에 활용합니다. 파일명도 함께 언급할 수 있습니다.
-7. 답변은 항상 사용자의 질문 의도에 부합하도록 노력합니다.
-8. 문서 내용에 여러 관련 정보가 있을 경우, 가장 중요하거나 질문과 직접적으로 관련된 정보를 중심으로 요약하여 답변합니다.
-9. 안전, 품질, 규정 준수와 관련된 질문에는 특히 신중하고 정확한 정보를 제공합니다.
-10. 답변은 문단으로 구분하여 가독성을 높입니다. 복잡한 내용은 필요시 목록 형태로 제시할 수 있습니다."""
-    if os.path.exists(RULES_PATH_REPO):
-        try:
-            with open(RULES_PATH_REPO, "r", encoding="utf-8") as f: rules_content = f.read()
-            print(f"Prompt rules loaded successfully from '{RULES_PATH_REPO}'.")
-            return rules_content
-        except Exception as e:
-            # st.warning(f"Error loading '{RULES_PATH_REPO}': {e}. Using default rules defined above.") # UI 경고 최소화
-            print(f"WARNING: Error loading prompt rules from '{RULES_PATH_REPO}': {e}. Using default rules defined in code.")
-            return default_rules
-    else:
-        print(f"WARNING: Prompt rules file not found at '{RULES_PATH_REPO}'. Using default rules defined in code.")
-        return default_rules
+    return load_prompt_rules(RULES_PATH)
 PROMPT_RULES_CONTENT = load_prompt_rules_cached()
 
 def extract_text_from_file(uploaded_file_obj):
@@ -910,8 +1242,10 @@ def extract_text_from_file(uploaded_file_obj):
         uploaded_file_obj.seek(0)
         file_bytes = uploaded_file_obj.read()
         if ext == ".pdf":
-            with fitz.open(stream=file_bytes, filetype="pdf") as doc: text_content = "\n".join(page.get_text() for page in doc)
+            fitz = lazy_import("fitz") # PyMuPDF
+            with fitz.open(stream=file_bytes, filetype="pdf") as doc: text_content = f"\n{PAGE_BREAK}\n".join(page.get_text() for page in doc) # 페이지 구분 (머리말/꼬리말 제거용)
         elif ext == ".docx": # 테이블 추출 개선 버전
+            docx = lazy_import("docx")
             with io.BytesIO(file_bytes) as doc_io:
                 doc = docx.Document(doc_io); full_text = []
                 for para in doc.paragraphs: full_text.append(para.text)
@@ -924,9 +1258,11 @@ def extract_text_from_file(uploaded_file_obj):
                     full_text.append("\n".join(table_data_text)) # 각 테이블 내용을 하나의 문자열로
                 text_content = "\n\n".join(full_text) # 단락과 테이블 내용을 합침
         elif ext in (".xlsx", ".xlsm"):
+            pd = lazy_import("pandas")
             with io.BytesIO(file_bytes) as excel_io: df_dict = pd.read_excel(excel_io, sheet_name=None)
             text_content = "\n\n".join(f"--- Sheet: {name} ---\n{df.to_string(index=False)}" for name, df in df_dict.items())
         elif ext == ".csv":
+            pd = lazy_import("pandas")
             with io.BytesIO(file_bytes) as csv_io: # BytesIO 사용
                 try: df = pd.read_csv(csv_io)
                 except UnicodeDecodeError: # UTF-8 실패 시 CP949 시도
@@ -934,7 +1270,10 @@ def extract_text_from_file(uploaded_file_obj):
                     df = pd.read_csv(io.BytesIO(file_bytes), encoding='cp949') 
                 text_content = df.to_string(index=False)
         elif ext == ".pptx":
-            with io.BytesIO(file_bytes) as ppt_io: prs = Presentation(ppt_io); text_content = "\n".join(shape.text for slide in prs.slides for shape in slide.shapes if hasattr(shape, "text"))
+            pptx = lazy_import("pptx")
+            with io.BytesIO(file_bytes) as ppt_io:
+                prs = pptx.Presentation(ppt_io)
+                text_content = f"\n{PAGE_BREAK}\n".join("\n".join(shape.text for shape in slide.shapes if hasattr(shape, "text")) for slide in prs.slides) # 슬라이드 구분
         elif ext == ".txt":
             try: text_content = file_bytes.decode('utf-8')
             except UnicodeDecodeError: 
@@ -955,43 +1294,19 @@ def save_original_file_to_blob(uploaded_file_obj, _container_client, base_path="
         file_bytes_for_original = uploaded_file_obj.read() # 여기서 파일 내용을 다시 읽음
         with io.BytesIO(file_bytes_for_original) as data_stream:
             blob_client_instance.upload_blob(data_stream, overwrite=True, timeout=120)
-        print(f"Successfully saved original file '{safe_file_name}' to Blob as '{blob_name}'"); return blob_name
+        print(f"Successfully saved original file '{safe_file_name}' to Blob as '{blob_name}'")
+        record_blob_change(blob_name, "upload", _container_client, size=len(file_bytes_for_original)); return blob_name
     except Exception as e: print(f"ERROR saving original file to Blob ('{uploaded_file_obj.name}'): {e}"); return None
 
-def log_openai_api_usage_to_blob(user_id, model_name, usage_object, _container_client, request_type="general_api_call"):
+def log_openai_api_usage_to_blob(user_id, model_name, usage_object, _container_client, request_type="general_api_call", department=None):
     if not _container_client: print(f"ERROR: Blob client None, cannot log API usage."); return False
-    log_entry = {
-        "timestamp": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "user_id": user_id, 
-        "model_name": model_name, "request_type": request_type, 
-        "prompt_tokens": getattr(usage_object, 'prompt_tokens', 0), 
-        "completion_tokens": getattr(usage_object, 'completion_tokens', 0), 
-        "total_tokens": getattr(usage_object, 'total_tokens', 0)
-    }
+    log_entry = make_usage_log_entry(user_id, model_name, request_type, usage_object, department)
     try:
-        current_logs = load_data_from_blob(USAGE_LOG_BLOB_NAME, _container_client, "API usage log", default_value=[])
-        if not isinstance(current_logs, list): current_logs = [] # 데이터가 리스트가 아니면 초기화
-        current_logs.append(log_entry)
-        if save_data_to_blob(current_logs, USAGE_LOG_BLOB_NAME, _container_client, "API usage log"):
-            print(f"Successfully logged API usage for user '{user_id}'."); return True
-        else:
-            print(f"ERROR: Failed to save API usage log to Blob after appending new entry."); return False
+        get_log_writer_cached(_container_client).log("usage", log_entry) # 큐에 넣기만 함 (Blob 기록은 백그라운드)
+        return True
     except Exception as e: print(f"GENERAL ERROR logging API usage: {e}\n{traceback.format_exc()}"); return False
 
-def chunk_text_into_pieces(text_to_chunk, chunk_size=500): # 청크 크기는 토큰이 아닌 글자 수 기반
-    if not text_to_chunk or not text_to_chunk.strip(): return [];
-    chunks_list, current_buffer = [], ""
-    for line in text_to_chunk.split("\n"): 
-        stripped_line = line.strip()
-        if not stripped_line and not current_buffer.strip(): continue 
-        if len(current_buffer) + len(stripped_line) + 1 < chunk_size: 
-            current_buffer += stripped_line + "\n"
-        else: 
-            if current_buffer.strip(): chunks_list.append(current_buffer.strip())
-            current_buffer = stripped_line + "\n" 
-    if current_buffer.strip(): chunks_list.append(current_buffer.strip())
-    return [c for c in chunks_list if c] # 내용이 있는 청크만 반환
-
-def get_image_description(image_bytes, image_filename, client_instance):
+def get_image_description(image_bytes, image_filename, client_instance, caller=None):
     if not client_instance: print("ERROR: OpenAI client not ready for image description."); return None
     print(f"DEBUG: Requesting description for image '{image_filename}'")
     try:
@@ -1000,35 +1315,36 @@ def get_image_description(image_bytes, image_filename, client_instance):
         mime_type = "image/jpeg" if ext in [".jpg", ".jpeg"] else "image/png" if ext == ".png" else "application/octet-stream" # 기본값 변경
         vision_model = st.secrets.get("AZURE_OPENAI_DEPLOYMENT", "gpt-4-vision-preview") # secrets에 없으면 기본 모델명 사용
         
-        response = client_instance.chat.completions.create(
-            model=vision_model, 
+        response = client_instance.chat_completion(
+            "vision", model=vision_model, caller=caller,
             messages=[{"role": "user", "content": [
                 {"type": "text", "text": f"Describe this image (filename: '{image_filename}') from a work/professional perspective. This description will be used for text-based search. Mention key objects, states, possible contexts, and any elements relevant to GMP/SOP if applicable."}, 
                 {"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{base64_image}" }}
             ]}], 
-            max_tokens=IMAGE_DESCRIPTION_MAX_TOKENS, temperature=0.2, timeout=AZURE_OPENAI_TIMEOUT
+            max_tokens=IMAGE_DESCRIPTION_MAX_TOKENS, temperature=0.2
         )
         description = response.choices[0].message.content.strip()
-        print(f"DEBUG: Image description for '{image_filename}' generated (len: {len(description)}).")
-        # 여기서 API 사용량 로깅 추가 가능
+        print(f"DEBUG: Image description for '{image_filename}' generated (len: {len(description)}).") # 사용량은 llm_client의 usage_meter가 기록
         return description
+    except USER_FACING_LLM_ERRORS: raise
     except Exception as e: 
         print(f"ERROR during image description for '{image_filename}': {e}\n{traceback.format_exc()}")
         # st.error(f"이미지 설명 생성 오류: {e}") # UI 오류 최소화
         return None
 
-def get_text_embedding(text_to_embed, client=openai_client, model=EMBEDDING_MODEL):
+def get_text_embedding(text_to_embed, client=llm_client, model=EMBEDDING_MODEL, caller=None):
     if not client or not model or not text_to_embed or not text_to_embed.strip(): 
         # print("Skipping embedding for empty or invalid input.") # 너무 빈번한 로그 방지
         return None
     try: 
-        response = client.embeddings.create(input=[text_to_embed], model=model, timeout=AZURE_OPENAI_TIMEOUT / 2)
+        response = client.embeddings("embedding", model, [text_to_embed], hedge=True, caller=caller)
         return response.data[0].embedding
+    except USER_FACING_LLM_ERRORS: raise # 빈 검색 결과 대신 채팅 화면의 한도 초과/대기열 안내로 전달
     except Exception as e: 
         print(f"ERROR during single text embedding for text starting with '{text_to_embed[:30]}...': {e}")
         return None
 
-def get_batch_embeddings(texts_to_embed, client=openai_client, model=EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE):
+def get_batch_embeddings(texts_to_embed, client=llm_client, model=EMBEDDING_MODEL, batch_size=EMBEDDING_BATCH_SIZE, caller=None):
     if not client or not model or not texts_to_embed: return []
     all_embeddings = []
     for i in range(0, len(texts_to_embed), batch_size):
@@ -1036,7 +1352,8 @@ def get_batch_embeddings(texts_to_embed, client=openai_client, model=EMBEDDING_M
         if not batch: continue # 빈 배치면 건너뛰기
         print(f"DEBUG: Requesting embeddings for batch of {len(batch)} texts...")
         try:
-            response = client.embeddings.create(input=batch, model=model, timeout=AZURE_OPENAI_TIMEOUT)
+            with trace_span("embedding.batch", batch_size=len(batch)):
+                response = client.embeddings("embedding_batch", model, batch, caller=caller)
             # 응답 순서 보장을 위해 index 기준으로 정렬
             batch_embeddings = [item.embedding for item in sorted(response.data, key=lambda emb_item: emb_item.index)]
             all_embeddings.extend(batch_embeddings)
@@ -1046,99 +1363,287 @@ def get_batch_embeddings(texts_to_embed, client=openai_client, model=EMBEDDING_M
             all_embeddings.extend([None] * len(batch)) # 실패 시 None으로 채움
     return all_embeddings
 
-def search_similar_chunks(query_text, k_results=3):
-    if index is None or index.ntotal == 0 or not metadata: 
-        print("Vector DB empty or not loaded. Search aborted.")
+def get_visible_shard_names():
+    # 현재 사용자가 검색할 수 있는 벡터 DB 샤드: 공통 + 자기 부서 (관리자는 모든 샤드 -> None)
+    user_info = st.session_state.get("user") or {}
+    if user_info.get("role") == "admin": return None
+    user_department_shard = department_shard_name(user_info.get("department"))
+    return [COMMON_SHARD_NAME] + ([user_department_shard] if user_department_shard else [])
+
+def search_similar_chunks_via_service(query_text, k_results, stage_timings, stage_name):
+    # 질의 임베딩과 FAISS 검색을 사이드카가 처리 (다른 세션의 검색과 함께 배치). 임베딩 사용량은 이 세션 사용자 기준으로 계량
+    caller = get_usage_caller("query_embedding")
+    try:
+        with stage_timings.measure(f"{stage_name}.service_search"):
+            search_fn = lambda: retrieval_client.search(query_text, k=k_results, shards=get_visible_shard_names())
+            response = llm_client.run_metered(caller, EMBEDDING_MODEL, search_fn, input_texts=[query_text]) if llm_client else search_fn()
+    except RetrievalServiceError as e_service:
+        print(f"ERROR: Retrieval service search failed: {e_service}"); return []
+    results = response.results
+    if tokenizer:
+        for item in results: ensure_item_token_count(item, tokenizer) # 서비스 메타데이터에 토큰 수가 없는 이전 청크
+    return results
+
+def search_similar_chunks(query_text, k_results=RETRIEVAL_K_RESULTS, stage_timings=None, stage_name="retrieval"):
+    if retrieval_client:
+        return search_similar_chunks_via_service(query_text, k_results, stage_timings or StageTimings(), stage_name)
+    if vector_store is None:
+        print("Vector DB not loaded. Search aborted.")
         return []
-    query_vector = get_text_embedding(query_text)
+    stage_timings = stage_timings or StageTimings()
+    vector_store.maybe_refresh_layout(VECTOR_LAYOUT_REFRESH_INTERVAL_SECONDS) # 전환이 끝났으면 새 인덱스와 새 임베딩 모델로 검색
+    with stage_timings.measure(f"{stage_name}.embedding"):
+        query_vector = get_text_embedding(query_text, model=vector_store.embedding_model(EMBEDDING_MODEL), caller=get_usage_caller("query_embedding"))
     if query_vector is None: 
         print("Query embedding failed. Search aborted.")
         return []
     try:
-        actual_k = min(k_results, index.ntotal); 
-        if actual_k == 0 : return []
-        distances, indices_found = index.search(np.array([query_vector]).astype("float32"), actual_k)
-        results = []
-        for idx_val in indices_found[0]:
-            if 0 <= idx_val < len(metadata) and isinstance(metadata[idx_val], dict):
-                 results.append({
-                    "source": metadata[idx_val].get("file_name", "Unknown Source"), 
-                    "content": metadata[idx_val].get("content", ""), 
-                    "is_image_description": metadata[idx_val].get("is_image_description", False), 
-                    "original_file_extension": metadata[idx_val].get("original_file_extension", "")
-                })
-            else:
-                print(f"Warning: Invalid index {idx_val} from FAISS search. Metadata length: {len(metadata)}")
-        return results
+        with stage_timings.measure(f"{stage_name}.faiss_search"): # 볼 수 있는 샤드에 병렬로 검색하고 거리 순으로 합침
+            return vector_store.search_batch([query_vector], [k_results], [get_visible_shard_names()])[0]
     except Exception as e: 
         # st.error(f"Similarity search error: {e}") # UI 오류 최소화
         print(f"ERROR: Similarity search failed: {e}\n{traceback.format_exc()}"); return []
 
-def add_document_to_vector_db_and_blob(uploaded_file_obj, processed_content_unused, text_chunks, _container_client, is_image_description=False):
-    global index, metadata # 전역 변수 수정 명시
+def current_faq_scope_and_fingerprint(chat_model, rules_version, visible_shard_names):
+    # 반환: (이 사용자의 검색 범위, 현재 인덱스 지문). 검색 DB를 쓸 수 없으면 (None, None)
+    # 지문 비교용으로 범위의 샤드를 불러옴 (검색할 때 어차피 불러오는 샤드. 임베딩/검색 호출 없음)
+    if retrieval_client:
+        try: store_stats = retrieval_client.load_shards(visible_shard_names)
+        except RetrievalServiceError as e_service: print(f"WARNING: Could not load retrieval service shards for FAQ cache: {e_service}"); return None, None
+    elif vector_store is not None:
+        vector_store.maybe_refresh_layout(VECTOR_LAYOUT_REFRESH_INTERVAL_SECONDS)
+        store_stats = vector_store.load_shards(visible_shard_names)
+    else:
+        return None, None
+    scope = resolve_scope(store_stats, visible_shard_names)
+    return scope, index_fingerprint(store_stats, scope, rules_version, chat_model)
+
+def refresh_faq_answer_in_background(faq_entry, answer_text, retrieved_chunks, chat_model, rules_version):
+    # 인덱스/규칙이 바뀐 FAQ 항목을 방금 평소 경로로 만든 답변으로 갱신 (답변 표시를 늦추지 않도록 백그라운드)
+    sources = list(dict.fromkeys(item.get("source", "Unknown Source") for item in retrieved_chunks or []))
+    visible_shard_names, faq_cache = get_visible_shard_names(), get_faq_cache_cached(container_client) # 스레드에서는 세션 정보/st 캐시를 쓰지 않음
+    def refresh_entry():
+        try:
+            scope, fingerprint = current_faq_scope_and_fingerprint(chat_model, rules_version, visible_shard_names)
+            if scope != faq_entry.get("scope") or fingerprint is None: return # 그 사이 범위가 바뀐 경우
+            faq_cache.refresh_entry(faq_entry["key"], answer_text, sources, fingerprint)
+            print(f"FAQ cache entry '{faq_entry['key']}' refreshed after index change.")
+        except Exception as e_faq_refresh:
+            print(f"ERROR refreshing FAQ cache entry '{faq_entry.get('key')}': {e_faq_refresh}\n{traceback.format_exc()}")
+    refresh_thread = threading.Thread(target=refresh_entry, name="faq-cache-refresh", daemon=True)
+    refresh_thread.start()
+
+def log_document_upload(file_name, file_type_log_desc, chunks_added, _container_client, dedup_stats=None):
+    # 업로드 로그 기록 (dedup_stats: 건너뛴 중복 청크 통계)
+    uploader_name = st.session_state.user.get("name", "N/A")
+    log_entry = {"file": file_name, "type": file_type_log_desc, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "chunks_added": chunks_added, "uploader": uploader_name}
+    if dedup_stats: log_entry.update(duplicates_skipped=dedup_stats.get("embeddings_saved", 0), index_bytes_saved=dedup_stats.get("index_bytes_saved", 0))
+    try: get_log_writer_cached(_container_client).log("upload", log_entry)
+    except Exception as e_upload_log: print(f"ERROR queueing upload log entry: {e_upload_log}"); st.warning("Failed to save upload log to Blob.") # 경고만 표시
+
+def report_skipped_duplicate_chunks(file_name, dedup_stats):
+    # 학습에서 건너뛴 중복 청크와 절약한 임베딩/인덱스 크기를 관리자 화면에 표시
+    if not dedup_stats or not dedup_stats.get("embeddings_saved"): return
+    st.info(f"'{file_name}': 중복 청크 {dedup_stats['embeddings_saved']}개 제외 (완전 중복 {dedup_stats.get('exact_duplicates', 0)}, 근접 중복 {dedup_stats.get('near_duplicates', 0)}) · "
+            f"임베딩 {dedup_stats['embeddings_saved']}회, 인덱스 {dedup_stats.get('index_bytes_saved', 0) / 1024:,.1f}KB 절약")
+
+def add_document_via_retrieval_service(uploaded_file_obj, text_chunks, _container_client, is_image_description, file_type_log_desc, shard_name):
+    # 임베딩/인덱스 추가/Blob 저장은 사이드카가 처리 (이 프로세스는 인덱스를 쓰지 않음). 관리자 학습은 쿼터 미적용
+    caller = get_usage_caller("document_embedding", enforce_quota=False)
+    token_counts = [len(tokenizer.encode(chunk)) for chunk in text_chunks] if tokenizer else None
+    ingest_fn = lambda: retrieval_client.ingest(uploaded_file_obj.name, text_chunks, is_image_description=is_image_description,
+                                                original_file_extension=os.path.splitext(uploaded_file_obj.name)[1].lower(), token_counts=token_counts, shard=shard_name)
+    try:
+        with trace_span("vector_db.service_ingest", chunks=len(text_chunks)):
+            response = llm_client.run_metered(caller, EMBEDDING_MODEL, ingest_fn) if llm_client else ingest_fn()
+    except RetrievalServiceError as e_service: # 임베딩 모델 전환 중이면 503 (학습 일시 중지)
+        st.error(f"Error during document learning via retrieval service for '{uploaded_file_obj.name}': {e_service}")
+        print(f"ERROR: Retrieval service ingest failed: {e_service}"); return False
+    report_skipped_duplicate_chunks(uploaded_file_obj.name, response.dedup)
+    if response.added == 0 and not response.failed and response.dedup.get("embeddings_saved"):
+        st.info(f"'{uploaded_file_obj.name}'의 내용은 모두 이미 학습되어 있습니다."); return True
+    if response.added == 0:
+        st.error(f"No valid embeddings generated for '{uploaded_file_obj.name}'. Document not learned."); return False
+    if response.failed:
+        st.warning(f"Some content from '{uploaded_file_obj.name}' failed embedding. Only successful parts learned.")
+    print(f"Added {response.added} new chunks from '{uploaded_file_obj.name}' to shard '{shard_name}' via retrieval service. Shard total: {response.ntotal}")
+    log_document_upload(uploaded_file_obj.name, file_type_log_desc, response.added, _container_client, response.dedup)
+    return True
+
+def add_document_to_vector_db_and_blob(uploaded_file_obj, processed_content_unused, text_chunks, _container_client, is_image_description=False, shard_name=COMMON_SHARD_NAME):
+    # shard_name: 학습할 벡터 DB 샤드 (공통 또는 부서/컬렉션). 해당 샤드의 인덱스/메타데이터만 다시 저장
     if not text_chunks: st.warning(f"No content chunks to process for '{uploaded_file_obj.name}'."); return False
     if not _container_client: st.error("Cannot save learning results: Azure Blob client not ready."); return False
     
     file_type_log_desc = "image description" if is_image_description else "text document"
-    print(f"Adding '{file_type_log_desc}' from '{uploaded_file_obj.name}' to vector DB.")
+    print(f"Adding '{file_type_log_desc}' from '{uploaded_file_obj.name}' to vector DB shard '{shard_name}'.")
+    if retrieval_client:
+        return add_document_via_retrieval_service(uploaded_file_obj, text_chunks, _container_client, is_image_description, file_type_log_desc, shard_name)
+    if vector_store is None: st.error("Cannot learn document: vector DB is not loaded."); return False
+    try: vector_store.check_ingest_allowed() # 최신 배치(임베딩 모델)로 학습
+    except VectorIngestPausedError as e_paused: st.warning(f"'{uploaded_file_obj.name}' 학습을 잠시 미룹니다: {e_paused}"); return False
+    shard = vector_store.get_shard(shard_name)
+    with shard.ingest_session(): # 중복 확인부터 저장까지 같은 샤드의 다른 학습과 겹치지 않게
+        # 샤드에 이미 있거나 문서 안에서 반복되는 청크(상용구, 개정 이력표 등)는 임베딩하지 않음
+        with trace_span("vector_db.dedup", chunks=len(text_chunks)): kept_chunk_positions, dedup_stats = shard.filter_duplicate_chunks(text_chunks, uploaded_file_obj.name)
+        report_skipped_duplicate_chunks(uploaded_file_obj.name, dedup_stats)
+        text_chunks = [text_chunks[chunk_no] for chunk_no in kept_chunk_positions]
+        if not text_chunks: st.info(f"'{uploaded_file_obj.name}'의 내용은 모두 이미 학습되어 있습니다."); return True
     
-    chunk_embeddings = get_batch_embeddings(text_chunks)
-    vectors_to_add, new_metadata_entries = [], []
-    successful_embedding_count = 0
-
-    for i, chunk in enumerate(text_chunks):
-        embedding = chunk_embeddings[i] if i < len(chunk_embeddings) else None
-        if embedding:
-            vectors_to_add.append(embedding)
-            new_metadata_entries.append({
-                "file_name": uploaded_file_obj.name, "content": chunk, 
-                "is_image_description": is_image_description, 
-                "original_file_extension": os.path.splitext(uploaded_file_obj.name)[1].lower()
-            })
-            successful_embedding_count +=1
-        else:
-            print(f"Warning: Failed to get embedding for chunk {i+1} of '{uploaded_file_obj.name}'. Skipping.")
+        chunk_embeddings = get_batch_embeddings(text_chunks, model=vector_store.embedding_model(EMBEDDING_MODEL),
+                                                caller=get_usage_caller("document_embedding", enforce_quota=False)) # 관리자 학습은 쿼터 미적용
+        vectors_to_add, new_metadata_entries = [], []
+        successful_embedding_count = 0
+
+        for i, chunk in enumerate(text_chunks):
+            embedding = chunk_embeddings[i] if i < len(chunk_embeddings) else None
+            if embedding:
+                vectors_to_add.append(embedding)
+                new_metadata_entries.append({
+                    "file_name": uploaded_file_obj.name, "content": chunk, 
+                    "is_image_description": is_image_description, 
+                    "original_file_extension": os.path.splitext(uploaded_file_obj.name)[1].lower(),
+                    "token_count": len(tokenizer.encode(chunk)) if tokenizer else None
+                })
+                successful_embedding_count +=1
+            else:
+                print(f"Warning: Failed to get embedding for chunk {i+1} of '{uploaded_file_obj.name}'. Skipping.")
 
-    if successful_embedding_count == 0: 
-        st.error(f"No valid embeddings generated for '{uploaded_file_obj.name}'. Document not learned."); return False
-    if successful_embedding_count < len(text_chunks):
-        st.warning(f"Some content from '{uploaded_file_obj.name}' failed embedding. Only successful parts learned.")
+        if successful_embedding_count == 0: 
+            st.error(f"No valid embeddings generated for '{uploaded_file_obj.name}'. Document not learned."); return False
+        if successful_embedding_count < len(text_chunks):
+            st.warning(f"Some content from '{uploaded_file_obj.name}' failed embedding. Only successful parts learned.")
 
-    try:
-        current_dim = np.array(vectors_to_add[0]).shape[0]
-        if index is None or index.d != current_dim: 
-            print(f"Re-initializing FAISS index. Old dim: {index.d if index else 'None'}, New dim: {current_dim}")
-            index = faiss.IndexFlatL2(current_dim); metadata = []
-        
-        if vectors_to_add: index.add(np.array(vectors_to_add).astype("float32"))
-        metadata.extend(new_metadata_entries)
-        print(f"Added {len(vectors_to_add)} new chunks from '{uploaded_file_obj.name}'. Index total: {index.ntotal}, Dim: {index.d}")
-
-        # FAISS 인덱스 및 메타데이터 Blob에 저장
-        with tempfile.TemporaryDirectory() as tmpdir:
-            temp_index_path = os.path.join(tmpdir, "temp.index")
-            if index.ntotal > 0: 
-                 faiss.write_index(index, temp_index_path)
-                 if not save_binary_data_to_blob(temp_index_path, INDEX_BLOB_NAME, _container_client, "vector index"):
-                     st.error("Failed to save vector index to Blob."); return False # 심각한 오류로 간주
-            else: print(f"Skipping saving empty index to Blob: {INDEX_BLOB_NAME}")
-        
-        if not save_data_to_blob(metadata, METADATA_BLOB_NAME, _container_client, "metadata"):
-            st.error("Failed to save metadata to Blob."); return False # 심각한 오류로 간주
-
-        # 업로드 로그 기록
-        uploader_name = st.session_state.user.get("name", "N/A")
-        log_entry = {"file": uploaded_file_obj.name, "type": file_type_log_desc, "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S"), "chunks_added": len(vectors_to_add), "uploader": uploader_name}
-        upload_logs = load_data_from_blob(UPLOAD_LOG_BLOB_NAME, _container_client, "upload log", default_value=[])
-        if not isinstance(upload_logs, list): upload_logs = []
-        upload_logs.append(log_entry)
-        if not save_data_to_blob(upload_logs, UPLOAD_LOG_BLOB_NAME, _container_client, "upload log"):
-            st.warning("Failed to save upload log to Blob.") # 경고만 표시
-        return True
-    except Exception as e: 
-        st.error(f"Error during document learning or Azure Blob upload for '{uploaded_file_obj.name}': {e}")
-        print(f"ERROR: Failed to add document or upload to Blob: {e}\n{traceback.format_exc()}"); return False
+        try:
+            # 인덱스 추가 후 이 샤드의 인덱스/메타데이터를 Blob에 저장 (저장 실패 시 예외)
+            with trace_span("vector_db.faiss_add", vectors=len(vectors_to_add), shard=shard.name): shard_total = shard.add_and_save(vectors_to_add, new_metadata_entries)
+            record_blob_change(shard.index_blob_name, "upload", _container_client); record_blob_change(shard.metadata_blob_name, "upload", _container_client)
+            print(f"Added {len(vectors_to_add)} new chunks from '{uploaded_file_obj.name}' to shard '{shard.name}'. Shard total: {shard_total}")
 
+            log_document_upload(uploaded_file_obj.name, file_type_log_desc, len(vectors_to_add), _container_client, dedup_stats)
+            return True
+        except Exception as e: 
+            st.error(f"Error during document learning or Azure Blob upload for '{uploaded_file_obj.name}': {e}")
+            print(f"ERROR: Failed to add document or upload to Blob: {e}\n{traceback.format_exc()}"); return False
+
+
+# --- 질문 처리 전 단계 (동시 실행) ---
+def get_streamlit_thread_initializer():
+    # 작업 스레드에서도 st.session_state / st.warning 등을 쓸 수 있도록 현재 실행 컨텍스트를 연결
+    # 이번 실행의 trace도 연결해 작업 스레드의 단계가 현재 span 아래에 기록되도록 함
+    script_run_ctx = get_script_run_ctx()
+    if script_run_ctx is None: return None
+    request_trace, parent_span_id = current_trace(), current_span_id()
+    def initialize_worker_thread():
+        add_script_run_ctx(threading.current_thread(), script_run_ctx)
+        bind_trace(request_trace, parent_span_id)
+    return initialize_worker_thread
+
+def process_chat_attachment(uploaded_file_obj, query_text, is_image, stage_timings, search_with_description=True):
+    # 반환: {"content": 추출 텍스트 또는 이미지 설명, "source": 표시 이름, "retrieved_chunks": 이미지 설명을 포함한 검색 결과}
+    if is_image:
+        with stage_timings.measure("attachment.image_description"):
+            description = get_image_description(uploaded_file_obj.getvalue(), uploaded_file_obj.name, llm_client, caller=get_usage_caller("chat_image_description"))
+        if not description: return {"content": None}
+        retrieved_chunks = []
+        if search_with_description: # 이미지 설명이 있으면 설명을 덧붙인 질의로 한 번 더 검색
+            retrieved_chunks = search_similar_chunks(f"{query_text}\n\n첨부 이미지 내용: {description}", k_results=RETRIEVAL_K_RESULTS, stage_timings=stage_timings, stage_name="attachment.image_retrieval")
+        return {"content": description, "source": f"사용자 첨부 이미지: {uploaded_file_obj.name}", "retrieved_chunks": retrieved_chunks}
+    with stage_timings.measure("attachment.text_extraction"):
+        extracted_text = extract_text_from_file(uploaded_file_obj)
+    return {"content": extracted_text or None, "source": f"사용자 첨부 파일: {uploaded_file_obj.name}", "retrieved_chunks": []}
+
+# --- 프롬프트 조립 ---
+@st.cache_resource
+def get_prompt_builder(rules_text):
+    # 규칙 내용이 바뀌면 새 빌더(새 규칙 버전)가 만들어지고 정적 토큰 수도 다시 계산됨
+    return PromptBuilder(tokenizer, rules_text)
+
+# --- 멀티턴 대화 메모리 ---
+def summarize_conversation_turns(summary_request_messages):
+    # conversation_memory.update_rolling_summary에서 호출되는 요약 함수
+    chat_model = st.secrets.get("AZURE_OPENAI_DEPLOYMENT")
+    response = llm_client.chat_completion(
+        "summary", model=chat_model, caller=get_usage_caller("conversation_summary"), messages=summary_request_messages,
+        max_tokens=MEMORY_SUMMARY_MAX_TOKENS, temperature=0.0
+    )
+    return response.choices[0].message.content.strip(), response.usage
+
+def prepare_conversation_history_for_request(history_messages):
+    # 최근 턴은 토큰 예산 내 원문으로, 그 이전 턴은 누적 요약으로 포함. 갱신된 요약은 세션(대화)에 저장
+    memory_state = st.session_state.get("conversation_memory") or empty_memory_state()
+    message_token_counts = prune_message_token_counts(st.session_state.get("message_token_counts") or {}, history_messages)
+    window_start, recent_turn_tokens = select_recent_turns(history_messages, tokenizer, MEMORY_RECENT_TURNS_TOKENS, min_index=memory_state.get("summarized_upto", 0), token_counts=message_token_counts)
+    st.session_state.message_token_counts = message_token_counts
+    memory_state, _ = update_rolling_summary(memory_state, history_messages, window_start, tokenizer, summarize_conversation_turns, MEMORY_SUMMARY_TURN_INPUT_TOKENS) # 요약 사용량은 usage_meter가 기록
+    st.session_state.conversation_memory = memory_state
+    history_for_request = build_history_messages(memory_state, history_messages, window_start)
+    history_tokens = recent_turn_tokens + count_summary_tokens(memory_state, tokenizer)
+    print(f"Conversation memory: {len(history_messages) - window_start} recent messages + summary of {memory_state.get('summarized_upto', 0)} messages ({history_tokens} tokens).")
+    return history_for_request, history_tokens
+
+# --- 긴 문서 전체 번역/요약 (map-reduce) ---
+@st.cache_resource
+def get_long_document_section_cache():
+    # 세션/재실행에 관계없이 프로세스 전체에서 섹션 결과를 공유
+    return SectionResultCache()
+
+def call_long_document_llm(client_instance, chat_model, instruction, content, caller=None):
+    response = client_instance.chat_completion(
+        "long_document", model=chat_model, caller=caller,
+        messages=[{"role":"system", "content": f"{PROMPT_RULES_CONTENT}\n\n{instruction}"}, {"role":"user", "content": content}],
+        max_tokens=MODEL_MAX_OUTPUT_TOKENS, temperature=CHAT_TEMPERATURE
+    )
+    return response.choices[0].message.content.strip(), response.usage
+
+def execute_long_document_job(job, client_instance, chat_model):
+    # job: {"mode", "file_name", "sections"}. 섹션을 병렬 처리하고 완료되는 대로 순서대로 화면에 출력
+    # 섹션 호출도 사용자/부서 쿼터를 적용받아, 분당 한도에 닿으면 토큰이 다시 찰 때까지 기다리며 진행
+    sections, mode, file_name = job["sections"], job["mode"], job["file_name"]
+    section_total = len(sections)
+    section_cache = get_long_document_section_cache()
+    cache_keys = [make_section_cache_key(mode, chat_model, PROMPT_RULES_CONTENT, s) for s in sections]
+    usage_caller = get_usage_caller(f"long_document_{mode}") # 섹션 작업 스레드에는 세션이 연결되어 있지 않으므로 미리 만듦
+
+    def process_section(section_idx, section_text):
+        instruction = LONG_DOC_MODE_INSTRUCTIONS[mode].format(section_no=section_idx + 1, section_total=section_total, file_name=file_name)
+        return call_long_document_llm(client_instance, chat_model, instruction, section_text, caller=usage_caller)
+
+    progress_bar = st.progress(0.0, text=f"'{file_name}' 섹션 0/{section_total} 처리 중...")
+    output_placeholder = st.empty()
+    section_outputs = {}
+    streamed_parts, cached_count = [], 0
+    for section_idx, result in run_sections_in_order(sections, process_section, cache_keys, section_cache, max_workers=LONG_DOC_MAX_WORKERS):
+        section_outputs[section_idx] = result
+        if result["cached"]: cached_count += 1
+        streamed_parts.append(result["output"] if result["output"] else f"[섹션 {section_idx + 1}/{section_total} 처리 실패]")
+        progress_bar.progress((section_idx + 1) / section_total, text=f"'{file_name}' 섹션 {section_idx + 1}/{section_total} 처리 완료")
+        output_placeholder.text("\n\n".join(streamed_parts))
+
+    failed_sections = [i for i in range(section_total) if not section_outputs.get(i, {}).get("output")]
+    assembled_content = assemble_section_outputs(section_outputs, section_total)
+
+    # 요약 모드는 섹션 요약을 하나로 합치는 reduce 단계를 추가로 수행 (모든 섹션이 성공했을 때만)
+    if mode == LONG_DOC_MODE_SUMMARIZE and section_total > 1 and not failed_sections:
+        reduce_cache_key = make_section_cache_key(f"{mode}:reduce", chat_model, PROMPT_RULES_CONTENT, assembled_content)
+        reduced_content = section_cache.get(reduce_cache_key)
+        if reduced_content is None:
+            try:
+                reduced_content, _ = call_long_document_llm(client_instance, chat_model, LONG_DOC_REDUCE_INSTRUCTION.format(file_name=file_name), assembled_content, caller=usage_caller)
+                if reduced_content: section_cache.put(reduce_cache_key, reduced_content)
+            except Exception as e_reduce:
+                print(f"ERROR during long document reduce step for '{file_name}': {e_reduce}\n{traceback.format_exc()}")
+                reduced_content = None
+        if reduced_content: assembled_content = reduced_content
+
+    progress_bar.empty(); output_placeholder.empty()
+    print(f"Long document job '{mode}' for '{file_name}': {section_total} sections, {cached_count} from cache, {len(failed_sections)} failed.")
+
+    st.session_state.long_doc_last_result = {"file_name": file_name, "mode": mode, "content": assembled_content}
+    st.session_state.long_doc_retry_job = job if failed_sections else None
+    if failed_sections:
+        assembled_content += f"\n\n(총 {section_total}개 섹션 중 {len(failed_sections)}개 섹션 처리에 실패했습니다. '실패한 섹션 다시 시도' 버튼으로 실패한 섹션만 다시 처리할 수 있습니다.)"
+    return assembled_content
 
 # --- 탭 정의 ---
 chat_interface_tab, admin_settings_tab = None, None
@@ -1151,6 +1656,7 @@ else: # 일반 사용자 또는 아직 current_user_info가 없을 경우 (로
 # --- 챗봇 질문 인터페이스 ---
 if chat_interface_tab: # 이 탭이 활성화되었거나, 일반 사용자의 경우 항상 이 블록 실행
     with chat_interface_tab:
+        chat_render_span = start_trace_span("render.chat")
         st.header("업무 질문")
         st.markdown("💡 예시: SOP 백업 주기, PIC/S Annex 11 차이, (파일 첨부 후) 이 사진 속 상황은 어떤 규정에 해당하나요? 등")
 
@@ -1161,6 +1667,25 @@ if chat_interface_tab: # 이 탭이 활성화되었거나, 일반 사용자의 
             bubble_class = "user-bubble" if role == "user" else "assistant-bubble"
             st.markdown(f"""<div class="chat-bubble-container {align_class}"><div class="bubble {bubble_class}">{content}</div><div class="timestamp">{time_str}</div></div>""", unsafe_allow_html=True)
 
+        # 최근 전체 번역/요약 결과 다운로드 및 실패 섹션 재시도
+        long_doc_last_result = st.session_state.get("long_doc_last_result")
+        if long_doc_last_result:
+            long_doc_mode_name = "번역" if long_doc_last_result["mode"] == LONG_DOC_MODE_TRANSLATE else "요약"
+            st.download_button(
+                f"📥 '{long_doc_last_result['file_name']}' 전체 {long_doc_mode_name} 결과 다운로드",
+                data=long_doc_last_result["content"].encode("utf-8"),
+                file_name=f"{os.path.splitext(long_doc_last_result['file_name'])[0]}_{long_doc_last_result['mode']}.txt",
+                mime="text/plain", key="long_doc_download_button"
+            )
+        if st.session_state.get("long_doc_retry_job") and llm_client:
+            if st.button("🔁 실패한 섹션 다시 시도", key="long_doc_retry_button"):
+                retry_job = st.session_state.long_doc_retry_job
+                retry_model = st.secrets.get("AZURE_OPENAI_DEPLOYMENT")
+                with st.spinner(f"'{retry_job['file_name']}' 실패한 섹션 재처리 중..."):
+                    retry_content = execute_long_document_job(retry_job, llm_client, retry_model)
+                st.session_state.current_chat_messages.append({"role":"assistant", "content":retry_content, "time":datetime.now().strftime("%Y-%m-%d %H:%M")})
+                st.rerun()
+
         st.markdown("<div style='height:16px'></div>", unsafe_allow_html=True) 
         
         # 파일 업로더 토글 버튼
@@ -1177,6 +1702,8 @@ if chat_interface_tab: # 이 탭이 활성화되었거나, 일반 사용자의 
             if uploaded_chat_file_runtime: 
                 st.caption(f"첨부됨: {uploaded_chat_file_runtime.name} ({uploaded_chat_file_runtime.type}, {uploaded_chat_file_runtime.size} bytes)")
                 if uploaded_chat_file_runtime.type.startswith("image/"): st.image(uploaded_chat_file_runtime, width=200)
+                else: st.radio("첨부 문서 처리 방식", list(LONG_DOC_MODE_LABELS.keys()), horizontal=True, key="long_doc_mode_choice",
+                               help="전체 번역/요약은 문서를 여러 섹션으로 나누어 병렬 처리하므로 긴 문서도 끝까지 처리됩니다.")
 
         # 채팅 입력 폼
         with st.form("chat_input_form_v7_del", clear_on_submit=True): 
@@ -1185,9 +1712,13 @@ if chat_interface_tab: # 이 탭이 활성화되었거나, 일반 사용자의 
                 user_query_input_form = st.text_input("질문 입력:", placeholder="여기에 질문을 입력하세요...", key="user_query_text_input_v7_del", label_visibility="collapsed") 
             with send_button_col: send_query_button_form = st.form_submit_button("전송")
 
+        chat_render_span.end()
+
         if send_query_button_form and user_query_input_form.strip(): # 전송 버튼 눌리고 내용 있으면
-            if not openai_client or not tokenizer: # 필수 클라이언트/라이브러리 확인
-                st.error("OpenAI 서비스 또는 토크나이저가 준비되지 않아 답변을 생성할 수 없습니다. 관리자에게 문의하세요."); st.stop()
+            if not llm_client or not tokenizer: # 필수 클라이언트/라이브러리 확인
+                st.error("OpenAI 서비스 또는 토크나이저가 준비되지 않아 답변을 생성할 수 없습니다. 관리자에게 문의하세요.")
+                finish_rerun_trace("main", error="LLM client or tokenizer not ready"); st.stop()
+            chat_turn_span = start_trace_span("chat_turn", has_attachment=bool(uploaded_chat_file_runtime))
             
             timestamp_now_str = datetime.now().strftime("%Y-%m-%d %H:%M")
             
@@ -1209,118 +1740,149 @@ if chat_interface_tab: # 이 탭이 활성화되었거나, 일반 사용자의 
             
             with st.spinner("답변 생성 중... 잠시만 기다려주세요."):
                 assistant_response_content = "답변 생성 중 오류가 발생했습니다. 다시 시도해주세요." # 기본 오류 메시지
+                chat_turn_error = None
                 try: 
-                    print("Step 1: Preparing context and calculating tokens...")
                     context_items_for_llm_prompt = [] # LLM 프롬프트에 포함될 컨텍스트 아이템
-                    
-                    # 채팅 시 첨부 파일 처리
-                    text_content_from_chat_file, is_chat_file_image, chat_file_source_display_name = None, False, None
+                    pre_llm_timings = StageTimings()
+                    chat_history_before_query = st.session_state.current_chat_messages[:-1] # 방금 추가한 사용자 메시지는 제외
+
+                    chat_model_deployment_name = st.secrets.get("AZURE_OPENAI_DEPLOYMENT")
+                    if not chat_model_deployment_name:
+                        st.error("채팅 모델 배포 이름('AZURE_OPENAI_DEPLOYMENT')이 secrets에 없습니다."); raise ValueError("Chat model name missing.")
+
+                    is_chat_file_image = False
+                    if uploaded_chat_file_runtime:
+                        is_chat_file_image = os.path.splitext(uploaded_chat_file_runtime.name)[1].lower() in [".png", ".jpg", ".jpeg"]
+
+                    # 전체 번역/요약 요청이면 첨부 문서를 섹션 단위로 map-reduce 처리 (검색/대화 기록 단계 불필요)
+                    long_doc_mode = None
+                    if uploaded_chat_file_runtime and not is_chat_file_image:
+                        long_doc_mode = LONG_DOC_MODE_LABELS.get(st.session_state.get("long_doc_mode_choice", "일반 질문")) or detect_long_document_mode(user_query_input_form)
+
+                    # 자주 묻는 질문이면 미리 만든 답변을 바로 사용 (이전 대화와 첨부 파일이 없는 질문만: 캐시 답변은 대화 맥락 없이 만든 답변)
+                    # 인덱스/규칙/모델이 바뀐 항목은 평소처럼 답한 뒤 갱신
+                    faq_entry, faq_status = None, "miss"
+                    if not uploaded_chat_file_runtime and not chat_history_before_query and container_client:
+                        try:
+                            with trace_span("faq_cache.lookup"):
+                                faq_rules_version = get_prompt_builder(PROMPT_RULES_CONTENT).rules_version
+                                faq_scope, faq_fingerprint = current_faq_scope_and_fingerprint(chat_model_deployment_name, faq_rules_version, get_visible_shard_names())
+                                if faq_scope is not None:
+                                    faq_entry, faq_status = get_faq_cache_cached(container_client).lookup(user_query_input_form, faq_scope, faq_fingerprint)
+                        except Exception as e_faq_lookup:
+                            print(f"ERROR looking up FAQ answer cache: {e_faq_lookup}"); faq_entry, faq_status = None, "miss"
+
+                    def run_plain_query_retrieval():
+                        return search_similar_chunks(user_query_input_form, k_results=RETRIEVAL_K_RESULTS, stage_timings=pre_llm_timings, stage_name="retrieval")
+                    def run_history_preparation():
+                        return prepare_conversation_history_for_request(chat_history_before_query)
+
+                    # 서로 의존하지 않는 단계를 동시에 실행: 첨부 파일 처리(이미지 설명/텍스트 추출), 원 질문 임베딩+검색, 대화 기록 준비
+                    pre_llm_stage_fns = {}
                     if uploaded_chat_file_runtime:
-                        file_extension_chat = os.path.splitext(uploaded_chat_file_runtime.name)[1].lower()
-                        is_chat_file_image = file_extension_chat in [".png", ".jpg", ".jpeg"]
-                        
-                        if is_chat_file_image:
-                            print(f"DEBUG Chat: Processing uploaded image '{uploaded_chat_file_runtime.name}' for description.")
-                            with st.spinner(f"첨부 이미지 '{uploaded_chat_file_runtime.name}' 분석 중..."):
-                                image_bytes = uploaded_chat_file_runtime.getvalue()
-                                description = get_image_description(image_bytes, uploaded_chat_file_runtime.name, openai_client)
-                            if description:
-                                text_content_from_chat_file = description
-                                chat_file_source_display_name = f"사용자 첨부 이미지: {uploaded_chat_file_runtime.name}"
-                                print(f"DEBUG Chat: Image description generated (len: {len(description)}).")
-                            else: st.warning(f"이미지 '{uploaded_chat_file_runtime.name}' 설명을 생성하지 못했습니다.")
-                        else: 
-                            print(f"DEBUG Chat: Extracting text from uploaded file '{uploaded_chat_file_runtime.name}'.")
-                            text_content_from_chat_file = extract_text_from_file(uploaded_chat_file_runtime)
-                            if text_content_from_chat_file: 
-                                chat_file_source_display_name = f"사용자 첨부 파일: {uploaded_chat_file_runtime.name}"
-                                print(f"DEBUG Chat: Text extracted (len: {len(text_content_from_chat_file)}).")
-                            elif text_content_from_chat_file == "": st.info(f"파일 '{uploaded_chat_file_runtime.name}'이 비었거나 내용을 추출할 수 없습니다.")
-                        
-                        if text_content_from_chat_file: 
+                        pre_llm_stage_fns["attachment"] = lambda: process_chat_attachment(uploaded_chat_file_runtime, user_query_input_form, is_chat_file_image, pre_llm_timings, search_with_description=not long_doc_mode)
+                    if not long_doc_mode and faq_status != "hit":
+                        pre_llm_stage_fns["retrieval"] = run_plain_query_retrieval
+                        pre_llm_stage_fns["history"] = run_history_preparation
+                    pre_llm_results = run_concurrent_stages(pre_llm_stage_fns, pre_llm_timings, thread_initializer=get_streamlit_thread_initializer(), propagate_exceptions=USER_FACING_LLM_ERRORS)
+
+                    attachment_result = pre_llm_results.get("attachment", (None, None))[0] or {}
+                    text_content_from_chat_file = attachment_result.get("content")
+                    if uploaded_chat_file_runtime:
+                        if text_content_from_chat_file:
+                            print(f"DEBUG Chat: Attachment '{uploaded_chat_file_runtime.name}' processed (len: {len(text_content_from_chat_file)}).")
                             context_items_for_llm_prompt.append({
-                                "source": chat_file_source_display_name, "content": text_content_from_chat_file, 
+                                "source": attachment_result.get("source"), "content": text_content_from_chat_file, 
                                 "is_image_description": is_chat_file_image
                             })
-                    
-                    # 프롬프트 구성 및 토큰 계산
-                    prompt_template_for_llm = f"{PROMPT_RULES_CONTENT}\n\n다음은 사용자의 질문에 답변하는 데 도움이 되는 문서 내용입니다:\n<문서 시작>\n{{context}}\n<문서 끝>"
-                    base_prompt_tokens = len(tokenizer.encode(prompt_template_for_llm.replace('{context}', '')))
-                    user_query_tokens = len(tokenizer.encode(user_query_input_form))
-                    max_context_tokens_allowed = TARGET_INPUT_TOKENS_FOR_PROMPT - base_prompt_tokens - user_query_tokens
-                    
-                    final_context_string_for_llm = "현재 참고할 수 있는 문서가 없습니다."
-                    if max_context_tokens_allowed > 0:
-                        query_for_vector_db_search = user_query_input_form
-                        if is_chat_file_image and text_content_from_chat_file: # 이미지 설명이 있으면 검색 쿼리에 추가
-                            query_for_vector_db_search = f"{user_query_input_form}\n\n첨부 이미지 내용: {text_content_from_chat_file}"
-                        
-                        retrieved_db_chunks = search_similar_chunks(query_for_vector_db_search, k_results=3)
+                        elif is_chat_file_image: st.warning(f"이미지 '{uploaded_chat_file_runtime.name}' 설명을 생성하지 못했습니다.")
+                        else: st.info(f"파일 '{uploaded_chat_file_runtime.name}'이 비었거나 내용을 추출할 수 없습니다.")
+
+                    if long_doc_mode and not text_content_from_chat_file:
+                        # 문서 내용을 얻지 못했으면 일반 질문으로 처리 (건너뛴 단계를 이어서 실행)
+                        long_doc_mode = None
+                        pre_llm_results.update(run_concurrent_stages({"retrieval": run_plain_query_retrieval, "history": run_history_preparation}, pre_llm_timings, thread_initializer=get_streamlit_thread_initializer(), propagate_exceptions=USER_FACING_LLM_ERRORS))
+                    print(f"Pre-LLM stage timings: {pre_llm_timings.format_summary()}")
+
+                    if faq_status == "hit":
+                        assistant_response_content = format_cached_answer(faq_entry)
+                        print(f"FAQ cache hit for '{user_query_input_form[:50]}' (entry {faq_entry['key']}, generated {faq_entry.get('generated_at')}).")
+                    elif long_doc_mode:
+                        with trace_span("long_document.split"):
+                            long_doc_sections = split_text_into_token_sections(text_content_from_chat_file, tokenizer, LONG_DOC_SECTION_TOKENS)
+                        print(f"Long document '{long_doc_mode}' for '{uploaded_chat_file_runtime.name}' split into {len(long_doc_sections)} sections.")
+                        long_doc_job = {"mode": long_doc_mode, "file_name": uploaded_chat_file_runtime.name, "sections": long_doc_sections}
+                        with trace_span("long_document.job", mode=long_doc_mode, sections=len(long_doc_sections)):
+                            assistant_response_content = execute_long_document_job(long_doc_job, llm_client, chat_model_deployment_name)
+                    else:
+                        # 프롬프트 구성 및 토큰 계산 (정적 규칙의 토큰 수는 캐시, 청크 토큰 수는 메타데이터 값 사용)
+                        prompt_builder = get_prompt_builder(PROMPT_RULES_CONTENT)
+                        conversation_history_messages, history_tokens = pre_llm_results.get("history", (None, None))[0] or ([], 0)
+                        # 이미지 설명을 포함한 검색 결과를 앞에 두고 원 질문 검색 결과를 뒤에 (중복은 프롬프트 조립 시 제거)
+                        retrieved_db_chunks = (attachment_result.get("retrieved_chunks") or []) + (pre_llm_results.get("retrieval", (None, None))[0] or [])
                         if retrieved_db_chunks: context_items_for_llm_prompt.extend(retrieved_db_chunks)
-                        
-                        if context_items_for_llm_prompt:
-                            unique_contents_seen = set()
-                            formatted_context_segments = []
-                            for item in context_items_for_llm_prompt:
-                                content_segment = item.get("content","").strip()
-                                if content_segment and content_segment not in unique_contents_seen:
-                                    source_name = item.get('source','알 수 없음').replace("사용자 첨부 이미지: ","").replace("사용자 첨부 파일: ","")
-                                    prefix = "[이미지 설명: " if item.get("is_image_description") else "[출처 문서: "
-                                    formatted_context_segments.append(f"{prefix}{source_name}]\n{content_segment}")
-                                    unique_contents_seen.add(content_segment)
-                            
-                            if formatted_context_segments:
-                                combined_context_str = "\n\n---\n\n".join(formatted_context_segments)
-                                encoded_combined_context = tokenizer.encode(combined_context_str)
-                                if len(encoded_combined_context) > max_context_tokens_allowed:
-                                    truncated_tokens_for_context = encoded_combined_context[:max_context_tokens_allowed]
-                                    final_context_string_for_llm = tokenizer.decode(truncated_tokens_for_context)
-                                    if len(encoded_combined_context) > len(truncated_tokens_for_context):
-                                        final_context_string_for_llm += "\n(...문서 내용이 길어 일부 잘렸을 수 있습니다.)"
-                                else: final_context_string_for_llm = combined_context_str
-                    
-                    system_prompt_final = prompt_template_for_llm.replace('{context}', final_context_string_for_llm)
-                    total_input_tokens = len(tokenizer.encode(system_prompt_final)) + user_query_tokens
-                    if total_input_tokens > MODEL_MAX_INPUT_TOKENS: 
-                        print(f"CRITICAL WARNING: Total input tokens ({total_input_tokens}) exceed model max ({MODEL_MAX_INPUT_TOKENS})!")
-                    
-                    api_messages_to_send = [{"role":"system", "content": system_prompt_final}, {"role":"user", "content": user_query_input_form}]
-                    print("Step 2: Sending request to Azure OpenAI for chat completion...")
+
+                        with trace_span("prompt.build"): # 토큰 계산 포함
+                            api_messages_to_send, prompt_stats = prompt_builder.build(
+                                user_query_input_form, context_items_for_llm_prompt,
+                                history_messages=conversation_history_messages, history_tokens=history_tokens,
+                                max_input_tokens=TARGET_INPUT_TOKENS_FOR_PROMPT
+                            )
+                        total_input_tokens = prompt_stats["total_input_tokens"]
+                        print(f"Prompt assembled in {prompt_stats['assembly_ms']} ms (rules {prompt_stats['rules_version']}): static {prompt_stats['static_prefix_tokens']}, history {history_tokens}, context {prompt_stats['context_tokens']}, query {prompt_stats['query_tokens']} tokens.")
+                        if total_input_tokens > MODEL_MAX_INPUT_TOKENS: 
+                            print(f"CRITICAL WARNING: Total input tokens ({total_input_tokens}) exceed model max ({MODEL_MAX_INPUT_TOKENS})!")
                     
-                    chat_model_deployment_name = st.secrets.get("AZURE_OPENAI_DEPLOYMENT")
-                    if not chat_model_deployment_name:
-                        st.error("채팅 모델 배포 이름('AZURE_OPENAI_DEPLOYMENT')이 secrets에 없습니다."); raise ValueError("Chat model name missing.")
-                        
-                    chat_completion_result = openai_client.chat.completions.create(
-                        model=chat_model_deployment_name, messages=api_messages_to_send,
-                        max_tokens=MODEL_MAX_OUTPUT_TOKENS, temperature=0.1, timeout=AZURE_OPENAI_TIMEOUT
-                    )
-                    assistant_response_content = chat_completion_result.choices[0].message.content.strip()
-                    print("Azure OpenAI response received.")
-
-                    if chat_completion_result.usage and container_client:
-                        log_openai_api_usage_to_blob(user_name_for_log, chat_model_deployment_name, chat_completion_result.usage, container_client, request_type="chat_completion_with_rag")
+                        queue_status_placeholder = st.empty() # 다른 요청이 많아 대기열에서 기다리는 동안 대기 순번 표시
+                        def show_queue_position(requests_ahead, queue_length):
+                            queue_status_placeholder.info(f"요청이 많아 순서를 기다리고 있습니다. 앞에 {requests_ahead}건이 대기 중입니다 (전체 대기 {queue_length}건).")
+                        with trace_span("llm.chat_completion", model=chat_model_deployment_name, input_tokens=total_input_tokens):
+                            try:
+                                chat_completion_result = llm_client.chat_completion(
+                                    "chat", model=chat_model_deployment_name, caller=get_usage_caller("chat_completion_with_rag"), messages=api_messages_to_send,
+                                    max_tokens=MODEL_MAX_OUTPUT_TOKENS, temperature=CHAT_TEMPERATURE, input_tokens=total_input_tokens, on_queue_wait=show_queue_position
+                                )
+                            finally: queue_status_placeholder.empty()
+                        assistant_response_content = chat_completion_result.choices[0].message.content.strip()
+                        print("Azure OpenAI response received.") # 사용량은 llm_client의 usage_meter가 기록
+                        if faq_status == "stale": # 이전 대화/첨부 파일이 없는 질문이라 캐시 답변과 같은 조건의 답변
+                            refresh_faq_answer_in_background(faq_entry, assistant_response_content, retrieved_db_chunks, chat_model_deployment_name, prompt_builder.rules_version)
                 
+                except QuotaExceededError as quota_err:
+                    quota_owner_label = "부서" if quota_err.scope == QUOTA_SCOPE_DEPARTMENT else "사용자"
+                    if quota_err.period == QUOTA_PERIOD_DAY:
+                        assistant_response_content = f"오늘의 {quota_owner_label} 토큰 사용 한도를 모두 사용했습니다. 내일 다시 시도하거나 관리자에게 문의해주세요."
+                    else:
+                        assistant_response_content = f"{quota_owner_label} 분당 토큰 사용 한도를 초과했습니다. 약 {int(quota_err.retry_after_seconds or 0) + 1}초 후 다시 시도해주세요."
+                    st.warning(assistant_response_content)
+                    print(f"QUOTA EXCEEDED during response generation: {quota_err}"); chat_turn_error = quota_err
+                except LLMQueueFullError as queue_err:
+                    assistant_response_content = "현재 요청이 많아 답변을 시작하지 못했습니다. 잠시 후 다시 시도해주세요."
+                    st.warning(assistant_response_content)
+                    print(f"LLM QUEUE TIMEOUT during response generation: {queue_err}"); chat_turn_error = queue_err
+                except LLMUnavailableError as llm_err:
+                    assistant_response_content = "AI 서비스 응답이 지연되거나 일시적으로 사용할 수 없습니다. 잠시 후 다시 시도해주세요."
+                    st.error(assistant_response_content)
+                    print(f"LLM UNAVAILABLE during response generation: {llm_err}"); chat_turn_error = llm_err
                 except Exception as gen_err: 
                     assistant_response_content = f"답변 생성 중 예상치 못한 오류 발생: {gen_err}."
                     st.error(assistant_response_content) # UI에 오류 표시
-                    print(f"UNEXPECTED ERROR during response generation: {gen_err}\n{traceback.format_exc()}")
+                    print(f"UNEXPECTED ERROR during response generation: {gen_err}\n{traceback.format_exc()}"); chat_turn_error = gen_err
 
             st.session_state.current_chat_messages.append({"role":"assistant", "content":assistant_response_content, "time":timestamp_now_str})
-            # 답변 후 현재 대화가 새 대화였으면 ID를 부여하고 저장할 준비 (실제 저장은 컨텍스트 전환 시)
-            if st.session_state.active_conversation_id is None and st.session_state.current_chat_messages:
-                # archive_current_chat_session_if_needed() 함수가 호출될 때 새 ID가 할당되고 저장됨.
-                # 사용자가 메시지를 계속 보내는 동안은 active_id는 None으로 유지될 수 있으며,
-                # 새 대화 시작 / 다른 대화 로드 / 로그아웃 시 아카이브 함수가 호출되면서 ID가 부여되고 저장됨.
-                # 만약, 첫 응답 직후 바로 all_user_conversations에 반영하고 싶다면 여기서 archive 함수 호출 필요.
-                # 지금은 archive 함수가 컨텍스트 전환 시점에 호출되도록 되어 있으므로, 여기서는 특별한 처리 안함.
-                pass
+            # 답변마다 자동 저장 예약 (새 대화면 여기서 ID 부여). 저장은 백그라운드에서 새 메시지만 덧붙이므로 답변 지연 없음
+            try: schedule_active_conversation_autosave()
+            except Exception as e_autosave: print(f"ERROR scheduling conversation autosave: {e_autosave}\n{traceback.format_exc()}")
+            chat_turn_span.end(error=chat_turn_error)
+            finish_rerun_trace("main", always_record=True)
             
             print("Response processing complete. Triggering rerun to display new messages."); st.rerun()
 
 # --- 관리자 설정 탭 ---
 if admin_settings_tab: # admin_settings_tab이 None이 아니고, 현재 활성화된 탭일 때 (st.tabs 사용 시 자동 처리)
     with admin_settings_tab:
+        admin_render_span = start_trace_span("render.admin")
+        pd = lazy_import("pandas") # 관리자 화면의 표/차트용
         st.header("⚙️ 관리자 설정")
         # 가입 승인 대기자
         st.subheader("👥 가입 승인 대기자")
@@ -1332,22 +1894,54 @@ if admin_settings_tab: # admin_settings_tab이 None이 아니고, 현재 활성
                     with st.expander(f"{pending_data.get('name','N/A')} ({pending_uid}) - {pending_data.get('department','N/A')}"):
                         approve_col, reject_col = st.columns(2)
                         if approve_col.button("승인", key=f"admin_approve_user_v7_{pending_uid}"): 
-                            USERS[pending_uid]["approved"] = True
-                            if save_data_to_blob(USERS, USERS_BLOB_NAME, container_client, "user info (approval)"):
-                                st.success(f"사용자 '{pending_uid}' 승인 완료."); st.rerun()
+                            def approve_user(users_data, uid=pending_uid):
+                                if uid in users_data: users_data[uid]["approved"] = True
+                                return users_data
+                            updated_users = update_data_in_blob(USERS_BLOB_NAME, container_client, approve_user, "user info (approval)", default_value={})
+                            if updated_users is not None:
+                                USERS = updated_users; st.success(f"사용자 '{pending_uid}' 승인 완료."); st.rerun()
                             else: st.error("사용자 승인 정보 저장 실패.")
                         if reject_col.button("거절", key=f"admin_reject_user_v7_{pending_uid}"): 
-                            USERS.pop(pending_uid, None)
-                            if save_data_to_blob(USERS, USERS_BLOB_NAME, container_client, "user info (rejection)"):
-                                st.info(f"사용자 '{pending_uid}' 거절 처리 완료."); st.rerun()
+                            def reject_user(users_data, uid=pending_uid):
+                                users_data.pop(uid, None); return users_data
+                            updated_users = update_data_in_blob(USERS_BLOB_NAME, container_client, reject_user, "user info (rejection)", default_value={})
+                            if updated_users is not None:
+                                USERS = updated_users; st.info(f"사용자 '{pending_uid}' 거절 처리 완료."); st.rerun()
                             else: st.error("사용자 거절 정보 저장 실패.")
             else: st.info("승인 대기 중인 사용자가 없습니다.")
         st.markdown("---")
 
         # 파일 업로드 및 학습
         st.subheader("📁 파일 업로드 및 학습 (Azure Blob Storage)")
+        if retrieval_client:
+            try:
+                service_health = retrieval_client.health()
+                st.caption(f"검색 서비스 사용 중 ({retrieval_client.service_url}) · 학습된 청크 {service_health.get('ntotal', 0):,}개")
+            except RetrievalServiceError as e_service_health:
+                st.warning(f"검색 서비스에 연결할 수 없습니다: {e_service_health}")
+        if container_client:
+            # 임베딩 모델 전환(embedding_migration.py) 진행 상황
+            try: migration_state = load_migration_state(container_client)
+            except Exception as e_migration_state: migration_state = None; print(f"ERROR loading embedding migration state: {e_migration_state}")
+            if migration_state and migration_state.get("status") != "completed":
+                migrated_chunks, source_chunks = migration_progress(migration_state)
+                st.caption(f"임베딩 모델 전환 {migration_state.get('status')}: {migration_state['source'].get('embedding_model')} → "
+                           f"{migration_state['target'].get('embedding_model')} · {migrated_chunks:,}/{source_chunks:,} 청크 (갱신 {migration_state.get('updated_at')})")
+                st.progress(min(1.0, migrated_chunks / source_chunks) if source_chunks else 0.0)
+                if migration_state.get("error"): st.warning(f"전환 중단됨: {migration_state['error']} (embedding_migration.py resume으로 이어서 진행)")
+            # 자주 묻는 질문 답변 캐시 (faq_cache.py) 사용 현황 (이 프로세스 기준)
+            faq_cache_stats = get_faq_cache_cached(container_client).snapshot()
+            if faq_cache_stats["entries"] or faq_cache_stats["hits"]:
+                st.caption(f"FAQ 답변 캐시 {faq_cache_stats['entries']}개 · 바로 답변 {faq_cache_stats['hits']}회, 인덱스 변경으로 재생성 {faq_cache_stats['stale']}회 "
+                           f"(갱신 {faq_cache_stats['refreshed']}회), 미적중 {faq_cache_stats['misses']}회")
         if 'processed_admin_file_info' not in st.session_state: st.session_state.processed_admin_file_info = None
         def clear_processed_admin_file_info_callback(): st.session_state.processed_admin_file_info = None
+        # 학습 대상 샤드: 공통(모든 사용자 검색) 또는 부서/컬렉션 (해당 부서 사용자와 관리자만 검색)
+        known_shard_names = vector_store.shard_names() if vector_store else []
+        department_shard_names = {department_shard_name(user_data.get("department")) for user_data in USERS.values() if isinstance(user_data, dict)} - {None}
+        learning_shard_options = list(dict.fromkeys([COMMON_SHARD_NAME] + sorted(department_shard_names) + known_shard_names))
+        learning_shard_name = st.selectbox("학습 대상 검색 범위", learning_shard_options, key="admin_learning_shard",
+                                           format_func=lambda shard_name: "공통 (모든 사용자)" if shard_name == COMMON_SHARD_NAME else f"{shard_name} 전용")
         
         admin_uploaded_file_widget = st.file_uploader(
             "학습할 파일 업로드 (PDF, DOCX, XLSX, CSV, PPTX, TXT, PNG, JPG, JPEG)",
@@ -1367,32 +1961,39 @@ if admin_settings_tab: # admin_settings_tab이 None이 아니고, 현재 활성
                     content_to_learn, is_description_for_learning = None, False
 
                     if is_admin_upload_image:
-                        with st.spinner(f"이미지 '{admin_uploaded_file_widget.name}' 처리 및 설명 생성 중..."):
+                        with st.spinner(f"이미지 '{admin_uploaded_file_widget.name}' 처리 및 설명 생성 중..."), trace_span("admin_upload.image_description"):
                             admin_img_bytes = admin_uploaded_file_widget.getvalue()
-                            admin_img_description = get_image_description(admin_img_bytes, admin_uploaded_file_widget.name, openai_client)
+                            admin_img_description = get_image_description(admin_img_bytes, admin_uploaded_file_widget.name, llm_client, caller=get_usage_caller("document_image_description", enforce_quota=False))
                         if admin_img_description:
                             content_to_learn = admin_img_description; is_description_for_learning = True
                             st.info(f"이미지 '{admin_uploaded_file_widget.name}' 설명 생성 (길이: {len(admin_img_description)}). 이 설명이 학습됩니다.")
                             st.text_area("생성된 이미지 설명 (학습용)", admin_img_description, height=150, disabled=True)
                         else: st.error(f"이미지 '{admin_uploaded_file_widget.name}' 설명 생성 실패. 학습 제외.")
                     else: 
-                        with st.spinner(f"'{admin_uploaded_file_widget.name}'에서 텍스트 추출 중..."):
+                        with st.spinner(f"'{admin_uploaded_file_widget.name}'에서 텍스트 추출 중..."), trace_span("admin_upload.text_extraction", extension=file_ext_admin_ul):
                             content_to_learn = extract_text_from_file(admin_uploaded_file_widget)
                         if content_to_learn: st.info(f"'{admin_uploaded_file_widget.name}' 텍스트 추출 (길이: {len(content_to_learn)}).")
                         else: st.warning(f"'{admin_uploaded_file_widget.name}' 내용 추출 불가 또는 비어있음. 학습 제외.")
                     
                     if content_to_learn: 
                         with st.spinner(f"'{admin_uploaded_file_widget.name}' 내용 처리 및 학습 중..."):
-                            chunks_for_learning = chunk_text_into_pieces(content_to_learn)
+                            if not is_description_for_learning: # 페이지마다 반복되는 머리말/꼬리말 제거 후 분할
+                                content_to_learn, header_footer_stats = strip_repeated_page_lines(content_to_learn)
+                                if header_footer_stats["lines_removed"]:
+                                    st.caption(f"페이지 {header_footer_stats['pages']}개에서 반복되는 머리말/꼬리말 {header_footer_stats['lines_removed']}줄 "
+                                               f"({header_footer_stats['chars_removed']:,}자) 제거.")
+                            with trace_span("admin_upload.chunking"): chunks_for_learning = chunk_text_into_pieces(content_to_learn)
                             if chunks_for_learning:
                                 original_blob_path = save_original_file_to_blob(admin_uploaded_file_widget, container_client)
                                 if original_blob_path: st.caption(f"원본 파일 '{admin_uploaded_file_widget.name}' Blob 저장: '{original_blob_path}'.")
                                 else: st.warning(f"원본 파일 '{admin_uploaded_file_widget.name}' Blob 저장 실패.")
 
-                                if add_document_to_vector_db_and_blob(admin_uploaded_file_widget, content_to_learn, chunks_for_learning, container_client, is_image_description=is_description_for_learning):
+                                with trace_span("admin_upload.learn", chunks=len(chunks_for_learning)):
+                                    learned_successfully = add_document_to_vector_db_and_blob(admin_uploaded_file_widget, content_to_learn, chunks_for_learning, container_client, is_image_description=is_description_for_learning, shard_name=learning_shard_name)
+                                if learned_successfully:
                                     st.success(f"파일 '{admin_uploaded_file_widget.name}' 학습 및 Azure Blob Storage 업데이트 완료!")
                                     st.session_state.processed_admin_file_info = current_admin_file_details 
-                                    st.rerun() 
+                                    finish_rerun_trace("main", always_record=True); st.rerun() 
                                 else: st.error(f"'{admin_uploaded_file_widget.name}' 학습 또는 Blob 업데이트 중 오류."); st.session_state.processed_admin_file_info = None 
                             else: st.warning(f"'{admin_uploaded_file_widget.name}'에 대한 학습 청크 생성 안됨."); st.session_state.processed_admin_file_info = None
                 except Exception as e_admin_file_main_proc:
@@ -1405,51 +2006,172 @@ if admin_settings_tab: # admin_settings_tab이 None이 아니고, 현재 활성
             st.error("파일 업로드 및 학습 불가: Azure Blob 클라이언트가 준비되지 않았습니다.")
         st.markdown("---")
 
-        # API 사용량 모니터링
+        # API 사용량 모니터링 (사전 집계 + 최근 원본 로그 페이지)
         st.subheader("📊 API 사용량 모니터링 (Blob 로그 기반)")
         if container_client:
-            usage_data_list = load_data_from_blob(USAGE_LOG_BLOB_NAME, container_client, "API usage log", default_value=[])
-            if usage_data_list and isinstance(usage_data_list, list) and len(usage_data_list) > 0 :
-                df_usage = pd.DataFrame(usage_data_list)
-                for col_token in ["total_tokens", "prompt_tokens", "completion_tokens"]: 
-                    df_usage[col_token] = pd.to_numeric(df_usage.get(col_token, 0), errors='coerce').fillna(0)
-                if "request_type" not in df_usage.columns: df_usage["request_type"] = "unknown"
-                
-                total_tokens_all = df_usage["total_tokens"].sum()
-                st.metric("총 API 호출 수", len(df_usage))
-                st.metric("총 사용 토큰 수", f"{int(total_tokens_all):,}")
-
-                token_cost_config = 0.0
-                try: token_cost_config = float(st.secrets.get("TOKEN_COST","0.0"))
-                except (ValueError, TypeError): pass 
-                st.metric("예상 비용 (USD)", f"${total_tokens_all * token_cost_config:.4f}") 
-
-                if "timestamp" in df_usage.columns:
-                    try: 
-                         df_usage['timestamp'] = pd.to_datetime(df_usage['timestamp'])
-                         st.dataframe(df_usage.sort_values(by="timestamp",ascending=False), use_container_width=True, hide_index=True)
-                    except Exception as e_sort_usage_df:
-                         print(f"Warning: Could not sort usage log by timestamp: {e_sort_usage_df}")
-                         st.dataframe(df_usage, use_container_width=True, hide_index=True) 
-                else: st.dataframe(df_usage, use_container_width=True, hide_index=True)
-            else: st.info("Blob에 기록된 API 사용량 데이터가 없거나 비어있습니다.")
+            rollup_store = get_usage_rollup_store_cached(container_client)
+            token_cost_config = 0.0
+            try: token_cost_config = float(st.secrets.get("TOKEN_COST","0.0"))
+            except (ValueError, TypeError): pass 
+
+            try: totals_by_key, totals_updated_at = rollup_store.load_totals()
+            except Exception as e_read_totals:
+                print(f"ERROR reading usage totals rollup: {e_read_totals}\n{traceback.format_exc()}"); totals_by_key, totals_updated_at = {}, None
+            total_calls_all = sum(m.get("calls", 0) for m in totals_by_key.values())
+            total_tokens_all = sum(m.get("total_tokens", 0) for m in totals_by_key.values())
+            col_metric_calls, col_metric_tokens, col_metric_cost = st.columns(3)
+            col_metric_calls.metric("총 API 호출 수", f"{total_calls_all:,}")
+            col_metric_tokens.metric("총 사용 토큰 수", f"{int(total_tokens_all):,}")
+            col_metric_cost.metric("예상 비용 (USD)", f"${total_tokens_all * token_cost_config:.4f}") 
+            if totals_updated_at: st.caption(f"집계 갱신 시각: {totals_updated_at} (새 사용량은 약 {LOG_FLUSH_INTERVAL_SECONDS:g}초 주기로 반영)")
+
+            today_date = datetime.now().date()
+            usage_date_range = st.date_input("조회 기간", value=(today_date - timedelta(days=6), today_date), max_value=today_date, key="usage_date_range")
+            if isinstance(usage_date_range, (list, tuple)) and len(usage_date_range) == 2: range_start, range_end = usage_date_range
+            else: range_start = range_end = usage_date_range[0] if isinstance(usage_date_range, (list, tuple)) and usage_date_range else today_date
+            usage_group_labels = {"user_id": "사용자", "model_name": "모델", "request_type": "요청 유형"}
+            usage_group_by = st.selectbox("집계 기준", list(usage_group_labels.keys()), format_func=lambda k: usage_group_labels[k], key="usage_group_by")
+
+            try: daily_rows = rollup_store.load_daily_rows(range_start, range_end)
+            except Exception as e_read_daily:
+                print(f"ERROR reading daily usage rollups: {e_read_daily}\n{traceback.format_exc()}"); daily_rows = []
+            if daily_rows:
+                df_daily = pd.DataFrame(daily_rows)
+                range_tokens = int(df_daily["total_tokens"].sum())
+                st.write(f"**기간 합계:** 호출 {int(df_daily['calls'].sum()):,}회 / 토큰 {range_tokens:,} / 예상 비용 ${range_tokens * token_cost_config:.4f}")
+                st.bar_chart(df_daily.pivot_table(index="date", columns=usage_group_by, values="total_tokens", aggfunc="sum", fill_value=0))
+                df_grouped = df_daily.groupby(usage_group_by, as_index=False)[["calls", "prompt_tokens", "completion_tokens", "total_tokens"]].sum()
+                st.dataframe(df_grouped.sort_values(by="total_tokens", ascending=False), use_container_width=True, hide_index=True)
+                if range_start == range_end:
+                    try: hourly_rows = rollup_store.load_hourly_rows(range_start)
+                    except Exception as e_read_hourly:
+                        print(f"ERROR reading hourly usage rollup: {e_read_hourly}"); hourly_rows = []
+                    if hourly_rows:
+                        st.caption("시간대별 토큰 사용량")
+                        st.bar_chart(pd.DataFrame(hourly_rows).pivot_table(index="hour", columns=usage_group_by, values="total_tokens", aggfunc="sum", fill_value=0))
+            else: st.info("선택한 기간에 집계된 API 사용량 데이터가 없습니다.")
+
+            with st.expander("최근 API 호출 기록 (원본 로그)"):
+                usage_page = st.session_state.get("usage_recent_page", 0)
+                try: recent_entries, has_next_page = read_recent_log_entries(container_client, USAGE_LOG_PREFIX, page=usage_page, page_size=USAGE_RECENT_PAGE_SIZE)
+                except Exception as e_read_recent:
+                    print(f"ERROR reading recent usage log entries: {e_read_recent}\n{traceback.format_exc()}"); recent_entries, has_next_page = [], False
+                if recent_entries: st.dataframe(pd.DataFrame(recent_entries), use_container_width=True, hide_index=True)
+                else: st.info("최근 API 호출 기록이 없습니다.")
+                col_page_prev, col_page_label, col_page_next = st.columns([1, 2, 1])
+                if col_page_prev.button("◀ 이전", disabled=usage_page == 0, key="usage_page_prev"):
+                    st.session_state.usage_recent_page = usage_page - 1; st.rerun()
+                col_page_label.caption(f"{usage_page + 1} 페이지 (페이지당 {USAGE_RECENT_PAGE_SIZE}건, 최신순)")
+                if col_page_next.button("다음 ▶", disabled=not has_next_page, key="usage_page_next"):
+                    st.session_state.usage_recent_page = usage_page + 1; st.rerun()
+
+            if st.button("🔄 전체 로그로 사용량 집계 다시 만들기", key="rebuild_usage_rollups", help="이전 형식(단일 JSON) 로그 이관 또는 집계 불일치 복구 시 사용. 전체 로그를 읽으므로 시간이 걸릴 수 있습니다."):
+                with st.spinner("전체 사용량 로그로 집계 재생성 중..."):
+                    try:
+                        rebuilt_count = rollup_store.rebuild(read_log_stream(container_client, USAGE_LOG_PREFIX, legacy_blob_name=USAGE_LOG_BLOB_NAME))
+                        st.success(f"사용량 집계를 다시 만들었습니다 ({rebuilt_count:,}건)."); st.rerun()
+                    except Exception as e_rebuild:
+                        st.error(f"사용량 집계 재생성 중 오류: {e_rebuild}")
+                        print(f"ERROR rebuilding usage rollups: {e_rebuild}\n{traceback.format_exc()}")
         else: st.warning("API 사용량 모니터링 표시 불가: Azure Blob 클라이언트가 준비되지 않았습니다.")
         st.markdown("---")
 
-        # Azure Blob Storage 파일 목록
-        st.subheader("📂 Azure Blob Storage 파일 목록 (최근 100개)")
+        # 사용자/부서별 토큰 쿼터 현황 (이 프로세스 기준)
+        st.subheader("🎫 토큰 쿼터 현황")
+        quota_limiter = get_token_quota_limiter_cached()
+        quota_scope_labels, quota_period_labels = {QUOTA_SCOPE_USER: "사용자", QUOTA_SCOPE_DEPARTMENT: "부서"}, {QUOTA_PERIOD_MINUTE: "분당", QUOTA_PERIOD_DAY: "일일"}
+        st.caption(" / ".join(f"{quota_scope_labels[scope]} {quota_period_labels[period]}: {f'{limit:,} 토큰' if limit else '제한 없음'}" for (scope, period), limit in quota_limiter.limits.items()))
+        if not quota_limiter.enabled: st.info("설정된 토큰 쿼터가 없습니다. secrets에 QUOTA_USER_TOKENS_PER_MINUTE 등을 설정하면 적용됩니다.")
+        else:
+            quota_rows = quota_limiter.snapshot()
+            if quota_rows: st.dataframe(pd.DataFrame(quota_rows).rename(columns={"scope": "범위", "key": "대상", "minute_tokens_available": "분당 잔여", "minute_limit": "분당 한도", "today_tokens": "오늘 사용", "daily_limit": "일일 한도"}), use_container_width=True, hide_index=True)
+            else: st.info("아직 쿼터가 적용된 호출이 없습니다.")
+        scheduler_state = get_llm_scheduler_cached().snapshot()
+        st.caption(f"모델 호출 대기열: 실행 중 {scheduler_state['running']}/{scheduler_state['max_concurrent_requests']}건 · 대기 {scheduler_state['waiting']}건 · "
+                   f"진행 중 토큰 {scheduler_state['inflight_tokens']:,} · 평균 대기 {scheduler_state['avg_wait_seconds']}초 · 대기 시간 초과 {scheduler_state['timeouts']}건")
+        if scheduler_state["waiting_by_user"]:
+            st.dataframe(pd.DataFrame([{"사용자": user_key, "대기 요청": waiting_count} for user_key, waiting_count in scheduler_state["waiting_by_user"].items()]), use_container_width=True, hide_index=True)
+        st.markdown("---")
+
+        # 단계별 처리 시간 (rerun 추적 기반 백분위, 느린 요청 상세)
+        st.subheader("🧭 단계별 처리 시간")
+        if container_client:
+            trace_view_days = st.selectbox("조회 기간", TRACE_VIEW_DAY_OPTIONS, format_func=lambda days: f"최근 {days}일", key="trace_view_days")
+            trace_since_day = (datetime.now() - timedelta(days=trace_view_days - 1)).strftime("%Y-%m-%d")
+            try:
+                trace_records = load_trace_records_cached(TRACES_LOG_PREFIX, trace_since_day)
+                span_summary_rows = summarize_span_durations(trace_records)
+                if span_summary_rows:
+                    st.caption(f"실행(rerun) {len(trace_records):,}건 기준 (채팅 답변/관리자 작업 전체, 그 밖의 실행은 {TRACE_SAMPLE_RATE:.0%} 표본) · {TRACE_VIEW_CACHE_TTL_SECONDS}초마다 갱신")
+                    st.dataframe(pd.DataFrame(span_summary_rows).rename(columns={"name": "단계", "count": "횟수", "p50_ms": "p50 (ms)", "p95_ms": "p95 (ms)", "p99_ms": "p99 (ms)", "max_ms": "최대 (ms)"}), use_container_width=True, hide_index=True)
+                else: st.info("기록된 추적 정보가 없습니다.")
+
+                with st.expander(f"느린 요청 ({SLOW_TRACE_THRESHOLD_MS / 1000:.0f}초 이상)"):
+                    slow_trace_records = sorted(load_trace_records_cached(SLOW_TRACES_LOG_PREFIX, trace_since_day), key=lambda record: record.get("timestamp", ""), reverse=True)[:SLOW_TRACE_VIEW_LIMIT]
+                    if slow_trace_records:
+                        st.dataframe(pd.DataFrame([{
+                            "시각": record.get("timestamp"), "소요 (ms)": record.get("duration_ms"), "사용자": (record.get("attributes") or {}).get("user_id"),
+                            "주요 단계": ", ".join(span.get("name", "") for span in sorted(record.get("spans") or [], key=lambda span: span.get("duration_ms", 0), reverse=True)[1:4])
+                        } for record in slow_trace_records]), use_container_width=True, hide_index=True)
+                        selected_slow_index = st.selectbox("상세 보기", range(len(slow_trace_records)), key="slow_trace_selected",
+                                                           format_func=lambda i: f"{slow_trace_records[i].get('timestamp')} · {slow_trace_records[i].get('duration_ms', 0):,.0f}ms · {(slow_trace_records[i].get('attributes') or {}).get('user_id') or '-'}")
+                        st.dataframe(pd.DataFrame([{
+                            "단계": f"{'· ' * depth}{span.get('name')}", "시작 (ms)": span.get("start_ms"), "소요 (ms)": span.get("duration_ms"),
+                            "상태": span.get("status"), "스레드": span.get("thread"), "속성": json.dumps(span.get("attributes") or {}, ensure_ascii=False)
+                        } for depth, span in iter_trace_spans(slow_trace_records[selected_slow_index])]), use_container_width=True, hide_index=True)
+                    else: st.info("느린 요청이 없습니다.")
+            except Exception as e_traces:
+                st.error(f"추적 정보 조회 중 오류: {e_traces}")
+                print(f"ERROR loading trace records: {e_traces}\n{traceback.format_exc()}")
+        else: st.warning("단계별 처리 시간 표시 불가: Azure Blob 클라이언트가 준비되지 않았습니다.")
+        st.markdown("---")
+
+        # 앱 시작(콜드 스타트) 시간 측정 결과
+        st.subheader("⏱️ 앱 시작 시간 측정")
+        st.caption("모듈 불러오기(import)와 초기화(init)에 걸린 시간입니다. 이 프로세스에서 처음 한 번 측정한 값이며, 'at'은 프로세스 시작 후 경과 시간입니다.")
+        warmup_status = get_startup_warmup_cached(container_client).status()
+        if warmup_status: st.caption("백그라운드 준비 상태: " + ", ".join(f"{name} {status}" for name, status in warmup_status.items()))
+        startup_rows = STARTUP_TIMINGS.rows()
+        if startup_rows:
+            st.dataframe(pd.DataFrame(startup_rows).rename(columns={"kind": "종류", "name": "항목", "elapsed_ms": "소요 (ms)", "started_at_ms": "at (ms)", "thread": "스레드"}), use_container_width=True, hide_index=True)
+        else: st.info("측정된 항목이 없습니다.")
+        st.markdown("---")
+
+        # Azure Blob Storage 파일 목록 (경로별 페이지 조회 / 변경 기록 기반 최신순)
+        st.subheader("📂 Azure Blob Storage 파일 목록")
         if container_client:
+            blob_view_mode = st.radio("보기", ["최근 변경", "경로별 탐색"], horizontal=True, key="blob_browser_view_mode")
             try:
-                blob_display_list = []
-                blob_items_sorted = sorted(container_client.list_blobs(), key=lambda b: b.last_modified, reverse=True)
-                for count_blob, blob_item_data in enumerate(blob_items_sorted):
-                    if count_blob >= 100: break
-                    blob_display_list.append({
-                        "파일명": blob_item_data.name, "크기 (bytes)": blob_item_data.size,
-                        "수정일": blob_item_data.last_modified.strftime('%Y-%m-%d %H:%M:%S') if blob_item_data.last_modified else 'N/A'
-                    })
-                if blob_display_list: st.dataframe(pd.DataFrame(blob_display_list), use_container_width=True, hide_index=True)
-                else: st.info("Azure Blob Storage에 파일이 없습니다.")
+                if blob_view_mode == "최근 변경":
+                    changes_page = st.session_state.get("blob_changes_page", 0)
+                    recent_changes, has_more_changes = read_recent_log_entries(container_client, CHANGES_LOG_PREFIX, page=changes_page, page_size=BLOB_BROWSER_PAGE_SIZE)
+                    if recent_changes:
+                        st.dataframe(pd.DataFrame(recent_changes).rename(columns={"timestamp": "시각", "blob": "파일명", "action": "작업", "size": "크기 (bytes)"}), use_container_width=True, hide_index=True)
+                    else: st.info("최근 변경 기록이 없습니다.")
+                    col_changes_prev, col_changes_label, col_changes_next = st.columns([1, 2, 1])
+                    if col_changes_prev.button("◀ 이전", disabled=changes_page == 0, key="blob_changes_prev"):
+                        st.session_state.blob_changes_page = changes_page - 1; st.rerun()
+                    col_changes_label.caption(f"{changes_page + 1} 페이지 (최신순)")
+                    if col_changes_next.button("다음 ▶", disabled=not has_more_changes, key="blob_changes_next"):
+                        st.session_state.blob_changes_page = changes_page + 1; st.rerun()
+                else:
+                    blob_prefix_input = st.text_input("경로 (접두사)", value=st.session_state.get("blob_browser_prefix", ""), placeholder="예: chat_histories/, original_files/", key="blob_browser_prefix_input")
+                    if blob_prefix_input != st.session_state.get("blob_browser_prefix", ""): # 경로가 바뀌면 첫 페이지부터
+                        st.session_state.blob_browser_prefix = blob_prefix_input; st.session_state.blob_browser_tokens = [None]
+                    page_tokens = st.session_state.get("blob_browser_tokens") or [None] # 지금까지 방문한 페이지의 시작 token
+                    listing_cache = get_blob_listing_cache_cached()
+                    blob_rows, next_page_token = listing_cache.get_page(container_client, blob_prefix_input, BLOB_BROWSER_PAGE_SIZE, page_tokens[-1])
+                    if blob_rows:
+                        st.dataframe(pd.DataFrame(blob_rows).rename(columns={"name": "파일명", "size": "크기 (bytes)", "last_modified": "수정일"}), use_container_width=True, hide_index=True)
+                    else: st.info("해당 경로에 파일이 없습니다.")
+                    col_browse_prev, col_browse_label, col_browse_refresh, col_browse_next = st.columns([1, 2, 1, 1])
+                    if col_browse_prev.button("◀ 이전", disabled=len(page_tokens) <= 1, key="blob_browser_prev"):
+                        st.session_state.blob_browser_tokens = page_tokens[:-1]; st.rerun()
+                    col_browse_label.caption(f"{len(page_tokens)} 페이지 (이름순, 페이지당 {BLOB_BROWSER_PAGE_SIZE}개)")
+                    if col_browse_refresh.button("🔄", key="blob_browser_refresh", help="목록 새로고침"):
+                        listing_cache.invalidate(blob_prefix_input); st.rerun()
+                    if col_browse_next.button("다음 ▶", disabled=not next_page_token, key="blob_browser_next"):
+                        st.session_state.blob_browser_tokens = page_tokens + [next_page_token]; st.rerun()
             except AzureError as ae_blob_list: 
                  st.error(f"Azure Blob 파일 목록 조회 중 Azure 서비스 오류: {ae_blob_list}")
                  print(f"AZURE ERROR listing blobs: {ae_blob_list}\n{traceback.format_exc()}")
@@ -1457,3 +2179,6 @@ if admin_settings_tab: # admin_settings_tab이 None이 아니고, 현재 활성
                 st.error(f"Azure Blob 파일 목록 조회 중 알 수 없는 오류: {e_blob_list}")
                 print(f"ERROR listing blobs: {e_blob_list}\n{traceback.format_exc()}")
         else: st.warning("파일 목록 표시 불가: Azure Blob 클라이언트가 준비되지 않았습니다.")
+        admin_render_span.end()
+
+finish_rerun_trace("main")
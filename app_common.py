@@ -0,0 +1,54 @@
+# 앱(app.py)과 명령줄 도구(batch_qa.py, faq_cache.py, embedding_migration.py, retrieval_service.py)가 함께 쓰는 설정과 도우미
+# 도구가 채팅 화면과 같은 프롬프트 규칙/검색 개수/토큰 예산/로그 위치를 쓰도록 값은 여기에서만 정의
+import time
+
+from log_writer import BackgroundLogWriter
+from usage_rollups import UsageRollupStore
+
+RULES_PATH = ".streamlit/prompt_rules.txt"
+USERS_BLOB_NAME = "app_data/users.json"
+CHAT_HISTORY_BASE_PATH = "chat_histories/" # 사용자별 대화 내역 저장 기본 경로
+USAGE_LOG_PREFIX = "app_logs/usage/"
+USAGE_ROLLUP_PREFIX = "app_logs/usage_rollups/" # 시간별/일별 사용량 사전 집계
+LOG_FLUSH_INTERVAL_SECONDS = 5.0 # 백그라운드 로그 기록 주기
+
+RETRIEVAL_K_RESULTS = 3 # 질문 하나당 검색할 청크 수
+MODEL_MAX_INPUT_TOKENS = 128000 # 사용하는 LLM의 최대 입력 토큰 수 (예: gpt-4-turbo)
+MODEL_MAX_OUTPUT_TOKENS = 4096 # LLM의 최대 출력 토큰 수 (조정 가능)
+BUFFER_TOKENS = 500 # 프롬프트 구성 시 여유 토큰
+TARGET_INPUT_TOKENS_FOR_PROMPT = MODEL_MAX_INPUT_TOKENS - MODEL_MAX_OUTPUT_TOKENS - BUFFER_TOKENS
+CHAT_TEMPERATURE = 0.1
+EMBEDDING_BATCH_SIZE = 16 # 임베딩 배치 크기
+TOKENIZER_ENCODINGS = ("o200k_base", "cl100k_base") # 명령줄 도구가 차례로 시도하는 tiktoken 인코더
+
+
+def load_tokenizer():
+    # 명령줄 도구용 (앱은 시작 준비 단계에서 따로 불러옴). 쓸 수 있는 인코더가 없으면 RuntimeError
+    import tiktoken
+    for encoding_name in TOKENIZER_ENCODINGS:
+        try:
+            return tiktoken.get_encoding(encoding_name)
+        except Exception as e_encoding:
+            print(f"WARNING: Could not load tiktoken '{encoding_name}' encoder: {e_encoding}")
+    raise RuntimeError("No tiktoken encoder available. Prompt token budgeting requires a tokenizer.")
+
+
+def make_usage_log_entry(user_id, model_name, request_type, usage, department=None):
+    # 사용량 로그 한 줄 (관리자 사용량 화면/집계가 읽는 형식)
+    log_entry = {
+        "timestamp": time.strftime("%Y-%m-%d %H:%M:%S"), "user_id": user_id, "model_name": model_name, "request_type": request_type,
+        "prompt_tokens": getattr(usage, "prompt_tokens", 0), "completion_tokens": getattr(usage, "completion_tokens", 0) or 0, # 임베딩 응답에는 없음
+        "total_tokens": getattr(usage, "total_tokens", 0)
+    }
+    if department: log_entry["department"] = department
+    return log_entry
+
+
+def make_usage_logger(container_client):
+    # 명령줄 도구의 사용량을 앱과 같은 사용량 로그/집계에 기록. 반환: (BackgroundLogWriter, TokenUsageMeter의 on_usage 콜백)
+    log_writer = BackgroundLogWriter(container_client, {"usage": USAGE_LOG_PREFIX}, flush_interval=LOG_FLUSH_INTERVAL_SECONDS,
+                                     on_entries_written={"usage": UsageRollupStore(container_client, rollup_prefix=USAGE_ROLLUP_PREFIX).apply_entries})
+
+    def record_usage(caller, model_name, usage):
+        log_writer.log("usage", make_usage_log_entry(caller.user_name, model_name, caller.request_type, usage, caller.department))
+    return log_writer, record_usage
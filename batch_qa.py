@@ -0,0 +1,343 @@
+# 헤드리스 일괄 질의응답 (CLI / REST)
+# - 채팅 화면과 같은 방식으로 답변: 질문 검색(k=3) -> PromptBuilder로 프롬프트 조립 -> 채팅 모델 호출 (대화 기록/첨부 파일 없음)
+# - 검색은 RETRIEVAL_SERVICE_URL이 있으면 검색 사이드카(retrieval_service.py)를 사용해 앱과 인덱스/질의 임베딩 캐시를 공유하고,
+#   없으면 이 프로세스에서 Blob의 인덱스를 불러와 사용 (동시 검색은 SearchBatcher로 묶음). --shards로 검색할 샤드 지정 (기본: 모든 샤드)
+# - 채팅 모델 호출은 llm_scheduler로 동시 호출 수/분당 토큰을 제한하고, 사용량은 앱과 같은 사용량 로그(app_logs/usage/)에 기록
+# 실행:
+#   python batch_qa.py run --input questions.csv --output answers.jsonl --concurrency 4 [--resume]
+#     입력: CSV(question 열, 선택적으로 id 열) 또는 JSONL({"id": ..., "question": ...})
+#     출력: .jsonl 또는 .csv. 질문이 끝나는 순서대로 한 줄씩 기록
+#     --resume이면 출력 파일에 오류 없이 기록된 id는 건너뛰고, 실패했던 행과 중복 행은 지운 뒤 이어서 기록 (id마다 한 행)
+#   python batch_qa.py serve --listen 127.0.0.1:8766
+#     POST /ask {"question": str, "id": 선택, "shards": 선택}          -> 결과 한 건 (JSON)
+#     POST /batch {"questions": [str | {"id", "question"}], "shards": 선택} -> 끝나는 순서대로 결과를 한 줄씩 (application/x-ndjson)
+#     secrets의 BATCH_QA_API_KEY 필수 ("Authorization: Bearer <키>" 헤더). 없으면 시작하지 않음
+#     검색 범위는 요청의 "shards" (--shards를 주면 그 안에서만 허용), 없으면 --shards 또는 공통 샤드만
+# 설정은 앱과 같은 .streamlit/secrets.toml을 읽음
+import argparse
+import csv
+import hmac
+import json
+import os
+import sys
+import threading
+import time
+import tomllib
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from http.server import BaseHTTPRequestHandler
+from types import SimpleNamespace
+
+from app_common import (
+    CHAT_TEMPERATURE, MODEL_MAX_OUTPUT_TOKENS, RETRIEVAL_K_RESULTS, RULES_PATH, TARGET_INPUT_TOKENS_FOR_PROMPT, load_tokenizer, make_usage_logger
+)
+from llm_scheduler import FairLLMScheduler
+from prompt_builder import PromptBuilder, ensure_item_token_count, load_prompt_rules
+from retrieval_client import RetrievalServiceClient, usage_from_dict
+from retrieval_service import RetrievalService, make_container_client, make_llm_client, make_server
+from token_quota import TokenUsageMeter, UsageCaller
+from vector_shards import COMMON_SHARD_NAME, ShardedVectorStore
+
+DEFAULT_CONCURRENCY = 4
+DEFAULT_SERVE_LISTEN = "127.0.0.1:8766"
+BATCH_USER_NAME = "batch_qa" # 사용량 로그의 user_id (--user로 변경)
+OUTPUT_CSV_FIELDS = ["id", "question", "answer", "sources", "input_tokens", "prompt_tokens", "completion_tokens", "embedding_tokens",
+                     "total_tokens", "context_truncated", "latency_ms", "error"]
+
+
+class InProcessRetriever:
+    # RetrievalService를 이 프로세스에서 직접 사용 (응답 형식은 RetrievalServiceClient.search와 같게)
+    def __init__(self, retrieval_service):
+        self.retrieval_service = retrieval_service
+
+    def search(self, query_text, k=RETRIEVAL_K_RESULTS, shards=None):
+        response = self.retrieval_service.search(query_text, k, shards)
+        return SimpleNamespace(results=response["results"], usage=usage_from_dict(response["usage"]), embedding_cached=response["embedding_cached"])
+
+    def stats(self):
+        return self.retrieval_service.stats()
+
+    def load_shards(self, shard_names=None):
+        return self.retrieval_service.vector_store.load_shards(shard_names)
+
+
+class BatchQAPipeline:
+    def __init__(self, llm_client, retriever, prompt_builder, chat_model, embedding_model, k_results=RETRIEVAL_K_RESULTS, shards=None):
+        self.llm_client = llm_client
+        self.retriever = retriever
+        self.prompt_builder = prompt_builder
+        self.chat_model = chat_model
+        self.embedding_model = embedding_model
+        self.k_results = k_results
+        self.shards = shards # 검색할 샤드 (None이면 모든 샤드)
+
+    def answer(self, question_id, question_text, caller, shards=None):
+        # 반환: 출력 파일 한 줄 (오류도 결과로 기록하고 다음 질문 계속). shards가 있으면 self.shards 대신 그 샤드만 검색
+        search_shards = self.shards if shards is None else shards
+        started_at = time.perf_counter()
+        result = {"id": question_id, "question": question_text, "answer": None, "sources": [], "input_tokens": None, "prompt_tokens": 0,
+                  "completion_tokens": 0, "embedding_tokens": 0, "total_tokens": 0, "context_truncated": False, "latency_ms": None, "error": None}
+        try:
+            search_response = self.llm_client.run_metered(
+                caller._replace(request_type="batch_qa_query_embedding"), self.embedding_model,
+                lambda: self.retriever.search(question_text, k=self.k_results, shards=search_shards), input_texts=[question_text])
+            result["embedding_tokens"] = search_response.usage.total_tokens
+            retrieved_chunks = search_response.results
+            for item in retrieved_chunks: ensure_item_token_count(item, self.prompt_builder.tokenizer)
+            result["sources"] = list(dict.fromkeys(item.get("source", "Unknown Source") for item in retrieved_chunks))
+
+            api_messages, prompt_stats = self.prompt_builder.build(question_text, retrieved_chunks, max_input_tokens=TARGET_INPUT_TOKENS_FOR_PROMPT)
+            result["input_tokens"], result["context_truncated"] = prompt_stats["total_input_tokens"], prompt_stats["context_truncated"]
+            completion = self.llm_client.chat_completion(
+                "chat", model=self.chat_model, caller=caller._replace(request_type="batch_qa_chat_completion"), messages=api_messages,
+                max_tokens=MODEL_MAX_OUTPUT_TOKENS, temperature=CHAT_TEMPERATURE, input_tokens=prompt_stats["total_input_tokens"])
+            result["answer"] = (completion.choices[0].message.content or "").strip()
+            if completion.usage is not None:
+                result["prompt_tokens"], result["completion_tokens"] = completion.usage.prompt_tokens or 0, completion.usage.completion_tokens or 0
+        except Exception as e_answer:
+            print(f"ERROR answering question '{question_id}': {e_answer}\n{traceback.format_exc()}")
+            result["error"] = f"{type(e_answer).__name__}: {e_answer}"
+        result["total_tokens"] = result["prompt_tokens"] + result["completion_tokens"] + result["embedding_tokens"]
+        result["latency_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+        return result
+
+    def answer_many(self, questions, caller, concurrency=DEFAULT_CONCURRENCY, shards=None):
+        # questions: [{"id", "question"}]. 끝나는 순서대로 결과를 내보냄
+        with ThreadPoolExecutor(max_workers=max(1, concurrency), thread_name_prefix="batch-qa") as executor:
+            pending = [executor.submit(self.answer, question["id"], question["question"], caller, shards) for question in questions]
+            for finished in as_completed(pending):
+                yield finished.result()
+
+
+def normalize_questions(raw_questions):
+    # 문자열 또는 {"id", "question"} 목록 -> [{"id", "question"}]. id가 없으면 순번
+    questions = []
+    for row_no, raw_question in enumerate(raw_questions, start=1):
+        if isinstance(raw_question, str):
+            raw_question = {"question": raw_question}
+        question_text = str(raw_question.get("question") or "").strip()
+        if not question_text:
+            print(f"WARNING: Skipping row {row_no} without a question.")
+            continue
+        questions.append({"id": str(raw_question.get("id") or row_no), "question": question_text})
+    return questions
+
+
+def load_questions(input_path):
+    if input_path.lower().endswith(".csv"):
+        with open(input_path, "r", encoding="utf-8-sig", newline="") as input_file:
+            return normalize_questions(list(csv.DictReader(input_file)))
+    with open(input_path, "r", encoding="utf-8") as input_file:
+        return normalize_questions([json.loads(line) for line in input_file if line.strip()])
+
+
+def load_answered_rows(output_path):
+    # --resume: 출력 파일에 오류 없이 기록된 행 (같은 id가 여러 번 있으면 마지막 행)
+    if not os.path.exists(output_path):
+        return []
+    with open(output_path, "r", encoding="utf-8-sig", newline="") as output_file:
+        rows = list(csv.DictReader(output_file)) if output_path.lower().endswith(".csv") else [json.loads(line) for line in output_file if line.strip()]
+    answered_by_id = {}
+    for row in rows:
+        if not row.get("error"): answered_by_id[str(row.get("id"))] = row
+    return list(answered_by_id.values())
+
+
+class ResultWriter:
+    # 결과를 받는 즉시 한 줄씩 기록하고 flush (중간에 멈춰도 끝난 결과는 남음)
+    # kept_rows: 새 결과 앞에 남길 이전 결과 (--resume). 임시 파일에 쓴 뒤 교체하므로 교체 전에 멈춰도 기존 출력 파일은 그대로
+    def __init__(self, output_path, kept_rows=()):
+        self.is_csv = output_path.lower().endswith(".csv")
+        self._lock = threading.Lock()
+        temp_path = f"{output_path}.tmp"
+        self._open(temp_path, "w")
+        for row in kept_rows: self.write(row)
+        self._file.close()
+        os.replace(temp_path, output_path)
+        self._open(output_path, "a")
+
+    def _open(self, path, mode):
+        self._file = open(path, mode, encoding="utf-8", newline="")
+        self._csv_writer = csv.DictWriter(self._file, fieldnames=OUTPUT_CSV_FIELDS) if self.is_csv else None
+        if self._csv_writer and mode == "w": self._csv_writer.writeheader()
+
+    def write(self, result):
+        with self._lock:
+            if self._csv_writer:
+                sources = result["sources"]
+                self._csv_writer.writerow(dict(result, sources="; ".join(sources) if isinstance(sources, list) else sources))
+            else:
+                self._file.write(json.dumps(result, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def build_pipeline(secrets, concurrency, shards=None):
+    # 반환: (BatchQAPipeline, BackgroundLogWriter)
+    container_client = make_container_client(secrets)
+    log_writer, record_usage = make_usage_logger(container_client)
+    tokenizer = load_tokenizer()
+    scheduler = FairLLMScheduler(max_concurrent_requests=concurrency, max_inflight_tokens=int(secrets.get("LLM_MAX_INFLIGHT_TOKENS", 0) or 0),
+                                 tokens_per_minute=int(secrets.get("LLM_DEPLOYMENT_TOKENS_PER_MINUTE", 0) or 0))
+    usage_meter = TokenUsageMeter(None, on_usage=record_usage, count_tokens_fn=lambda text: len(tokenizer.encode(text))) # 일괄 작업은 사용자 쿼터 미적용
+    llm_client = make_llm_client(secrets, usage_meter=usage_meter, scheduler=scheduler, fallback_deployment=secrets.get("AZURE_OPENAI_FALLBACK_DEPLOYMENT"))
+    embedding_model = secrets["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"]
+    if secrets.get("RETRIEVAL_SERVICE_URL"):
+        print(f"Using shared retrieval service at {secrets['RETRIEVAL_SERVICE_URL']}.")
+        retriever = RetrievalServiceClient(secrets["RETRIEVAL_SERVICE_URL"])
+    else:
+        vector_store = ShardedVectorStore(container_client)
+        print(f"Vector DB shards: {', '.join(vector_store.discover())}")
+        retriever = InProcessRetriever(RetrievalService(vector_store, llm_client, embedding_model))
+    prompt_builder = PromptBuilder(tokenizer, load_prompt_rules(RULES_PATH))
+    return BatchQAPipeline(llm_client, retriever, prompt_builder, secrets["AZURE_OPENAI_DEPLOYMENT"], embedding_model, shards=shards), log_writer
+
+
+def run_batch(pipeline, questions, output_path, caller, concurrency=DEFAULT_CONCURRENCY, resume=False):
+    # 반환: 요약 dict
+    answered_rows = load_answered_rows(output_path) if resume else []
+    if resume:
+        completed_ids = {str(row.get("id")) for row in answered_rows}
+        questions = [question for question in questions if question["id"] not in completed_ids]
+        print(f"Resuming: {len(completed_ids)} questions already answered, {len(questions)} remaining.")
+    summary = {"questions": len(questions), "answered": 0, "failed": 0, "total_tokens": 0}
+    started_at = time.perf_counter()
+    result_writer = ResultWriter(output_path, kept_rows=answered_rows)
+    try:
+        for result in pipeline.answer_many(questions, caller, concurrency):
+            result_writer.write(result)
+            summary["failed" if result["error"] else "answered"] += 1
+            summary["total_tokens"] += result["total_tokens"]
+            done_count = summary["answered"] + summary["failed"]
+            print(f"[{done_count}/{len(questions)}] {result['id']}: {'ERROR ' + result['error'] if result['error'] else 'ok'} ({result['latency_ms']} ms, {result['total_tokens']} tokens)")
+    finally:
+        result_writer.close()
+    summary["elapsed_seconds"] = round(time.perf_counter() - started_at, 1)
+    return summary
+
+
+def make_request_handler(pipeline, caller, concurrency, api_key, allowed_shards=None):
+    # allowed_shards: 요청이 지정할 수 있는 샤드 (None이면 제한 없음). 요청에 "shards"가 없으면 allowed_shards 또는 공통 샤드만 검색
+    if not api_key:
+        raise ValueError("BATCH_QA_API_KEY is required to serve the batch Q&A API.")
+    default_shards = list(allowed_shards) if allowed_shards else [COMMON_SHARD_NAME]
+
+    class BatchQARequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass
+
+        def address_string(self):
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+        def send_json(self, status_code, payload):
+            response_bytes = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(response_bytes)))
+            self.end_headers()
+            self.wfile.write(response_bytes)
+
+        def is_authorized(self):
+            return hmac.compare_digest(self.headers.get("Authorization", ""), f"Bearer {api_key}")
+
+        def do_GET(self):
+            if self.path == "/health": self.send_json(200, {"status": "ok"})
+            else: self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            if not self.is_authorized():
+                self.send_json(401, {"error": "Unauthorized."}); return
+            try:
+                request_body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+            except ValueError:
+                self.send_json(400, {"error": "Request body must be JSON."}); return
+            requested_shards = request_body.get("shards")
+            if requested_shards is None:
+                search_shards = default_shards
+            elif isinstance(requested_shards, list) and requested_shards and all(isinstance(shard_name, str) and shard_name for shard_name in requested_shards):
+                search_shards = requested_shards
+            else:
+                self.send_json(400, {"error": "'shards' must be a non-empty list of shard names."}); return
+            if allowed_shards and not set(search_shards) <= set(allowed_shards):
+                self.send_json(403, {"error": f"Shards outside the allowed scope: {', '.join(sorted(set(search_shards) - set(allowed_shards)))}."}); return
+            if self.path == "/ask":
+                questions = normalize_questions([request_body])
+                if not questions:
+                    self.send_json(400, {"error": "'question' is required."}); return
+                self.send_json(200, pipeline.answer(questions[0]["id"], questions[0]["question"], caller, search_shards))
+            elif self.path == "/batch":
+                questions = normalize_questions(request_body.get("questions") or [])
+                if not questions:
+                    self.send_json(400, {"error": "'questions' is required."}); return
+                # 끝나는 대로 한 줄씩 보냄 (길이를 미리 알 수 없으므로 연결 종료로 응답 끝을 표시)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson; charset=utf-8")
+                self.send_header("Connection", "close")
+                self.end_headers()
+                self.close_connection = True
+                for result in pipeline.answer_many(questions, caller, concurrency, search_shards):
+                    self.wfile.write((json.dumps(result, ensure_ascii=False) + "\n").encode("utf-8"))
+                    self.wfile.flush()
+            else:
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+    return BatchQARequestHandler
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Answer question sets against the SOP corpus without the Streamlit UI.")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Same secrets file as the Streamlit app.")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_CONCURRENCY, help="Questions answered at the same time.")
+    parser.add_argument("--user", default=BATCH_USER_NAME, help="user_id recorded in the usage log.")
+    parser.add_argument("--department", default=None, help="Department recorded in the usage log.")
+    parser.add_argument("--shards", default=None, help=f"Comma-separated vector DB shards to search (e.g. '{COMMON_SHARD_NAME},품질보증팀'). run: default all shards. "
+                                                       f"serve: the shards requests may ask for, and the default when a request has no 'shards' (default: '{COMMON_SHARD_NAME}' only).")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    run_parser = subparsers.add_parser("run", help="Answer a CSV/JSONL question file.")
+    run_parser.add_argument("--input", required=True, help="CSV with a 'question' column (optional 'id') or JSONL.")
+    run_parser.add_argument("--output", required=True, help=".jsonl or .csv, written as questions finish.")
+    run_parser.add_argument("--resume", action="store_true", help="Skip ids already answered in --output and append.")
+    serve_parser = subparsers.add_parser("serve", help="Serve POST /ask and POST /batch (requires BATCH_QA_API_KEY).")
+    serve_parser.add_argument("--listen", default=DEFAULT_SERVE_LISTEN, help="host:port or unix:/path/to.sock")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.secrets, "rb") as secrets_file:
+        secrets = tomllib.load(secrets_file)
+    caller = UsageCaller(args.user, args.user, args.department, "batch_qa", enforce_quota=False)
+    if args.command == "run":
+        questions = load_questions(args.input)
+        if not questions:
+            print(f"ERROR: No questions found in '{args.input}'.")
+            return 1
+    elif not secrets.get("BATCH_QA_API_KEY"):
+        print("ERROR: Set BATCH_QA_API_KEY in the secrets file before serving the batch Q&A API.")
+        return 1
+    shards = [shard_name.strip() for shard_name in args.shards.split(",") if shard_name.strip()] if args.shards else None
+    pipeline, log_writer = build_pipeline(secrets, args.concurrency, shards if args.command == "run" else None)
+    try:
+        if args.command == "run":
+            summary = run_batch(pipeline, questions, args.output, caller, args.concurrency, args.resume)
+            print(f"Done: {summary['answered']} answered, {summary['failed']} failed, {summary['total_tokens']:,} tokens in {summary['elapsed_seconds']}s. Results: '{args.output}'.")
+            return 1 if summary["failed"] else 0
+        server = make_server(args.listen, make_request_handler(pipeline, caller, args.concurrency, secrets["BATCH_QA_API_KEY"], allowed_shards=shards))
+        print(f"Batch Q&A API listening on {args.listen}.")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+        return 0
+    finally:
+        log_writer.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,314 @@
+# 오프라인 종단간 벤치마크 (Azure 서비스 없이 실행)
+# 사용법:
+#   python benchmark.py --sizes 10,50,200 --questions 20 --formats txt,docx,pdf
+#   python benchmark.py --save-baseline benchmark_baseline.json   # 결과를 기준값으로 저장
+#   python benchmark.py --baseline benchmark_baseline.json        # 기준값과 비교 (허용 범위보다 나빠지면 종료 코드 1)
+# 동작:
+# - 부모 프로세스가 FakeAzureOpenAIServer(지연/요청 수 제한 설정 가능)를 띄우고,
+#   코퍼스 크기마다 새 프로세스(--worker)에서 streamlit.testing.v1.AppTest로 app.py를 그대로 실행
+#   (저장소는 STORAGE_BACKEND=local + LOCAL_STORAGE_LATENCY_MS, OpenAI 엔드포인트는 가짜 서버)
+# - 관리자 세션에서 합성 SOP 문서를 하나씩 업로드해 학습시킨 뒤, 일반 사용자 세션에서 질문을 보냄
+# - 함수별 소요 시간은 앱이 남기는 trace(app_logs/traces/)의 span으로 집계 (BENCHMARK_STAGES 참고)
+# - 처리량, 지연 백분위(p50/p95/p99), 메모리(tracemalloc 최고치, 최대 RSS)를 출력하고 기준값과 비교
+# 필요 사항: 앱 requirements, AppTest에서 file_uploader를 지원하는 streamlit,
+#           tiktoken 인코딩 파일 (인터넷이 없으면 TIKTOKEN_CACHE_DIR에 미리 받아 둔 캐시)
+import argparse
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from benchmark_fakes import FAKE_CHAT_ANSWER, FakeAzureOpenAIServer, generate_sop_question, generate_sop_text, render_document
+from storage_backends import LocalContainerClient
+from log_writer import read_log_stream
+from tracing import percentile
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "app.py")
+TRACES_LOG_PREFIX = "app_logs/traces/" # app.py의 TRACES_LOG_PREFIX와 같아야 함
+ADMIN_UPLOADER_KEY = "admin_file_uploader_v7_del"
+QUESTION_INPUT_KEY = "user_query_text_input_v7_del"
+QUESTION_SUBMIT_LABEL = "전송"
+BENCH_EMBEDDING_DEPLOYMENT = "bench-embedding"
+BENCH_CHAT_DEPLOYMENT = "bench-chat"
+BENCH_ADMIN_USER = {"uid": "bench_admin", "name": "벤치마크 관리자", "department": "QA", "role": "admin", "approved": True}
+BENCH_CHAT_USER = {"uid": "bench_user", "name": "벤치마크 사용자", "department": "QA", "role": "user", "approved": True}
+TRACE_WAIT_TIMEOUT_SECONDS = 30.0 # 앱의 백그라운드 로그 기록기가 trace를 내보낼 때까지 기다리는 최대 시간
+DEFAULT_REGRESSION_TOLERANCE = 0.2
+
+# 보고서 이름 -> 앱 trace의 span 이름
+BENCHMARK_STAGES = {
+    "extract_text_from_file": "admin_upload.text_extraction",
+    "chunk_text_into_pieces": "admin_upload.chunking",
+    "add_document_to_vector_db_and_blob": "admin_upload.learn",
+    "embedding.batch": "embedding.batch",
+    "vector_db.faiss_add": "vector_db.faiss_add",
+    "search_similar_chunks": "retrieval",
+    "query_embedding": "retrieval.embedding",
+    "faiss_search": "retrieval.faiss_search",
+    "prompt.build": "prompt.build",
+    "llm.chat_completion": "llm.chat_completion",
+    "question_flow": "chat_turn",
+    "rerun": "rerun",
+}
+# 기준값 비교 대상: (경로, 작을수록 좋은지)
+COMPARED_METRICS = [
+    (("ingestion", "wall_ms", "p50"), True), (("ingestion", "wall_ms", "p95"), True),
+    (("ingestion", "documents_per_second"), False), (("ingestion", "chunks_per_second"), False),
+    (("questions", "wall_ms", "p50"), True), (("questions", "wall_ms", "p95"), True), (("questions", "wall_ms", "p99"), True),
+    (("questions", "questions_per_second"), False),
+    (("memory", "max_rss_mb"), True),
+] + [(("stages", stage_label, "p95"), True) for stage_label in BENCHMARK_STAGES]
+
+
+def latency_summary(values_ms):
+    sorted_values = sorted(values_ms)
+    if not sorted_values:
+        return {"count": 0}
+    return {
+        "count": len(sorted_values), "mean": round(sum(sorted_values) / len(sorted_values), 1),
+        "p50": percentile(sorted_values, 50), "p95": percentile(sorted_values, 95), "p99": percentile(sorted_values, 99),
+        "max": sorted_values[-1]
+    }
+
+
+def new_app_test(app_path, secrets, user_info, run_timeout):
+    from streamlit.testing.v1 import AppTest # 벤치마크 실행 시에만 필요
+    app_test = AppTest.from_file(app_path, default_timeout=run_timeout)
+    for secret_name, secret_value in secrets.items():
+        app_test.secrets[secret_name] = secret_value
+    app_test.session_state["authenticated"] = True # 로그인 화면 건너뜀
+    app_test.session_state["user"] = dict(user_info)
+    return app_test
+
+
+def raise_on_app_exception(app_test, step_description):
+    if len(app_test.exception):
+        raise RuntimeError(f"App raised an exception while {step_description}: {app_test.exception[0].value}")
+
+
+def wait_for_trace_records(storage_dir, min_counts_by_span, timeout=TRACE_WAIT_TIMEOUT_SECONDS):
+    # min_counts_by_span: {span 이름: 최소 개수}. 모두 채워지거나 timeout이 지나면 그때까지의 trace 반환
+    container_client = LocalContainerClient(storage_dir)
+    deadline = time.monotonic() + timeout
+    while True:
+        trace_records = read_log_stream(container_client, TRACES_LOG_PREFIX)
+        span_counts = {}
+        for trace_record in trace_records:
+            for span_record in trace_record.get("spans") or []:
+                span_counts[span_record.get("name")] = span_counts.get(span_record.get("name"), 0) + 1
+        if all(span_counts.get(name, 0) >= min_count for name, min_count in min_counts_by_span.items()) or time.monotonic() > deadline:
+            return trace_records
+        time.sleep(0.5)
+
+
+def run_corpus_benchmark(app_path, endpoint, corpus_size, question_count, formats, storage_latency_ms, seed, run_timeout):
+    # 한 프로세스에서 코퍼스 하나를 학습시키고 질문. 반환: 결과 dict
+    tracemalloc.start()
+    storage_dir = tempfile.mkdtemp(prefix="chatbot_bench_")
+    secrets = {
+        "STORAGE_BACKEND": "local", "LOCAL_STORAGE_DIR": storage_dir, "LOCAL_STORAGE_LATENCY_MS": storage_latency_ms,
+        "AZURE_OPENAI_KEY": "benchmark", "AZURE_OPENAI_ENDPOINT": endpoint,
+        "AZURE_OPENAI_DEPLOYMENT": BENCH_CHAT_DEPLOYMENT, "AZURE_OPENAI_EMBEDDING_DEPLOYMENT": BENCH_EMBEDDING_DEPLOYMENT,
+    }
+    result = {"corpus_size": corpus_size, "question_count": question_count, "formats": formats}
+    try:
+        # 1) 학습: 관리자 세션에서 문서를 하나씩 업로드
+        admin_app = new_app_test(app_path, secrets, BENCH_ADMIN_USER, run_timeout)
+        cold_start = time.perf_counter()
+        admin_app.run()
+        result["cold_start_ms"] = round((time.perf_counter() - cold_start) * 1000, 1)
+        raise_on_app_exception(admin_app, "starting the admin session")
+
+        tracemalloc.reset_peak()
+        ingest_wall_ms, failed_documents = [], 0
+        for doc_no in range(corpus_size):
+            file_extension, payload, mime_type = render_document(generate_sop_text(doc_no, seed=seed), formats[doc_no % len(formats)])
+            file_name = f"SOP-{doc_no:04d}{file_extension}"
+            admin_app.file_uploader(key=ADMIN_UPLOADER_KEY).set_value((file_name, payload, mime_type))
+            started = time.perf_counter()
+            admin_app.run()
+            ingest_wall_ms.append(round((time.perf_counter() - started) * 1000, 1))
+            raise_on_app_exception(admin_app, f"ingesting '{file_name}'")
+            processed_info = admin_app.session_state["processed_admin_file_info"] if "processed_admin_file_info" in admin_app.session_state else None
+            if not processed_info or processed_info[0] != file_name: # 학습 성공 시에만 기록됨
+                failed_documents += 1
+        ingest_seconds = sum(ingest_wall_ms) / 1000
+        result["ingestion"] = {
+            "documents": corpus_size, "failed_documents": failed_documents, "wall_ms": latency_summary(ingest_wall_ms),
+            "documents_per_second": round(corpus_size / ingest_seconds, 3) if ingest_seconds else None,
+            "peak_traced_memory_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        }
+
+        # 2) 질문: 일반 사용자 세션에서 전체 질문 흐름 실행
+        chat_app = new_app_test(app_path, secrets, BENCH_CHAT_USER, run_timeout)
+        chat_app.run()
+        raise_on_app_exception(chat_app, "starting the chat session")
+        tracemalloc.reset_peak()
+        question_wall_ms, failed_questions = [], 0
+        for question_no in range(question_count):
+            chat_app.text_input(key=QUESTION_INPUT_KEY).set_value(generate_sop_question(question_no % max(corpus_size, 1), seed=seed))
+            submit_button = next(button for button in chat_app.button if button.label == QUESTION_SUBMIT_LABEL)
+            started = time.perf_counter()
+            submit_button.click()
+            chat_app.run()
+            question_wall_ms.append(round((time.perf_counter() - started) * 1000, 1))
+            raise_on_app_exception(chat_app, f"answering question {question_no}")
+            chat_messages = chat_app.session_state["current_chat_messages"]
+            if not chat_messages or chat_messages[-1].get("content") != FAKE_CHAT_ANSWER:
+                failed_questions += 1
+        question_seconds = sum(question_wall_ms) / 1000
+        result["questions"] = {
+            "questions": question_count, "failed_questions": failed_questions, "wall_ms": latency_summary(question_wall_ms),
+            "questions_per_second": round(question_count / question_seconds, 3) if question_seconds else None,
+            "peak_traced_memory_mb": round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+        }
+
+        # 3) 함수별 소요 시간 (앱 trace의 span)
+        trace_records = wait_for_trace_records(storage_dir, {"admin_upload.learn": corpus_size - failed_documents, "chat_turn": question_count})
+        durations_by_span, learned_chunks = {}, 0
+        for trace_record in trace_records:
+            for span_record in trace_record.get("spans") or []:
+                durations_by_span.setdefault(span_record.get("name"), []).append(span_record.get("duration_ms", 0))
+                if span_record.get("name") == "admin_upload.learn":
+                    learned_chunks += (span_record.get("attributes") or {}).get("chunks", 0)
+        result["stages"] = {stage_label: latency_summary(durations_by_span.get(span_name, [])) for stage_label, span_name in BENCHMARK_STAGES.items()}
+        result["ingestion"]["chunks"] = learned_chunks
+        result["ingestion"]["chunks_per_second"] = round(learned_chunks / ingest_seconds, 3) if ingest_seconds else None
+        result["memory"] = {
+            "max_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), # Linux: KB 단위
+            "peak_traced_memory_mb": max(result["ingestion"]["peak_traced_memory_mb"], result["questions"]["peak_traced_memory_mb"])
+        }
+    finally:
+        tracemalloc.stop()
+        shutil.rmtree(storage_dir, ignore_errors=True)
+    return result
+
+
+def get_metric(result, metric_path):
+    value = result
+    for key in metric_path:
+        if not isinstance(value, dict) or key not in value:
+            return None
+        value = value[key]
+    return value if isinstance(value, (int, float)) else None
+
+
+def compare_with_baseline(results, baseline_results, tolerance=DEFAULT_REGRESSION_TOLERANCE):
+    # 반환: 비교 행 목록. regression=True면 기준값보다 tolerance 넘게 나빠진 항목
+    baseline_by_size = {baseline_result["corpus_size"]: baseline_result for baseline_result in baseline_results}
+    comparison_rows = []
+    for result in results:
+        baseline_result = baseline_by_size.get(result["corpus_size"])
+        if baseline_result is None:
+            continue
+        for metric_path, lower_is_better in COMPARED_METRICS:
+            current_value, baseline_value = get_metric(result, metric_path), get_metric(baseline_result, metric_path)
+            if current_value is None or not baseline_value:
+                continue
+            change_ratio = (current_value - baseline_value) / baseline_value
+            comparison_rows.append({
+                "corpus_size": result["corpus_size"], "metric": ".".join(metric_path), "baseline": baseline_value, "current": current_value,
+                "change_pct": round(change_ratio * 100, 1),
+                "regression": change_ratio > tolerance if lower_is_better else change_ratio < -tolerance
+            })
+    return comparison_rows
+
+
+def format_report(results, server_stats_by_size):
+    lines = []
+    for result in results:
+        ingestion, questions = result.get("ingestion", {}), result.get("questions", {})
+        lines.append(f"=== Corpus {result['corpus_size']} documents ({', '.join(result['formats'])}), {result['question_count']} questions ===")
+        lines.append(f"Cold start: {result.get('cold_start_ms')}ms | Memory: max RSS {result['memory']['max_rss_mb']}MB, peak traced {result['memory']['peak_traced_memory_mb']}MB")
+        lines.append(f"Ingestion: {ingestion.get('documents_per_second')} docs/s, {ingestion.get('chunks_per_second')} chunks/s ({ingestion.get('chunks')} chunks, {ingestion.get('failed_documents')} failed) | wall {ingestion.get('wall_ms')}")
+        lines.append(f"Questions: {questions.get('questions_per_second')} q/s ({questions.get('failed_questions')} failed) | wall {questions.get('wall_ms')}")
+        for stage_label, stage_summary in result.get("stages", {}).items():
+            if stage_summary.get("count"):
+                lines.append(f"  {stage_label:<36} n={stage_summary['count']:<5} p50={stage_summary['p50']:>8.1f}ms p95={stage_summary['p95']:>8.1f}ms p99={stage_summary['p99']:>8.1f}ms max={stage_summary['max']:>8.1f}ms")
+        lines.append(f"Fake OpenAI server: {server_stats_by_size.get(result['corpus_size'])}")
+    return "\n".join(lines)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Offline end-to-end benchmark for the chatbot (fake OpenAI server + local blob storage).")
+    parser.add_argument("--sizes", default="10,50,200", help="Comma-separated corpus sizes (documents).")
+    parser.add_argument("--questions", type=int, default=20, help="Questions asked per corpus.")
+    parser.add_argument("--formats", default="txt,docx,pdf", help="Synthetic document formats, used in rotation (txt, docx, pdf, xlsx).")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--llm-latency-ms", type=float, default=50.0, help="Fake OpenAI base latency per request.")
+    parser.add_argument("--embedding-latency-per-item-ms", type=float, default=1.0)
+    parser.add_argument("--chat-latency-ms", type=float, default=500.0)
+    parser.add_argument("--requests-per-minute", type=int, default=0, help="Fake OpenAI rate limit (0 = unlimited). Excess requests get 429.")
+    parser.add_argument("--storage-latency-ms", type=float, default=10.0, help="Simulated latency per local blob request.")
+    parser.add_argument("--run-timeout", type=float, default=300.0, help="Timeout for a single app rerun (seconds).")
+    parser.add_argument("--output", help="Write full results as JSON.")
+    parser.add_argument("--baseline", help="Compare against a stored baseline JSON.")
+    parser.add_argument("--save-baseline", help="Store these results as the baseline JSON.")
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_REGRESSION_TOLERANCE, help="Allowed relative regression before failing (0.2 = 20%%).")
+    parser.add_argument("--worker", action="store_true", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-size", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--worker-endpoint", help=argparse.SUPPRESS)
+    parser.add_argument("--worker-output", help=argparse.SUPPRESS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    formats = [file_format.strip() for file_format in args.formats.split(",") if file_format.strip()]
+    if args.worker:
+        worker_result = run_corpus_benchmark(APP_PATH, args.worker_endpoint, args.worker_size, args.questions, formats,
+                                             args.storage_latency_ms, args.seed, args.run_timeout)
+        with open(args.worker_output, "w", encoding="utf-8") as output_file:
+            json.dump(worker_result, output_file, ensure_ascii=False)
+        return 0
+
+    fake_server = FakeAzureOpenAIServer(latency_ms=args.llm_latency_ms, embedding_latency_per_item_ms=args.embedding_latency_per_item_ms,
+                                        chat_latency_ms=args.chat_latency_ms, requests_per_minute=args.requests_per_minute).start()
+    print(f"Fake Azure OpenAI server listening at {fake_server.endpoint}")
+    results, server_stats_by_size = [], {}
+    try:
+        for corpus_size in [int(size) for size in args.sizes.split(",") if size.strip()]:
+            stats_before = fake_server.snapshot_stats()
+            with tempfile.TemporaryDirectory(prefix="chatbot_bench_result_") as result_dir:
+                worker_output = os.path.join(result_dir, "result.json")
+                worker_command = [sys.executable, os.path.abspath(__file__), "--worker", "--worker-size", str(corpus_size),
+                                  "--worker-endpoint", fake_server.endpoint, "--worker-output", worker_output,
+                                  "--questions", str(args.questions), "--formats", ",".join(formats), "--seed", str(args.seed),
+                                  "--storage-latency-ms", str(args.storage_latency_ms), "--run-timeout", str(args.run_timeout)]
+                print(f"Running corpus of {corpus_size} documents...")
+                subprocess.run(worker_command, check=True, stdout=subprocess.DEVNULL) # 앱의 print 출력은 숨김 (오류는 stderr로)
+                with open(worker_output, "r", encoding="utf-8") as result_file:
+                    results.append(json.load(result_file))
+            stats_after = fake_server.snapshot_stats()
+            server_stats_by_size[corpus_size] = {name: stats_after[name] - stats_before.get(name, 0) for name in stats_after}
+    finally:
+        fake_server.stop()
+
+    print(format_report(results, server_stats_by_size))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as output_file:
+            json.dump({"results": results, "server_stats": server_stats_by_size}, output_file, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(results, baseline_file, ensure_ascii=False, indent=2)
+        print(f"Baseline saved to '{args.save_baseline}'.")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as baseline_file:
+            comparison_rows = compare_with_baseline(results, json.load(baseline_file), args.tolerance)
+        regressions = [row for row in comparison_rows if row["regression"]]
+        for row in comparison_rows:
+            marker = "REGRESSION" if row["regression"] else "ok"
+            print(f"[{marker}] corpus {row['corpus_size']} {row['metric']}: {row['baseline']} -> {row['current']} ({row['change_pct']:+.1f}%)")
+        if regressions:
+            print(f"{len(regressions)} metric(s) regressed by more than {args.tolerance * 100:.0f}% against the baseline.")
+            return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,216 @@
+# 오프라인 벤치마크용 대역(stand-in)
+# - FakeAzureOpenAIServer: Azure OpenAI REST 경로(embeddings, chat/completions)를 흉내 내는 로컬 HTTP 서버
+#   같은 텍스트에는 항상 같은 벡터(단어 해시 기반)를 반환하므로 검색 결과가 재현 가능하고,
+#   요청별 지연과 분당 요청 수 제한(초과 시 429 + Retry-After)을 설정할 수 있음
+# - 저장소는 storage_backends.LocalContainerClient(simulated_latency_seconds)를 사용
+# - 합성 SOP 문서 생성 (txt / docx / pdf / xlsx)
+import base64
+import hashlib
+import io
+import json
+import math
+import random
+import re
+import struct
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+FAKE_EMBEDDING_DIMENSION = 1536 # 앱의 FAISS 인덱스 차원과 같아야 함
+FAKE_CHAT_ANSWER = "제공된 문서에 따르면 해당 절차는 SOP에 정의된 순서대로 수행해야 합니다."
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+
+SOP_TOPICS = ["일탈 관리", "변경 관리", "교육 훈련", "데이터 백업", "장비 적격성 평가", "세척 밸리데이션", "문서 관리", "감사 추적",
+              "컴퓨터화 시스템 밸리데이션", "시정 및 예방 조치", "공급업체 평가", "보관 및 출하", "환경 모니터링", "시험 기록 검토"]
+SOP_ACTIONS = ["검토한다", "승인한다", "기록한다", "보관한다", "확인한다", "보고한다", "평가한다", "교육한다"]
+SOP_SUBJECTS = ["QA 담당자", "부서장", "작업자", "시스템 관리자", "품질 책임자", "밸리데이션 담당자"]
+SOP_OBJECTS = ["점검 결과", "변경 요청서", "일탈 보고서", "백업 로그", "교육 기록", "감사 추적 기록", "시험 성적서", "장비 사용 일지"]
+
+
+def deterministic_embedding(text, dimension=FAKE_EMBEDDING_DIMENSION):
+    # 단어마다 해시로 차원과 부호를 정해 더한 뒤 정규화 (bag-of-words). 같은 단어를 공유하는 텍스트끼리 가까워짐
+    vector = [0.0] * dimension
+    for word in WORD_PATTERN.findall(text.lower()):
+        digest = hashlib.md5(word.encode("utf-8")).digest()
+        vector[int.from_bytes(digest[:4], "little") % dimension] += 1.0 if digest[4] & 1 else -1.0
+    norm = math.sqrt(sum(value * value for value in vector))
+    if norm == 0:
+        vector[0], norm = 1.0, 1.0
+    return [value / norm for value in vector]
+
+
+class RateLimiter:
+    # 분당 요청 수 제한 (토큰 버킷). 0이면 제한 없음
+    def __init__(self, requests_per_minute=0):
+        self.requests_per_minute = requests_per_minute
+        self._tokens = float(requests_per_minute)
+        self._updated_at = time.monotonic()
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        # 반환: 다시 시도하기까지 기다릴 초 (0이면 허용)
+        if self.requests_per_minute <= 0:
+            return 0.0
+        refill_per_second = self.requests_per_minute / 60.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(float(self.requests_per_minute), self._tokens + (now - self._updated_at) * refill_per_second)
+            self._updated_at = now
+            if self._tokens >= 1.0:
+                self._tokens -= 1.0
+                return 0.0
+            return (1.0 - self._tokens) / refill_per_second
+
+
+class FakeAzureOpenAIServer:
+    # latency_ms: 요청당 기본 지연, embedding_latency_per_item_ms: 임베딩 입력 하나당 추가 지연
+    # chat_latency_ms: 채팅 요청당 지연 (latency_ms 대신), requests_per_minute: 전체 요청 수 제한
+    def __init__(self, host="127.0.0.1", port=0, latency_ms=0.0, embedding_latency_per_item_ms=0.0,
+                 chat_latency_ms=None, requests_per_minute=0):
+        self.latency_ms = latency_ms
+        self.embedding_latency_per_item_ms = embedding_latency_per_item_ms
+        self.chat_latency_ms = chat_latency_ms
+        self.rate_limiter = RateLimiter(requests_per_minute)
+        self.stats = {"embedding_requests": 0, "embedding_inputs": 0, "chat_requests": 0, "rate_limited": 0, "errors": 0}
+        self._stats_lock = threading.Lock()
+        self._httpd = ThreadingHTTPServer((host, port), self._make_handler())
+        self._httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def endpoint(self):
+        host, port = self._httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(target=self._httpd.serve_forever, name="fake-azure-openai", daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._httpd.shutdown()
+        self._httpd.server_close()
+
+    def count(self, stat_name, amount=1):
+        with self._stats_lock:
+            self.stats[stat_name] += amount
+
+    def snapshot_stats(self):
+        with self._stats_lock:
+            return dict(self.stats)
+
+    def handle_embeddings(self, request_body):
+        input_texts = request_body.get("input")
+        if isinstance(input_texts, str):
+            input_texts = [input_texts]
+        self.count("embedding_requests"); self.count("embedding_inputs", len(input_texts))
+        time.sleep((self.latency_ms + self.embedding_latency_per_item_ms * len(input_texts)) / 1000)
+        use_base64 = request_body.get("encoding_format") == "base64" # openai SDK 기본값
+        data, prompt_tokens = [], 0
+        for item_index, input_text in enumerate(input_texts):
+            vector = deterministic_embedding(str(input_text))
+            prompt_tokens += max(1, len(str(input_text)) // 4)
+            embedding = base64.b64encode(struct.pack(f"<{len(vector)}f", *vector)).decode("ascii") if use_base64 else vector
+            data.append({"object": "embedding", "index": item_index, "embedding": embedding})
+        return {"object": "list", "data": data, "model": request_body.get("model", "fake-embedding"),
+                "usage": {"prompt_tokens": prompt_tokens, "total_tokens": prompt_tokens}}
+
+    def handle_chat_completion(self, request_body, deployment):
+        self.count("chat_requests")
+        time.sleep((self.chat_latency_ms if self.chat_latency_ms is not None else self.latency_ms) / 1000)
+        prompt_tokens = sum(max(1, len(json.dumps(message.get("content"), ensure_ascii=False)) // 4) for message in request_body.get("messages") or [])
+        completion_tokens = max(1, len(FAKE_CHAT_ANSWER) // 4)
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}", "object": "chat.completion", "created": int(time.time()), "model": deployment,
+            "choices": [{"index": 0, "finish_reason": "stop", "message": {"role": "assistant", "content": FAKE_CHAT_ANSWER}}],
+            "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        }
+
+    def _make_handler(self):
+        server = self
+
+        class FakeAzureOpenAIHandler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass # 요청마다 출력하지 않음
+
+            def send_json(self, status_code, payload, headers=None):
+                response_bytes = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+                self.send_response(status_code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response_bytes)))
+                for header_name, header_value in (headers or {}).items():
+                    self.send_header(header_name, header_value)
+                self.end_headers()
+                self.wfile.write(response_bytes)
+
+            def do_POST(self):
+                request_body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                path_parts = self.path.split("?", 1)[0].strip("/").split("/") # openai/deployments/{이름}/{작업...}
+                retry_after = server.rate_limiter.try_acquire()
+                if retry_after > 0:
+                    server.count("rate_limited")
+                    self.send_json(429, {"error": {"code": "429", "message": "Rate limit exceeded (fake server)."}},
+                                   headers={"Retry-After": str(max(1, math.ceil(retry_after))), "retry-after-ms": str(int(retry_after * 1000))})
+                    return
+                try:
+                    if len(path_parts) >= 4 and path_parts[:2] == ["openai", "deployments"] and path_parts[3] == "embeddings":
+                        self.send_json(200, server.handle_embeddings(request_body))
+                    elif len(path_parts) >= 5 and path_parts[:2] == ["openai", "deployments"] and path_parts[3:5] == ["chat", "completions"]:
+                        self.send_json(200, server.handle_chat_completion(request_body, path_parts[2]))
+                    else:
+                        self.send_json(404, {"error": {"code": "404", "message": f"Unknown path: {self.path}"}})
+                except Exception as e_fake:
+                    server.count("errors")
+                    self.send_json(500, {"error": {"code": "500", "message": str(e_fake)}})
+
+        return FakeAzureOpenAIHandler
+
+
+def generate_sop_text(doc_no, sections=8, sentences_per_section=6, seed=0):
+    # 재현 가능한 합성 SOP 본문. 문서마다 주제와 고유 번호가 달라 검색 질의로 구분 가능
+    rng = random.Random(seed * 100003 + doc_no)
+    topic = SOP_TOPICS[doc_no % len(SOP_TOPICS)]
+    lines = [f"SOP-{doc_no:04d} {topic} 절차서", f"문서 번호: SOP-QA-{doc_no:04d} / 개정 {rng.randint(0, 9)}", ""]
+    for section_no in range(1, sections + 1):
+        lines.append(f"{section_no}. {topic} {['목적', '적용 범위', '책임', '절차', '기록', '교육', '예외 처리', '참고 문서'][(section_no - 1) % 8]}")
+        for _ in range(sentences_per_section):
+            lines.append(f"{rng.choice(SOP_SUBJECTS)}는 {topic} 관련 {rng.choice(SOP_OBJECTS)}를 {rng.randint(1, 30)}일 이내에 {rng.choice(SOP_ACTIONS)}.")
+        lines.append("")
+    return "\n".join(lines)
+
+
+def generate_sop_question(doc_no, seed=0):
+    rng = random.Random(seed * 7919 + doc_no)
+    topic = SOP_TOPICS[doc_no % len(SOP_TOPICS)]
+    return f"SOP-{doc_no:04d} {topic} 절차에서 {rng.choice(SOP_OBJECTS)}는 누가 언제까지 {rng.choice(SOP_ACTIONS).replace('한다', '해야 하나요')}?"
+
+
+def render_document(text, file_format):
+    # 반환: (파일 확장자, bytes, MIME 형식). docx/pdf/xlsx는 해당 라이브러리가 필요
+    if file_format == "txt":
+        return ".txt", text.encode("utf-8"), "text/plain"
+    if file_format == "docx":
+        import docx
+        document = docx.Document()
+        for line in text.split("\n"):
+            document.add_paragraph(line)
+        output = io.BytesIO(); document.save(output)
+        return ".docx", output.getvalue(), "application/vnd.openxmlformats-officedocument.wordprocessingml.document"
+    if file_format == "pdf":
+        import fitz # PyMuPDF
+        pdf_document = fitz.open()
+        lines = text.split("\n")
+        for page_start in range(0, len(lines), 45):
+            page = pdf_document.new_page()
+            page.insert_text((50, 60), "\n".join(lines[page_start:page_start + 45]), fontsize=9, fontname="korea") # 한글 내장 글꼴
+        pdf_bytes = pdf_document.tobytes(); pdf_document.close()
+        return ".pdf", pdf_bytes, "application/pdf"
+    if file_format == "xlsx":
+        import pandas as pd
+        output = io.BytesIO()
+        pd.DataFrame({"line": text.split("\n")}).to_excel(output, index=False)
+        return ".xlsx", output.getvalue(), "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+    raise ValueError(f"Unsupported synthetic document format: {file_format}")
@@ -0,0 +1,63 @@
+# 관리자 화면 Blob 탐색기
+# - 경로(prefix) 단위로 한 페이지씩만 조회 (서비스의 continuation token 사용, 전체 목록을 내려받아 정렬하지 않음)
+# - 같은 페이지를 짧은 TTL 동안 캐시하여 rerun마다 다시 조회하지 않음
+# - 최신순 보기는 Blob을 쓰거나 지울 때 남기는 변경 기록(날짜별 JSONL, log_writer의 "changes" 스트림)을 사용
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from log_writer import LOG_TIMESTAMP_FORMAT
+
+
+def make_blob_change_entry(blob_name, action, size=None):
+    return {"timestamp": datetime.now().strftime(LOG_TIMESTAMP_FORMAT), "blob": blob_name, "action": action, "size": size}
+
+
+def blob_item_to_row(blob_item):
+    last_modified = getattr(blob_item, "last_modified", None)
+    return {
+        "name": blob_item.name, "size": getattr(blob_item, "size", None),
+        "last_modified": last_modified.strftime(LOG_TIMESTAMP_FORMAT) if last_modified else None
+    }
+
+
+def list_blob_page(container_client, prefix="", page_size=100, continuation_token=None):
+    # 반환: (행 목록, 다음 페이지 token 또는 None). 이름순(서비스 정렬)으로 page_size개씩
+    pager = container_client.list_blobs(name_starts_with=prefix or None, results_per_page=page_size).by_page(continuation_token=continuation_token)
+    try:
+        page_items = next(pager)
+    except StopIteration:
+        return [], None
+    return [blob_item_to_row(blob_item) for blob_item in page_items], pager.continuation_token
+
+
+class BlobListingCache:
+    # (prefix, page_size, token) -> (행 목록, 다음 token). TTL이 지나면 다시 조회
+    def __init__(self, ttl_seconds=30.0, max_entries=200):
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_page(self, container_client, prefix="", page_size=100, continuation_token=None):
+        cache_key = (prefix, page_size, continuation_token)
+        with self._lock:
+            cached_entry = self._entries.get(cache_key)
+            if cached_entry and time.monotonic() - cached_entry[0] < self.ttl_seconds:
+                return cached_entry[1], cached_entry[2]
+        rows, next_token = list_blob_page(container_client, prefix, page_size, continuation_token)
+        with self._lock:
+            self._entries[cache_key] = (time.monotonic(), rows, next_token)
+            self._entries.move_to_end(cache_key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return rows, next_token
+
+    def invalidate(self, prefix=None):
+        with self._lock:
+            if prefix is None:
+                self._entries.clear()
+            else:
+                for cache_key in [k for k in self._entries if k[0] == prefix]:
+                    del self._entries[cache_key]
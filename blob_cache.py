@@ -0,0 +1,82 @@
+# Blob에 저장된 JSON 문서(사용자 정보, 대화 색인 등)를 위한 프로세스 공용 캐시
+# - TTL 안에서는 네트워크 요청 없이 메모리의 값을 반환
+# - TTL이 지나면 ETag 조건부 GET(If-None-Match)으로 검증: 변경이 없으면 304만 받고 본문은 내려받지 않음
+# - 이 프로세스에서 쓴 값은 put()으로 바로 반영, 삭제 등 다른 경로의 변경은 invalidate()로 무효화
+# 반환값은 항상 복사본이므로 호출한 쪽에서 수정해도 캐시된 값은 바뀌지 않는다.
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceNotFoundError, ResourceNotModifiedError
+
+from blob_io import parse_downloaded_json
+
+BLOB_NOT_FOUND = object() # Blob이 없을 때 get()이 반환하는 값
+
+
+class BlobDocumentCache:
+    def __init__(self, container_client, ttl_seconds=10.0, max_entries=256):
+        self.container_client = container_client
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self._entries = OrderedDict() # blob 이름 -> {"data", "etag", "validated_at"}
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "revalidated": 0, "downloads": 0, "not_found": 0}
+
+    def _store(self, blob_name, data, etag):
+        with self._lock:
+            self._entries[blob_name] = {"data": data, "etag": etag, "validated_at": time.monotonic()}
+            self._entries.move_to_end(blob_name)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def _count(self, stat_name):
+        with self._lock:
+            self.stats[stat_name] += 1
+
+    def get(self, blob_name):
+        # 파싱된 JSON(빈 파일이면 None) 또는 BLOB_NOT_FOUND. JSON 파싱 오류/Azure 오류는 호출한 쪽으로 전달
+        return self.get_with_etag(blob_name)[0]
+
+    def get_with_etag(self, blob_name):
+        # (데이터, ETag). 조건부 업로드(blob_io.update_json_blob)의 첫 시도 기준 값으로 사용
+        with self._lock:
+            entry = self._entries.get(blob_name)
+            if entry is not None:
+                self._entries.move_to_end(blob_name)
+                if time.monotonic() - entry["validated_at"] < self.ttl_seconds:
+                    self.stats["hits"] += 1
+                    return self._copy_data(entry["data"]), entry["etag"]
+
+        blob_client = self.container_client.get_blob_client(blob_name)
+        try:
+            if entry is not None and entry["etag"]:
+                downloader = blob_client.download_blob(etag=entry["etag"], match_condition=MatchConditions.IfModified, timeout=60)
+            else:
+                downloader = blob_client.download_blob(timeout=60)
+            data = parse_downloaded_json(downloader)
+        except ResourceNotModifiedError:
+            self._count("revalidated")
+            self._store(blob_name, entry["data"], entry["etag"])
+            return self._copy_data(entry["data"]), entry["etag"]
+        except ResourceNotFoundError:
+            self._count("not_found")
+            self._store(blob_name, BLOB_NOT_FOUND, None)
+            return BLOB_NOT_FOUND, None
+        self._count("downloads")
+        self._store(blob_name, data, downloader.properties.etag)
+        return copy.deepcopy(data), downloader.properties.etag
+
+    @staticmethod
+    def _copy_data(data):
+        return data if data is BLOB_NOT_FOUND else copy.deepcopy(data)
+
+    def put(self, blob_name, data, etag):
+        # 이 프로세스에서 업로드한 값 반영 (업로드 응답의 ETag를 함께 저장해 다음 검증에 사용)
+        self._store(blob_name, copy.deepcopy(data), etag)
+
+    def invalidate(self, blob_name):
+        with self._lock:
+            self._entries.pop(blob_name, None)
@@ -0,0 +1,143 @@
+# Blob JSON 읽기/쓰기 도우미
+# - 임시 파일 없이 메모리에서 간결한(compact) JSON으로 직렬화
+# - 선택적으로 gzip/zstd 압축. 압축 방식은 Blob 메타데이터(payload_encoding)에 기록하고,
+#   메타데이터가 없는 이전 파일도 읽을 수 있도록 매직 바이트로도 판별
+#   (HTTP Content-Encoding 헤더는 전송 계층에서 자동 해제될 수 있어 사용하지 않음)
+# - ETag 조건부 업로드: 다른 곳에서 먼저 수정했으면 최신 값을 다시 읽어 update_fn을 다시 적용(merge)한 뒤 재시도
+# - Append Blob에 줄 단위로 덧붙이기 (로그, 대화 자동 저장)
+import copy
+import gzip
+import json
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError
+from azure.storage.blob import ContentSettings
+
+try:
+    import zstandard # 선택 사항. 설치되어 있지 않으면 zstd 요청 시 gzip 사용
+except ImportError:
+    zstandard = None
+
+PAYLOAD_ENCODING_METADATA_KEY = "payload_encoding"
+PAYLOAD_ENCODING_GZIP = "gzip"
+PAYLOAD_ENCODING_ZSTD = "zstd"
+GZIP_MAGIC = b"\x1f\x8b"
+ZSTD_MAGIC = b"\x28\xb5\x2f\xfd"
+DEFAULT_MAX_UPDATE_ATTEMPTS = 5
+MAX_APPEND_BLOCK_BYTES = 4 * 1024 * 1024 # Append Blob 블록 하나의 최대 크기
+
+
+class BlobWriteConflictError(Exception):
+    # 조건부 업로드가 재시도 횟수 안에 성공하지 못했을 때 (동시 수정이 계속 발생)
+    pass
+
+
+class BlobAppendError(Exception):
+    # 여러 블록으로 나눈 덧붙이기가 중간에 실패했을 때. committed_lines: 이미 기록된 앞쪽 줄 수 (다시 보내면 중복)
+    def __init__(self, message, committed_lines):
+        super().__init__(message)
+        self.committed_lines = committed_lines
+
+
+def encode_json_payload(data, compression=None):
+    # 반환: (bytes, payload_encoding 또는 None)
+    payload = json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if compression == PAYLOAD_ENCODING_ZSTD and zstandard is None:
+        print("WARNING: zstandard is not installed. Using gzip compression instead of zstd.")
+        compression = PAYLOAD_ENCODING_GZIP
+    if compression == PAYLOAD_ENCODING_ZSTD:
+        return zstandard.ZstdCompressor(level=3).compress(payload), PAYLOAD_ENCODING_ZSTD
+    if compression == PAYLOAD_ENCODING_GZIP:
+        return gzip.compress(payload, compresslevel=6, mtime=0), PAYLOAD_ENCODING_GZIP
+    return payload, None
+
+
+def decode_blob_payload(raw_bytes, payload_encoding=None):
+    # 압축 해제된 bytes 반환
+    if payload_encoding == PAYLOAD_ENCODING_GZIP or (payload_encoding is None and raw_bytes[:2] == GZIP_MAGIC):
+        return gzip.decompress(raw_bytes)
+    if payload_encoding == PAYLOAD_ENCODING_ZSTD or (payload_encoding is None and raw_bytes[:4] == ZSTD_MAGIC):
+        if zstandard is None:
+            raise RuntimeError("Blob payload is zstd-compressed but the zstandard package is not installed.")
+        return zstandard.ZstdDecompressor().decompressobj().decompress(raw_bytes)
+    return raw_bytes
+
+
+def parse_downloaded_json(downloader):
+    # download_blob() 결과를 JSON으로 파싱. 빈 파일이면 None
+    raw_bytes = downloader.readall()
+    if not raw_bytes:
+        return None
+    payload_encoding = (getattr(downloader.properties, "metadata", None) or {}).get(PAYLOAD_ENCODING_METADATA_KEY)
+    return json.loads(decode_blob_payload(raw_bytes, payload_encoding))
+
+
+def download_json_blob(container_client, blob_name, timeout=60):
+    # 반환: (데이터, ETag). 없으면 ResourceNotFoundError
+    downloader = container_client.get_blob_client(blob_name).download_blob(timeout=timeout)
+    return parse_downloaded_json(downloader), downloader.properties.etag
+
+
+def upload_json_blob(container_client, blob_name, data, compression=None, etag=None, if_missing=False, timeout=60):
+    # etag: 지정하면 해당 버전일 때만 덮어씀 (다르면 ResourceModifiedError)
+    # if_missing: Blob이 없을 때만 생성 (있으면 ResourceExistsError)
+    # 반환: 새 ETag
+    payload, payload_encoding = encode_json_payload(data, compression)
+    upload_kwargs = {
+        "overwrite": not if_missing, "timeout": timeout,
+        "content_settings": ContentSettings(content_type="application/json; charset=utf-8"),
+        "metadata": {PAYLOAD_ENCODING_METADATA_KEY: payload_encoding} if payload_encoding else {}
+    }
+    if etag and not if_missing:
+        upload_kwargs.update(etag=etag, match_condition=MatchConditions.IfNotModified)
+    upload_result = container_client.get_blob_client(blob_name).upload_blob(payload, **upload_kwargs)
+    return (upload_result or {}).get("etag")
+
+
+def update_json_blob(container_client, blob_name, update_fn, compression=None, default_value=None,
+                     read_fn=None, max_attempts=DEFAULT_MAX_UPDATE_ATTEMPTS, timeout=60):
+    # 읽기 -> update_fn(현재 값) -> 조건부 업로드. 충돌하면 최신 값을 다시 읽어 update_fn을 다시 적용
+    # update_fn은 같은 변경을 여러 번(다른 기준 값에) 적용해도 되도록 작성해야 함 (예: users[uid]["approved"] = True)
+    # read_fn(blob_name) -> (데이터, ETag): 첫 시도에만 사용 (예: 캐시). 이후 시도는 항상 Blob에서 직접 읽음
+    # 반환: (저장된 데이터, 새 ETag)
+    for attempt in range(1, max_attempts + 1):
+        try:
+            current_data, etag = read_fn(blob_name) if (attempt == 1 and read_fn) else download_json_blob(container_client, blob_name, timeout)
+        except ResourceNotFoundError:
+            current_data, etag = None, None
+        if current_data is None:
+            current_data = copy.deepcopy(default_value)
+        updated_data = update_fn(current_data)
+        try:
+            new_etag = upload_json_blob(container_client, blob_name, updated_data, compression, etag=etag, if_missing=etag is None, timeout=timeout)
+            return updated_data, new_etag
+        except (ResourceModifiedError, ResourceExistsError):
+            print(f"Blob '{blob_name}' was modified concurrently. Re-reading and merging ({attempt}/{max_attempts}).")
+    raise BlobWriteConflictError(f"Could not update '{blob_name}' after {max_attempts} attempts due to concurrent modifications.")
+
+
+def append_blob_lines(container_client, blob_name, lines, timeout=30):
+    # Append Blob에 줄들을 덧붙임 (없으면 생성). 블록 크기 한도를 넘지 않도록 줄 경계에서 나누어 보냄
+    # 블록 하나는 원자적으로 기록되므로, 중간 블록에서 실패하면 BlobAppendError로 이미 기록된 줄 수를 알려줌
+    blob_client = container_client.get_blob_client(blob_name)
+    payloads, current_payload, current_line_count = [], b"", 0 # [(블록, 줄 수)]
+    for line in lines:
+        encoded_line = line.encode("utf-8")
+        if current_payload and len(current_payload) + len(encoded_line) > MAX_APPEND_BLOCK_BYTES:
+            payloads.append((current_payload, current_line_count)); current_payload, current_line_count = b"", 0
+        current_payload += encoded_line; current_line_count += 1
+    if current_payload: payloads.append((current_payload, current_line_count))
+    committed_lines = 0
+    for payload, line_count in payloads:
+        try:
+            try:
+                blob_client.append_block(payload, timeout=timeout)
+            except ResourceNotFoundError:
+                try:
+                    blob_client.create_append_blob(etag="*", match_condition=MatchConditions.IfMissing, timeout=timeout)
+                except ResourceExistsError:
+                    pass # 다른 프로세스가 먼저 만든 경우
+                blob_client.append_block(payload, timeout=timeout)
+        except Exception as e_append:
+            raise BlobAppendError(f"Appending to '{blob_name}' failed after {committed_lines}/{len(lines)} lines: {e_append}", committed_lines) from e_append
+        committed_lines += line_count
@@ -0,0 +1,205 @@
+# 학습 시 중복 청크 줄이기
+# - 머리말/꼬리말 제거: 페이지(PDF 페이지, PPTX 슬라이드)마다 위/아래 몇 줄에 반복되는 줄(숫자만 다른 "Page 3 of 10" 포함)을 청크 분할 전에 제거
+#   페이지 구분은 extract_text_from_file이 넣는 PAGE_BREAK("\f")
+# - 근접 중복 청크: 글자 n-gram MinHash 서명 + LSH 밴딩으로 후보를 찾고, 서명으로 추정한 Jaccard 유사도가 임계값 이상이면 중복
+#   · 같은 문서 안의 근접 중복과 샤드에 이미 있는 완전 중복(공백 정규화 후 동일)은 건너뜀
+#   · 샤드에 있는 근접 중복은 이미 max_cross_file_copies개 이상 있을 때만 건너뜀 (상용구는 여러 문서에 반복되고,
+#     개정판 SOP처럼 숫자 몇 개만 다른 청크는 보통 이전 판 하나와만 비슷하므로 보존)
+# - numpy만 사용 (검색 프로세스와 같은 의존성)
+import hashlib
+import re
+import time
+from collections import Counter
+
+from text_chunking import PAGE_BREAK
+SHINGLE_SIZE = 5 # 글자 수 (한국어는 단어보다 글자 n-gram이 안정적)
+NUM_PERMUTATIONS = 128
+LSH_BANDS = 16 # 밴드당 8행: 유사도 0.9면 후보가 될 확률 ~99.99%, 0.5면 ~6%
+NEAR_DUPLICATE_THRESHOLD = 0.9
+MAX_CROSS_FILE_COPIES = 2
+HEADER_FOOTER_SCAN_LINES = 3 # 페이지 위/아래에서 머리말/꼬리말로 볼 줄 수
+HEADER_FOOTER_MIN_PAGES = 3
+HEADER_FOOTER_MIN_PAGE_RATIO = 0.6
+MAX_HEADER_FOOTER_LINE_LENGTH = 150
+PAGE_NUMBER_LINE_MAX_LENGTH = 40
+
+
+def normalize_chunk_text(text):
+    return re.sub(r"\s+", " ", text or "").strip()
+
+
+def normalize_page_line(line):
+    # 짧은 줄은 페이지 번호/날짜처럼 숫자만 달라도 같은 줄로 봄 (긴 본문 줄은 그대로 비교)
+    normalized_line = normalize_chunk_text(line)
+    return re.sub(r"\d+", "#", normalized_line) if len(normalized_line) <= PAGE_NUMBER_LINE_MAX_LENGTH else normalized_line
+
+
+def strip_repeated_page_lines(text, scan_lines=HEADER_FOOTER_SCAN_LINES, min_pages=HEADER_FOOTER_MIN_PAGES, min_page_ratio=HEADER_FOOTER_MIN_PAGE_RATIO):
+    # 반환: (제거 후 텍스트, 통계 dict). 페이지 구분이 없거나 페이지가 적으면 그대로
+    pages = text.split(PAGE_BREAK) if text else []
+    stats = {"pages": len(pages), "lines_removed": 0, "chars_removed": 0, "patterns": 0}
+    if len(pages) < min_pages:
+        return text, stats
+    page_lines = [page.split("\n") for page in pages]
+    edge_line_counts = Counter()
+    for lines in page_lines:
+        content_positions = [line_no for line_no, line in enumerate(lines) if line.strip()]
+        edge_positions = content_positions[:scan_lines] + content_positions[-scan_lines:]
+        edge_line_counts.update({normalize_page_line(lines[line_no]) for line_no in edge_positions
+                                 if len(lines[line_no].strip()) <= MAX_HEADER_FOOTER_LINE_LENGTH})
+    min_count = max(min_pages, int(len(pages) * min_page_ratio + 0.999))
+    repeated_lines = {line for line, count in edge_line_counts.items() if line and count >= min_count}
+    if not repeated_lines:
+        return text, stats
+    stripped_pages = []
+    for lines in page_lines:
+        content_positions = [line_no for line_no, line in enumerate(lines) if line.strip()]
+        edge_positions = set(content_positions[:scan_lines] + content_positions[-scan_lines:])
+        kept_lines = []
+        for line_no, line in enumerate(lines):
+            if line_no in edge_positions and normalize_page_line(line) in repeated_lines:
+                stats["lines_removed"] += 1; stats["chars_removed"] += len(line)
+            else:
+                kept_lines.append(line)
+        stripped_pages.append("\n".join(kept_lines))
+    stats["patterns"] = len(repeated_lines)
+    return PAGE_BREAK.join(stripped_pages), stats
+
+
+class MinHasher:
+    def __init__(self, num_permutations=NUM_PERMUTATIONS, shingle_size=SHINGLE_SIZE, seed=1):
+        import numpy
+        self.np = numpy
+        self.shingle_size = shingle_size
+        random_state = numpy.random.RandomState(seed)
+        # 64비트 곱셈-이동 해시 (numpy uint64 곱셈은 2^64로 나눈 나머지)
+        self.multipliers = random_state.randint(1, 2**63 - 1, size=num_permutations, dtype=numpy.int64).astype(numpy.uint64) | numpy.uint64(1)
+        self.offsets = random_state.randint(0, 2**63 - 1, size=num_permutations, dtype=numpy.int64).astype(numpy.uint64)
+
+    def shingle_hashes(self, normalized_text):
+        np = self.np
+        code_points = np.frombuffer(normalized_text.encode("utf-32-le"), dtype=np.uint32).astype(np.uint64)
+        if len(code_points) <= self.shingle_size:
+            return np.array([int.from_bytes(hashlib.blake2b(normalized_text.encode("utf-8"), digest_size=8).digest(), "little")], dtype=np.uint64)
+        shingle_count = len(code_points) - self.shingle_size + 1
+        hashes = np.zeros(shingle_count, dtype=np.uint64)
+        with np.errstate(over="ignore"):
+            for offset in range(self.shingle_size): # 다항식 해시 (벡터 연산)
+                hashes = hashes * np.uint64(1000003) + code_points[offset:offset + shingle_count]
+        return np.unique(hashes)
+
+    def signature(self, normalized_text):
+        np = self.np
+        shingles = self.shingle_hashes(normalized_text)
+        with np.errstate(over="ignore"):
+            permuted = self.multipliers[:, None] * shingles[None, :] + self.offsets[:, None]
+        return permuted.min(axis=1)
+
+
+class NearDuplicateIndex:
+    # 서명 목록 + LSH 버킷. 항목마다 출처 파일 이름을 함께 보관
+    # 서명은 하위 32비트만 보관 (메모리/저장 크기 절반. 값이 우연히 같을 확률 2^-32라 유사도 추정에 영향 없음)
+    # to_rows()/add_entries(stored_rows=)로 서명을 저장했다가 다시 쓸 수 있음 (샤드 메타데이터 옆 파일, vector_shards)
+    def __init__(self, threshold=NEAR_DUPLICATE_THRESHOLD, num_permutations=NUM_PERMUTATIONS, bands=LSH_BANDS, hasher=None):
+        self.threshold = threshold
+        self.hasher = hasher or MinHasher(num_permutations)
+        self.np = self.hasher.np
+        self.num_permutations = num_permutations
+        self.rows_per_band = num_permutations // bands
+        self.bands = bands
+        self._signatures, self._file_names, self._content_checks = [], [], []
+        self._exact_keys = {} # 정규화한 내용 해시 -> 항목 번호
+        self._buckets = [dict() for _ in range(bands)]
+
+    def __len__(self):
+        return len(self._signatures)
+
+    def _band_keys(self, signature):
+        return [signature[band_no * self.rows_per_band:(band_no + 1) * self.rows_per_band].tobytes() for band_no in range(self.bands)]
+
+    @staticmethod
+    def exact_key(normalized_text):
+        return hashlib.sha1(normalized_text.encode("utf-8")).digest()
+
+    @staticmethod
+    def content_check(exact_key):
+        # 저장한 서명 행이 어떤 내용의 서명인지 확인하는 값
+        return int.from_bytes(exact_key[:4], "little")
+
+    def _compact(self, signature):
+        return self.np.asarray(signature).astype(self.np.uint32)
+
+    def add(self, normalized_text, file_name, signature=None):
+        signature = self._compact(self.hasher.signature(normalized_text) if signature is None else signature)
+        exact_key = self.exact_key(normalized_text)
+        item_no = len(self._signatures)
+        self._signatures.append(signature); self._file_names.append(file_name); self._content_checks.append(self.content_check(exact_key))
+        self._exact_keys.setdefault(exact_key, item_no)
+        for band_no, band_key in enumerate(self._band_keys(signature)):
+            self._buckets[band_no].setdefault(band_key, []).append(item_no)
+
+    def add_entries(self, metadata_entries, stored_rows=None):
+        # stored_rows: 이전에 to_rows()로 저장한 행. 앞에서부터 내용이 일치하는 행의 서명은 다시 계산하지 않음 (일치하지 않는 행부터 계산)
+        # 반환: 저장한 서명을 다시 쓴 항목 수
+        reusable_rows = stored_rows if stored_rows is not None and stored_rows.ndim == 2 and stored_rows.shape[1] == self.num_permutations + 1 else None
+        reused_count = 0
+        for entry in metadata_entries:
+            if not isinstance(entry, dict):
+                continue
+            normalized_text = normalize_chunk_text(entry.get("content", ""))
+            signature, item_no = None, len(self._signatures)
+            if reusable_rows is not None and item_no < len(reusable_rows) and int(reusable_rows[item_no, 0]) == self.content_check(self.exact_key(normalized_text)):
+                signature = reusable_rows[item_no, 1:]; reused_count += 1
+            else:
+                reusable_rows = None
+            self.add(normalized_text, entry.get("file_name", ""), signature)
+        return reused_count
+
+    def to_rows(self):
+        # 반환: 항목마다 [내용 확인 값, 서명...] (uint32 2차원 배열)
+        np = self.np
+        if not self._signatures:
+            return np.zeros((0, self.num_permutations + 1), dtype=np.uint32)
+        return np.column_stack([np.array(self._content_checks, dtype=np.uint32), np.vstack(self._signatures)])
+
+    def find_exact(self, normalized_text):
+        return self._exact_keys.get(self.exact_key(normalized_text))
+
+    def find_similar(self, signature):
+        # 반환: 임계값 이상인 항목의 출처 파일 이름 집합
+        signature = self._compact(signature)
+        candidate_item_nos = set()
+        for band_no, band_key in enumerate(self._band_keys(signature)):
+            candidate_item_nos.update(self._buckets[band_no].get(band_key, ()))
+        return {self._file_names[item_no] for item_no in candidate_item_nos
+                if float((self._signatures[item_no] == signature).mean()) >= self.threshold}
+
+
+def filter_near_duplicate_chunks(chunks, file_name, corpus_index=None, dimension=0, max_cross_file_copies=MAX_CROSS_FILE_COPIES,
+                                 threshold=NEAR_DUPLICATE_THRESHOLD):
+    # 반환: (남길 청크 번호 목록, 통계 dict). corpus_index: 샤드에 이미 있는 청크의 NearDuplicateIndex (없으면 문서 안에서만 비교)
+    # dimension: 절약한 인덱스 크기 계산용 (IndexFlatL2는 벡터당 dimension x 4바이트)
+    started_at = time.perf_counter()
+    document_index = NearDuplicateIndex(threshold, hasher=corpus_index.hasher if corpus_index is not None else None)
+    kept_positions, stats = [], {"input_chunks": len(chunks), "exact_duplicates": 0, "near_duplicates": 0, "content_bytes_saved": 0}
+    for chunk_no, chunk in enumerate(chunks):
+        normalized_text = normalize_chunk_text(chunk)
+        if not normalized_text:
+            continue
+        is_exact_duplicate = document_index.find_exact(normalized_text) is not None or (corpus_index is not None and corpus_index.find_exact(normalized_text) is not None)
+        is_near_duplicate = False
+        if not is_exact_duplicate:
+            signature = document_index.hasher.signature(normalized_text)
+            is_near_duplicate = bool(document_index.find_similar(signature))
+            if not is_near_duplicate and corpus_index is not None:
+                is_near_duplicate = len(corpus_index.find_similar(signature)) >= max_cross_file_copies
+        if is_exact_duplicate or is_near_duplicate:
+            stats["exact_duplicates" if is_exact_duplicate else "near_duplicates"] += 1
+            stats["content_bytes_saved"] += len(chunk.encode("utf-8"))
+            continue
+        document_index.add(normalized_text, file_name, signature)
+        kept_positions.append(chunk_no)
+    stats["embeddings_saved"] = stats["exact_duplicates"] + stats["near_duplicates"]
+    stats["index_bytes_saved"] = stats["embeddings_saved"] * dimension * 4
+    stats["elapsed_ms"] = round((time.perf_counter() - started_at) * 1000, 1)
+    return kept_positions, stats
@@ -0,0 +1,102 @@
+# 활성 대화 자동 저장 (write-behind)
+# - 답변이 끝날 때마다 schedule()로 대화 스냅샷을 넘기면 짧은 지연(debounce) 뒤 백그라운드 스레드가 저장
+#   (지연 시간 안에 같은 대화가 여러 번 예약되면 마지막 스냅샷 한 번만 저장)
+# - 실제 저장 방식은 persist_fn(key, 스냅샷, 저장 상태) -> 새 저장 상태 가 결정
+#   (앱에서는 새 메시지만 대화별 tail 파일에 덧붙이고, 일정 개수마다 전체 스냅샷으로 합침)
+# - 채팅 처리 경로는 큐에 넣기만 하므로 답변 지연이 늘지 않음
+import threading
+import time
+import traceback
+
+AUTOSAVE_RETRY_DELAY_SECONDS = 5.0
+
+
+class ConversationAutosaver:
+    def __init__(self, persist_fn, debounce_seconds=1.5):
+        self.persist_fn = persist_fn
+        self.debounce_seconds = debounce_seconds
+        self._pending = {} # key -> (스냅샷, 저장 예정 시각)
+        self._saved_states = {} # key -> persist_fn이 반환한 저장 상태 (예: 저장된 메시지 수)
+        self._in_progress = set()
+        self._condition = threading.Condition()
+        self.stats = {"scheduled": 0, "saved": 0, "coalesced": 0, "failed": 0}
+        self._thread = threading.Thread(target=self._run, name="conversation-autosave", daemon=True)
+        self._thread.start()
+
+    def register_saved_state(self, key, saved_state):
+        # 대화를 불러왔을 때 이미 저장되어 있는 상태를 알려 줌 (그 이후 메시지만 새로 저장)
+        with self._condition:
+            if key not in self._pending and key not in self._in_progress:
+                self._saved_states[key] = dict(saved_state)
+
+    def schedule(self, key, snapshot):
+        with self._condition:
+            if key in self._pending:
+                self.stats["coalesced"] += 1
+                due_time = self._pending[key][1] # 처음 예약한 시각 유지 -> 계속 예약되어도 debounce 안에 저장
+            else:
+                due_time = time.monotonic() + self.debounce_seconds
+            self._pending[key] = (snapshot, due_time)
+            self.stats["scheduled"] += 1
+            self._condition.notify_all()
+
+    def flush(self, key=None, timeout=10.0):
+        # 예약된 저장을 즉시 실행하고 끝날 때까지 대기 (대화 전환/로그아웃 시). key가 None이면 전체
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            for pending_key in ([key] if key is not None else list(self._pending)):
+                if pending_key in self._pending:
+                    self._pending[pending_key] = (self._pending[pending_key][0], time.monotonic())
+            self._condition.notify_all()
+            def is_done():
+                if key is None:
+                    return not self._pending and not self._in_progress
+                return key not in self._pending and key not in self._in_progress
+            while not is_done():
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(timeout=remaining)
+            return True
+
+    def cancel(self, key):
+        # 삭제된 대화의 예약 저장 취소 (진행 중인 저장은 끝날 때까지 기다림)
+        with self._condition:
+            self._pending.pop(key, None)
+            while key in self._in_progress:
+                self._condition.wait(timeout=1.0)
+            self._saved_states.pop(key, None)
+
+    def _next_due_key(self):
+        now = time.monotonic()
+        due_keys = [k for k, (_, due_time) in self._pending.items() if due_time <= now and k not in self._in_progress]
+        if due_keys:
+            return min(due_keys, key=lambda k: self._pending[k][1]), None
+        waiting_due_times = [due_time for k, (_, due_time) in self._pending.items() if k not in self._in_progress]
+        return None, (min(waiting_due_times) - now if waiting_due_times else None)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                due_key, wait_seconds = self._next_due_key()
+                while due_key is None:
+                    self._condition.wait(timeout=wait_seconds)
+                    due_key, wait_seconds = self._next_due_key()
+                snapshot, _ = self._pending.pop(due_key)
+                saved_state = dict(self._saved_states.get(due_key, {}))
+                self._in_progress.add(due_key)
+            try:
+                new_saved_state = self.persist_fn(due_key, snapshot, saved_state)
+                with self._condition:
+                    self._saved_states[due_key] = new_saved_state
+                    self.stats["saved"] += 1
+            except Exception as e_persist:
+                print(f"ERROR autosaving conversation {due_key}: {e_persist}\n{traceback.format_exc()}")
+                with self._condition:
+                    self.stats["failed"] += 1
+                    if due_key not in self._pending: # 그 사이 더 새로운 스냅샷이 없으면 같은 스냅샷으로 다시 시도
+                        self._pending[due_key] = (snapshot, time.monotonic() + AUTOSAVE_RETRY_DELAY_SECONDS)
+            finally:
+                with self._condition:
+                    self._in_progress.discard(due_key)
+                    self._condition.notify_all()
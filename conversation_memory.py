@@ -0,0 +1,112 @@
+# 멀티턴 대화 메모리
+# - 최근 턴은 토큰 예산 내에서 원문 그대로 LLM 요청에 포함
+# - 예산 밖으로 밀려난 오래된 턴은 누적(rolling) 요약으로 압축하여 대화와 함께 저장
+#   (요약은 새로 밀려난 턴이 있을 때만 갱신되므로 매 질문마다 다시 만들지 않음)
+
+MEMORY_SUMMARY_INSTRUCTION = (
+    "당신은 사내 GMP/SOP 업무 가이드 챗봇의 대화 기록을 압축하는 도우미입니다. "
+    "'기존 요약'과 '새 대화'를 합쳐, 이후 질문에 답하는 데 필요한 사실(질문 주제, 언급된 문서명/SOP 번호, "
+    "규정 조항, 수치, 사용자가 제시한 조건, 챗봇이 내린 결론)만 남긴 한국어 요약을 작성하십시오. "
+    "인사말이나 중복 내용은 제외하고, 요약문만 출력하십시오."
+)
+
+MESSAGE_TOKEN_OVERHEAD = 4 # 메시지마다 role 등 포맷 오버헤드로 추가되는 토큰 (근사치)
+
+
+def empty_memory_state():
+    return {"summary": "", "summarized_upto": 0}
+
+
+def truncate_text_to_tokens(text, tokenizer, max_tokens):
+    encoded_text = tokenizer.encode(text or "")
+    if len(encoded_text) <= max_tokens:
+        return text or ""
+    return tokenizer.decode(encoded_text[:max_tokens]) + " (...생략)"
+
+
+def count_message_tokens(message, tokenizer, token_counts=None):
+    # token_counts: {메시지 내용: 토큰 수}. 세션에 메시지 목록과 나란히 두어 같은 메시지를 매 질문마다 다시 인코딩하지 않음
+    # (메시지 dict에 저장하면 저장되는 대화와 요청에 그대로 섞여 나감)
+    content = message.get("content", "") or ""
+    if token_counts is None:
+        return len(tokenizer.encode(content)) + MESSAGE_TOKEN_OVERHEAD
+    if content not in token_counts:
+        token_counts[content] = len(tokenizer.encode(content))
+    return token_counts[content] + MESSAGE_TOKEN_OVERHEAD
+
+
+def prune_message_token_counts(token_counts, history_messages):
+    # 현재 대화에 남아 있는 메시지의 토큰 수만 유지 (대화 전환/삭제 후 캐시가 계속 커지지 않도록)
+    return {content: token_counts[content] for content in {message.get("content", "") or "" for message in history_messages} if content in token_counts}
+
+
+def count_summary_tokens(memory_state, tokenizer):
+    if not memory_state or not memory_state.get("summary"):
+        return 0
+    if not isinstance(memory_state.get("summary_tokens"), int):
+        memory_state["summary_tokens"] = len(tokenizer.encode(f"이전 대화 요약:\n{memory_state['summary']}"))
+    return memory_state["summary_tokens"] + MESSAGE_TOKEN_OVERHEAD
+
+
+def select_recent_turns(history_messages, tokenizer, budget_tokens, min_index=0, token_counts=None):
+    # 가장 최근 메시지부터 거꾸로 예산(budget_tokens) 안에 들어가는 만큼 선택한다.
+    # 이미 요약에 포함된 구간(min_index 이전)은 다시 넣지 않는다. token_counts: count_message_tokens 참고
+    # 반환: (창 시작 인덱스, 사용한 토큰 수). history_messages[시작:]가 최근 턴 창.
+    window_start, used_tokens = len(history_messages), 0
+    for msg_idx in range(len(history_messages) - 1, min_index - 1, -1):
+        message_tokens = count_message_tokens(history_messages[msg_idx], tokenizer, token_counts)
+        if used_tokens + message_tokens > budget_tokens:
+            break
+        used_tokens += message_tokens
+        window_start = msg_idx
+    return window_start, used_tokens
+
+
+def format_turns_for_summary(turns, tokenizer, per_turn_max_tokens):
+    # 요약 입력이 지나치게 커지지 않도록 턴마다 길이를 제한 (예: 전체 번역 결과 같은 긴 답변)
+    role_labels = {"user": "사용자", "assistant": "챗봇"}
+    formatted_turns = []
+    for turn in turns:
+        turn_content = truncate_text_to_tokens(turn.get("content", ""), tokenizer, per_turn_max_tokens)
+        formatted_turns.append(f"{role_labels.get(turn.get('role'), turn.get('role', '?'))}: {turn_content}")
+    return "\n\n".join(formatted_turns)
+
+
+def build_summary_request_messages(previous_summary, turns_text):
+    return [
+        {"role": "system", "content": MEMORY_SUMMARY_INSTRUCTION},
+        {"role": "user", "content": f"[기존 요약]\n{previous_summary or '(없음)'}\n\n[새 대화]\n{turns_text}"}
+    ]
+
+
+def update_rolling_summary(memory_state, history_messages, window_start, tokenizer, summarize_fn, per_turn_max_tokens):
+    # 최근 턴 창 밖으로 새로 밀려난 턴(summarized_upto ~ window_start)이 있을 때만 요약을 갱신한다.
+    # summarize_fn(messages) -> (요약 문자열, usage). 실패 시 기존 요약을 그대로 유지.
+    memory_state = dict(memory_state or empty_memory_state())
+    summarized_upto = memory_state.get("summarized_upto", 0)
+    if window_start <= summarized_upto:
+        return memory_state, None
+    turns_text = format_turns_for_summary(history_messages[summarized_upto:window_start], tokenizer, per_turn_max_tokens)
+    try:
+        new_summary, usage = summarize_fn(build_summary_request_messages(memory_state.get("summary", ""), turns_text))
+    except Exception as e_summary:
+        print(f"ERROR updating rolling conversation summary (turns {summarized_upto}-{window_start}): {e_summary}")
+        return memory_state, None
+    if not new_summary:
+        print(f"WARNING: Empty rolling summary returned for turns {summarized_upto}-{window_start}. Keeping previous summary.")
+        return memory_state, usage
+    print(f"Rolling conversation summary updated to cover {window_start} messages.")
+    new_memory_state = {"summary": new_summary.strip(), "summarized_upto": window_start}
+    count_summary_tokens(new_memory_state, tokenizer)
+    return new_memory_state, usage
+
+
+def build_history_messages(memory_state, history_messages, window_start):
+    # LLM 요청에 넣을 대화 기록 메시지 (요약 + 최근 턴 원문)
+    history_for_request = []
+    if memory_state and memory_state.get("summary"):
+        history_for_request.append({"role": "system", "content": f"이전 대화 요약:\n{memory_state['summary']}"})
+    for message in history_messages[window_start:]:
+        if message.get("role") in ("user", "assistant") and message.get("content"):
+            history_for_request.append({"role": message["role"], "content": message["content"]})
+    return history_for_request
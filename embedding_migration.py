@@ -0,0 +1,244 @@
+# 임베딩 모델 전환 (온라인 재임베딩)
+# - 현재 배치(active.json, 없으면 vector_db/)의 모든 샤드 청크를 새 임베딩 모델로 다시 임베딩해 새 배치(vector_db/models/<모델>/)에 저장
+# - 진행하는 동안 앱/검색 서비스는 기존 인덱스로 계속 검색하고 학습도 기존 배치에 받음. 새 배치는 active.json을 바꾸기 전까지 아무도 읽지 않음
+# - 새 배치 샤드의 i번째 벡터 = 기존 샤드의 i번째 청크. 중단되면 새 배치 샤드에 저장된 길이부터 이어서 진행 (resume)
+# - 전환: 따라잡기(진행 중 새로 학습된 청크) -> active.json에 학습 일시 중지(ingest_paused) 기록 -> 모든 프로세스가 확인할 때까지 대기
+#   (--cutover-grace-seconds, 앱/검색 서비스의 배치 확인 주기보다 길게) -> 마지막 따라잡기 -> active.json을 새 배치로 교체 (한 번에 전환)
+#   일시 중지 동안에도 검색은 기존 인덱스로 계속 처리. 전환 중 실패하면 기존 배치로 되돌림
+# - 처리량: --tokens-per-minute(토큰 버킷)와 --batch-size. 사용량은 앱과 같은 사용량 로그에 request_type="embedding_migration"으로 기록
+# - 진행 상황은 vector_db/migration/state.json (관리자 화면과 status 명령에 표시). 한 번에 하나만 실행
+# 실행:
+#   python embedding_migration.py start --model text-embedding-3-large [--tokens-per-minute 300000] [--no-cutover]
+#   python embedding_migration.py resume      # 중단된 전환 이어서
+#   python embedding_migration.py cutover     # --no-cutover로 준비만 해 둔 전환 적용
+#   python embedding_migration.py status
+# 설정은 앱과 같은 .streamlit/secrets.toml을 읽음
+import argparse
+import os
+import re
+import sys
+import time
+import tomllib
+
+from app_common import EMBEDDING_BATCH_SIZE, load_tokenizer, make_usage_logger
+from blob_io import upload_json_blob
+from retrieval_service import make_container_client, make_llm_client
+from token_quota import TokenBucket, TokenUsageMeter, UsageCaller
+from vector_shards import (MIGRATION_STATE_BLOB_NAME, MODEL_LAYOUT_PREFIX, VectorLayout, VectorShard, layout_from_dict, list_shard_names,
+                           load_active_layout, load_migration_state, migration_progress, write_active_layout)
+
+DEFAULT_BATCH_SIZE = EMBEDDING_BATCH_SIZE
+DEFAULT_CHECKPOINT_EVERY = 20 # 배치 N개마다 새 배치 샤드를 Blob에 저장
+DEFAULT_CUTOVER_GRACE_SECONDS = 90.0 # app.py/retrieval_service의 배치 확인 주기(30초)보다 길게
+MAX_CATCH_UP_PASSES = 5
+MIGRATION_USER_NAME = "embedding_migration"
+ACTIVE_STATUSES = ("running", "failed", "ready", "cutting_over") # 이어서 진행할 수 있는 상태
+
+
+class MigrationError(Exception):
+    pass
+
+
+def model_layout_prefix(model_name):
+    return f"{MODEL_LAYOUT_PREFIX}{re.sub(r'[^A-Za-z0-9._-]+', '_', model_name)}/"
+
+
+def save_migration_state(container_client, state):
+    state["updated_at"] = time.strftime("%Y-%m-%d %H:%M:%S")
+    upload_json_blob(container_client, MIGRATION_STATE_BLOB_NAME, state, timeout=30)
+
+
+class EmbeddingMigrator:
+    # state: save_migration_state로 저장하는 진행 상황 dict (source/target은 VectorLayout을 dict로)
+    # count_tokens_fn: 분당 토큰 한도 대기에 쓰는 입력 토큰 추정 (main은 tiktoken 인코더. 실제 사용량으로 버킷을 보정)
+    def __init__(self, container_client, llm_client, state, caller, count_tokens_fn, batch_size=DEFAULT_BATCH_SIZE, tokens_per_minute=0,
+                 checkpoint_every=DEFAULT_CHECKPOINT_EVERY, clock=time.monotonic, sleep=time.sleep):
+        self.container_client = container_client
+        self.llm_client = llm_client
+        self.state = state
+        self.caller = caller
+        self.count_tokens_fn = count_tokens_fn
+        self.batch_size = max(1, int(batch_size))
+        self.checkpoint_every = max(1, int(checkpoint_every))
+        self.clock, self.sleep = clock, sleep
+        self.token_bucket = TokenBucket(tokens_per_minute, clock()) if tokens_per_minute > 0 else None
+        self.source_layout = layout_from_dict(state["source"])
+        self.target_layout = layout_from_dict(state["target"])
+
+    def save_state(self):
+        save_migration_state(self.container_client, self.state)
+
+    def embed(self, texts):
+        # 반환: (벡터 목록, 사용 토큰). 분당 토큰 한도를 넘지 않게 기다린 뒤 호출하고 실제 사용량으로 버킷을 보정
+        estimated_tokens = sum(self.count_tokens_fn(text) for text in texts)
+        if self.token_bucket is not None:
+            wait_seconds = self.token_bucket.wait_seconds(estimated_tokens, self.clock())
+            if wait_seconds > 0: self.sleep(wait_seconds)
+            self.token_bucket.refill(self.clock()); self.token_bucket.adjust(estimated_tokens)
+        response = self.llm_client.embeddings("embedding_batch", self.target_layout.embedding_model, texts, caller=self.caller)
+        used_tokens = getattr(response.usage, "total_tokens", 0) or 0
+        if self.token_bucket is not None and used_tokens: self.token_bucket.adjust(used_tokens - estimated_tokens)
+        return [item.embedding for item in sorted(response.data, key=lambda emb_item: emb_item.index)], used_tokens
+
+    def migrate_shard(self, shard_name):
+        # 기존 샤드에서 새 배치 샤드에 아직 없는 청크를 다시 임베딩. 반환: 이번에 옮긴 청크 수
+        source_shard = VectorShard(shard_name, self.container_client, self.source_layout.dimension, self.source_layout.prefix)
+        source_errors = source_shard.load()
+        target_shard = VectorShard(shard_name, self.container_client, self.target_layout.dimension, self.target_layout.prefix)
+        target_errors = target_shard.load()
+        if source_errors or target_errors:
+            raise MigrationError(f"Could not load shard '{shard_name}': {'; '.join(source_errors + target_errors)}")
+        source_entries = source_shard.metadata
+        migrated_count = target_shard.stats()["ntotal"]
+        if migrated_count > len(source_entries):
+            raise MigrationError(f"Target shard '{shard_name}' has {migrated_count} vectors but the source only has {len(source_entries)} chunks.")
+        shard_state = self.state["shards"].setdefault(shard_name, {})
+        shard_state.update(source_total=len(source_entries), migrated=migrated_count)
+        if migrated_count == len(source_entries):
+            return 0
+        print(f"Shard '{shard_name}': re-embedding chunks {migrated_count + 1}-{len(source_entries)} with '{self.target_layout.embedding_model}'.")
+        copied_count, unsaved_batches = 0, 0
+        for batch_start in range(migrated_count, len(source_entries), self.batch_size):
+            batch_entries = source_entries[batch_start:batch_start + self.batch_size]
+            vectors, used_tokens = self.embed([str(entry.get("content") or "") or " " for entry in batch_entries])
+            target_shard.add(vectors, [dict(entry) for entry in batch_entries])
+            copied_count += len(batch_entries); unsaved_batches += 1
+            self.state["total_tokens"] = self.state.get("total_tokens", 0) + used_tokens
+            if unsaved_batches >= self.checkpoint_every:
+                shard_state["migrated"] = target_shard.save(); unsaved_batches = 0
+                self.save_state()
+                migrated_total, source_total = migration_progress(self.state)
+                print(f"  checkpoint: shard '{shard_name}' {shard_state['migrated']:,}/{len(source_entries):,} · all shards {migrated_total:,}/{source_total:,}")
+        shard_state["migrated"] = target_shard.save()
+        self.save_state()
+        return copied_count
+
+    def catch_up(self):
+        # 기존 배치의 모든 샤드를 한 번씩 따라잡음. 반환: 이번에 옮긴 청크 수
+        return sum(self.migrate_shard(shard_name) for shard_name in list_shard_names(self.container_client, self.source_layout.prefix))
+
+    def copy_all(self):
+        # 진행 중 새로 학습된 청크가 없을 때까지 반복 (학습이 계속 들어오면 나머지는 전환 직전 따라잡기에서 처리)
+        for _ in range(MAX_CATCH_UP_PASSES):
+            if self.catch_up() == 0:
+                break
+        self.state["status"] = "ready"; self.save_state()
+
+    def cutover(self, grace_seconds=DEFAULT_CUTOVER_GRACE_SECONDS):
+        # 학습 일시 중지 -> 대기 -> 마지막 따라잡기 -> 새 배치로 교체. 실패하면 기존 배치로 되돌림
+        active_layout = load_active_layout(self.container_client)
+        if active_layout.prefix == self.target_layout.prefix and not active_layout.ingest_paused:
+            self.state["status"] = "completed"; self.save_state() # 새 배치 기록 직후 중단된 경우
+            return
+        if active_layout.prefix != self.source_layout.prefix:
+            raise MigrationError(f"The active layout is '{active_layout.prefix}', not the migration source '{self.source_layout.prefix}'.")
+        self.state["status"] = "cutting_over"; self.save_state()
+        write_active_layout(self.container_client, self.source_layout._replace(ingest_paused=True))
+        try:
+            print(f"Document learning paused. Waiting {grace_seconds:.0f}s for all processes to notice before the final catch-up.")
+            self.sleep(grace_seconds)
+            self.catch_up()
+            write_active_layout(self.container_client, self.target_layout, previous=self.source_layout._asdict())
+        except BaseException:
+            write_active_layout(self.container_client, self.source_layout._replace(ingest_paused=False))
+            raise
+        self.state["status"] = "completed"; self.state["completed_at"] = time.strftime("%Y-%m-%d %H:%M:%S"); self.save_state()
+        print(f"Cut over to '{self.target_layout.embedding_model}' ({self.target_layout.prefix}, dimension {self.target_layout.dimension}).")
+
+
+def new_migration_state(container_client, llm_client, caller, target_model, default_model):
+    source_layout = load_active_layout(container_client)
+    if source_layout.ingest_paused:
+        raise MigrationError("Document learning is paused by an unfinished cutover. Run 'resume' instead.")
+    source_model = source_layout.embedding_model or default_model
+    if target_model == source_model:
+        raise MigrationError(f"'{target_model}' is already the active embedding model.")
+    target_prefix = model_layout_prefix(target_model)
+    if target_prefix == source_layout.prefix:
+        raise MigrationError(f"Target layout '{target_prefix}' is the active layout.")
+    probe_response = llm_client.embeddings("embedding_batch", target_model, ["dimension probe"], caller=caller) # 새 모델의 차원 확인
+    source_dict = dict(source_layout._asdict(), embedding_model=source_model)
+    target_layout = VectorLayout(target_prefix, target_model, len(probe_response.data[0].embedding))
+    return {"status": "running", "source": source_dict, "target": target_layout._asdict(), "shards": {}, "total_tokens": 0,
+            "started_at": time.strftime("%Y-%m-%d %H:%M:%S")}
+
+
+def print_status(state):
+    if not state:
+        print("No embedding migration has been started."); return
+    migrated_total, source_total = migration_progress(state)
+    print(f"{state['source'].get('embedding_model')} -> {state['target'].get('embedding_model')} (dimension {state['target'].get('dimension')}): "
+          f"{state.get('status')} · {migrated_total:,}/{source_total:,} chunks · {state.get('total_tokens', 0):,} tokens · updated {state.get('updated_at')}")
+    if state.get("error"): print(f"  last error: {state['error']}")
+    for shard_name, shard_state in sorted(state.get("shards", {}).items()):
+        print(f"  {shard_name}: {shard_state.get('migrated', 0):,}/{shard_state.get('source_total', 0):,}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Re-embed the vector DB with a new embedding model while the app keeps serving, then cut over.")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Same secrets file as the Streamlit app.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for command_name, command_help in (("start", "Start a migration to --model."), ("resume", "Continue an interrupted migration."),
+                                       ("cutover", "Apply a migration prepared with --no-cutover.")):
+        command_parser = subparsers.add_parser(command_name, help=command_help)
+        if command_name == "start":
+            command_parser.add_argument("--model", required=True, help="New Azure OpenAI embedding deployment.")
+        command_parser.add_argument("--batch-size", type=int, default=DEFAULT_BATCH_SIZE, help="Chunks per embedding request.")
+        command_parser.add_argument("--tokens-per-minute", type=int, default=0, help="Embedding throughput limit (0: no limit).")
+        command_parser.add_argument("--checkpoint-every", type=int, default=DEFAULT_CHECKPOINT_EVERY, help="Save progress every N batches.")
+        command_parser.add_argument("--cutover-grace-seconds", type=float, default=DEFAULT_CUTOVER_GRACE_SECONDS,
+                                    help="How long learning stays paused before the final catch-up.")
+        if command_name != "cutover":
+            command_parser.add_argument("--no-cutover", action="store_true", help="Stop after re-embedding; run 'cutover' later.")
+    subparsers.add_parser("status", help="Show migration progress.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.secrets, "rb") as secrets_file:
+        secrets = tomllib.load(secrets_file)
+    container_client = make_container_client(secrets)
+    state = load_migration_state(container_client)
+    if args.command == "status":
+        print_status(state); return 0
+    if args.command == "start" and state and state.get("status") in ACTIVE_STATUSES:
+        print(f"ERROR: A migration to '{state['target'].get('embedding_model')}' is {state['status']}. Use 'resume' to continue it."); return 1
+    if args.command != "start" and not (state and state.get("status") in ACTIVE_STATUSES):
+        print("ERROR: There is no unfinished migration to continue."); return 1
+    if args.command == "cutover" and state.get("status") not in ("ready", "cutting_over"):
+        print(f"ERROR: The migration is {state['status']}; run 'resume' first."); return 1
+
+    tokenizer = load_tokenizer()
+    count_tokens_fn = lambda text: len(tokenizer.encode(text))
+    log_writer, record_usage = make_usage_logger(container_client)
+    caller = UsageCaller(MIGRATION_USER_NAME, MIGRATION_USER_NAME, None, "embedding_migration", enforce_quota=False)
+    llm_client = make_llm_client(secrets, usage_meter=TokenUsageMeter(None, on_usage=record_usage, count_tokens_fn=count_tokens_fn))
+    try:
+        if args.command == "start":
+            state = new_migration_state(container_client, llm_client, caller, args.model, secrets["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"])
+            save_migration_state(container_client, state)
+            print(f"Migrating {state['source']['embedding_model']} ({state['source']['prefix']}) -> {args.model} ({state['target']['prefix']}, "
+                  f"dimension {state['target']['dimension']}).")
+        migrator = EmbeddingMigrator(container_client, llm_client, state, caller, count_tokens_fn, args.batch_size, args.tokens_per_minute, args.checkpoint_every)
+        try:
+            if args.command != "cutover":
+                state["status"] = "running"; state.pop("error", None)
+                migrator.copy_all()
+            if args.command == "cutover" or not args.no_cutover:
+                migrator.cutover(args.cutover_grace_seconds)
+        except (Exception, KeyboardInterrupt) as e_migration:
+            state["status"], state["error"] = "failed", str(e_migration) or type(e_migration).__name__
+            save_migration_state(container_client, state)
+            print(f"ERROR: Migration stopped: {state['error']}. Progress is saved; run 'resume' to continue.")
+            return 1
+        print_status(state)
+        return 0
+    except MigrationError as e_setup:
+        print(f"ERROR: {e_setup}"); return 1
+    finally:
+        log_writer.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
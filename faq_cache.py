@@ -0,0 +1,342 @@
+# 자주 묻는 질문(FAQ) 답변 캐시
+# - 오프라인 작업(build): chat_histories/의 대화에서 첫 질문(이전 대화 없이 단독으로 의미가 있는 질문)만 모아
+#   임베딩 유사도로 묶고, 여러 번(min_count) 여러 사용자(min_users)가 물은 질문 묶음의 답변을 현재 인덱스와 프롬프트 규칙으로 미리 만들어 둠
+#   (batch_qa.BatchQAPipeline 사용: 채팅 화면의 첫 질문과 같은 검색/프롬프트/모델)
+# - 검색 범위가 다르면 답이 다를 수 있으므로 항목은 (질문 묶음, 검색 범위 = 질문한 사용자가 볼 수 있는 샤드 목록)마다 따로 만듦
+# - 앱은 첨부 파일이 없는 질문을 정규화해 묶음에 있던 표현과 같으면 API 호출 없이 바로 답변 (출처와 생성 시각 표시)
+#   표현 비교만 하므로 임베딩 호출도 없고, 뜻이 다른 질문에 잘못 답할 위험이 낮음
+# - 항목마다 생성 당시의 인덱스 지문(배치 경로, 샤드별 벡터 수)과 규칙 버전, 채팅 모델을 저장. 학습/모델 전환/규칙 변경으로 지문이 달라지면
+#   캐시 답변을 쓰지 않고 평소처럼 답한 뒤 그 답변으로 항목을 갱신 (이전 대화/첨부 파일이 없을 때만). refresh 명령으로 한꺼번에 갱신도 가능
+# 실행:
+#   python faq_cache.py build [--min-count 3] [--min-users 2] [--max-entries 100] [--since-days 90]
+#   python faq_cache.py refresh        # 지문이 달라진 항목만 다시 답변
+#   python faq_cache.py status
+# 설정은 앱과 같은 .streamlit/secrets.toml을 읽음
+import argparse
+import hashlib
+import os
+import re
+import sys
+import threading
+import time
+import tomllib
+from datetime import datetime, timedelta
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from app_common import CHAT_HISTORY_BASE_PATH, EMBEDDING_BATCH_SIZE, USERS_BLOB_NAME
+from blob_io import download_json_blob, update_json_blob, upload_json_blob
+from log_writer import parse_jsonl_bytes
+from vector_shards import COMMON_SHARD_NAME, department_shard_name
+
+FAQ_CACHE_BLOB_NAME = "faq_cache/answers.json"
+FAQ_CACHE_COMPRESSION = "gzip"
+ATTACHMENT_MARKER = "\n(첨부 파일:" # app.py가 첨부 파일이 있는 질문 뒤에 붙이는 표시
+DEFAULT_MIN_COUNT = 3
+DEFAULT_MIN_USERS = 2
+DEFAULT_MAX_ENTRIES = 100
+DEFAULT_SINCE_DAYS = 90
+DEFAULT_CLUSTER_SIMILARITY = 0.92 # 코사인 유사도 (같은 질문의 다른 표현으로 볼 기준)
+MAX_VARIANTS_PER_ENTRY = 20
+MIN_QUESTION_LENGTH = 4
+DEFAULT_RELOAD_INTERVAL_SECONDS = 300.0
+FAQ_JOB_USER_NAME = "faq_cache"
+
+
+def normalize_question(question_text):
+    # 대소문자, 공백, 문장 부호 차이는 같은 질문으로 봄
+    return re.sub(r"[\s\W_]+", " ", (question_text or "").lower()).strip()
+
+
+def resolve_scope(store_stats, visible_shard_names):
+    # 반환: 실제로 검색되는 샤드 이름 목록 (visible_shard_names가 None이면 모든 샤드)
+    known_shard_names = set((store_stats or {}).get("shards", {}))
+    if visible_shard_names is None:
+        return sorted(known_shard_names)
+    return sorted(shard_name for shard_name in set(visible_shard_names) if shard_name in known_shard_names)
+
+
+def index_fingerprint(store_stats, scope, rules_version, chat_model):
+    # 반환: 답변이 기대는 인덱스/규칙/모델 상태 (범위의 샤드가 아직 불러오지 않은 상태면 None: 비교 불가)
+    shard_stats = (store_stats or {}).get("shards", {})
+    shard_totals = {}
+    for shard_name in scope:
+        if "ntotal" not in shard_stats.get(shard_name, {}):
+            return None
+        shard_totals[shard_name] = shard_stats[shard_name]["ntotal"]
+    return {"layout": store_stats.get("layout_prefix"), "shards": shard_totals, "rules_version": rules_version, "chat_model": chat_model}
+
+
+def make_entry_key(representative_question, scope):
+    return hashlib.sha1(f"{normalize_question(representative_question)}|{','.join(scope)}".encode("utf-8")).hexdigest()[:16]
+
+
+def format_cached_answer(entry):
+    # 화면/대화 기록에 남길 답변 (출처와 생성 시각 표시)
+    source_text = ", ".join(entry.get("sources") or []) or "없음"
+    return (f"{entry['answer']}\n\n---\n"
+            f"*자주 묻는 질문 답변 · {entry.get('generated_at', '')} 기준 문서로 생성 · 출처: {source_text}*")
+
+
+class FAQAnswerCache:
+    # 앱 프로세스에서 공유. Blob의 캐시를 reload_interval_seconds마다 다시 읽음
+    def __init__(self, container_client, reload_interval_seconds=DEFAULT_RELOAD_INTERVAL_SECONDS, clock=time.monotonic):
+        self.container_client = container_client
+        self.reload_interval_seconds = reload_interval_seconds
+        self.clock = clock
+        self._entries_by_variant = {} # 정규화한 질문 -> [항목]
+        self._entry_count = 0
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "stale": 0, "misses": 0, "refreshed": 0}
+
+    def _reload_if_due(self):
+        if self._loaded_at is not None and self.clock() - self._loaded_at < self.reload_interval_seconds:
+            return
+        self._loaded_at = self.clock() # 실패해도 다음 주기까지 다시 시도하지 않음
+        try:
+            cache_data = download_json_blob(self.container_client, FAQ_CACHE_BLOB_NAME, timeout=30)[0] or {}
+        except ResourceNotFoundError:
+            cache_data = {}
+        except Exception as e_load:
+            print(f"ERROR loading FAQ answer cache: {e_load}"); return
+        entries_by_variant = {}
+        for entry in cache_data.get("entries", []):
+            for variant in entry.get("variants", []):
+                entries_by_variant.setdefault(variant, []).append(entry)
+        self._entries_by_variant, self._entry_count = entries_by_variant, len(cache_data.get("entries", []))
+
+    def lookup(self, question_text, scope, fingerprint):
+        # 반환: (항목, 상태) 상태: "hit"(바로 사용) / "stale"(같은 질문/범위의 항목이 있지만 인덱스 등이 바뀜) / "miss"
+        normalized_question = normalize_question(question_text)
+        with self._lock:
+            self._reload_if_due()
+            scoped_entries = [entry for entry in self._entries_by_variant.get(normalized_question, []) if entry.get("scope") == scope]
+            if not scoped_entries:
+                self.stats["misses"] += 1; return None, "miss"
+            entry = scoped_entries[0]
+            if fingerprint is not None and entry.get("fingerprint") == fingerprint:
+                self.stats["hits"] += 1; return entry, "hit"
+            self.stats["stale"] += 1; return entry, "stale"
+
+    def refresh_entry(self, entry_key, answer, sources, fingerprint):
+        # 평소 경로로 새로 만든 답변으로 항목 갱신 (다른 프로세스의 갱신과 충돌하면 다시 읽어 적용)
+        generated_at = datetime.now().strftime("%Y-%m-%d %H:%M")
+
+        def apply_refresh(cache_data):
+            for entry in (cache_data or {}).get("entries", []):
+                if entry.get("key") == entry_key:
+                    entry.update(answer=answer, sources=sources, fingerprint=fingerprint, generated_at=generated_at, generated_by="chat_refresh")
+            return cache_data
+        update_json_blob(self.container_client, FAQ_CACHE_BLOB_NAME, apply_refresh, compression=FAQ_CACHE_COMPRESSION, default_value={"entries": []})
+        with self._lock:
+            for entries in self._entries_by_variant.values():
+                for entry in entries:
+                    if entry.get("key") == entry_key:
+                        entry.update(answer=answer, sources=sources, fingerprint=fingerprint, generated_at=generated_at, generated_by="chat_refresh")
+            self.stats["refreshed"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.stats, entries=self._entry_count)
+
+
+# --- 오프라인 작업 ---
+def iter_first_questions(container_client, since=None):
+    # 반환: (user_id, 질문, 대화 시작 시각) - 대화마다 첫 사용자 메시지 (첨부 파일이 있던 질문은 제외)
+    for blob_item in container_client.list_blobs(name_starts_with=CHAT_HISTORY_BASE_PATH):
+        relative_name = blob_item.name[len(CHAT_HISTORY_BASE_PATH):]
+        user_id, _, conversation_path = relative_name.partition("/")
+        if not conversation_path.startswith("conversations/") or not conversation_path.endswith(".json"):
+            continue
+        try:
+            conversation = download_json_blob(container_client, blob_item.name)[0] or {}
+        except Exception as e_conversation:
+            print(f"WARNING: Skipping conversation '{blob_item.name}': {e_conversation}"); continue
+        messages = conversation.get("messages") or []
+        if not messages: # 스냅샷 없이 자동 저장(tail)만 된 대화
+            try:
+                tail_bytes = container_client.get_blob_client(blob_item.name[:-len(".json")] + ".tail.jsonl").download_blob(timeout=60).readall()
+                messages = [tail_line["m"] for tail_line in parse_jsonl_bytes(tail_bytes, blob_item.name) if tail_line.get("i") == 0 and isinstance(tail_line.get("m"), dict)]
+            except ResourceNotFoundError:
+                continue
+        first_message = next((message for message in messages if isinstance(message, dict) and message.get("role") == "user"), None)
+        if not first_message:
+            continue
+        question_text = str(first_message.get("content") or "").strip()
+        started_at = conversation.get("timestamp") or first_message.get("time") or ""
+        if ATTACHMENT_MARKER in question_text or len(normalize_question(question_text)) < MIN_QUESTION_LENGTH:
+            continue
+        if since and started_at and started_at[:10] < since:
+            continue
+        yield user_id, question_text, started_at
+
+
+def cluster_questions(question_records, embed_fn, similarity=DEFAULT_CLUSTER_SIMILARITY):
+    # question_records: [(user_id, 질문, 범위)]. 정규화한 표현끼리 먼저 합치고, 자주 나온 표현부터 임베딩 유사도로 묶음
+    # 반환: [{"representative", "variants", "askers": [(user_id, 범위)]}] (질문 수 많은 순)
+    import numpy
+    askers_by_variant, text_by_variant = {}, {}
+    for user_id, question_text, scope in question_records:
+        variant = normalize_question(question_text)
+        askers_by_variant.setdefault(variant, []).append((user_id, scope))
+        text_by_variant.setdefault(variant, question_text)
+    variants = sorted(askers_by_variant, key=lambda variant: -len(askers_by_variant[variant]))
+    if not variants:
+        return []
+    vectors = numpy.array(embed_fn([text_by_variant[variant] for variant in variants]), dtype="float32")
+    vectors /= numpy.maximum(numpy.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+    clusters, leader_vectors = [], []
+    for variant_no, variant in enumerate(variants):
+        if leader_vectors:
+            similarities = numpy.array(leader_vectors) @ vectors[variant_no]
+            best_cluster_no = int(similarities.argmax())
+            if similarities[best_cluster_no] >= similarity:
+                clusters[best_cluster_no]["variants"].append(variant)
+                clusters[best_cluster_no]["askers"].extend(askers_by_variant[variant]); continue
+        clusters.append({"representative": text_by_variant[variant], "variants": [variant], "askers": list(askers_by_variant[variant])})
+        leader_vectors.append(vectors[variant_no])
+    return sorted(clusters, key=lambda cluster: -len(cluster["askers"]))
+
+
+def select_entry_candidates(clusters, min_count=DEFAULT_MIN_COUNT, min_users=DEFAULT_MIN_USERS, max_entries=DEFAULT_MAX_ENTRIES):
+    # 반환: [(질문 묶음, 범위, 질문 수, 사용자 수)] - 범위별로 따로 세어 기준을 넘는 것만
+    candidates = []
+    for cluster in clusters:
+        askers_by_scope = {}
+        for user_id, scope in cluster["askers"]:
+            askers_by_scope.setdefault(tuple(scope), []).append(user_id)
+        for scope, user_ids in askers_by_scope.items():
+            if scope and len(user_ids) >= min_count and len(set(user_ids)) >= min_users:
+                candidates.append((cluster, list(scope), len(user_ids), len(set(user_ids))))
+    candidates.sort(key=lambda candidate: -candidate[2])
+    return candidates[:max_entries]
+
+
+def answer_entry(pipeline, caller, question_text, scope):
+    # 반환: (결과 dict, 지문). 범위의 샤드만 검색
+    result = pipeline.answer(make_entry_key(question_text, scope), question_text, caller, shards=scope)
+    fingerprint = index_fingerprint(pipeline.retriever.stats(), scope, pipeline.prompt_builder.rules_version, pipeline.chat_model)
+    return result, fingerprint
+
+
+def build_faq_cache(container_client, pipeline, caller, min_count, min_users, max_entries, since_days, similarity=DEFAULT_CLUSTER_SIMILARITY):
+    # 반환: 저장한 캐시 dict
+    try:
+        users = download_json_blob(container_client, USERS_BLOB_NAME)[0] or {}
+    except ResourceNotFoundError:
+        users = {}
+    store_stats = pipeline.retriever.stats()
+    since = (datetime.now() - timedelta(days=since_days)).strftime("%Y-%m-%d") if since_days else None
+    question_records = []
+    for user_id, question_text, _ in iter_first_questions(container_client, since):
+        user_info = users.get(user_id) if isinstance(users.get(user_id), dict) else {}
+        # app.py의 get_visible_shard_names와 같은 범위 (관리자는 모든 샤드)
+        user_department_shard = department_shard_name(user_info.get("department"))
+        visible_shard_names = None if user_info.get("role") == "admin" else [COMMON_SHARD_NAME] + ([user_department_shard] if user_department_shard else [])
+        question_records.append((user_id, question_text, resolve_scope(store_stats, visible_shard_names)))
+    print(f"Mined {len(question_records)} first questions from chat histories.")
+
+    def embed_questions(texts):
+        vectors = []
+        for batch_start in range(0, len(texts), EMBEDDING_BATCH_SIZE):
+            response = pipeline.llm_client.embeddings("embedding_batch", pipeline.embedding_model, texts[batch_start:batch_start + EMBEDDING_BATCH_SIZE],
+                                                      caller=caller._replace(request_type="faq_cache_question_embedding"))
+            vectors.extend(item.embedding for item in sorted(response.data, key=lambda emb_item: emb_item.index))
+        return vectors
+    candidates = select_entry_candidates(cluster_questions(question_records, embed_questions, similarity), min_count, min_users, max_entries)
+    print(f"{len(candidates)} frequent question clusters to answer.")
+    entries = []
+    for cluster, scope, ask_count, user_count in candidates:
+        result, fingerprint = answer_entry(pipeline, caller, cluster["representative"], scope)
+        if result["error"] or not result["answer"]:
+            print(f"WARNING: Skipping FAQ '{cluster['representative'][:40]}': {result['error'] or 'empty answer'}"); continue
+        entries.append({
+            "key": make_entry_key(cluster["representative"], scope), "question": cluster["representative"], "variants": cluster["variants"][:MAX_VARIANTS_PER_ENTRY],
+            "scope": scope, "answer": result["answer"], "sources": result["sources"], "ask_count": ask_count, "user_count": user_count,
+            "fingerprint": fingerprint, "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M"), "generated_by": "faq_job"
+        })
+        print(f"  [{ask_count}x/{user_count} users] {cluster['representative'][:60]} -> {len(result['answer'])} chars")
+    cache_data = {"entries": entries, "built_at": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                  "settings": {"min_count": min_count, "min_users": min_users, "since_days": since_days, "similarity": similarity}}
+    upload_json_blob(container_client, FAQ_CACHE_BLOB_NAME, cache_data, compression=FAQ_CACHE_COMPRESSION)
+    return cache_data
+
+
+def refresh_faq_cache(container_client, pipeline, caller):
+    # 지문이 달라진 항목만 다시 답변. 반환: 갱신한 항목 수
+    try:
+        cache_data = download_json_blob(container_client, FAQ_CACHE_BLOB_NAME)[0] or {}
+    except ResourceNotFoundError:
+        print("No FAQ answer cache yet. Run 'build' first."); return 0
+    refreshed_answers = {}
+    for entry in cache_data.get("entries", []):
+        store_stats = pipeline.retriever.load_shards(entry["scope"]) # 범위의 샤드만 불러와 현재 지문 계산 (검색/임베딩 호출 없음)
+        current_fingerprint = index_fingerprint(store_stats, entry["scope"], pipeline.prompt_builder.rules_version, pipeline.chat_model)
+        if current_fingerprint is not None and current_fingerprint == entry.get("fingerprint"):
+            continue
+        result, fingerprint = answer_entry(pipeline, caller, entry["question"], entry["scope"])
+        if result["error"] or not result["answer"]:
+            print(f"WARNING: Could not refresh FAQ '{entry['question'][:40]}': {result['error'] or 'empty answer'}"); continue
+        refreshed_answers[entry["key"]] = {"answer": result["answer"], "sources": result["sources"], "fingerprint": fingerprint,
+                                           "generated_at": datetime.now().strftime("%Y-%m-%d %H:%M"), "generated_by": "faq_job"}
+
+    def apply_refresh(latest_cache_data):
+        for entry in (latest_cache_data or {}).get("entries", []):
+            if entry.get("key") in refreshed_answers: entry.update(refreshed_answers[entry["key"]])
+        return latest_cache_data
+    if refreshed_answers:
+        update_json_blob(container_client, FAQ_CACHE_BLOB_NAME, apply_refresh, compression=FAQ_CACHE_COMPRESSION, default_value={"entries": []})
+    return len(refreshed_answers)
+
+
+def print_status(container_client):
+    try:
+        cache_data = download_json_blob(container_client, FAQ_CACHE_BLOB_NAME)[0] or {}
+    except ResourceNotFoundError:
+        print("No FAQ answer cache yet."); return
+    print(f"FAQ answer cache built {cache_data.get('built_at')}: {len(cache_data.get('entries', []))} entries.")
+    for entry in cache_data.get("entries", []):
+        print(f"  [{entry.get('ask_count')}x] ({', '.join(entry['scope'])}) {entry['question'][:60]} · {entry.get('generated_by')} {entry.get('generated_at')}")
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Precompute answers for frequently asked questions mined from chat histories.")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Same secrets file as the Streamlit app.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="Mine chat histories and answer frequent questions (replaces the cache).")
+    build_parser.add_argument("--min-count", type=int, default=DEFAULT_MIN_COUNT, help="Times a question must have been asked.")
+    build_parser.add_argument("--min-users", type=int, default=DEFAULT_MIN_USERS, help="Distinct users who must have asked it.")
+    build_parser.add_argument("--max-entries", type=int, default=DEFAULT_MAX_ENTRIES)
+    build_parser.add_argument("--since-days", type=int, default=DEFAULT_SINCE_DAYS, help="Only conversations started in the last N days (0: all).")
+    build_parser.add_argument("--similarity", type=float, default=DEFAULT_CLUSTER_SIMILARITY, help="Cosine similarity for grouping phrasings.")
+    subparsers.add_parser("refresh", help="Re-answer entries whose index, rules or model changed.")
+    subparsers.add_parser("status", help="List cached questions.")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.secrets, "rb") as secrets_file:
+        secrets = tomllib.load(secrets_file)
+    from batch_qa import build_pipeline # 채팅 화면과 같은 검색/프롬프트/모델 (status만 할 때는 불러오지 않음)
+    from retrieval_service import make_container_client
+    from token_quota import UsageCaller
+    container_client = make_container_client(secrets)
+    if args.command == "status":
+        print_status(container_client); return 0
+    caller = UsageCaller(FAQ_JOB_USER_NAME, FAQ_JOB_USER_NAME, None, "faq_cache", enforce_quota=False)
+    pipeline, log_writer = build_pipeline(secrets, concurrency=1)
+    try:
+        if args.command == "build":
+            cache_data = build_faq_cache(container_client, pipeline, caller, args.min_count, args.min_users, args.max_entries, args.since_days, args.similarity)
+            print(f"Saved {len(cache_data['entries'])} FAQ answers to '{FAQ_CACHE_BLOB_NAME}'.")
+        else:
+            print(f"Refreshed {refresh_faq_cache(container_client, pipeline, caller)} FAQ answers.")
+        return 0
+    finally:
+        log_writer.close()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
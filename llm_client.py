@@ -0,0 +1,268 @@
+# Azure OpenAI 호출을 감싸는 복원력 있는 클라이언트
+# - 작업 종류(chat/embedding/vision 등)별 타임아웃
+# - 재시도 가능한 오류(연결/타임아웃/429/5xx)에 대해 지터를 준 지수 백오프 재시도
+# - 단건 임베딩 요청이 느리면 같은 요청을 한 번 더 보내(hedging) 먼저 온 응답을 사용
+# - 대체 배포(fallback deployment)로 전환
+# - 배포별 서킷 브레이커: 연속 실패 시 일정 시간 동안 즉시 실패 처리
+# - usage_meter(token_quota.TokenUsageMeter)가 있으면 caller를 지정한 호출마다 사용자/부서 쿼터 적용 및 사용량 기록
+# - scheduler(llm_scheduler.FairLLMScheduler)가 있으면 채팅 모델 호출은 사용자별 공정 대기열을 거쳐 동시 호출 수/토큰 한도 안에서 보냄
+import random
+import threading
+import time
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from openai import APIConnectionError, APITimeoutError, RateLimitError, APIStatusError
+
+from llm_scheduler import LLMQueueTimeoutError
+
+DEFAULT_OPERATION_TIMEOUTS = {
+    "chat": 90.0,
+    "long_document": 120.0,
+    "summary": 45.0,
+    "vision": 60.0,
+    "embedding": 10.0, # 검색용 단건 임베딩
+    "embedding_batch": 60.0, # 학습용 배치 임베딩
+}
+FALLBACK_ENABLED_OPERATIONS = {"chat", "long_document", "summary", "vision"} # 임베딩은 벡터 호환성 때문에 대체 배포 사용 안 함
+
+
+class LLMUnavailableError(Exception):
+    # 재시도/대체 배포까지 모두 실패했을 때
+    pass
+
+
+class CircuitOpenError(LLMUnavailableError):
+    # 서킷 브레이커가 열려 있어 요청을 보내지 않고 즉시 실패했을 때
+    pass
+
+
+class LLMQueueFullError(LLMUnavailableError):
+    # 스케줄러 대기열에서 제한 시간 안에 차례가 오지 않았을 때
+    pass
+
+
+def is_retryable_error(error):
+    if isinstance(error, (APIConnectionError, APITimeoutError, RateLimitError)): # APITimeoutError는 APIConnectionError의 하위 클래스
+        return True
+    if isinstance(error, APIStatusError):
+        return error.status_code == 429 or error.status_code >= 500
+    return False
+
+
+def get_retry_after_seconds(error):
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None) or {}
+    for header_name in ("retry-after-ms", "retry-after"):
+        header_value = headers.get(header_name)
+        if not header_value:
+            continue
+        try:
+            seconds = float(header_value)
+            return seconds / 1000 if header_name == "retry-after-ms" else seconds
+        except (TypeError, ValueError):
+            continue
+    return None
+
+
+class RetryPolicy:
+    def __init__(self, max_attempts=3, base_delay=0.5, max_delay=8.0):
+        self.max_attempts = max(1, int(max_attempts))
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def compute_delay(self, attempt, retry_after=None):
+        # full jitter: 0 ~ base * 2^(attempt-1) 사이 임의 값. 서버가 Retry-After를 주면 그 이상 대기
+        backoff_delay = random.uniform(0, min(self.max_delay, self.base_delay * (2 ** (attempt - 1))))
+        if retry_after is not None:
+            return min(self.max_delay, max(backoff_delay, retry_after))
+        return backoff_delay
+
+
+class CircuitBreaker:
+    # closed -> (연속 실패 failure_threshold회) -> open -> (reset_timeout 경과) -> half_open (시험 요청 1건)
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self._probe_in_flight = False
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == "closed":
+                return True
+            if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = "half_open"
+                self._probe_in_flight = False
+            if self.state == "half_open" and not self._probe_in_flight:
+                self._probe_in_flight = True
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            if self.state != "closed":
+                print(f"Circuit breaker '{self.name}' closed again after successful request.")
+            self.state, self.consecutive_failures, self._probe_in_flight = "closed", 0, False
+
+    def record_failure(self):
+        with self._lock:
+            self.consecutive_failures += 1
+            if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+                if self.state != "open":
+                    print(f"WARNING: Circuit breaker '{self.name}' opened after {self.consecutive_failures} consecutive failures.")
+                self.state, self.opened_at, self._probe_in_flight = "open", time.monotonic(), False
+                return True
+            return False
+
+    def seconds_until_retry(self):
+        with self._lock:
+            if self.state != "open":
+                return 0.0
+            return max(0.0, self.reset_timeout - (time.monotonic() - self.opened_at))
+
+
+class ResilientLLMClient:
+    def __init__(self, raw_client, operation_timeouts=None, retry_policy=None, fallback_deployment=None,
+                 embedding_hedge_after=None, breaker_failure_threshold=5, breaker_reset_timeout=30.0, max_hedge_workers=8, usage_meter=None,
+                 scheduler=None, scheduler_max_wait_seconds=None):
+        self.raw_client = raw_client
+        self.usage_meter = usage_meter
+        self.scheduler = scheduler
+        self.scheduler_max_wait_seconds = scheduler_max_wait_seconds
+        self.operation_timeouts = dict(DEFAULT_OPERATION_TIMEOUTS, **(operation_timeouts or {}))
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.fallback_deployment = fallback_deployment
+        self.embedding_hedge_after = embedding_hedge_after # None이면 hedging 하지 않음
+        self.breaker_failure_threshold = breaker_failure_threshold
+        self.breaker_reset_timeout = breaker_reset_timeout
+        self.stats = Counter()
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self._hedge_executor = ThreadPoolExecutor(max_workers=max_hedge_workers, thread_name_prefix="llm-hedge") if embedding_hedge_after else None
+
+    def get_breaker(self, deployment_name):
+        with self._lock:
+            if deployment_name not in self._breakers:
+                self._breakers[deployment_name] = CircuitBreaker(deployment_name, self.breaker_failure_threshold, self.breaker_reset_timeout)
+            return self._breakers[deployment_name]
+
+    def breaker_states(self):
+        with self._lock:
+            return {name: breaker.state for name, breaker in self._breakers.items()}
+
+    def _count(self, stat_name, amount=1):
+        with self._lock:
+            self.stats[stat_name] += amount
+
+    def _call_with_retries(self, operation, deployment_name, request_fn):
+        breaker = self.get_breaker(deployment_name)
+        last_error = None
+        for attempt in range(1, self.retry_policy.max_attempts + 1):
+            if not breaker.allow_request():
+                self._count("circuit_rejections")
+                raise CircuitOpenError(f"Circuit for '{deployment_name}' is open (retry in {breaker.seconds_until_retry():.0f}s).") from last_error
+            try:
+                result = request_fn()
+                breaker.record_success()
+                return result
+            except Exception as e_request:
+                if not is_retryable_error(e_request):
+                    breaker.record_success() # 엔드포인트는 응답했음 (요청 자체의 오류) -> 서킷에 반영하지 않음
+                    raise
+                last_error = e_request
+                if breaker.record_failure():
+                    self._count("circuit_opens")
+                if attempt >= self.retry_policy.max_attempts:
+                    break
+                delay = self.retry_policy.compute_delay(attempt, get_retry_after_seconds(e_request))
+                self._count("retries")
+                print(f"WARNING: {operation} call to '{deployment_name}' failed ({type(e_request).__name__}: {e_request}). Retry {attempt}/{self.retry_policy.max_attempts - 1} in {delay:.2f}s.")
+                time.sleep(delay)
+        raise LLMUnavailableError(f"{operation} call to '{deployment_name}' failed after {self.retry_policy.max_attempts} attempts: {last_error}") from last_error
+
+    def _run_hedged(self, request_fn, hedge_after):
+        # 첫 요청이 hedge_after초 안에 끝나지 않으면 같은 요청을 하나 더 보내고 먼저 성공한 응답을 사용
+        primary_future = self._hedge_executor.submit(request_fn)
+        done, _ = wait([primary_future], timeout=hedge_after)
+        if done:
+            return primary_future.result()
+        self._count("hedges_sent")
+        hedge_future = self._hedge_executor.submit(request_fn)
+        pending = {primary_future, hedge_future}
+        first_error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for finished_future in done:
+                if finished_future.exception() is None:
+                    if finished_future is hedge_future:
+                        self._count("hedges_won")
+                    return finished_future.result()
+                first_error = first_error or finished_future.exception()
+        raise first_error
+
+    def run_metered(self, caller, model, call_fn, **estimate_kwargs):
+        # 재시도/대체 배포를 포함한 전체 호출을 한 번으로 계량 (hedging으로 중복 전송된 요청은 먼저 온 응답의 usage만 기록)
+        # 검색 서비스(retrieval_client)처럼 다른 프로세스가 대신 API를 호출하는 경우에도 call_fn 응답에 usage가 있으면 같은 방식으로 계량
+        if self.usage_meter is None or caller is None:
+            return call_fn()
+        return self.usage_meter.run(caller, model, call_fn, **estimate_kwargs)
+
+    def chat_completion(self, operation, model, caller=None, input_tokens=None, on_queue_wait=None, **request_kwargs):
+        # operation: "chat" / "long_document" / "summary" / "vision" 등. timeout은 작업별 설정값을 사용
+        # caller: token_quota.UsageCaller (쿼터 초과 시 QuotaExceededError)
+        # input_tokens: 이미 계산한 입력 토큰 수 (스케줄러 입장 기준. 없으면 메시지로 추정), on_queue_wait(앞 요청 수, 전체 대기 수): 대기 중 호출
+        return self.run_metered(caller, model, lambda: self._run_scheduled(
+            caller, lambda: self._chat_completion_with_fallback(operation, model, request_kwargs), request_kwargs, input_tokens, on_queue_wait),
+            messages=request_kwargs.get("messages"), max_tokens=request_kwargs.get("max_tokens"))
+
+    def _run_scheduled(self, caller, call_fn, request_kwargs, input_tokens, on_queue_wait):
+        # 쿼터 예약 뒤 스케줄러 대기열에 들어감 (재시도/대체 배포 동안에도 자리를 유지)
+        if self.scheduler is None:
+            return call_fn()
+        if input_tokens is None:
+            input_tokens = self.usage_meter.estimate_tokens(messages=request_kwargs.get("messages")) if self.usage_meter else \
+                sum(len(str(message.get("content") or "")) // 2 + 1 for message in request_kwargs.get("messages") or [])
+        try:
+            ticket = self.scheduler.acquire(caller.user_id if caller else None, input_tokens + int(request_kwargs.get("max_tokens") or 0),
+                                            max_wait_seconds=self.scheduler_max_wait_seconds, on_wait=on_queue_wait)
+        except LLMQueueTimeoutError as e_queue:
+            self._count("queue_timeouts")
+            raise LLMQueueFullError(str(e_queue)) from e_queue
+        actual_tokens = None
+        try:
+            response = call_fn()
+            actual_tokens = getattr(getattr(response, "usage", None), "total_tokens", None)
+            return response
+        finally:
+            self.scheduler.release(ticket, actual_tokens)
+
+    def _chat_completion_with_fallback(self, operation, model, request_kwargs):
+        timeout = self.operation_timeouts.get(operation, self.operation_timeouts["chat"])
+        deployments = [model]
+        if self.fallback_deployment and self.fallback_deployment != model and operation in FALLBACK_ENABLED_OPERATIONS:
+            deployments.append(self.fallback_deployment)
+        last_error = None
+        for deployment_name in deployments:
+            if deployment_name != model:
+                self._count("fallbacks")
+                print(f"WARNING: Falling back to deployment '{deployment_name}' for {operation} after: {last_error}")
+            try:
+                return self._call_with_retries(operation, deployment_name, lambda: self.raw_client.chat.completions.create(
+                    model=deployment_name, timeout=timeout, **request_kwargs))
+            except LLMUnavailableError as e_unavailable:
+                last_error = e_unavailable
+        raise last_error
+
+    def embeddings(self, operation, model, input_texts, hedge=False, caller=None):
+        # operation: "embedding"(검색용 단건, hedging 대상) / "embedding_batch"(학습용)
+        timeout = self.operation_timeouts.get(operation, self.operation_timeouts["embedding_batch"])
+        request_fn = lambda: self.raw_client.embeddings.create(input=input_texts, model=model, timeout=timeout)
+        if hedge and self._hedge_executor is not None:
+            plain_request_fn = request_fn
+            request_fn = lambda: self._run_hedged(plain_request_fn, self.embedding_hedge_after)
+        return self.run_metered(caller, model, lambda: self._call_with_retries(operation, model, request_fn), input_texts=input_texts)
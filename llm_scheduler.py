@@ -0,0 +1,140 @@
+# 채팅 모델 호출 스케줄러 (프로세스 전체에서 하나를 공유)
+# - 동시 호출 수 상한(max_concurrent_requests)과 진행 중 토큰 상한(max_inflight_tokens),
+#   배포의 분당 토큰(TPM) 한도(tokens_per_minute, 토큰 버킷)를 넘지 않을 때만 요청을 보냄
+# - 대기열은 사용자별 공정 큐: 요청마다 가상 종료 시각(시작 = max(현재 가상 시각, 그 사용자의 마지막 종료), 종료 = 시작 + 토큰)을 매겨
+#   종료 시각이 가장 이른 요청부터 보냄. 큰 요청을 연달아 보내는 사용자가 다른 사용자의 짧은 질문을 밀어내지 않음
+# - 맨 앞 요청이 한도 때문에 못 나가면 뒤 요청도 기다림 (큰 요청이 계속 밀리지 않도록)
+# - 대기 중에는 on_wait(앞에 있는 요청 수, 전체 대기 수)를 주기적으로 호출해 화면에 대기 순번을 표시할 수 있음
+# - 토큰 수는 예상 입력 토큰 + max_tokens. 호출이 끝나면 release에 실제 사용량을 넘겨 TPM 버킷을 보정
+import itertools
+import threading
+import time
+
+from token_quota import TokenBucket
+
+DEFAULT_POLL_INTERVAL_SECONDS = 0.5
+
+
+class LLMQueueTimeoutError(Exception):
+    # 대기열에서 max_wait_seconds 안에 차례가 오지 않았을 때
+    def __init__(self, waited_seconds, position):
+        self.waited_seconds, self.position = waited_seconds, position
+        super().__init__(f"LLM request was not scheduled within {waited_seconds:.1f}s ({position} requests ahead).")
+
+
+class SchedulerTicket:
+    def __init__(self, user_id, tokens, finish_tag, seq, enqueued_at):
+        self.user_id, self.tokens, self.finish_tag, self.seq, self.enqueued_at = user_id, tokens, finish_tag, seq, enqueued_at
+        self.admitted = False
+
+    @property
+    def sort_key(self):
+        return (self.finish_tag, self.seq)
+
+
+class FairLLMScheduler:
+    # 한도가 0이면 해당 한도 없음 (max_concurrent_requests는 1 이상)
+    def __init__(self, max_concurrent_requests=8, max_inflight_tokens=0, tokens_per_minute=0, clock=time.monotonic):
+        self.max_concurrent_requests = max(1, int(max_concurrent_requests))
+        self.max_inflight_tokens = max(0, int(max_inflight_tokens))
+        self.clock = clock
+        self._minute_bucket = TokenBucket(tokens_per_minute, clock()) if tokens_per_minute > 0 else None
+        self._waiting = [] # 대기 중인 SchedulerTicket
+        self._running = set()
+        self._inflight_tokens = 0
+        self._virtual_time = 0.0
+        self._user_finish_tags = {} # 사용자 -> 마지막 요청의 가상 종료 시각
+        self._seq = itertools.count()
+        self.stats = {"admitted": 0, "queued": 0, "timeouts": 0, "max_queue_length": 0, "total_wait_seconds": 0.0}
+        self._condition = threading.Condition()
+
+    def _can_admit(self, ticket, now):
+        if len(self._running) >= self.max_concurrent_requests:
+            return False
+        # 한도보다 큰 요청은 진행 중인 요청이 없을 때만 보냄
+        if self.max_inflight_tokens and self._running and self._inflight_tokens + ticket.tokens > self.max_inflight_tokens:
+            return False
+        return self._minute_bucket is None or self._minute_bucket.wait_seconds(ticket.tokens, now) <= 0
+
+    def _dispatch(self):
+        # 가상 종료 시각 순으로 보낼 수 있는 만큼 보냄 (_condition을 잡은 상태에서 호출)
+        now = self.clock()
+        admitted_any = False
+        while self._waiting:
+            next_ticket = min(self._waiting, key=lambda ticket: ticket.sort_key)
+            if not self._can_admit(next_ticket, now):
+                break
+            self._waiting.remove(next_ticket)
+            next_ticket.admitted = True
+            self._running.add(next_ticket)
+            self._inflight_tokens += next_ticket.tokens
+            self._virtual_time = max(self._virtual_time, next_ticket.finish_tag - next_ticket.tokens)
+            if self._minute_bucket is not None: self._minute_bucket.adjust(next_ticket.tokens)
+            self.stats["admitted"] += 1
+            self.stats["total_wait_seconds"] += now - next_ticket.enqueued_at
+            admitted_any = True
+        if not self._waiting and not self._running:
+            self._user_finish_tags.clear() # 유휴 상태가 되면 사용자별 이력 초기화
+        if admitted_any: self._condition.notify_all()
+
+    def _position(self, ticket):
+        return sum(1 for other in self._waiting if other.sort_key < ticket.sort_key)
+
+    def acquire(self, user_id, tokens, max_wait_seconds=None, on_wait=None, poll_interval=DEFAULT_POLL_INTERVAL_SECONDS):
+        # 반환: SchedulerTicket (호출이 끝나면 반드시 release). 대기 시간이 max_wait_seconds를 넘으면 LLMQueueTimeoutError
+        tokens = max(1, int(tokens))
+        user_key = user_id or "anonymous"
+        with self._condition:
+            start_tag = max(self._virtual_time, self._user_finish_tags.get(user_key, 0.0))
+            ticket = SchedulerTicket(user_key, tokens, start_tag + tokens, next(self._seq), self.clock())
+            self._user_finish_tags[user_key] = ticket.finish_tag
+            self._waiting.append(ticket)
+            self._dispatch()
+            if not ticket.admitted:
+                self.stats["queued"] += 1
+                self.stats["max_queue_length"] = max(self.stats["max_queue_length"], len(self._waiting))
+        while True:
+            with self._condition:
+                if not ticket.admitted:
+                    self._condition.wait(timeout=poll_interval)
+                    self._dispatch() # TPM 버킷이 다시 찼을 수 있음
+                if ticket.admitted:
+                    return ticket
+                waited_seconds = self.clock() - ticket.enqueued_at
+                position, queue_length = self._position(ticket), len(self._waiting)
+                if max_wait_seconds is not None and waited_seconds >= max_wait_seconds:
+                    self._waiting.remove(ticket)
+                    self.stats["timeouts"] += 1
+                    self._dispatch()
+                    raise LLMQueueTimeoutError(waited_seconds, position)
+            if on_wait is not None:
+                try:
+                    on_wait(position, queue_length)
+                except Exception as e_callback:
+                    print(f"WARNING: LLM queue wait callback failed: {e_callback}")
+
+    def release(self, ticket, actual_tokens=None):
+        # actual_tokens: 실제 사용 토큰 (없으면 예상값 유지). 실패한 호출도 반드시 호출
+        with self._condition:
+            if ticket not in self._running:
+                return
+            self._running.discard(ticket)
+            self._inflight_tokens -= ticket.tokens
+            if self._minute_bucket is not None and actual_tokens is not None:
+                self._minute_bucket.refill(self.clock()); self._minute_bucket.adjust(int(actual_tokens) - ticket.tokens)
+            self._dispatch()
+
+    def snapshot(self):
+        # 관리자 화면용 현재 상태
+        with self._condition:
+            if self._minute_bucket is not None: self._minute_bucket.refill(self.clock())
+            waiting_by_user = {}
+            for ticket in self._waiting: waiting_by_user[ticket.user_id] = waiting_by_user.get(ticket.user_id, 0) + 1
+            return {
+                "running": len(self._running), "waiting": len(self._waiting), "inflight_tokens": self._inflight_tokens,
+                "max_concurrent_requests": self.max_concurrent_requests, "max_inflight_tokens": self.max_inflight_tokens or None,
+                "minute_tokens_available": int(self._minute_bucket.tokens) if self._minute_bucket is not None else None,
+                "waiting_by_user": waiting_by_user,
+                "avg_wait_seconds": round(self.stats["total_wait_seconds"] / self.stats["admitted"], 2) if self.stats["admitted"] else 0.0,
+                **{stat_name: stat_value for stat_name, stat_value in self.stats.items() if stat_name != "total_wait_seconds"}
+            }
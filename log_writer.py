@@ -0,0 +1,173 @@
+# 사용량/업로드 로그를 위한 백그라운드 로그 기록기
+# - log()는 메모리 큐에 넣기만 하므로 O(1)이며 채팅 처리 경로를 막지 않음
+# - 백그라운드 스레드가 주기적으로 모아서 날짜별 JSONL Append Blob에 덧붙임
+#   (예: app_logs/usage/2025-05-20.jsonl). 전체 파일을 내려받아 다시 올리지 않으므로
+#   로그가 커져도 기록 비용이 일정하고, 여러 프로세스가 동시에 써도 항목이 유실되지 않음
+import json
+import queue
+import threading
+import traceback
+from datetime import datetime
+
+from blob_io import BlobAppendError, append_blob_lines
+
+LOG_TIMESTAMP_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def day_partition_blob_name(stream_prefix, timestamp_str=None):
+    # 로그 항목의 시각 기준 날짜 파티션. 시각을 해석할 수 없으면 현재 날짜 사용
+    try:
+        day_str = datetime.strptime(timestamp_str, LOG_TIMESTAMP_FORMAT).strftime("%Y-%m-%d")
+    except (TypeError, ValueError):
+        day_str = datetime.now().strftime("%Y-%m-%d")
+    return f"{stream_prefix}{day_str}.jsonl"
+
+
+def parse_jsonl_bytes(raw_bytes, source_description="log"):
+    entries = []
+    for line_no, line in enumerate(raw_bytes.decode("utf-8", errors="replace").splitlines(), start=1):
+        if not line.strip():
+            continue
+        try:
+            entries.append(json.loads(line))
+        except json.JSONDecodeError:
+            print(f"WARNING: Skipping malformed JSONL line {line_no} in {source_description}.")
+    return entries
+
+
+class BackgroundLogWriter:
+    def __init__(self, container_client, stream_prefixes, flush_interval=5.0, max_batch_entries=500, max_pending_entries=50000, on_entries_written=None):
+        # stream_prefixes: {스트림 이름: Blob 경로 접두사}. 예: {"usage": "app_logs/usage/"}
+        # on_entries_written: {스트림 이름: fn(항목 목록)}. 기록에 성공한 항목으로 호출 (예: 사용량 집계 갱신)
+        #   예외를 내면 다음 주기에 (새 항목이 없어도) 다시 호출 - 반영하지 못한 증분은 콜백 쪽에서 보관 (항목을 다시 넘기면 중복 반영)
+        self.container_client = container_client
+        self.stream_prefixes = dict(stream_prefixes)
+        self.on_entries_written = dict(on_entries_written or {})
+        self.flush_interval = flush_interval
+        self.max_batch_entries = max_batch_entries
+        self.max_pending_entries = max_pending_entries
+        self._queue = queue.Queue()
+        self._retry_entries = [] # 기록 실패로 다음 주기에 다시 시도할 (스트림 이름, blob 이름, 줄) 목록
+        self._callback_retry_streams = set() # 콜백이 실패해 다음 주기에 다시 호출할 스트림
+        self._flush_requested = threading.Event()
+        self._stop_requested = False
+        self._stats_lock = threading.Lock() # log()는 여러 세션 스레드에서, 나머지는 기록 스레드에서 갱신
+        self.stats = {"logged": 0, "written": 0, "failed_flushes": 0, "failed_callbacks": 0, "dropped": 0}
+        self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+        self._thread.start()
+
+    def log(self, stream_name, entry):
+        if stream_name not in self.stream_prefixes:
+            raise ValueError(f"Unknown log stream '{stream_name}'.")
+        self._queue.put_nowait((stream_name, entry))
+        self._count("logged")
+        if self._queue.qsize() >= self.max_batch_entries:
+            self._flush_requested.set()
+
+    def _count(self, stat_name, amount=1):
+        with self._stats_lock:
+            self.stats[stat_name] += amount
+
+    def flush(self, timeout=10.0):
+        # 지금까지 기록된 항목을 즉시 내보내고 완료될 때까지 대기 (종료 시 / 관리자 화면 갱신 시 사용)
+        # 큐에 표시(Event)를 넣고 기록 스레드가 그 앞의 항목까지 처리한 뒤 표시를 설정할 때까지 기다림
+        # (이미 진행 중인 기록 주기가 끝난 것만 보고 반환하면 방금 넣은 항목이 아직 큐에 남아 있을 수 있음)
+        flush_marker = threading.Event()
+        self._queue.put_nowait((None, flush_marker))
+        self._flush_requested.set()
+        return flush_marker.wait(timeout=timeout)
+
+    def close(self, timeout=10.0):
+        self._stop_requested = True
+        self.flush(timeout=timeout)
+
+    def _drain_queue(self):
+        drained = []
+        while True:
+            try:
+                drained.append(self._queue.get_nowait())
+            except queue.Empty:
+                return drained
+
+    def _write_pending(self):
+        # 반환: 이번 주기에 꺼낸 flush 표시 목록 (기록을 마친 뒤 설정)
+        lines_by_blob = {} # blob 이름 -> (스트림 이름, 줄 목록)
+        for stream_name, blob_name, line in self._retry_entries:
+            lines_by_blob.setdefault(blob_name, (stream_name, []))[1].append(line)
+        self._retry_entries = []
+        flush_markers = []
+        for stream_name, entry in self._drain_queue():
+            if stream_name is None:
+                flush_markers.append(entry); continue
+            blob_name = day_partition_blob_name(self.stream_prefixes[stream_name], entry.get("timestamp") or entry.get("time"))
+            lines_by_blob.setdefault(blob_name, (stream_name, []))[1].append(json.dumps(entry, ensure_ascii=False) + "\n")
+
+        written_entries_by_stream = {}
+        for blob_name, (stream_name, lines) in lines_by_blob.items():
+            try:
+                append_blob_lines(self.container_client, blob_name, lines)
+                committed_lines = lines
+            except Exception as e_append:
+                # 앞쪽 블록이 이미 기록됐으면 그 줄은 다시 보내지 않음 (다시 보내면 로그와 집계에 중복)
+                committed_count = e_append.committed_lines if isinstance(e_append, BlobAppendError) else 0
+                committed_lines = lines[:committed_count]
+                self._count("failed_flushes")
+                print(f"ERROR appending {len(lines) - committed_count} of {len(lines)} log lines to '{blob_name}': {e_append}. Will retry on next flush.")
+                self._retry_entries.extend((stream_name, blob_name, line) for line in lines[committed_count:])
+            self._count("written", len(committed_lines))
+            if committed_lines and stream_name in self.on_entries_written:
+                written_entries_by_stream.setdefault(stream_name, []).extend(json.loads(line) for line in committed_lines)
+
+        for stream_name in self._callback_retry_streams:
+            written_entries_by_stream.setdefault(stream_name, [])
+        for stream_name, written_entries in written_entries_by_stream.items():
+            try:
+                self.on_entries_written[stream_name](written_entries)
+                self._callback_retry_streams.discard(stream_name)
+            except Exception as e_callback:
+                self._count("failed_callbacks")
+                self._callback_retry_streams.add(stream_name)
+                print(f"ERROR in '{stream_name}' written-entries callback for {len(written_entries)} entries: {e_callback}. Will call again on next flush.")
+
+        if len(self._retry_entries) > self.max_pending_entries: # Blob 장애가 길어질 때 메모리 무한 증가 방지
+            dropped_count = len(self._retry_entries) - self.max_pending_entries
+            self._retry_entries = self._retry_entries[dropped_count:]
+            self._count("dropped", dropped_count)
+            print(f"WARNING: Dropped {dropped_count} oldest pending log lines after repeated write failures.")
+        return flush_markers
+
+    def _run(self):
+        while True:
+            self._flush_requested.wait(timeout=self.flush_interval)
+            self._flush_requested.clear()
+            flush_markers = []
+            try:
+                flush_markers = self._write_pending()
+            except Exception as e_flush:
+                print(f"ERROR in background log writer: {e_flush}\n{traceback.format_exc()}")
+            for flush_marker in flush_markers:
+                flush_marker.set()
+            if self._stop_requested and self._queue.empty():
+                return
+
+
+def read_log_stream(container_client, stream_prefix, legacy_blob_name=None, since_day=None):
+    # 날짜별 JSONL 파티션(및 이전 형식의 단일 JSON 로그)을 읽어 항목 목록으로 반환
+    # since_day: "YYYY-MM-DD" 이후 파티션만 읽음 (파일 이름으로 판단하므로 다른 날짜 파일은 내려받지 않음)
+    entries = []
+    if legacy_blob_name:
+        try:
+            legacy_client = container_client.get_blob_client(legacy_blob_name)
+            if legacy_client.exists():
+                legacy_data = json.loads(legacy_client.download_blob(timeout=60).readall() or b"[]")
+                if isinstance(legacy_data, list):
+                    entries.extend(legacy_data)
+        except Exception as e_legacy:
+            print(f"WARNING: Could not read legacy log '{legacy_blob_name}': {e_legacy}")
+    for blob_item in container_client.list_blobs(name_starts_with=stream_prefix):
+        partition_day = blob_item.name[len(stream_prefix):].replace(".jsonl", "")
+        if since_day and partition_day < since_day:
+            continue
+        raw_bytes = container_client.get_blob_client(blob_item.name).download_blob(timeout=60).readall()
+        entries.extend(parse_jsonl_bytes(raw_bytes, blob_item.name))
+    return entries
@@ -0,0 +1,151 @@
+# 긴 문서 전체 번역/요약을 위한 map-reduce 파이프라인
+# - 문서를 토큰 수 기준 섹션으로 분할
+# - 섹션별 LLM 호출을 제한된 병렬도로 동시 실행하되, 결과는 원래 순서대로 스트리밍
+# - 섹션별 결과를 캐시하여 재시도 시 실패한 섹션만 다시 처리
+import hashlib
+import threading
+import traceback
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+LONG_DOC_MODE_TRANSLATE = "translate"
+LONG_DOC_MODE_SUMMARIZE = "summarize"
+
+LONG_DOC_MODE_INSTRUCTIONS = {
+    LONG_DOC_MODE_TRANSLATE: (
+        "다음은 긴 문서를 여러 섹션으로 나눈 것 중 하나입니다 (섹션 {section_no}/{section_total}, 파일명: {file_name}).\n"
+        "이 섹션의 내용을 처음부터 끝까지 빠짐없이 순서대로 번역하십시오. 요약하거나 생략하지 말고, "
+        "서론/맺음말/출처 표기 없이 번역문만 출력하십시오. 원문이 한국어이면 영어로, 그 외 언어이면 한국어로 번역합니다."
+    ),
+    LONG_DOC_MODE_SUMMARIZE: (
+        "다음은 긴 문서를 여러 섹션으로 나눈 것 중 하나입니다 (섹션 {section_no}/{section_total}, 파일명: {file_name}).\n"
+        "이 섹션의 핵심 내용(절차, 책임, 기준값, 주기, 조항 번호 등)을 빠짐없이 한국어로 요약하십시오. "
+        "다른 섹션과 합쳐질 예정이므로 서론/맺음말 없이 요약만 출력하십시오."
+    ),
+}
+
+LONG_DOC_REDUCE_INSTRUCTION = (
+    "다음은 문서 '{file_name}'을(를) 섹션별로 요약한 결과입니다. 중복을 제거하고 문서 전체의 구조를 반영하여 "
+    "하나의 일관된 요약으로 정리하십시오. 마지막에 [출처: {file_name}]를 표기하십시오."
+)
+
+LONG_DOC_SECTION_FAILED_TEMPLATE = "[섹션 {section_no}/{section_total} 처리 실패: {error}]"
+
+
+def detect_long_document_mode(query_text):
+    # 질문 문구로 전체 번역/요약 요청 여부를 판별 (명시적으로 모드를 고르지 않은 경우용)
+    normalized = (query_text or "").replace(" ", "")
+    if "전체번역" in normalized or "전문번역" in normalized:
+        return LONG_DOC_MODE_TRANSLATE
+    if "전체요약" in normalized or "전문요약" in normalized:
+        return LONG_DOC_MODE_SUMMARIZE
+    return None
+
+
+def split_text_into_token_sections(text_to_split, tokenizer, max_section_tokens):
+    # 줄 단위로 누적하여 max_section_tokens 이하의 섹션을 만든다.
+    # 한 줄이 그 자체로 한도를 넘으면 토큰 단위로 잘라 여러 섹션으로 나눈다.
+    if not text_to_split or not text_to_split.strip():
+        return []
+    if max_section_tokens <= 0:
+        raise ValueError("max_section_tokens must be positive.")
+
+    sections, current_lines, current_tokens = [], [], 0
+    for line in text_to_split.split("\n"):
+        line_tokens = len(tokenizer.encode(line)) + 1 # 줄바꿈 몫
+        if line_tokens > max_section_tokens:
+            if current_lines:
+                sections.append("\n".join(current_lines).strip())
+                current_lines, current_tokens = [], 0
+            encoded_line = tokenizer.encode(line)
+            for start in range(0, len(encoded_line), max_section_tokens):
+                sections.append(tokenizer.decode(encoded_line[start:start + max_section_tokens]).strip())
+            continue
+        if current_tokens + line_tokens > max_section_tokens and current_lines:
+            sections.append("\n".join(current_lines).strip())
+            current_lines, current_tokens = [], 0
+        current_lines.append(line)
+        current_tokens += line_tokens
+    if current_lines:
+        sections.append("\n".join(current_lines).strip())
+    return [s for s in sections if s]
+
+
+def make_section_cache_key(mode, model_name, rules_text, section_text):
+    # 모드/모델/규칙/섹션 원문이 모두 같을 때만 결과를 재사용
+    hasher = hashlib.sha256()
+    for part in (mode, model_name, rules_text, section_text):
+        hasher.update((part or "").encode("utf-8"))
+        hasher.update(b"\x00")
+    return hasher.hexdigest()
+
+
+class SectionResultCache:
+    # 프로세스 전역에서 공유되는 섹션 결과 캐시 (스레드 안전, 개수 제한 LRU)
+    def __init__(self, max_entries=2000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+            return self._entries[key]
+
+    def put(self, key, value):
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+def run_sections_in_order(sections, process_section_fn, cache_keys, cache, max_workers=4):
+    # 캐시에 없는 섹션만 스레드 풀에서 동시에 처리하고, 결과는 섹션 순서대로 yield 한다.
+    # yield 값: (섹션 인덱스, 결과 dict)
+    #   결과 dict = {"output": str|None, "usage": obj|None, "error": str|None, "cached": bool}
+    # 실패한 섹션은 캐시에 저장하지 않으므로 다음 실행 때 해당 섹션만 다시 처리된다.
+    if not sections:
+        return
+    max_workers = max(1, int(max_workers))
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="long-doc") as executor:
+        cached_outputs, pending_futures = {}, {}
+        for section_idx, section_text in enumerate(sections):
+            cached_output = cache.get(cache_keys[section_idx])
+            if cached_output is not None:
+                cached_outputs[section_idx] = cached_output
+            else:
+                pending_futures[section_idx] = executor.submit(process_section_fn, section_idx, section_text)
+
+        for section_idx in range(len(sections)):
+            if section_idx in cached_outputs:
+                yield section_idx, {"output": cached_outputs[section_idx], "usage": None, "error": None, "cached": True}
+                continue
+            try:
+                section_output, section_usage = pending_futures[section_idx].result()
+                if not section_output:
+                    raise ValueError("Empty response for section.")
+                cache.put(cache_keys[section_idx], section_output)
+                yield section_idx, {"output": section_output, "usage": section_usage, "error": None, "cached": False}
+            except Exception as e_section:
+                print(f"ERROR processing long document section {section_idx + 1}/{len(sections)}: {e_section}\n{traceback.format_exc()}")
+                yield section_idx, {"output": None, "usage": None, "error": str(e_section), "cached": False}
+
+
+def assemble_section_outputs(section_outputs, section_total):
+    # section_outputs: {인덱스: 결과 dict}. 실패한 섹션은 자리표시 문구로 채워 순서를 유지
+    assembled_parts = []
+    for section_idx in range(section_total):
+        result = section_outputs.get(section_idx)
+        if result and result.get("output"):
+            assembled_parts.append(result["output"].strip())
+        else:
+            error_text = result.get("error") if result else "not processed"
+            assembled_parts.append(LONG_DOC_SECTION_FAILED_TEMPLATE.format(section_no=section_idx + 1, section_total=section_total, error=error_text))
+    return "\n\n".join(assembled_parts)
@@ -0,0 +1,66 @@
+# 질문 처리 전 단계(첨부 파일 추출, 질의 임베딩/검색, 대화 기록 준비 등)를 동시에 실행하기 위한 도우미
+# 서로 의존하지 않는 단계는 스레드 풀에서 함께 실행하고, 단계마다 소요 시간을 따로 기록한다.
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from tracing import trace_span
+
+
+class StageTimings:
+    # 단계 이름 -> 소요 시간(ms). 여러 스레드에서 동시에 기록 가능
+    # measure()는 활성 trace가 있으면 같은 이름의 span도 함께 기록
+    def __init__(self):
+        self._timings = {}
+        self._lock = threading.Lock()
+
+    def record(self, stage_name, elapsed_seconds):
+        with self._lock:
+            self._timings[stage_name] = round(elapsed_seconds * 1000, 1)
+
+    @contextmanager
+    def measure(self, stage_name):
+        stage_start = time.perf_counter()
+        try:
+            with trace_span(stage_name):
+                yield
+        finally:
+            self.record(stage_name, time.perf_counter() - stage_start)
+
+    def as_dict(self):
+        with self._lock:
+            return dict(self._timings)
+
+    def format_summary(self):
+        return ", ".join(f"{name} {elapsed_ms:.0f}ms" for name, elapsed_ms in self.as_dict().items())
+
+
+def run_concurrent_stages(stage_fns, stage_timings, thread_initializer=None, propagate_exceptions=()):
+    # stage_fns: {단계 이름: 인자 없는 함수}. 모든 단계를 동시에 실행하고 전부 끝날 때까지 기다린다.
+    # 반환: {단계 이름: (결과, 오류 문자열 또는 None)}. 한 단계의 실패가 다른 단계를 막지 않는다.
+    # thread_initializer: 작업 스레드 시작 시 호출 (예: Streamlit 실행 컨텍스트 연결)
+    # propagate_exceptions: 이 유형의 예외는 결과에 담지 않고 모든 단계가 끝난 뒤 다시 발생 (예: 쿼터 초과 -> 사용자 안내)
+    if not stage_fns:
+        return {}
+
+    def run_timed_stage(stage_name, stage_fn):
+        with stage_timings.measure(stage_name):
+            return stage_fn()
+
+    stage_results, propagated_exception = {}, None
+    with stage_timings.measure("pre_llm_total"):
+        with ThreadPoolExecutor(max_workers=len(stage_fns), thread_name_prefix="pre-llm", initializer=thread_initializer) as executor:
+            stage_futures = {name: executor.submit(run_timed_stage, name, fn) for name, fn in stage_fns.items()}
+            for stage_name, stage_future in stage_futures.items():
+                try:
+                    stage_results[stage_name] = (stage_future.result(), None)
+                except propagate_exceptions as e_propagated:
+                    propagated_exception = propagated_exception or e_propagated
+                except Exception as e_stage:
+                    print(f"ERROR in pre-LLM stage '{stage_name}': {e_stage}\n{traceback.format_exc()}")
+                    stage_results[stage_name] = (None, str(e_stage))
+    if propagated_exception is not None:
+        raise propagated_exception
+    return stage_results
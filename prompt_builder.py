@@ -0,0 +1,154 @@
+# 채팅 프롬프트 조립기
+# - 정적인 부분(프롬프트 규칙, 문서 컨텍스트 머리/꼬리 문구)의 토큰 수는 규칙 버전별로 한 번만 계산
+# - 청크별 토큰 수는 메타데이터에 저장된 값을 사용하여 컨텍스트 전체를 다시 인코딩하지 않음
+# - 메시지 순서: [규칙(고정)] → [이전 대화] → [문서 컨텍스트] → [질문]
+#   규칙 system 메시지는 매 요청 바이트 단위로 동일하므로 서비스 측 프롬프트 prefix 캐시가 적중할 수 있다.
+import hashlib
+import os
+import threading
+import time
+
+from chunk_dedup import NEAR_DUPLICATE_THRESHOLD, MinHasher, normalize_chunk_text
+from conversation_memory import MESSAGE_TOKEN_OVERHEAD
+
+CONTEXT_HEADER = "다음은 사용자의 질문에 답변하는 데 도움이 되는 문서 내용입니다:\n<문서 시작>\n"
+CONTEXT_FOOTER = "\n<문서 끝>"
+NO_CONTEXT_TEXT = "현재 참고할 수 있는 문서가 없습니다."
+CONTEXT_SEPARATOR = "\n\n---\n\n"
+CONTEXT_TRUNCATED_NOTE = "\n(...문서 내용이 길어 일부 잘렸을 수 있습니다.)"
+DEFAULT_PROMPT_RULES = """1. 제공된 '문서 내용'을 최우선으로 참고하여 답변합니다.
+2. 질문에 대한 정보가 문서 내용에 명확히 없는 경우, "제공된 문서에서 관련 정보를 찾을 수 없습니다."라고 답변합니다. 추측성 답변은 피합니다.
+3. 답변은 구체적이고 명확해야 하며, 가능하다면 관련 규정 번호나 절차 단계를 언급합니다.
+4. 답변은 항상 한국어로 정중하게 제공합니다.
+5. 계산이 필요한 경우, 정확한 계산 과정을 포함하여 답변합니다.
+6. 사용자가 업로드한 파일(이미지 포함)의 내용과 질문을 연관지어 답변해야 할 경우, 해당 파일의 내용을 분석하여 답변에 활용합니다. 파일명도 함께 언급할 수 있습니다.
+7. 답변은 항상 사용자의 질문 의도에 부합하도록 노력합니다.
+8. 문서 내용에 여러 관련 정보가 있을 경우, 가장 중요하거나 질문과 직접적으로 관련된 정보를 중심으로 요약하여 답변합니다.
+9. 안전, 품질, 규정 준수와 관련된 질문에는 특히 신중하고 정확한 정보를 제공합니다.
+10. 답변은 문단으로 구분하여 가독성을 높입니다. 복잡한 내용은 필요시 목록 형태로 제시할 수 있습니다."""
+
+
+def load_prompt_rules(rules_path):
+    # 규칙 파일이 없거나 읽을 수 없으면 기본 규칙 사용 (앱과 batch_qa가 같은 규칙을 쓰도록)
+    if os.path.exists(rules_path):
+        try:
+            with open(rules_path, "r", encoding="utf-8") as f: rules_content = f.read()
+            print(f"Prompt rules loaded successfully from '{rules_path}'.")
+            return rules_content
+        except Exception as e:
+            print(f"WARNING: Error loading prompt rules from '{rules_path}': {e}. Using default rules defined in code.")
+            return DEFAULT_PROMPT_RULES
+    else:
+        print(f"WARNING: Prompt rules file not found at '{rules_path}'. Using default rules defined in code.")
+        return DEFAULT_PROMPT_RULES
+
+
+def get_rules_version(rules_text):
+    return hashlib.sha256((rules_text or "").encode("utf-8")).hexdigest()[:12]
+
+
+def ensure_item_token_count(item, tokenizer):
+    # 청크(메타데이터 항목 또는 검색 결과)에 토큰 수가 없으면 한 번만 계산해 저장
+    if not isinstance(item.get("token_count"), int):
+        item["token_count"] = len(tokenizer.encode(item.get("content", "") or ""))
+    return item["token_count"]
+
+
+class PromptBuilder:
+    def __init__(self, tokenizer, rules_text):
+        self.tokenizer = tokenizer
+        self.rules_text = rules_text or ""
+        self.rules_version = get_rules_version(self.rules_text)
+        self._static_token_counts = {} # (규칙 버전, 이름) -> 토큰 수
+        self._lock = threading.Lock()
+        self._minhasher = None # 근접 중복 컨텍스트 제거용 (처음 필요할 때 생성)
+
+    def count_static_tokens(self, part_name, part_text):
+        cache_key = (self.rules_version, part_name)
+        with self._lock:
+            if cache_key in self._static_token_counts:
+                return self._static_token_counts[cache_key]
+        token_count = len(self.tokenizer.encode(part_text))
+        with self._lock:
+            self._static_token_counts[cache_key] = token_count
+        return token_count
+
+    def static_prefix_tokens(self):
+        return self.count_static_tokens("rules", self.rules_text) + MESSAGE_TOKEN_OVERHEAD
+
+    def context_wrapper_tokens(self):
+        return self.count_static_tokens("context_wrapper", CONTEXT_HEADER + CONTEXT_FOOTER) + MESSAGE_TOKEN_OVERHEAD
+
+    def format_context_segments(self, context_items):
+        # 중복 내용을 제거하고 [출처 문서: ...] 머리말을 붙인 (세그먼트, 토큰 수) 목록을 만든다.
+        # 학습 전부터 인덱스에 있던 상용구 사본처럼 거의 같은 청크(MinHash 추정 유사도 NEAR_DUPLICATE_THRESHOLD 이상)도 하나만 넣는다.
+        unique_contents_seen, kept_signatures, formatted_segments = set(), [], []
+        for item in context_items:
+            content_segment = (item.get("content", "") or "").strip()
+            if not content_segment or content_segment in unique_contents_seen:
+                continue
+            unique_contents_seen.add(content_segment)
+            if self._minhasher is None: self._minhasher = MinHasher()
+            signature = self._minhasher.signature(normalize_chunk_text(content_segment))
+            if any(float((signature == kept_signature).mean()) >= NEAR_DUPLICATE_THRESHOLD for kept_signature in kept_signatures):
+                continue
+            kept_signatures.append(signature)
+            source_name = (item.get("source", "알 수 없음") or "알 수 없음").replace("사용자 첨부 이미지: ", "").replace("사용자 첨부 파일: ", "")
+            prefix = "[이미지 설명: " if item.get("is_image_description") else "[출처 문서: "
+            segment_header = f"{prefix}{source_name}]\n"
+            content_tokens = item["token_count"] if isinstance(item.get("token_count"), int) else ensure_item_token_count(item, self.tokenizer)
+            formatted_segments.append((segment_header + content_segment, len(self.tokenizer.encode(segment_header)) + content_tokens))
+        return formatted_segments
+
+    def fit_context_to_budget(self, formatted_segments, max_context_tokens):
+        # 토큰 수 합계로 예산을 판단하고, 넘치는 경우에만 마지막 세그먼트를 인코딩하여 자른다.
+        if max_context_tokens <= 0 or not formatted_segments:
+            return NO_CONTEXT_TEXT, self.count_static_tokens("no_context", NO_CONTEXT_TEXT), False
+        separator_tokens = self.count_static_tokens("context_separator", CONTEXT_SEPARATOR)
+        included_segments, used_tokens, truncated = [], 0, False
+        for segment_text, segment_tokens in formatted_segments:
+            joined_tokens = segment_tokens + (separator_tokens if included_segments else 0)
+            if used_tokens + joined_tokens <= max_context_tokens:
+                included_segments.append(segment_text); used_tokens += joined_tokens
+                continue
+            remaining_tokens = max_context_tokens - used_tokens - (separator_tokens if included_segments else 0)
+            if remaining_tokens > 0:
+                included_segments.append(self.tokenizer.decode(self.tokenizer.encode(segment_text)[:remaining_tokens]))
+                used_tokens = max_context_tokens
+            truncated = True
+            break
+        context_text = CONTEXT_SEPARATOR.join(included_segments)
+        if truncated:
+            context_text += CONTEXT_TRUNCATED_NOTE
+            used_tokens += self.count_static_tokens("context_truncated_note", CONTEXT_TRUNCATED_NOTE)
+        return context_text, used_tokens, truncated
+
+    def build(self, query_text, context_items, history_messages=None, history_tokens=0, max_input_tokens=None):
+        # 반환: (API 메시지 목록, 통계 dict)
+        build_start = time.perf_counter()
+        history_messages = history_messages or []
+        query_tokens = len(self.tokenizer.encode(query_text)) + MESSAGE_TOKEN_OVERHEAD
+        static_tokens = self.static_prefix_tokens()
+        wrapper_tokens = self.context_wrapper_tokens()
+        max_context_tokens = (max_input_tokens - static_tokens - wrapper_tokens - query_tokens - history_tokens) if max_input_tokens else float("inf")
+
+        formatted_segments = self.format_context_segments(context_items or [])
+        context_text, context_tokens, context_truncated = self.fit_context_to_budget(formatted_segments, max_context_tokens)
+
+        api_messages = [{"role": "system", "content": self.rules_text}]
+        api_messages.extend(history_messages)
+        api_messages.append({"role": "system", "content": f"{CONTEXT_HEADER}{context_text}{CONTEXT_FOOTER}"})
+        api_messages.append({"role": "user", "content": query_text})
+
+        prompt_stats = {
+            "rules_version": self.rules_version,
+            "static_prefix_tokens": static_tokens,
+            "history_tokens": history_tokens,
+            "context_tokens": context_tokens + wrapper_tokens,
+            "context_segments": len(formatted_segments),
+            "context_truncated": context_truncated,
+            "query_tokens": query_tokens,
+            "total_input_tokens": static_tokens + history_tokens + context_tokens + wrapper_tokens + query_tokens,
+            "assembly_ms": round((time.perf_counter() - build_start) * 1000, 2),
+        }
+        return api_messages, prompt_stats
@@ -0,0 +1,85 @@
+# retrieval_service.py(검색 사이드카)를 호출하는 얇은 클라이언트
+# - service_url: "http://host:port" 또는 "unix:/경로.sock"
+# - search/ingest 응답은 SimpleNamespace로 돌려주고 usage를 속성으로 두어 ResilientLLMClient.run_metered로 그대로 계량할 수 있게 함
+#   (임베딩 캐시 적중 등으로 API를 호출하지 않았으면 usage.total_tokens=0)
+import http.client
+import json
+import socket
+from types import SimpleNamespace
+from urllib.parse import urlsplit
+
+DEFAULT_TIMEOUT_SECONDS = 60.0
+
+
+class RetrievalServiceError(Exception):
+    pass
+
+
+class UnixSocketHTTPConnection(http.client.HTTPConnection):
+    def __init__(self, socket_path, timeout=DEFAULT_TIMEOUT_SECONDS):
+        super().__init__("localhost", timeout=timeout)
+        self.socket_path = socket_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.socket_path)
+
+
+def usage_from_dict(usage_dict):
+    usage_dict = usage_dict or {}
+    return SimpleNamespace(prompt_tokens=usage_dict.get("prompt_tokens", 0), completion_tokens=usage_dict.get("completion_tokens", 0),
+                           total_tokens=usage_dict.get("total_tokens", 0))
+
+
+class RetrievalServiceClient:
+    def __init__(self, service_url, timeout=DEFAULT_TIMEOUT_SECONDS):
+        self.service_url = service_url
+        self.timeout = timeout
+
+    def _connect(self, timeout):
+        if self.service_url.startswith("unix:"):
+            return UnixSocketHTTPConnection(self.service_url[len("unix:"):], timeout=timeout)
+        parsed_url = urlsplit(self.service_url)
+        return http.client.HTTPConnection(parsed_url.hostname, parsed_url.port or 80, timeout=timeout)
+
+    def _request(self, method, path, payload=None, timeout=None):
+        connection = self._connect(timeout or self.timeout)
+        try:
+            request_body = json.dumps(payload, ensure_ascii=False).encode("utf-8") if payload is not None else None
+            headers = {"Content-Type": "application/json"} if request_body is not None else {}
+            connection.request(method, path, body=request_body, headers=headers)
+            response = connection.getresponse()
+            response_body = json.loads(response.read() or b"{}")
+        except (OSError, http.client.HTTPException, ValueError) as e_connection:
+            raise RetrievalServiceError(f"Retrieval service request {method} {path} failed: {e_connection}") from e_connection
+        finally:
+            connection.close()
+        if response.status != 200:
+            raise RetrievalServiceError(f"Retrieval service returned {response.status} for {path}: {response_body.get('error', '')}")
+        return response_body
+
+    def search(self, query_text, k=3, shards=None):
+        # shards: 검색할 샤드 이름 목록 (None이면 모든 샤드)
+        response_body = self._request("POST", "/search", {"query": query_text, "k": k, "shards": shards})
+        return SimpleNamespace(results=response_body.get("results", []), usage=usage_from_dict(response_body.get("usage")),
+                               embedding_cached=response_body.get("embedding_cached", False))
+
+    def ingest(self, file_name, chunks, is_image_description=False, original_file_extension="", token_counts=None, shard=None, timeout=600.0):
+        # 학습은 청크 수에 비례해 오래 걸리므로 별도 타임아웃
+        response_body = self._request("POST", "/ingest", {
+            "file_name": file_name, "chunks": chunks, "is_image_description": is_image_description,
+            "original_file_extension": original_file_extension, "token_counts": token_counts, "shard": shard
+        }, timeout=timeout)
+        return SimpleNamespace(added=response_body.get("added", 0), failed=response_body.get("failed", 0), ntotal=response_body.get("ntotal", 0),
+                               usage=usage_from_dict(response_body.get("usage")), dedup=response_body.get("dedup") or {})
+
+    def load_shards(self, shard_names=None):
+        # 샤드를 검색(임베딩) 없이 불러옴. 반환: 불러온 뒤의 저장소 통계 (ShardedVectorStore.stats 형식)
+        return self._request("POST", "/load", {"shards": shard_names}, timeout=120.0)
+
+    def health(self):
+        return self._request("GET", "/health", timeout=5.0)
+
+    def stats(self):
+        return self._request("GET", "/stats", timeout=5.0)
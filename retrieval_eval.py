@@ -0,0 +1,389 @@
+# 검색 품질 평가: 정답 세트(질문 -> 출처 파일)로 여러 검색 설정의 recall@k, MRR, 평균 컨텍스트 토큰, 검색 지연을 비교
+# 사용법:
+#   python retrieval_eval.py --labels eval_set.jsonl --metadata metadata.json \
+#       --index-types flat,ivf,hnsw,pq --chunk-sizes 300,500,800 --k 3,5,10 --hybrid off,on --output eval_results.csv
+# - 정답 세트: JSONL, 한 줄에 {"question": "...", "source_files": ["파일명.pdf", ...]} ("source_file": "..."도 가능)
+# - 문서: 앱의 vector_db/metadata.json(압축된 파일도 가능)에서 파일별 청크를 이어 붙여 복원하거나 --documents-dir의 .txt/.md 파일 사용
+#   청크 크기별로 앱과 같은 규칙(text_chunking.chunk_text_into_pieces)으로 다시 나눔
+# - 임베딩은 --embedding-cache(.npz)에 모델별로 저장해 두고 재사용. --offline이면 캐시에 없는 텍스트가 있을 때 API를 호출하지 않고 중단
+#   API 설정은 앱 secrets와 같은 이름의 환경 변수 (AZURE_OPENAI_KEY, AZURE_OPENAI_ENDPOINT, AZURE_OPENAI_VERSION, AZURE_OPENAI_EMBEDDING_DEPLOYMENT)
+# - hybrid: 벡터 검색과 BM25(단어 + 글자 bigram) 결과를 RRF(reciprocal rank fusion)로 결합 (앱에는 없는 평가용 설정)
+# - 검색 지연: 질의 임베딩(캐시)을 제외한 인덱스 검색 + 결합 시간. 기본적으로 FAISS 스레드 1개로 측정 (--threads)
+import argparse
+import csv
+import hashlib
+import json
+import math
+import os
+import re
+import sys
+import time
+from collections import Counter
+
+from blob_io import decode_blob_payload
+from text_chunking import chunk_text_into_pieces
+from tracing import percentile
+
+EVAL_INDEX_TYPES = ("flat", "ivf", "hnsw", "pq")
+EVAL_EMBEDDING_BATCH_SIZE = 16 # 앱의 EMBEDDING_BATCH_SIZE와 같음
+RRF_RANK_CONSTANT = 60
+HYBRID_CANDIDATE_MULTIPLIER = 4 # hybrid일 때 각 검색기에서 k * 이 값만큼 후보를 가져와 결합
+LEXICAL_WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+DOCUMENT_FILE_EXTENSIONS = (".txt", ".md")
+RESULT_COLUMNS = ["index", "chunk_size", "chunks", "k", "hybrid", "recall_at_k", "mrr", "mean_context_tokens",
+                  "latency_p50_ms", "latency_p95_ms", "build_ms"]
+
+
+class EmbeddingCache:
+    # 키: sha256(모델 이름 + 텍스트) -> float32 벡터. .npz(keys, vectors) 파일에 저장
+    def __init__(self, path, model_name):
+        self.path = path
+        self.model_name = model_name
+        self._vectors = {}
+        self._dirty = False
+        if path and os.path.exists(path):
+            np = _import_numpy()
+            with np.load(path, allow_pickle=False) as cache_file:
+                for key, vector in zip(cache_file["keys"].tolist(), cache_file["vectors"]):
+                    self._vectors[key] = vector
+            print(f"Loaded {len(self._vectors)} cached embeddings from '{path}'.")
+
+    def make_key(self, text):
+        return hashlib.sha256(f"{self.model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def missing_texts(self, texts):
+        seen, missing = set(), []
+        for text in texts:
+            key = self.make_key(text)
+            if key not in self._vectors and key not in seen:
+                seen.add(key); missing.append(text)
+        return missing
+
+    def add(self, texts, vectors):
+        np = _import_numpy()
+        for text, vector in zip(texts, vectors):
+            self._vectors[self.make_key(text)] = np.asarray(vector, dtype="float32")
+        self._dirty = True
+
+    def matrix(self, texts):
+        np = _import_numpy()
+        return np.vstack([self._vectors[self.make_key(text)] for text in texts]).astype("float32")
+
+    def save(self):
+        if not self.path or not self._dirty:
+            return
+        np = _import_numpy()
+        keys = list(self._vectors)
+        temp_path = f"{self.path}.tmp.npz" # np.savez는 .npz가 아닌 경로에 확장자를 붙이므로 미리 붙여 둠
+        np.savez(temp_path, keys=np.array(keys), vectors=np.vstack([self._vectors[key] for key in keys]))
+        os.replace(temp_path, self.path)
+        self._dirty = False
+        print(f"Saved {len(keys)} embeddings to '{self.path}'.")
+
+
+def _import_numpy():
+    import numpy # 평가 실행 시에만 필요
+    return numpy
+
+
+def make_azure_embedder(model_name):
+    from openai import AzureOpenAI
+    client = AzureOpenAI(
+        api_key=os.environ["AZURE_OPENAI_KEY"], azure_endpoint=os.environ["AZURE_OPENAI_ENDPOINT"],
+        api_version=os.environ.get("AZURE_OPENAI_VERSION", "2024-02-15-preview"), timeout=60.0
+    )
+
+    def embed_batch(batch):
+        response = client.embeddings.create(model=model_name, input=batch)
+        return [item.embedding for item in sorted(response.data, key=lambda emb_item: emb_item.index)]
+    return embed_batch
+
+
+def make_fake_embedder():
+    # Azure 없이 도구 동작을 확인할 때 사용 (단어 해시 기반 벡터, 실제 검색 품질과는 무관)
+    from benchmark_fakes import deterministic_embedding
+    return lambda batch: [deterministic_embedding(text) for text in batch]
+
+
+def fill_embedding_cache(embedding_cache, texts, embed_batch, offline=False, batch_size=EVAL_EMBEDDING_BATCH_SIZE):
+    missing = embedding_cache.missing_texts(texts)
+    if not missing:
+        return
+    if offline:
+        raise RuntimeError(f"{len(missing)} texts are not in the embedding cache '{embedding_cache.path}'. Run once without --offline to fill it.")
+    print(f"Embedding {len(missing)} texts not found in the cache...")
+    for batch_start in range(0, len(missing), batch_size):
+        batch = missing[batch_start:batch_start + batch_size]
+        embedding_cache.add(batch, embed_batch(batch))
+    embedding_cache.save() # 중간에 실패해도 다음 실행에서 이어서 채울 수 있도록 설정마다 저장
+
+
+def load_documents_from_metadata(metadata_path):
+    # 반환: {파일 이름: 본문}. 파일별 청크를 학습 순서대로 이어 붙임 (청크는 줄 단위로 나뉘었으므로 다시 나눌 수 있음)
+    with open(metadata_path, "rb") as metadata_file:
+        metadata_items = json.loads(decode_blob_payload(metadata_file.read()))
+    chunks_by_file = {}
+    for item in metadata_items or []:
+        if isinstance(item, dict) and item.get("content"):
+            chunks_by_file.setdefault(item.get("file_name", "Unknown Source"), []).append(item["content"])
+    return {file_name: "\n".join(chunks) for file_name, chunks in chunks_by_file.items()}
+
+
+def load_documents_from_dir(documents_dir):
+    documents = {}
+    for file_name in sorted(os.listdir(documents_dir)):
+        if os.path.splitext(file_name)[1].lower() in DOCUMENT_FILE_EXTENSIONS:
+            with open(os.path.join(documents_dir, file_name), "r", encoding="utf-8") as document_file:
+                documents[file_name] = document_file.read()
+    return documents
+
+
+def load_labeled_questions(labels_path):
+    # 반환: [{"question": str, "source_files": set}]. 형식이 맞지 않는 줄은 건너뜀
+    labeled_questions = []
+    with open(labels_path, "r", encoding="utf-8") as labels_file:
+        for line_no, line in enumerate(labels_file, start=1):
+            if not line.strip():
+                continue
+            try:
+                entry = json.loads(line)
+                source_files = entry.get("source_files") or ([entry["source_file"]] if entry.get("source_file") else [])
+                if not str(entry.get("question", "")).strip() or not source_files:
+                    raise ValueError("'question' and 'source_files' are required")
+            except (ValueError, KeyError, AttributeError) as e_label:
+                print(f"WARNING: Skipping invalid label on line {line_no} of '{labels_path}': {e_label}")
+                continue
+            labeled_questions.append({"question": str(entry["question"]).strip(), "source_files": {os.path.basename(str(name)).strip() for name in source_files}})
+    return labeled_questions
+
+
+def load_token_counter():
+    # 앱과 같은 인코더 순서 (o200k_base -> cl100k_base). 불러올 수 없으면 None (컨텍스트 토큰은 보고하지 않음)
+    try:
+        import tiktoken
+    except ImportError:
+        print("WARNING: tiktoken is not installed. Context tokens will not be reported.")
+        return None
+    for encoding_name in ("o200k_base", "cl100k_base"):
+        try:
+            encoding = tiktoken.get_encoding(encoding_name)
+            return lambda text: len(encoding.encode(text))
+        except Exception as e_encoding:
+            print(f"WARNING: Could not load tiktoken '{encoding_name}' encoder: {e_encoding}")
+    return None
+
+
+def lexical_tokens(text):
+    # 한국어 조사/어미 차이에도 일치하도록 단어와 단어 안의 글자 bigram을 함께 사용
+    words = LEXICAL_WORD_PATTERN.findall(text.lower())
+    return words + [word[char_pos:char_pos + 2] for word in words if len(word) > 2 for char_pos in range(len(word) - 1)]
+
+
+class BM25Index:
+    def __init__(self, texts, k1=1.5, b=0.75):
+        self.k1, self.b = k1, b
+        self._postings = {} # 토큰 -> [(문서 번호, 빈도)]
+        self._doc_lengths = []
+        for doc_id, text in enumerate(texts):
+            token_counts = Counter(lexical_tokens(text))
+            self._doc_lengths.append(sum(token_counts.values()))
+            for token, count in token_counts.items():
+                self._postings.setdefault(token, []).append((doc_id, count))
+        self._avg_doc_length = (sum(self._doc_lengths) / len(self._doc_lengths)) if self._doc_lengths else 0.0
+
+    def search(self, query_text, k):
+        doc_count = len(self._doc_lengths)
+        scores = {}
+        for token in set(lexical_tokens(query_text)):
+            postings = self._postings.get(token)
+            if not postings:
+                continue
+            idf = math.log(1 + (doc_count - len(postings) + 0.5) / (len(postings) + 0.5))
+            for doc_id, count in postings:
+                length_norm = self.k1 * (1 - self.b + self.b * self._doc_lengths[doc_id] / (self._avg_doc_length or 1))
+                scores[doc_id] = scores.get(doc_id, 0.0) + idf * count * (self.k1 + 1) / (count + length_norm)
+        return [doc_id for doc_id, _ in sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]]
+
+
+def reciprocal_rank_fusion(ranked_lists, k, rank_constant=RRF_RANK_CONSTANT):
+    fused_scores = {}
+    for ranked_ids in ranked_lists:
+        for rank, doc_id in enumerate(ranked_ids, start=1):
+            fused_scores[doc_id] = fused_scores.get(doc_id, 0.0) + 1.0 / (rank_constant + rank)
+    return [doc_id for doc_id, _ in sorted(fused_scores.items(), key=lambda item: (-item[1], item[0]))[:k]]
+
+
+def build_faiss_index(index_type, vectors, options):
+    # 반환: (인덱스, 설정 설명). 학습 데이터가 적으면 nlist/nbits를 줄임 (FAISS 학습 최소 개수 경고 방지)
+    import faiss
+    vector_count, dimension = vectors.shape
+    if index_type == "flat":
+        index, description = faiss.index_factory(dimension, "Flat"), "Flat"
+    elif index_type == "ivf":
+        nlist = max(1, min(options.ivf_nlist, vector_count // 39))
+        index = faiss.index_factory(dimension, f"IVF{nlist},Flat")
+        index.train(vectors)
+        faiss.extract_index_ivf(index).nprobe = min(options.ivf_nprobe, nlist)
+        description = f"IVF{nlist},Flat nprobe={min(options.ivf_nprobe, nlist)}"
+    elif index_type == "hnsw":
+        index = faiss.index_factory(dimension, f"HNSW{options.hnsw_m}")
+        index.hnsw.efConstruction = options.hnsw_ef_construction
+        index.hnsw.efSearch = options.hnsw_ef_search
+        description = f"HNSW{options.hnsw_m} efSearch={options.hnsw_ef_search}"
+    elif index_type == "pq":
+        sub_quantizers = max(divisor for divisor in range(1, min(options.pq_m, dimension) + 1) if dimension % divisor == 0)
+        nbits = max(1, min(8, int(math.log2(max(2, vector_count // 39)))))
+        index = faiss.index_factory(dimension, f"PQ{sub_quantizers}x{nbits}")
+        index.train(vectors)
+        description = f"PQ{sub_quantizers}x{nbits}"
+    else:
+        raise ValueError(f"Unknown index type '{index_type}'. Use one of: {', '.join(EVAL_INDEX_TYPES)}")
+    index.add(vectors)
+    return index, description
+
+
+def evaluate_configuration(index, bm25_index, chunk_files, chunk_token_counts, labeled_questions, question_vectors, k, hybrid):
+    recall_sum, reciprocal_rank_sum, context_tokens, latencies_ms = 0.0, 0.0, [], []
+    candidate_k = min(len(chunk_files), k * HYBRID_CANDIDATE_MULTIPLIER if hybrid else k)
+    for question_no, labeled_question in enumerate(labeled_questions):
+        started = time.perf_counter()
+        _, found_ids = index.search(question_vectors[question_no:question_no + 1], candidate_k)
+        retrieved_ids = [int(doc_id) for doc_id in found_ids[0] if doc_id >= 0]
+        if hybrid:
+            retrieved_ids = reciprocal_rank_fusion([retrieved_ids, bm25_index.search(labeled_question["question"], candidate_k)], k)
+        retrieved_ids = retrieved_ids[:k]
+        latencies_ms.append((time.perf_counter() - started) * 1000)
+
+        retrieved_files = [chunk_files[doc_id] for doc_id in retrieved_ids]
+        relevant_files = labeled_question["source_files"]
+        recall_sum += len(relevant_files & set(retrieved_files)) / len(relevant_files)
+        first_hit_rank = next((rank for rank, file_name in enumerate(retrieved_files, start=1) if file_name in relevant_files), None)
+        reciprocal_rank_sum += 1.0 / first_hit_rank if first_hit_rank else 0.0
+        if chunk_token_counts is not None:
+            context_tokens.append(sum(chunk_token_counts[doc_id] for doc_id in retrieved_ids))
+    latencies_ms.sort()
+    question_count = len(labeled_questions)
+    return {
+        "recall_at_k": round(recall_sum / question_count, 4), "mrr": round(reciprocal_rank_sum / question_count, 4),
+        "mean_context_tokens": round(sum(context_tokens) / len(context_tokens), 1) if context_tokens else None,
+        "latency_p50_ms": round(percentile(latencies_ms, 50), 3), "latency_p95_ms": round(percentile(latencies_ms, 95), 3)
+    }
+
+
+def run_evaluation(documents, labeled_questions, embedding_cache, embed_batch, options):
+    # 반환: 설정별 결과 행 목록 (RESULT_COLUMNS + index_description)
+    unknown_sources = {name for labeled_question in labeled_questions for name in labeled_question["source_files"]} - set(documents)
+    if unknown_sources:
+        print(f"WARNING: {len(unknown_sources)} labeled source files are not in the corpus (they can never be retrieved): {sorted(unknown_sources)[:5]}")
+    question_texts = [labeled_question["question"] for labeled_question in labeled_questions]
+    fill_embedding_cache(embedding_cache, question_texts, embed_batch, options.offline)
+    question_vectors = embedding_cache.matrix(question_texts)
+    token_counter = load_token_counter()
+
+    result_rows = []
+    for chunk_size in options.chunk_sizes:
+        chunk_files, chunk_texts = [], []
+        for file_name, document_text in documents.items():
+            for chunk in chunk_text_into_pieces(document_text, chunk_size):
+                chunk_files.append(file_name); chunk_texts.append(chunk)
+        if not chunk_texts:
+            print(f"WARNING: No chunks for chunk size {chunk_size}. Skipping.")
+            continue
+        fill_embedding_cache(embedding_cache, chunk_texts, embed_batch, options.offline)
+        chunk_vectors = embedding_cache.matrix(chunk_texts)
+        chunk_token_counts = [token_counter(chunk) for chunk in chunk_texts] if token_counter else None
+        bm25_index = BM25Index(chunk_texts) if True in options.hybrid_modes else None
+        for index_type in options.index_types:
+            build_started = time.perf_counter()
+            index, index_description = build_faiss_index(index_type, chunk_vectors, options)
+            build_ms = round((time.perf_counter() - build_started) * 1000, 1)
+            for k in options.k_values:
+                for hybrid in options.hybrid_modes:
+                    row = {"index": index_type, "chunk_size": chunk_size, "chunks": len(chunk_texts), "k": k,
+                           "hybrid": "on" if hybrid else "off", "build_ms": build_ms, "index_description": index_description}
+                    row.update(evaluate_configuration(index, bm25_index, chunk_files, chunk_token_counts, labeled_questions, question_vectors, k, hybrid))
+                    result_rows.append(row)
+    return result_rows
+
+
+def format_results_table(result_rows):
+    header = f"{'index':<6} {'chunk':>6} {'chunks':>7} {'k':>3} {'hybrid':>6} {'recall@k':>9} {'MRR':>7} {'ctx_tok':>8} {'p50_ms':>8} {'p95_ms':>8} {'build_ms':>9}  detail"
+    lines = [header, "-" * len(header)]
+    for row in result_rows:
+        context_tokens = f"{row['mean_context_tokens']:.1f}" if row["mean_context_tokens"] is not None else "n/a"
+        lines.append(f"{row['index']:<6} {row['chunk_size']:>6} {row['chunks']:>7} {row['k']:>3} {row['hybrid']:>6} {row['recall_at_k']:>9.4f} {row['mrr']:>7.4f} "
+                     f"{context_tokens:>8} {row['latency_p50_ms']:>8.3f} {row['latency_p95_ms']:>8.3f} {row['build_ms']:>9.1f}  {row['index_description']}")
+    return "\n".join(lines)
+
+
+def write_results(result_rows, output_path):
+    if output_path.lower().endswith(".json"):
+        with open(output_path, "w", encoding="utf-8") as output_file:
+            json.dump(result_rows, output_file, ensure_ascii=False, indent=2)
+        return
+    with open(output_path, "w", encoding="utf-8", newline="") as output_file:
+        writer = csv.DictWriter(output_file, fieldnames=RESULT_COLUMNS + ["index_description"])
+        writer.writeheader(); writer.writerows(result_rows)
+
+
+def parse_int_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Compare retrieval configurations (recall@k, MRR, context tokens, latency) on a labeled question set.")
+    parser.add_argument("--labels", required=True, help="JSONL file: {\"question\": ..., \"source_files\": [...]} per line.")
+    corpus_group = parser.add_mutually_exclusive_group(required=True)
+    corpus_group.add_argument("--metadata", help="Vector DB metadata JSON (vector_db/metadata.json, compressed or not).")
+    corpus_group.add_argument("--documents-dir", help="Directory of .txt/.md source documents.")
+    parser.add_argument("--index-types", default="flat,ivf,hnsw,pq", help=f"Comma-separated subset of: {', '.join(EVAL_INDEX_TYPES)}.")
+    parser.add_argument("--chunk-sizes", default="500", help="Comma-separated chunk sizes (characters). The app uses 500.")
+    parser.add_argument("--k", default="3", help="Comma-separated k values. The app uses 3.")
+    parser.add_argument("--hybrid", default="off", help="Comma-separated: off, on.")
+    parser.add_argument("--embedding-cache", default="retrieval_eval_embeddings.npz")
+    parser.add_argument("--embedding-model", default=os.environ.get("AZURE_OPENAI_EMBEDDING_DEPLOYMENT", "text-embedding-ada-002"),
+                        help="Embedding deployment name (also part of the cache key).")
+    parser.add_argument("--embedder", choices=["azure", "fake"], default="azure", help="'fake' uses deterministic hash vectors (tool smoke test only).")
+    parser.add_argument("--offline", action="store_true", help="Fail instead of calling the embedding API for texts missing from the cache.")
+    parser.add_argument("--ivf-nlist", type=int, default=64)
+    parser.add_argument("--ivf-nprobe", type=int, default=8)
+    parser.add_argument("--hnsw-m", type=int, default=32)
+    parser.add_argument("--hnsw-ef-construction", type=int, default=40)
+    parser.add_argument("--hnsw-ef-search", type=int, default=64)
+    parser.add_argument("--pq-m", type=int, default=64, help="PQ sub-quantizers (largest divisor of the dimension not above this).")
+    parser.add_argument("--threads", type=int, default=1, help="FAISS OpenMP threads used for search.")
+    parser.add_argument("--output", help="Write results as CSV (or JSON if the path ends with .json).")
+    options = parser.parse_args(argv)
+    options.index_types = [item.strip().lower() for item in options.index_types.split(",") if item.strip()]
+    unknown_types = [index_type for index_type in options.index_types if index_type not in EVAL_INDEX_TYPES]
+    if unknown_types:
+        parser.error(f"Unknown index types: {', '.join(unknown_types)}")
+    options.chunk_sizes, options.k_values = parse_int_list(options.chunk_sizes), parse_int_list(options.k)
+    options.hybrid_modes = [item.strip().lower() in ("on", "true", "1") for item in options.hybrid.split(",") if item.strip()]
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    import faiss
+    faiss.omp_set_num_threads(options.threads)
+    documents = load_documents_from_metadata(options.metadata) if options.metadata else load_documents_from_dir(options.documents_dir)
+    labeled_questions = load_labeled_questions(options.labels)
+    if not documents or not labeled_questions:
+        print(f"ERROR: Nothing to evaluate ({len(documents)} documents, {len(labeled_questions)} labeled questions).")
+        return 1
+    print(f"Evaluating {len(labeled_questions)} questions against {len(documents)} documents.")
+    embedding_cache = EmbeddingCache(options.embedding_cache, options.embedding_model if options.embedder == "azure" else "fake")
+    embed_batch = None
+    if not options.offline:
+        embed_batch = make_azure_embedder(options.embedding_model) if options.embedder == "azure" else make_fake_embedder()
+    result_rows = run_evaluation(documents, labeled_questions, embedding_cache, embed_batch, options)
+    print(format_results_table(result_rows))
+    if options.output:
+        write_results(result_rows, options.output)
+        print(f"Results written to '{options.output}'.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
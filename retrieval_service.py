@@ -0,0 +1,323 @@
+# 문서 검색 사이드카 서비스 (노드당 하나)
+# - FAISS 인덱스와 메타데이터를 이 프로세스 하나만 메모리에 올리고, 같은 노드의 모든 Streamlit 프로세스가
+#   retrieval_client.RetrievalServiceClient로 검색/학습을 요청 (앱 프로세스 수만큼 인덱스가 복제되지 않음)
+# - 학습(ingest)도 이 서비스가 처리하므로 어느 앱 프로세스에서 올린 문서든 바로 모든 세션의 검색에 반영됨
+# - 인덱스는 부서/컬렉션별 샤드(vector_shards.ShardedVectorStore). 검색 요청마다 볼 수 있는 샤드를 지정하고, 학습은 샤드 하나에 추가
+# - 여러 세션에서 동시에 들어온 검색은 SearchBatcher가 짧은 시간(max_wait_ms) 모아 FAISS search 한 번으로 처리
+# - 질의 임베딩은 LRU 캐시로 재사용. 임베딩 API 사용량은 응답에 담아 돌려주고, 앱이 사용자별로 계량/기록 (token_quota)
+# 실행:
+#   python retrieval_service.py --listen 127.0.0.1:8765            # 또는 --listen unix:/tmp/chatbot-retrieval.sock
+#   앱 secrets에 RETRIEVAL_SERVICE_URL = "http://127.0.0.1:8765" (또는 "unix:/tmp/chatbot-retrieval.sock") 설정
+# 설정은 앱과 같은 .streamlit/secrets.toml을 읽음 (Azure OpenAI, STORAGE_BACKEND / AZURE_BLOB_CONN / BLOB_CONTAINER / LOCAL_STORAGE_DIR)
+# API (JSON):
+#   POST /search {"query": str, "k": int, "shards": [str] | null(모든 샤드)}  -> {"results": [...], "usage": {...} | null, "embedding_cached": bool}
+#   POST /ingest {"file_name", "chunks", "is_image_description", "original_file_extension", "token_counts", "shard"}
+#                -> {"added": int, "failed": int, "ntotal": int(샤드의 벡터 수), "usage": {...} | null, "dedup": {건너뛴 중복 청크 통계}}
+#                (임베딩 모델 전환 중이면 503)
+#   POST /load {"shards": [str] | null(모든 샤드)} -> 샤드를 검색 없이 불러온 뒤의 GET /health 통계 (FAQ 캐시 지문 비교용)
+#   POST /reload -> 불러온 샤드를 버리고 목록을 다시 확인 (다른 노드가 학습한 내용 반영)
+# 임베딩 모델 전환(embedding_migration.py)은 active.json을 주기적으로 확인해 반영 (질의 임베딩도 새 모델로)
+#   GET /health, GET /stats
+import argparse
+import hashlib
+import json
+import os
+import socketserver
+import sys
+import threading
+import time
+import tomllib
+import traceback
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from queue import Empty, Queue
+
+from app_common import EMBEDDING_BATCH_SIZE
+from llm_client import ResilientLLMClient, RetryPolicy
+from storage_backends import LocalContainerClient
+from vector_shards import COMMON_SHARD_NAME, ShardedVectorStore, VectorIngestPausedError
+
+EMBEDDING_HEDGE_AFTER_SECONDS = 1.5
+QUERY_EMBEDDING_CACHE_SIZE = 10000
+DEFAULT_LISTEN = "127.0.0.1:8765"
+DEFAULT_MAX_BATCH_SIZE = 64
+DEFAULT_MAX_WAIT_MS = 5.0 # 첫 검색 요청이 들어온 뒤 같은 배치로 묶을 요청을 기다리는 시간
+SEARCH_RESULT_TIMEOUT_SECONDS = 30.0
+LAYOUT_REFRESH_INTERVAL_SECONDS = 30.0 # 임베딩 모델 전환 확인 주기
+
+
+def usage_to_dict(usage):
+    if usage is None:
+        return None
+    return {"prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0, "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+            "total_tokens": getattr(usage, "total_tokens", 0) or 0}
+
+
+class QueryEmbeddingCache:
+    # 질의 텍스트 -> 임베딩 벡터 (LRU)
+    def __init__(self, max_entries=QUERY_EMBEDDING_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(model_name, text):
+        return hashlib.sha256(f"{model_name}\n{text}".encode("utf-8")).hexdigest()
+
+    def get(self, key):
+        with self._lock:
+            vector = self._entries.get(key)
+            if vector is not None:
+                self._entries.move_to_end(key)
+            return vector
+
+    def put(self, key, vector):
+        with self._lock:
+            self._entries[key] = vector
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+
+class SearchBatcher:
+    # 동시에 들어온 검색 요청을 모아 ShardedVectorStore.search_batch 한 번으로 처리하는 단일 작업 스레드 (샤드마다 FAISS search 한 번)
+    def __init__(self, vector_store, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self.vector_store = vector_store
+        self.max_batch_size = max_batch_size
+        self.max_wait_seconds = max_wait_ms / 1000
+        self.stats = {"batches": 0, "queries": 0, "max_batch_size_seen": 0}
+        self._queue = Queue()
+        self._stats_lock = threading.Lock()
+        threading.Thread(target=self._run, name="search-batcher", daemon=True).start()
+
+    def submit(self, query_vector, k, shard_names=None):
+        result_future = Future()
+        self._queue.put((query_vector, k, shard_names, result_future))
+        return result_future
+
+    def _run(self):
+        while True:
+            pending = [self._queue.get()]
+            deadline = time.monotonic() + self.max_wait_seconds
+            while len(pending) < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                try:
+                    pending.append(self._queue.get(timeout=remaining))
+                except Empty:
+                    break
+            try:
+                batch_results = self.vector_store.search_batch([item[0] for item in pending], [item[1] for item in pending], [item[2] for item in pending])
+                for (_, _, _, result_future), results in zip(pending, batch_results):
+                    result_future.set_result(results)
+            except Exception as e_batch:
+                print(f"ERROR during batched FAISS search ({len(pending)} queries): {e_batch}\n{traceback.format_exc()}")
+                for _, _, _, result_future in pending:
+                    if not result_future.done(): result_future.set_exception(e_batch)
+            with self._stats_lock:
+                self.stats["batches"] += 1
+                self.stats["queries"] += len(pending)
+                self.stats["max_batch_size_seen"] = max(self.stats["max_batch_size_seen"], len(pending))
+
+    def snapshot_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats["avg_batch_size"] = round(stats["queries"] / stats["batches"], 2) if stats["batches"] else 0.0
+        return stats
+
+
+class RetrievalService:
+    # embedding_model: 기존 배치(active.json 없음)에서 쓰는 앱 설정의 임베딩 모델
+    def __init__(self, vector_store, llm_client, embedding_model, max_batch_size=DEFAULT_MAX_BATCH_SIZE, max_wait_ms=DEFAULT_MAX_WAIT_MS):
+        self.vector_store = vector_store
+        self.llm_client = llm_client
+        self.embedding_model = embedding_model
+        self.embedding_cache = QueryEmbeddingCache()
+        self.batcher = SearchBatcher(vector_store, max_batch_size, max_wait_ms)
+
+    def current_embedding_model(self):
+        return self.vector_store.embedding_model(self.embedding_model)
+
+    def search(self, query_text, k, shard_names=None):
+        self.vector_store.maybe_refresh_layout(LAYOUT_REFRESH_INTERVAL_SECONDS)
+        embedding_model = self.current_embedding_model()
+        cache_key = QueryEmbeddingCache.make_key(embedding_model, query_text) # 모델이 바뀌면 이전 캐시는 자연히 적중하지 않음
+        query_vector, usage = self.embedding_cache.get(cache_key), None
+        embedding_cached = query_vector is not None
+        if query_vector is None:
+            response = self.llm_client.embeddings("embedding", embedding_model, [query_text], hedge=True)
+            query_vector, usage = response.data[0].embedding, response.usage
+            self.embedding_cache.put(cache_key, query_vector)
+        results = self.batcher.submit(query_vector, k, shard_names).result(timeout=SEARCH_RESULT_TIMEOUT_SECONDS)
+        return {"results": results, "usage": usage_to_dict(usage), "embedding_cached": embedding_cached}
+
+    def ingest(self, file_name, chunks, is_image_description=False, original_file_extension="", token_counts=None, shard_name=COMMON_SHARD_NAME):
+        # 임베딩 모델 전환 중이면 VectorIngestPausedError
+        self.vector_store.check_ingest_allowed()
+        embedding_model = self.current_embedding_model()
+        shard = self.vector_store.get_shard(shard_name)
+        with shard.ingest_session(): # 중복 확인부터 저장까지 같은 샤드의 다른 학습과 겹치지 않게
+            kept_positions, dedup_stats = shard.filter_duplicate_chunks(chunks, file_name)
+            chunks = [chunks[chunk_no] for chunk_no in kept_positions]
+            token_counts = [token_counts[chunk_no] if chunk_no < len(token_counts) else None for chunk_no in kept_positions] if token_counts else None
+            vectors, metadata_entries, usage_totals, failed_count = [], [], {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}, 0
+            for batch_start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+                batch = chunks[batch_start:batch_start + EMBEDDING_BATCH_SIZE]
+                try:
+                    response = self.llm_client.embeddings("embedding_batch", embedding_model, batch)
+                except Exception as e_embedding:
+                    print(f"ERROR during batch embedding for '{file_name}' (chunks {batch_start + 1}-{batch_start + len(batch)}): {e_embedding}")
+                    failed_count += len(batch); continue
+                for usage_key, usage_value in (usage_to_dict(response.usage) or {}).items(): usage_totals[usage_key] += usage_value
+                for item in sorted(response.data, key=lambda emb_item: emb_item.index):
+                    chunk_no = batch_start + item.index
+                    vectors.append(item.embedding)
+                    metadata_entries.append({
+                        "file_name": file_name, "content": chunks[chunk_no], "is_image_description": is_image_description,
+                        "original_file_extension": original_file_extension,
+                        "token_count": token_counts[chunk_no] if token_counts and chunk_no < len(token_counts) else None
+                    })
+            ntotal = shard.add_and_save(vectors, metadata_entries) if vectors else shard.stats()["ntotal"]
+        print(f"Ingested '{file_name}' into shard '{shard_name}': {len(vectors)} chunks added, {failed_count} failed, "
+              f"{dedup_stats['embeddings_saved']} duplicates skipped. Shard total: {ntotal}")
+        return {"added": len(vectors), "failed": failed_count, "ntotal": ntotal, "usage": usage_totals if usage_totals["total_tokens"] else None, "dedup": dedup_stats}
+
+    def stats(self):
+        return dict(self.vector_store.stats(), batcher=self.batcher.snapshot_stats(), query_embedding_cache_entries=len(self.embedding_cache),
+                    llm_client=dict(self.llm_client.stats))
+
+
+def make_request_handler(service):
+    class RetrievalRequestHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def log_message(self, format, *args):
+            pass # 요청마다 출력하지 않음
+
+        def address_string(self):
+            return self.client_address[0] if isinstance(self.client_address, tuple) else "unix"
+
+        def send_json(self, status_code, payload):
+            response_bytes = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+            self.send_response(status_code)
+            self.send_header("Content-Type", "application/json; charset=utf-8")
+            self.send_header("Content-Length", str(len(response_bytes)))
+            self.end_headers()
+            self.wfile.write(response_bytes)
+
+        def do_GET(self):
+            if self.path == "/health":
+                self.send_json(200, dict(service.vector_store.stats(), status="ok"))
+            elif self.path == "/stats":
+                self.send_json(200, service.stats())
+            else:
+                self.send_json(404, {"error": f"Unknown path: {self.path}"})
+
+        def do_POST(self):
+            try:
+                request_body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+                if self.path == "/search":
+                    if not str(request_body.get("query", "")).strip():
+                        self.send_json(400, {"error": "'query' is required."}); return
+                    self.send_json(200, service.search(request_body["query"], max(1, int(request_body.get("k", 3))), request_body.get("shards")))
+                elif self.path == "/ingest":
+                    if not request_body.get("file_name") or not request_body.get("chunks"):
+                        self.send_json(400, {"error": "'file_name' and 'chunks' are required."}); return
+                    self.send_json(200, service.ingest(
+                        request_body["file_name"], list(request_body["chunks"]), bool(request_body.get("is_image_description")),
+                        request_body.get("original_file_extension", ""), request_body.get("token_counts"), request_body.get("shard") or COMMON_SHARD_NAME))
+                elif self.path == "/load":
+                    self.send_json(200, service.vector_store.load_shards(request_body.get("shards")))
+                elif self.path == "/reload":
+                    service.vector_store.reload()
+                    self.send_json(200, service.vector_store.stats())
+                else:
+                    self.send_json(404, {"error": f"Unknown path: {self.path}"})
+            except VectorIngestPausedError as e_paused:
+                self.send_json(503, {"error": str(e_paused)})
+            except Exception as e_request:
+                print(f"ERROR handling {self.path}: {e_request}\n{traceback.format_exc()}")
+                self.send_json(500, {"error": str(e_request)})
+
+    return RetrievalRequestHandler
+
+
+SERVER_REQUEST_QUEUE_SIZE = 128 # 여러 세션이 동시에 연결하므로 기본 listen backlog(5)보다 크게
+
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = SERVER_REQUEST_QUEUE_SIZE
+
+
+class ThreadingTCPHTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = SERVER_REQUEST_QUEUE_SIZE
+
+
+def make_server(listen, request_handler):
+    # listen: "host:port" 또는 "unix:/경로.sock"
+    if listen.startswith("unix:"):
+        socket_path = listen[len("unix:"):]
+        if os.path.exists(socket_path):
+            os.remove(socket_path) # 이전 실행이 남긴 소켓 파일
+        return ThreadingUnixHTTPServer(socket_path, request_handler)
+    host, _, port = listen.rpartition(":")
+    return ThreadingTCPHTTPServer((host or "127.0.0.1", int(port)), request_handler)
+
+
+def make_container_client(secrets):
+    # 앱의 get_azure_blob_clients_cached와 같은 secrets 사용 (디스크 캐시는 사용하지 않음: 시작 시 한 번만 읽음)
+    if str(secrets.get("STORAGE_BACKEND", "azure")).lower() == "local":
+        return LocalContainerClient(secrets.get("LOCAL_STORAGE_DIR", "local_storage"))
+    from azure.storage.blob import BlobServiceClient
+    blob_service_client = BlobServiceClient.from_connection_string(secrets["AZURE_BLOB_CONN"], connection_timeout=60, read_timeout=120)
+    return blob_service_client.get_container_client(secrets["BLOB_CONTAINER"])
+
+
+def make_llm_client(secrets, **client_kwargs):
+    # client_kwargs: ResilientLLMClient 추가 인자 (예: batch_qa의 usage_meter, scheduler)
+    from openai import AzureOpenAI
+    raw_client = AzureOpenAI(
+        api_key=secrets["AZURE_OPENAI_KEY"], azure_endpoint=secrets["AZURE_OPENAI_ENDPOINT"],
+        api_version=secrets.get("AZURE_OPENAI_VERSION", "2024-02-15-preview"), timeout=60.0, max_retries=0
+    )
+    return ResilientLLMClient(raw_client, retry_policy=RetryPolicy(max_attempts=3), embedding_hedge_after=EMBEDDING_HEDGE_AFTER_SECONDS, **client_kwargs)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Retrieval sidecar: owns the FAISS index and serves batched searches to all app processes on this node.")
+    parser.add_argument("--listen", default=DEFAULT_LISTEN, help="host:port or unix:/path/to.sock")
+    parser.add_argument("--secrets", default=os.path.join(".streamlit", "secrets.toml"), help="Same secrets file as the Streamlit app.")
+    parser.add_argument("--max-batch-size", type=int, default=DEFAULT_MAX_BATCH_SIZE)
+    parser.add_argument("--max-wait-ms", type=float, default=DEFAULT_MAX_WAIT_MS)
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    with open(args.secrets, "rb") as secrets_file:
+        secrets = tomllib.load(secrets_file)
+    vector_store = ShardedVectorStore(make_container_client(secrets))
+    print(f"Vector DB shards: {', '.join(vector_store.discover())}")
+    vector_store.get_shard(COMMON_SHARD_NAME) # 공통 샤드만 미리 불러오고 나머지는 처음 검색될 때
+    service = RetrievalService(vector_store, make_llm_client(secrets), secrets["AZURE_OPENAI_EMBEDDING_DEPLOYMENT"], args.max_batch_size, args.max_wait_ms)
+    server = make_server(args.listen, make_request_handler(service))
+    print(f"Retrieval service listening on {args.listen} (batch up to {args.max_batch_size} queries / {args.max_wait_ms}ms).")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
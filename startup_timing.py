@@ -0,0 +1,113 @@
+# 앱 시작(콜드 스타트) 비용 측정, 무거운 모듈의 지연 로딩, 백그라운드 초기화
+# - fitz, pandas, docx, pptx, faiss, tiktoken 등은 lazy_import()로 처음 필요할 때 불러오고 걸린 시간을 기록
+# - 토크나이저, 벡터 DB처럼 오래 걸리는 초기화는 BackgroundWarmup이 로그인 화면과 별개로 백그라운드 스레드에서 준비
+# - 측정값은 프로세스 공용 STARTUP_TIMINGS에 (종류, 이름)별로 처음 한 번만 기록 (Streamlit rerun 때마다 쌓이지 않음)
+import importlib
+import sys
+import threading
+import time
+import traceback
+from contextlib import contextmanager
+
+TIMING_KIND_IMPORT = "import"
+TIMING_KIND_INIT = "init"
+TIMING_KIND_MILESTONE = "milestone"
+
+
+class StartupTimings:
+    def __init__(self):
+        self._process_start = time.perf_counter() # 이 모듈을 처음 불러온 시점 (앱 스크립트 시작 직후)
+        self._entries = {} # (종류, 이름) -> 기록
+        self._lock = threading.Lock()
+
+    def record(self, kind, name, elapsed_seconds, started_at=None):
+        started_at = started_at if started_at is not None else time.perf_counter() - elapsed_seconds
+        with self._lock:
+            self._entries.setdefault((kind, name), {
+                "kind": kind, "name": name, "elapsed_ms": round(elapsed_seconds * 1000, 1),
+                "started_at_ms": round((started_at - self._process_start) * 1000, 1),
+                "thread": threading.current_thread().name
+            })
+
+    @contextmanager
+    def measure(self, kind, name):
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(kind, name, time.perf_counter() - started_at, started_at)
+
+    def mark(self, name):
+        # 시작 후 특정 지점까지 걸린 시간 (예: 로그인 화면 첫 표시)
+        self.record(TIMING_KIND_MILESTONE, name, time.perf_counter() - self._process_start, self._process_start)
+
+    def rows(self):
+        with self._lock:
+            return sorted((dict(entry) for entry in self._entries.values()), key=lambda entry: entry["started_at_ms"])
+
+    def format_report(self):
+        lines = ["Startup timing report:"]
+        for entry in self.rows():
+            lines.append(f"  [{entry['kind']}] {entry['name']}: {entry['elapsed_ms']:.0f}ms (at +{entry['started_at_ms']:.0f}ms, {entry['thread']})")
+        return "\n".join(lines)
+
+
+STARTUP_TIMINGS = StartupTimings()
+
+
+def lazy_import(module_name, timings=STARTUP_TIMINGS):
+    # 처음 불러올 때만 시간 기록. 다른 스레드가 불러오는 중이면 importlib가 끝날 때까지 기다림
+    if module_name in sys.modules:
+        return importlib.import_module(module_name)
+    with timings.measure(TIMING_KIND_IMPORT, module_name):
+        return importlib.import_module(module_name)
+
+
+class BackgroundWarmup:
+    # 이름 -> 초기화 함수. submit() 즉시 작업마다 데몬 스레드에서 실행하고, result()는 끝날 때까지 기다려 결과 반환
+    # 초기화 함수 안에서는 Streamlit 명령(st.error 등)을 호출하지 말 것 (스크립트 실행 컨텍스트가 없는 스레드)
+    def __init__(self, timings=STARTUP_TIMINGS):
+        self.timings = timings
+        self._tasks = {} # 이름 -> {"done": Event, "result", "error"}
+        self._lock = threading.Lock()
+
+    def submit(self, name, init_fn):
+        task = {"done": threading.Event(), "result": None, "error": None}
+        with self._lock:
+            if name in self._tasks:
+                return
+            self._tasks[name] = task
+
+        def run_task():
+            try:
+                with self.timings.measure(TIMING_KIND_INIT, name):
+                    task["result"] = init_fn()
+            except Exception as e_init:
+                print(f"ERROR during background warm-up '{name}': {e_init}\n{traceback.format_exc()}")
+                task["error"] = e_init
+            finally:
+                task["done"].set()
+
+        threading.Thread(target=run_task, name=f"warmup-{name}", daemon=True).start()
+
+    def is_ready(self, name):
+        with self._lock:
+            task = self._tasks.get(name)
+        return task is not None and task["done"].is_set()
+
+    def result(self, name, timeout=None):
+        # 초기화 함수의 반환값. 초기화 중 예외가 났으면 같은 예외를, timeout 안에 끝나지 않으면 TimeoutError를 발생
+        with self._lock:
+            task = self._tasks.get(name)
+        if task is None:
+            raise KeyError(f"Warm-up task '{name}' was not submitted.")
+        if not task["done"].wait(timeout):
+            raise TimeoutError(f"Warm-up task '{name}' did not finish within {timeout} seconds.")
+        if task["error"] is not None:
+            raise task["error"]
+        return task["result"]
+
+    def status(self):
+        with self._lock:
+            tasks = dict(self._tasks)
+        return {name: ("failed" if task["error"] is not None else "ready") if task["done"].is_set() else "pending" for name, task in tasks.items()}
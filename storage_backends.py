@@ -0,0 +1,328 @@
+# 저장소 백엔드
+# 앱과 도우미 모듈(blob_io, blob_cache, log_writer, usage_rollups)은 Azure ContainerClient의 다음 기능만 사용한다.
+#   container: get_blob_client(name), list_blobs(name_starts_with), delete_blob(name)
+#   blob: exists(), download_blob(etag, match_condition) -> readall()/properties(etag, metadata),
+#         upload_blob(data, overwrite, etag, match_condition, metadata, content_settings) -> {"etag"},
+#         create_append_blob(etag, match_condition), append_block(data), get_blob_properties()
+# 조건 불일치/없음/이미 있음은 Azure와 같은 azure.core 예외로 알린다.
+# 이 인터페이스를 구현한 백엔드:
+# - Azure: azure.storage.blob ContainerClient 그대로
+# - LocalContainerClient: 로컬 디렉터리에 저장 (Azure 없이 오프라인 실행/벤치마크/테스트용)
+# - DiskCachedContainerClient: 다른 백엔드 앞에 두는 읽기 캐시. 내려받은 Blob을 로컬 디스크에 ETag와 함께 보관하고,
+#   다음 읽기 때는 조건부 GET으로 변경 여부만 확인해 변경이 없으면 디스크에서 반환
+import json
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+from types import SimpleNamespace
+
+from azure.core import MatchConditions
+from azure.core.exceptions import ResourceExistsError, ResourceModifiedError, ResourceNotFoundError, ResourceNotModifiedError
+
+PROPERTIES_DIR_NAME = ".blob_properties" # 로컬 저장소에서 ETag/메타데이터를 보관하는 하위 디렉터리
+
+
+class LocalBlobDownloader:
+    # download_blob() 결과와 같은 형태 (readall(), properties)
+    def __init__(self, data, properties):
+        self._data = data
+        self.properties = properties
+        self.size = len(data)
+
+    def readall(self):
+        return self._data
+
+
+def _read_upload_data(data):
+    if isinstance(data, str):
+        return data.encode("utf-8")
+    if hasattr(data, "read"):
+        return data.read()
+    return bytes(data)
+
+
+def _check_download_condition(current_etag, etag, match_condition):
+    if etag and match_condition == MatchConditions.IfModified and current_etag == etag:
+        raise ResourceNotModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+    if etag and match_condition == MatchConditions.IfNotModified and current_etag != etag:
+        raise ResourceModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+
+
+class LocalBlobPageIterator:
+    # ItemPaged.by_page()와 같은 형태. continuation_token은 다음 페이지 시작 위치
+    def __init__(self, blob_items, results_per_page, continuation_token=None):
+        self._blob_items = blob_items
+        self._results_per_page = results_per_page or len(blob_items) or 1
+        self._next_start = int(continuation_token) if continuation_token else 0
+        self.continuation_token = continuation_token
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._next_start >= len(self._blob_items) and (self._next_start > 0 or self.continuation_token is not None):
+            raise StopIteration
+        page_items = self._blob_items[self._next_start:self._next_start + self._results_per_page]
+        self._next_start += self._results_per_page
+        self.continuation_token = str(self._next_start) if self._next_start < len(self._blob_items) else None
+        return iter(page_items)
+
+
+class LocalBlobItemPaged(list):
+    # list_blobs() 결과. 그대로 순회하거나 by_page()로 페이지 단위 조회
+    def __init__(self, blob_items, results_per_page=None):
+        super().__init__(blob_items)
+        self.results_per_page = results_per_page
+
+    def by_page(self, continuation_token=None):
+        return LocalBlobPageIterator(list(self), self.results_per_page, continuation_token)
+
+
+class LocalBlobClient:
+    def __init__(self, container, blob_name):
+        self.container = container
+        self.blob_name = blob_name
+
+    def _require_properties(self):
+        properties = self.container.read_properties(self.blob_name)
+        if properties is None:
+            raise ResourceNotFoundError(f"The specified blob does not exist: {self.blob_name}")
+        return properties
+
+    def exists(self, **kwargs):
+        self.container.simulate_request_latency()
+        return self.container.read_properties(self.blob_name) is not None
+
+    def get_blob_properties(self, **kwargs):
+        self.container.simulate_request_latency()
+        return self._require_properties()
+
+    def download_blob(self, etag=None, match_condition=None, **kwargs):
+        self.container.simulate_request_latency()
+        with self.container.lock:
+            properties = self._require_properties()
+            _check_download_condition(properties.etag, etag, match_condition)
+            with open(self.container.data_path(self.blob_name), "rb") as data_file:
+                return LocalBlobDownloader(data_file.read(), properties)
+
+    def upload_blob(self, data, overwrite=False, etag=None, match_condition=None, metadata=None, content_settings=None, **kwargs):
+        payload = _read_upload_data(data)
+        self.container.simulate_request_latency()
+        with self.container.lock:
+            current_properties = self.container.read_properties(self.blob_name)
+            if current_properties is not None and not overwrite:
+                raise ResourceExistsError(f"The specified blob already exists: {self.blob_name}")
+            if etag and match_condition == MatchConditions.IfNotModified and (current_properties is None or current_properties.etag != etag):
+                raise ResourceModifiedError("The condition specified using HTTP conditional header(s) is not met.")
+            content_type = getattr(content_settings, "content_type", None)
+            properties = self.container.write_blob(self.blob_name, payload, metadata=metadata, content_type=content_type)
+        return {"etag": properties.etag, "last_modified": properties.last_modified}
+
+    def create_append_blob(self, etag=None, match_condition=None, metadata=None, **kwargs):
+        self.container.simulate_request_latency()
+        with self.container.lock:
+            if match_condition == MatchConditions.IfMissing and self.container.read_properties(self.blob_name) is not None:
+                raise ResourceExistsError(f"The specified blob already exists: {self.blob_name}")
+            properties = self.container.write_blob(self.blob_name, b"", metadata=metadata)
+        return {"etag": properties.etag, "last_modified": properties.last_modified}
+
+    def append_block(self, data, **kwargs):
+        payload = _read_upload_data(data)
+        self.container.simulate_request_latency()
+        with self.container.lock:
+            current_properties = self._require_properties()
+            with open(self.container.data_path(self.blob_name), "ab") as data_file:
+                data_file.write(payload)
+            properties = self.container.write_properties(self.blob_name, current_properties.metadata, current_properties.content_settings.content_type)
+        return {"etag": properties.etag, "last_modified": properties.last_modified}
+
+    def delete_blob(self, **kwargs):
+        self.container.delete_blob(self.blob_name)
+
+
+class LocalContainerClient:
+    # 로컬 디렉터리를 Blob 컨테이너처럼 사용. Blob 이름의 "/"는 하위 디렉터리가 됨
+    # simulated_latency_seconds: 요청마다 더할 지연 (벤치마크에서 원격 저장소의 왕복 시간을 흉내 낼 때)
+    def __init__(self, root_dir, simulated_latency_seconds=0.0):
+        self.root_dir = os.path.abspath(root_dir)
+        self.container_name = os.path.basename(self.root_dir)
+        self.simulated_latency_seconds = simulated_latency_seconds
+        self.lock = threading.RLock()
+        os.makedirs(self.root_dir, exist_ok=True)
+
+    def simulate_request_latency(self):
+        # 잠금 밖에서 호출해 다른 요청의 지연과 겹칠 수 있도록 함
+        if self.simulated_latency_seconds > 0:
+            time.sleep(self.simulated_latency_seconds)
+
+    def _safe_path(self, base_dir, blob_name, suffix=""):
+        blob_path = os.path.abspath(os.path.join(base_dir, *blob_name.split("/"))) + suffix
+        if not blob_path.startswith(base_dir + os.sep):
+            raise ValueError(f"Invalid blob name: {blob_name}")
+        return blob_path
+
+    def data_path(self, blob_name):
+        return self._safe_path(self.root_dir, blob_name)
+
+    def properties_path(self, blob_name):
+        return self._safe_path(os.path.join(self.root_dir, PROPERTIES_DIR_NAME), blob_name, ".json")
+
+    def read_properties(self, blob_name):
+        data_path = self.data_path(blob_name)
+        if not os.path.isfile(data_path):
+            return None
+        try:
+            with open(self.properties_path(blob_name), "r", encoding="utf-8") as properties_file:
+                stored = json.load(properties_file)
+        except (OSError, json.JSONDecodeError):
+            stored = {} # 직접 복사해 넣은 파일 등 속성 파일이 없는 경우
+        file_stat = os.stat(data_path)
+        return SimpleNamespace(
+            name=blob_name, size=file_stat.st_size,
+            etag=stored.get("etag") or f'"{int(file_stat.st_mtime_ns)}-{file_stat.st_size}"',
+            last_modified=datetime.fromtimestamp(file_stat.st_mtime, tz=timezone.utc),
+            metadata=stored.get("metadata") or {},
+            content_settings=SimpleNamespace(content_type=stored.get("content_type"))
+        )
+
+    def write_properties(self, blob_name, metadata=None, content_type=None, etag=None):
+        properties_path = self.properties_path(blob_name)
+        os.makedirs(os.path.dirname(properties_path), exist_ok=True)
+        self._atomic_write(properties_path, json.dumps({
+            "etag": etag or f'"{uuid.uuid4().hex}"', "metadata": metadata or {}, "content_type": content_type
+        }).encode("utf-8"))
+        return self.read_properties(blob_name)
+
+    def write_blob(self, blob_name, data, metadata=None, content_type=None, etag=None):
+        # etag를 지정하면 그대로 저장 (디스크 캐시가 원본 Blob의 ETag를 보관할 때 사용)
+        with self.lock:
+            data_path = self.data_path(blob_name)
+            os.makedirs(os.path.dirname(data_path), exist_ok=True)
+            self._atomic_write(data_path, data)
+            return self.write_properties(blob_name, metadata, content_type, etag)
+
+    @staticmethod
+    def _atomic_write(target_path, data):
+        temp_path = f"{target_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, target_path)
+
+    def get_blob_client(self, blob):
+        return LocalBlobClient(self, blob)
+
+    def list_blobs(self, name_starts_with=None, results_per_page=None, **kwargs):
+        self.simulate_request_latency()
+        blob_items = []
+        for dir_path, dir_names, file_names in os.walk(self.root_dir):
+            dir_names[:] = [d for d in dir_names if d != PROPERTIES_DIR_NAME]
+            for file_name in file_names:
+                if file_name.endswith(".tmp"):
+                    continue
+                blob_name = os.path.relpath(os.path.join(dir_path, file_name), self.root_dir).replace(os.sep, "/")
+                if name_starts_with and not blob_name.startswith(name_starts_with):
+                    continue
+                properties = self.read_properties(blob_name)
+                if properties is not None:
+                    blob_items.append(properties)
+        return LocalBlobItemPaged(sorted(blob_items, key=lambda item: item.name), results_per_page)
+
+    def delete_blob(self, blob, **kwargs):
+        self.simulate_request_latency()
+        with self.lock:
+            data_path = self.data_path(blob)
+            if not os.path.isfile(data_path):
+                raise ResourceNotFoundError(f"The specified blob does not exist: {blob}")
+            os.remove(data_path)
+            try: os.remove(self.properties_path(blob))
+            except OSError: pass
+
+
+class DiskCachedBlobClient:
+    def __init__(self, cached_container, inner_blob_client, blob_name):
+        self.cached_container = cached_container
+        self.inner = inner_blob_client
+        self.blob_name = blob_name
+
+    def __getattr__(self, attribute_name): # exists(), get_blob_properties() 등은 원본 백엔드로
+        return getattr(self.inner, attribute_name)
+
+    def download_blob(self, etag=None, match_condition=None, **kwargs):
+        disk_cache = self.cached_container.disk_cache
+        if match_condition is None: # 호출한 쪽에 조건이 없으면 디스크 사본의 ETag로 조건부 GET
+            cached_properties = disk_cache.read_properties(self.blob_name)
+            if cached_properties is not None:
+                try:
+                    downloader = self.inner.download_blob(etag=cached_properties.etag, match_condition=MatchConditions.IfModified, **kwargs)
+                except ResourceNotModifiedError:
+                    self.cached_container.count("disk_hits")
+                    return disk_cache.get_blob_client(self.blob_name).download_blob()
+                except ResourceNotFoundError:
+                    self.cached_container.evict(self.blob_name)
+                    raise
+            else:
+                downloader = self.inner.download_blob(**kwargs)
+        else:
+            downloader = self.inner.download_blob(etag=etag, match_condition=match_condition, **kwargs)
+        data = downloader.readall()
+        self.cached_container.count("downloads")
+        try:
+            disk_cache.write_blob(self.blob_name, data, metadata=getattr(downloader.properties, "metadata", None), etag=downloader.properties.etag)
+        except OSError as e_cache_write:
+            print(f"WARNING: Could not write '{self.blob_name}' to disk cache: {e_cache_write}")
+        return LocalBlobDownloader(data, downloader.properties)
+
+    def upload_blob(self, data, **kwargs):
+        payload = _read_upload_data(data)
+        upload_result = self.inner.upload_blob(payload, **kwargs)
+        new_etag = (upload_result or {}).get("etag")
+        if new_etag: # 방금 쓴 내용을 디스크 캐시에도 반영해 다음 읽기에서 다시 내려받지 않음
+            try: self.cached_container.disk_cache.write_blob(self.blob_name, payload, metadata=kwargs.get("metadata"), etag=new_etag)
+            except OSError: self.cached_container.evict(self.blob_name)
+        else:
+            self.cached_container.evict(self.blob_name)
+        return upload_result
+
+    def append_block(self, data, **kwargs):
+        self.cached_container.evict(self.blob_name)
+        return self.inner.append_block(data, **kwargs)
+
+    def create_append_blob(self, **kwargs):
+        self.cached_container.evict(self.blob_name)
+        return self.inner.create_append_blob(**kwargs)
+
+    def delete_blob(self, **kwargs):
+        self.cached_container.evict(self.blob_name)
+        return self.inner.delete_blob(**kwargs)
+
+
+class DiskCachedContainerClient:
+    # uncached_prefixes: 디스크 캐시를 거치지 않을 경로 (예: 계속 덧붙여지는 로그)
+    def __init__(self, inner_container_client, cache_dir, uncached_prefixes=()):
+        self.inner = inner_container_client
+        self.disk_cache = LocalContainerClient(cache_dir)
+        self.uncached_prefixes = tuple(uncached_prefixes)
+        self.stats = {"disk_hits": 0, "downloads": 0}
+        self._stats_lock = threading.Lock()
+
+    def __getattr__(self, attribute_name): # container_name, list_blobs() 등은 원본 백엔드로
+        return getattr(self.inner, attribute_name)
+
+    def count(self, stat_name):
+        with self._stats_lock:
+            self.stats[stat_name] += 1
+
+    def evict(self, blob_name):
+        try: self.disk_cache.delete_blob(blob_name)
+        except (ResourceNotFoundError, OSError, ValueError): pass
+
+    def get_blob_client(self, blob):
+        if blob.startswith(self.uncached_prefixes):
+            return self.inner.get_blob_client(blob)
+        return DiskCachedBlobClient(self, self.inner.get_blob_client(blob), blob)
+
+    def delete_blob(self, blob, **kwargs):
+        self.evict(blob)
+        return self.inner.delete_blob(blob, **kwargs)
@@ -0,0 +1,47 @@
+from datetime import date
+
+import pytest
+from azure.core.exceptions import ServiceRequestError
+
+import usage_rollups
+from storage_backends import LocalContainerClient
+from usage_rollups import RollupUpdateError, UsageRollupStore
+
+ENTRIES = [
+    {"timestamp": "2024-05-01 09:15:00", "user_id": "alice", "model_name": "gpt-4o", "request_type": "chat", "prompt_tokens": 10, "completion_tokens": 5, "total_tokens": 15},
+    {"timestamp": "2024-05-01 10:30:00", "user_id": "bob", "model_name": "gpt-4o", "request_type": "chat", "prompt_tokens": 20, "completion_tokens": 10, "total_tokens": 30},
+]
+
+
+def test_storage_error_keeps_unapplied_deltas(tmp_path, monkeypatch):
+    store = UsageRollupStore(LocalContainerClient(str(tmp_path)))
+    real_update = usage_rollups.update_json_blob
+    failed_blobs = []
+
+    def flaky_update(container_client, blob_name, update_fn, **kwargs):
+        if not failed_blobs: # 첫 파일 갱신에서 네트워크 오류
+            failed_blobs.append(blob_name)
+            raise ServiceRequestError("connection reset")
+        return real_update(container_client, blob_name, update_fn, **kwargs)
+
+    monkeypatch.setattr(usage_rollups, "update_json_blob", flaky_update)
+    with pytest.raises(RollupUpdateError):
+        store.apply_entries(ENTRIES)
+    assert store.pending_blob_count() == 1
+
+    store.apply_entries([]) # 로그 기록기의 재시도 호출
+    assert store.pending_blob_count() == 0
+    totals_by_key, totals_updated_at = store.load_totals()
+    assert sum(m["calls"] for m in totals_by_key.values()) == 2
+    assert sum(m["total_tokens"] for m in totals_by_key.values()) == 45
+    assert totals_updated_at
+    assert sum(row["calls"] for row in store.load_hourly_rows(date(2024, 5, 1))) == 2
+    assert sum(row["calls"] for row in store.load_daily_rows(date(2024, 5, 1), date(2024, 5, 31))) == 2
+
+
+def test_rebuild_writes_totals(tmp_path):
+    store = UsageRollupStore(LocalContainerClient(str(tmp_path)))
+    store.apply_entries(ENTRIES)
+    store.rebuild(ENTRIES[:1])
+    totals_by_key, _ = store.load_totals()
+    assert [m["total_tokens"] for m in totals_by_key.values()] == [15]
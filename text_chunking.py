@@ -0,0 +1,22 @@
+# 학습용 텍스트 청크 분할 (앱의 문서 학습과 retrieval_eval 평가 도구가 같은 규칙을 사용)
+# 페이지 구분(PAGE_BREAK, extract_text_from_file이 PDF 페이지/PPTX 슬라이드 사이에 넣음)에서는 새 청크를 시작
+# (표지, 개정 이력 페이지처럼 문서마다 반복되는 페이지가 본문과 섞이지 않아 중복 청크로 걸러짐)
+
+PAGE_BREAK = "\f"
+
+def chunk_text_into_pieces(text_to_chunk, chunk_size=500): # 청크 크기는 토큰이 아닌 글자 수 기반
+    if not text_to_chunk or not text_to_chunk.strip(): return [];
+    chunks_list, current_buffer = [], ""
+    for line in text_to_chunk.split("\n"): 
+        if PAGE_BREAK in line and not line.replace(PAGE_BREAK, "").strip():
+            if current_buffer.strip(): chunks_list.append(current_buffer.strip())
+            current_buffer = ""; continue
+        stripped_line = line.strip()
+        if not stripped_line and not current_buffer.strip(): continue 
+        if len(current_buffer) + len(stripped_line) + 1 < chunk_size: 
+            current_buffer += stripped_line + "\n"
+        else: 
+            if current_buffer.strip(): chunks_list.append(current_buffer.strip())
+            current_buffer = stripped_line + "\n" 
+    if current_buffer.strip(): chunks_list.append(current_buffer.strip())
+    return [c for c in chunks_list if c] # 내용이 있는 청크만 반환
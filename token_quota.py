@@ -0,0 +1,201 @@
+# API 토큰 사용량 계량과 사용자/부서별 쿼터
+# - TokenUsageMeter: ResilientLLMClient의 모든 호출(채팅, 요약, 긴 문서, 이미지 설명, 임베딩)을 감싸
+#   호출 전에 예상 토큰으로 쿼터를 예약하고, 응답의 usage로 정산한 뒤 on_usage 콜백(사용량 로그)을 호출
+# - TokenQuotaLimiter: 사용자/부서별 분당 토큰(토큰 버킷)과 일일 토큰 한도
+#   분당 한도를 넘으면 max_wait_seconds까지 기다렸다가 보내고(긴 문서 섹션 등은 자동으로 속도가 조절됨),
+#   그보다 오래 기다려야 하거나 일일 한도를 넘으면 QuotaExceededError
+# - 버킷/일일 사용량은 프로세스 메모리에만 유지 (여러 프로세스로 실행하면 프로세스별 한도, 재시작 시 일일 사용량 초기화)
+import threading
+import time
+from collections import namedtuple
+from datetime import datetime
+
+QUOTA_PERIOD_MINUTE = "minute"
+QUOTA_PERIOD_DAY = "day"
+QUOTA_SCOPE_USER = "user"
+QUOTA_SCOPE_DEPARTMENT = "department"
+IMAGE_INPUT_TOKEN_ESTIMATE = 1000 # 이미지 입력 하나의 예상 토큰 (정산 시 실제 usage로 보정)
+
+# user_id: 쿼터 키(uid), user_name: 사용량 로그의 user_id 값(기존 로그와 같은 이름 기준), request_type: 사용량 로그의 요청 유형
+# enforce_quota=False: 사용량은 기록하지만 쿼터는 적용하지 않음 (예: 관리자 문서 학습)
+UsageCaller = namedtuple("UsageCaller", ["user_id", "user_name", "department", "request_type", "enforce_quota"], defaults=[True])
+
+
+class QuotaExceededError(Exception):
+    def __init__(self, scope, key, period, retry_after_seconds=None):
+        self.scope, self.key, self.period, self.retry_after_seconds = scope, key, period, retry_after_seconds
+        retry_text = f" Retry after {retry_after_seconds:.0f}s." if retry_after_seconds else ""
+        super().__init__(f"Token quota exceeded for {scope} '{key}' ({period}).{retry_text}")
+
+
+class TokenBucket:
+    # capacity: 분당 토큰 수. 요청이 capacity보다 크면 버킷이 가득 찼을 때 허용하고 잔량을 음수(부채)로 둠
+    def __init__(self, capacity, now):
+        self.capacity = float(capacity)
+        self.refill_per_second = capacity / 60.0
+        self.tokens = float(capacity)
+        self.updated_at = now
+
+    def refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.refill_per_second)
+        self.updated_at = now
+
+    def wait_seconds(self, amount, now):
+        self.refill(now)
+        needed = min(float(amount), self.capacity)
+        return 0.0 if self.tokens >= needed else (needed - self.tokens) / self.refill_per_second
+
+    def adjust(self, amount):
+        # 양수면 차감, 음수면 환급 (capacity를 넘지 않게)
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class QuotaReservation:
+    def __init__(self, user_id, department, tokens, day):
+        self.user_id, self.department, self.tokens, self.day = user_id, department, tokens, day
+
+
+class TokenQuotaLimiter:
+    # 한도가 0이면 해당 한도 없음
+    def __init__(self, user_tokens_per_minute=0, department_tokens_per_minute=0, user_tokens_per_day=0, department_tokens_per_day=0,
+                 clock=time.monotonic, today_fn=lambda: datetime.now().strftime("%Y-%m-%d")):
+        self.limits = {
+            (QUOTA_SCOPE_USER, QUOTA_PERIOD_MINUTE): user_tokens_per_minute, (QUOTA_SCOPE_DEPARTMENT, QUOTA_PERIOD_MINUTE): department_tokens_per_minute,
+            (QUOTA_SCOPE_USER, QUOTA_PERIOD_DAY): user_tokens_per_day, (QUOTA_SCOPE_DEPARTMENT, QUOTA_PERIOD_DAY): department_tokens_per_day
+        }
+        self.clock = clock
+        self.today_fn = today_fn
+        self._buckets = {} # (범위, 키) -> TokenBucket
+        self._daily_usage = {} # (범위, 키) -> {"day": 일자, "tokens": 사용량}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return any(limit > 0 for limit in self.limits.values())
+
+    def _scope_keys(self, user_id, department):
+        scope_keys = [(QUOTA_SCOPE_USER, user_id or "anonymous")]
+        if department: scope_keys.append((QUOTA_SCOPE_DEPARTMENT, department))
+        return scope_keys
+
+    def _get_bucket(self, scope_key, now):
+        limit = self.limits[(scope_key[0], QUOTA_PERIOD_MINUTE)]
+        if limit <= 0:
+            return None
+        if scope_key not in self._buckets:
+            self._buckets[scope_key] = TokenBucket(limit, now)
+        return self._buckets[scope_key]
+
+    def _daily_tokens(self, scope_key, day):
+        usage = self._daily_usage.get(scope_key)
+        return usage["tokens"] if usage and usage["day"] == day else 0
+
+    def _add_daily_tokens(self, scope_key, day, amount):
+        usage = self._daily_usage.get(scope_key)
+        if not usage or usage["day"] != day:
+            usage = self._daily_usage[scope_key] = {"day": day, "tokens": 0}
+        usage["tokens"] = max(0, usage["tokens"] + amount)
+
+    def acquire(self, user_id, department, tokens, max_wait_seconds=0.0):
+        # 반환: QuotaReservation. 분당 한도 때문에 기다려야 하면 max_wait_seconds까지 기다림
+        tokens = max(0, int(tokens))
+        deadline = self.clock() + max_wait_seconds
+        while True:
+            with self._lock:
+                now, day = self.clock(), self.today_fn()
+                scope_keys = self._scope_keys(user_id, department)
+                for scope_key in scope_keys:
+                    daily_limit = self.limits[(scope_key[0], QUOTA_PERIOD_DAY)]
+                    if daily_limit > 0 and self._daily_tokens(scope_key, day) + tokens > daily_limit:
+                        raise QuotaExceededError(scope_key[0], scope_key[1], QUOTA_PERIOD_DAY)
+                scoped_buckets = [(scope_key, self._get_bucket(scope_key, now)) for scope_key in scope_keys]
+                scoped_buckets = [(scope_key, bucket) for scope_key, bucket in scoped_buckets if bucket is not None]
+                wait_seconds, blocked_scope = max(((bucket.wait_seconds(tokens, now), scope_key) for scope_key, bucket in scoped_buckets), default=(0.0, None))
+                if wait_seconds <= 0:
+                    for _, bucket in scoped_buckets: bucket.adjust(tokens)
+                    for scope_key in scope_keys: self._add_daily_tokens(scope_key, day, tokens)
+                    return QuotaReservation(user_id, department, tokens, day)
+                if now + wait_seconds > deadline:
+                    raise QuotaExceededError(blocked_scope[0], blocked_scope[1], QUOTA_PERIOD_MINUTE, retry_after_seconds=wait_seconds)
+            time.sleep(min(wait_seconds, max(0.0, deadline - self.clock())))
+
+    def settle(self, reservation, actual_tokens):
+        # 예약한 토큰을 실제 사용량으로 보정 (실패한 호출은 actual_tokens=0으로 환급)
+        delta = max(0, int(actual_tokens)) - reservation.tokens
+        if delta == 0:
+            return
+        with self._lock:
+            now = self.clock()
+            for scope_key in self._scope_keys(reservation.user_id, reservation.department):
+                bucket = self._get_bucket(scope_key, now)
+                if bucket is not None:
+                    bucket.refill(now); bucket.adjust(delta)
+                self._add_daily_tokens(scope_key, reservation.day, delta)
+
+    def snapshot(self):
+        # 관리자 화면용: 범위/키별 분당 잔여 토큰과 오늘 사용량
+        with self._lock:
+            now, day = self.clock(), self.today_fn()
+            rows = []
+            for scope_key in sorted(set(self._buckets) | set(self._daily_usage)):
+                bucket = self._buckets.get(scope_key)
+                if bucket is not None: bucket.refill(now)
+                rows.append({
+                    "scope": scope_key[0], "key": scope_key[1],
+                    "minute_tokens_available": int(bucket.tokens) if bucket is not None else None,
+                    "minute_limit": self.limits[(scope_key[0], QUOTA_PERIOD_MINUTE)] or None,
+                    "today_tokens": self._daily_tokens(scope_key, day),
+                    "daily_limit": self.limits[(scope_key[0], QUOTA_PERIOD_DAY)] or None
+                })
+            return rows
+
+
+class TokenUsageMeter:
+    # on_usage(caller, model_name, usage): 호출마다 사용량 기록 (usage가 없는 응답은 예상 토큰만 쿼터에 반영)
+    # count_tokens_fn(text): 예상 토큰 계산 (없으면 글자 수 기준 근사)
+    def __init__(self, quota_limiter, on_usage=None, count_tokens_fn=None, max_wait_seconds=20.0):
+        self.quota_limiter = quota_limiter
+        self.on_usage = on_usage
+        self.count_tokens_fn = count_tokens_fn
+        self.max_wait_seconds = max_wait_seconds
+
+    def count_tokens(self, text):
+        if not text:
+            return 0
+        if self.count_tokens_fn:
+            try:
+                return self.count_tokens_fn(text)
+            except Exception:
+                pass
+        return len(text) // 2 + 1
+
+    def estimate_tokens(self, messages=None, max_tokens=None, input_texts=None):
+        estimated_tokens = sum(self.count_tokens(str(text)) for text in input_texts or [])
+        for message in messages or []:
+            content = message.get("content")
+            if isinstance(content, list): # 이미지가 포함된 메시지
+                for part in content:
+                    estimated_tokens += IMAGE_INPUT_TOKEN_ESTIMATE if part.get("type") == "image_url" else self.count_tokens(part.get("text", ""))
+            else:
+                estimated_tokens += self.count_tokens(content or "")
+        return estimated_tokens + int(max_tokens or 0)
+
+    def run(self, caller, model_name, call_fn, **estimate_kwargs):
+        reservation = None
+        if caller.enforce_quota and self.quota_limiter is not None and self.quota_limiter.enabled:
+            reservation = self.quota_limiter.acquire(caller.user_id, caller.department, self.estimate_tokens(**estimate_kwargs), self.max_wait_seconds)
+        try:
+            response = call_fn()
+        except Exception:
+            if reservation is not None: self.quota_limiter.settle(reservation, 0)
+            raise
+        usage = getattr(response, "usage", None)
+        actual_tokens = getattr(usage, "total_tokens", None)
+        if reservation is not None:
+            self.quota_limiter.settle(reservation, reservation.tokens if actual_tokens is None else actual_tokens)
+        if actual_tokens and self.on_usage is not None: # 사용량 0 (예: 검색 서비스의 임베딩 캐시 적중)은 기록하지 않음
+            try:
+                self.on_usage(caller, model_name, usage)
+            except Exception as e_usage:
+                print(f"ERROR recording API usage for '{caller.request_type}': {e_usage}")
+        return response
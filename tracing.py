@@ -0,0 +1,200 @@
+# 요청(Streamlit rerun) 단위 추적
+# - rerun 하나가 trace 하나. 그 안의 단계(Blob 읽기, 화면 그리기, 추출, 임베딩, FAISS 검색, 토큰 계산, LLM 호출 등)를 span으로 기록
+# - 현재 trace는 스레드별로 활성화. 작업 스레드는 bind_trace()로 부모 span과 함께 연결 (pipeline_stages 등)
+# - 끝난 trace는 span 목록을 포함한 JSON 한 줄(OTLP span과 같은 필드 이름: trace_id, span_id, parent_span_id)로
+#   log_writer 스트림에 기록하고, 관리자 화면에서 단계별 p50/p95/p99와 느린 요청 목록으로 조회
+import threading
+import time
+import uuid
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+from log_writer import LOG_TIMESTAMP_FORMAT
+
+SPAN_STATUS_OK = "ok"
+SPAN_STATUS_ERROR = "error"
+TRACE_PERCENTILES = (50, 95, 99)
+
+_active = threading.local() # trace: 이 스레드의 활성 trace, span_stack: 열려 있는 span id 목록
+
+
+class TraceSpan:
+    def __init__(self, trace, name, parent_span_id, attributes):
+        self.trace = trace
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_span_id = parent_span_id
+        self.name = name
+        self.attributes = dict(attributes)
+        self.thread_name = threading.current_thread().name
+        self._start = time.perf_counter()
+        self._ended = False
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def end(self, error=None):
+        # 여러 번 호출해도 처음 한 번만 기록
+        if self._ended:
+            return
+        self._ended = True
+        self.trace._open_spans.pop(self.span_id, None)
+        span_stack = getattr(_active, "span_stack", None)
+        if span_stack and span_stack[-1] == self.span_id:
+            span_stack.pop()
+        self.trace._add_span_record({
+            "span_id": self.span_id, "parent_span_id": self.parent_span_id, "name": self.name,
+            "start_ms": round((self._start - self.trace._start) * 1000, 1),
+            "duration_ms": round((time.perf_counter() - self._start) * 1000, 1),
+            "status": SPAN_STATUS_ERROR if error else SPAN_STATUS_OK,
+            "error": str(error) if error else None,
+            "attributes": self.attributes, "thread": self.thread_name
+        })
+
+
+class _NoopSpan:
+    # 활성 trace가 없을 때 start_trace_span()이 반환하는 span (기록하지 않음)
+    def set_attribute(self, key, value):
+        pass
+
+    def end(self, error=None):
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+class RequestTrace:
+    def __init__(self, name, **attributes):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.timestamp = datetime.now().strftime(LOG_TIMESTAMP_FORMAT)
+        self._start = time.perf_counter()
+        self._span_records = []
+        self._open_spans = {} # 아직 끝나지 않은 span (finish 시 함께 닫음)
+        self._lock = threading.Lock()
+        self.root_span = TraceSpan(self, name, None, attributes)
+
+    def _add_span_record(self, span_record):
+        with self._lock:
+            self._span_records.append(span_record)
+
+    def start_span(self, name, parent_span_id=None, **attributes):
+        # 부모를 지정하지 않으면 이 스레드에서 열려 있는 가장 안쪽 span (없으면 root)
+        span_stack = getattr(_active, "span_stack", None)
+        if parent_span_id is None:
+            parent_span_id = span_stack[-1] if span_stack else self.root_span.span_id
+        span = TraceSpan(self, name, parent_span_id, attributes)
+        self._open_spans[span.span_id] = span
+        if span_stack is not None and getattr(_active, "trace", None) is self:
+            span_stack.append(span.span_id)
+        return span
+
+    @contextmanager
+    def span(self, name, **attributes):
+        span = self.start_span(name, **attributes)
+        try:
+            yield span
+        except Exception as e_span:
+            span.end(error=e_span)
+            raise
+        span.end()
+
+    def finish(self, error=None, **attributes):
+        # root span을 닫고 기록용 dict 반환 (root span이 spans의 첫 항목)
+        # 열려 있는 span(예: 화면 그리기 도중 끝난 실행)은 이 시점에 끝난 것으로 기록
+        for open_span in list(self._open_spans.values()):
+            open_span.set_attribute("closed_by_trace_finish", True)
+            open_span.end()
+        self.root_span.attributes.update(attributes)
+        self.root_span.end(error=error)
+        with self._lock:
+            span_records = sorted(self._span_records, key=lambda record: (record["parent_span_id"] is not None, record["start_ms"]))
+        root_record = span_records[0]
+        return {
+            "timestamp": self.timestamp, "trace_id": self.trace_id, "name": self.name,
+            "duration_ms": root_record["duration_ms"], "status": root_record["status"],
+            "attributes": root_record["attributes"], "spans": span_records
+        }
+
+
+def activate_trace(trace):
+    # 이 스레드의 활성 trace 설정 (None이면 해제)
+    _active.trace = trace
+    _active.span_stack = [] if trace is not None else None
+
+
+def current_trace():
+    return getattr(_active, "trace", None)
+
+
+def current_span_id():
+    span_stack = getattr(_active, "span_stack", None)
+    if span_stack:
+        return span_stack[-1]
+    trace = current_trace()
+    return trace.root_span.span_id if trace else None
+
+
+def bind_trace(trace, parent_span_id=None):
+    # 작업 스레드에서 호출. 이후 trace_span()은 parent_span_id(없으면 root) 아래에 기록
+    _active.trace = trace
+    _active.span_stack = [parent_span_id] if (trace is not None and parent_span_id) else []
+
+
+def trace_span(name, **attributes):
+    # 활성 trace가 없으면(백그라운드 스레드 등) 아무것도 하지 않는 context manager
+    trace = current_trace()
+    return trace.span(name, **attributes) if trace is not None else nullcontext()
+
+
+def start_trace_span(name, **attributes):
+    # with 블록으로 감싸기 어려운 구간용. 반환된 span의 end()를 호출해야 기록됨 (활성 trace가 없으면 NOOP_SPAN)
+    trace = current_trace()
+    return trace.start_span(name, **attributes) if trace is not None else NOOP_SPAN
+
+
+def percentile(sorted_values, pct):
+    # nearest-rank 방식
+    if not sorted_values:
+        return None
+    rank = max(1, int(-(-pct * len(sorted_values) // 100)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+def summarize_span_durations(trace_records):
+    # span 이름별 호출 수와 소요 시간 백분위(ms). 반환: 행 목록 (p95 내림차순)
+    durations_by_name = {}
+    for trace_record in trace_records:
+        for span_record in trace_record.get("spans") or []:
+            if isinstance(span_record.get("duration_ms"), (int, float)):
+                durations_by_name.setdefault(span_record.get("name", "unknown"), []).append(span_record["duration_ms"])
+    rows = []
+    for span_name, durations in durations_by_name.items():
+        durations.sort()
+        row = {"name": span_name, "count": len(durations)}
+        row.update({f"p{pct}_ms": percentile(durations, pct) for pct in TRACE_PERCENTILES})
+        row["max_ms"] = durations[-1]
+        rows.append(row)
+    return sorted(rows, key=lambda row: row["p95_ms"], reverse=True)
+
+
+def iter_trace_spans(trace_record):
+    # (깊이, span 기록)을 부모-자식 순서로 반환
+    children_by_parent = {}
+    for span_record in trace_record.get("spans") or []:
+        children_by_parent.setdefault(span_record.get("parent_span_id"), []).append(span_record)
+    pending = [(0, span_record) for span_record in sorted(children_by_parent.get(None, []), key=lambda record: record["start_ms"], reverse=True)]
+    while pending:
+        depth, span_record = pending.pop()
+        yield depth, span_record
+        child_records = sorted(children_by_parent.get(span_record["span_id"], []), key=lambda record: record["start_ms"], reverse=True)
+        pending.extend((depth + 1, child_record) for child_record in child_records)
+
+
+def format_trace_breakdown(trace_record):
+    # 로그 출력용: 들여쓴 span 목록
+    lines = [f"Trace {trace_record.get('trace_id')} '{trace_record.get('name')}' {trace_record.get('duration_ms', 0):.0f}ms"]
+    for depth, span_record in iter_trace_spans(trace_record):
+        error_suffix = f" ERROR: {span_record['error']}" if span_record.get("error") else ""
+        lines.append(f"{'  ' * (depth + 1)}- {span_record['name']}: {span_record['duration_ms']:.0f}ms (at +{span_record['start_ms']:.0f}ms){error_suffix}")
+    return "\n".join(lines)
@@ -0,0 +1,190 @@
+# API 사용량 사전 집계 (rollup)
+# 로그 기록기가 사용량 항목을 Blob에 쓸 때마다 시간별/일별 집계를 증분 갱신한다.
+# 관리자 화면은 원본 로그 전체 대신 이 집계 파일과 최근 원본 일부만 읽으므로
+# 로그가 몇 달치 쌓여도 화면 로딩 비용이 일정하다.
+#   app_logs/usage_rollups/daily/YYYY-MM.json     : {일자: {키: 지표}}
+#   app_logs/usage_rollups/hourly/YYYY-MM-DD.json : {시(HH): {키: 지표}}
+#   app_logs/usage_rollups/totals.json            : {"all": {키: 지표}, "updated_at": 마지막 갱신 시각} (전체 누적)
+# 키 = JSON 배열 [user_id, model_name, request_type]
+# 조건부 갱신이 실패한 증분(동시 수정 충돌, 네트워크 오류 등)은 버리지 않고 보관했다가 다음 갱신 때 함께 다시 적용
+import json
+import threading
+from datetime import datetime, timedelta
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from blob_io import BlobWriteConflictError, download_json_blob, update_json_blob
+from log_writer import LOG_TIMESTAMP_FORMAT, day_partition_blob_name, parse_jsonl_bytes
+
+ROLLUP_METRICS = ("calls", "prompt_tokens", "completion_tokens", "total_tokens")
+ROLLUP_DIMENSIONS = ("user_id", "model_name", "request_type")
+
+
+def make_rollup_key(entry):
+    return json.dumps([str(entry.get(dim) or "unknown") for dim in ROLLUP_DIMENSIONS], ensure_ascii=False)
+
+
+def parse_rollup_key(rollup_key):
+    return dict(zip(ROLLUP_DIMENSIONS, json.loads(rollup_key)))
+
+
+def _to_int(value):
+    try:
+        return int(value or 0)
+    except (TypeError, ValueError):
+        return 0
+
+
+def add_metrics(target_metrics, source_metrics):
+    for metric_name in ROLLUP_METRICS:
+        target_metrics[metric_name] = target_metrics.get(metric_name, 0) + _to_int(source_metrics.get(metric_name))
+    return target_metrics
+
+
+class RollupUpdateError(Exception):
+    # 일부 집계 파일을 갱신하지 못함 (증분은 보관되어 다음 apply_entries 때 다시 적용)
+    pass
+
+
+def aggregate_usage_entries(entries):
+    # 반환: {"daily": {월: {일자: {키: 지표}}}, "hourly": {일자: {시: {키: 지표}}}, "totals": {"all": {키: 지표}}}
+    aggregated = {"daily": {}, "hourly": {}, "totals": {}}
+    for entry in entries:
+        try:
+            entry_time = datetime.strptime(entry.get("timestamp", ""), LOG_TIMESTAMP_FORMAT)
+        except (TypeError, ValueError):
+            continue
+        rollup_key = make_rollup_key(entry)
+        entry_metrics = {"calls": 1, "prompt_tokens": entry.get("prompt_tokens"), "completion_tokens": entry.get("completion_tokens"), "total_tokens": entry.get("total_tokens")}
+        day_str, month_str, hour_str = entry_time.strftime("%Y-%m-%d"), entry_time.strftime("%Y-%m"), entry_time.strftime("%H")
+        add_metrics(aggregated["daily"].setdefault(month_str, {}).setdefault(day_str, {}).setdefault(rollup_key, {}), entry_metrics)
+        add_metrics(aggregated["hourly"].setdefault(day_str, {}).setdefault(hour_str, {}).setdefault(rollup_key, {}), entry_metrics)
+        add_metrics(aggregated["totals"].setdefault("all", {}).setdefault(rollup_key, {}), entry_metrics)
+    return aggregated
+
+
+def merge_bucketed_metrics(existing_buckets, delta_buckets):
+    # {버킷: {키: 지표}} 두 개를 합침 (daily의 일자, hourly의 시 단위)
+    for bucket_name, delta_by_key in delta_buckets.items():
+        bucket = existing_buckets.setdefault(bucket_name, {})
+        for rollup_key, delta_metrics in delta_by_key.items():
+            add_metrics(bucket.setdefault(rollup_key, {}), delta_metrics)
+    return existing_buckets
+
+
+class UsageRollupStore:
+    def __init__(self, container_client, rollup_prefix="app_logs/usage_rollups/"):
+        self.container_client = container_client
+        self.rollup_prefix = rollup_prefix
+        self._pending_deltas = {} # 집계 파일 이름 -> 아직 반영하지 못한 {버킷: {키: 지표}}
+        self._pending_lock = threading.Lock() # apply_entries는 로그 기록 스레드 하나에서만 호출되지만 rebuild는 화면에서 호출
+
+    def daily_blob_name(self, month_str): return f"{self.rollup_prefix}daily/{month_str}.json"
+    def hourly_blob_name(self, day_str): return f"{self.rollup_prefix}hourly/{day_str}.json"
+    def totals_blob_name(self): return f"{self.rollup_prefix}totals.json"
+
+    def _read_json(self, blob_name):
+        try:
+            return download_json_blob(self.container_client, blob_name, timeout=30)[0] or {}
+        except ResourceNotFoundError:
+            return {}
+
+    def _conditional_update(self, blob_name, update_fn):
+        # ETag 조건부 업로드로 여러 프로세스가 동시에 갱신해도 증분이 유실되지 않게 함
+        def stamped_update(current_data):
+            updated_data = update_fn(current_data)
+            if blob_name == self.totals_blob_name(): updated_data["updated_at"] = datetime.now().strftime(LOG_TIMESTAMP_FORMAT)
+            return updated_data
+        try:
+            update_json_blob(self.container_client, blob_name, stamped_update, default_value={}, timeout=30)
+            return True
+        except BlobWriteConflictError as e_conflict:
+            print(f"ERROR: {e_conflict}")
+            return False
+
+    def pending_blob_count(self):
+        with self._pending_lock:
+            return len(self._pending_deltas)
+
+    def apply_entries(self, entries):
+        # 새로 기록된 사용량 항목을 집계에 더함. 갱신 비용은 항목이 속한 일/월 수에만 비례
+        # 이전에 반영하지 못한 증분도 함께 다시 시도. 실패한 파일이 남으면 RollupUpdateError (로그 기록기가 다음 주기에 다시 호출)
+        aggregated = aggregate_usage_entries(entries)
+        with self._pending_lock:
+            for month_str, delta_days in aggregated["daily"].items():
+                merge_bucketed_metrics(self._pending_deltas.setdefault(self.daily_blob_name(month_str), {}), delta_days)
+            for day_str, delta_hours in aggregated["hourly"].items():
+                merge_bucketed_metrics(self._pending_deltas.setdefault(self.hourly_blob_name(day_str), {}), delta_hours)
+            if aggregated["totals"]:
+                merge_bucketed_metrics(self._pending_deltas.setdefault(self.totals_blob_name(), {}), aggregated["totals"])
+            pending_deltas, self._pending_deltas = self._pending_deltas, {}
+
+        failed_deltas = {}
+        for blob_name, delta_buckets in pending_deltas.items():
+            try:
+                updated = self._conditional_update(blob_name, lambda current_data, d=delta_buckets: merge_bucketed_metrics(current_data, d))
+            except Exception as e_update: # 네트워크 오류/시간 초과 등도 충돌과 같이 증분을 보관 (나머지 파일은 계속 갱신)
+                print(f"ERROR updating usage rollup '{blob_name}': {e_update}")
+                updated = False
+            if not updated:
+                failed_deltas[blob_name] = delta_buckets
+        if failed_deltas:
+            with self._pending_lock:
+                for blob_name, delta_buckets in failed_deltas.items():
+                    merge_bucketed_metrics(self._pending_deltas.setdefault(blob_name, {}), delta_buckets)
+            raise RollupUpdateError(f"{len(failed_deltas)} usage rollup blob(s) could not be updated. Their increments are kept and will be retried")
+
+    def rebuild(self, all_entries):
+        # 전체 원본 로그로 집계를 처음부터 다시 만듦 (기존 단일 JSON 로그 이관 또는 집계 불일치 복구용)
+        aggregated = aggregate_usage_entries(all_entries)
+        with self._pending_lock:
+            self._pending_deltas = {} # 원본 로그에 이미 포함된 증분
+        for blob_item in list(self.container_client.list_blobs(name_starts_with=self.rollup_prefix)):
+            self.container_client.delete_blob(blob_item.name)
+        for month_str, days in aggregated["daily"].items():
+            self._conditional_update(self.daily_blob_name(month_str), lambda _, d=days: d)
+        for day_str, hours in aggregated["hourly"].items():
+            self._conditional_update(self.hourly_blob_name(day_str), lambda _, h=hours: h)
+        self._conditional_update(self.totals_blob_name(), lambda _, t=aggregated["totals"]: t)
+        return len(all_entries)
+
+    def load_totals(self):
+        # 반환: ({키: 지표}, 마지막 갱신 시각). 누적 파일 하나만 읽으므로 로그 기간과 무관하게 일정한 비용
+        totals_data = self._read_json(self.totals_blob_name())
+        return totals_data.get("all", {}), totals_data.get("updated_at")
+
+    def load_daily_rows(self, start_day, end_day):
+        # start_day ~ end_day (date) 범위의 일별 집계 행. 읽는 파일 수는 범위에 포함된 월 수
+        rows, month_cursor = [], start_day.replace(day=1)
+        while month_cursor <= end_day:
+            month_data = self._read_json(self.daily_blob_name(month_cursor.strftime("%Y-%m")))
+            for day_str, by_key in month_data.items():
+                if start_day.strftime("%Y-%m-%d") <= day_str <= end_day.strftime("%Y-%m-%d"):
+                    for rollup_key, metrics in by_key.items():
+                        rows.append({"date": day_str, **parse_rollup_key(rollup_key), **metrics})
+            month_cursor = (month_cursor + timedelta(days=32)).replace(day=1)
+        return rows
+
+    def load_hourly_rows(self, day):
+        day_str = day.strftime("%Y-%m-%d")
+        hourly_data = self._read_json(self.hourly_blob_name(day_str))
+        return [{"hour": f"{day_str} {hour_str}:00", **parse_rollup_key(rollup_key), **metrics}
+                for hour_str, by_key in sorted(hourly_data.items()) for rollup_key, metrics in by_key.items()]
+
+
+def read_recent_log_entries(container_client, stream_prefix, page=0, page_size=50, max_lookback_days=31):
+    # 최신 항목부터 page번째 페이지를 반환. 오늘 파티션부터 하루씩 거슬러 올라가며 필요한 만큼만 내려받음
+    # 반환: (항목 목록, 다음 페이지 존재 여부)
+    needed_entries = (page + 1) * page_size + 1
+    collected_entries = []
+    for days_back in range(max_lookback_days):
+        partition_blob_name = day_partition_blob_name(stream_prefix, (datetime.now() - timedelta(days=days_back)).strftime(LOG_TIMESTAMP_FORMAT))
+        try:
+            raw_bytes = container_client.get_blob_client(partition_blob_name).download_blob(timeout=60).readall()
+        except ResourceNotFoundError:
+            continue
+        collected_entries.extend(reversed(parse_jsonl_bytes(raw_bytes, partition_blob_name)))
+        if len(collected_entries) >= needed_entries:
+            break
+    page_entries = collected_entries[page * page_size:(page + 1) * page_size]
+    return page_entries, len(collected_entries) > (page + 1) * page_size
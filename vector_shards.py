@@ -0,0 +1,514 @@
+# 부서/컬렉션별로 나눈 벡터 DB (샤드)
+# - 샤드마다 인덱스와 메타데이터를 따로 저장: 공통 샤드("common")는 기존 경로(vector_db/vector.index, vector_db/metadata.json)를 그대로 쓰고,
+#   그 외 샤드는 vector_db/shards/<샤드 이름>/ 아래에 저장 (기존 전역 인덱스는 옮기지 않아도 공통 샤드로 동작)
+# - 샤드는 처음 검색/학습할 때 불러옴 (시작 시에는 목록만 확인)
+#   검색 경로의 주기적 확인(maybe_refresh_layout)마다 샤드 목록과 불러온 샤드의 인덱스 ETag도 백그라운드에서 확인해
+#   다른 프로세스가 만든 샤드/학습한 벡터를 반영
+# - 부서 샤드 이름은 department_shard_name으로 만듦. 정리한 이름이 공통 샤드와 같아지는 부서는 전용 샤드를 가질 수 없음
+# - 검색은 볼 수 있는 샤드들에 병렬로 보내고(FAISS search는 GIL을 놓으므로 스레드로 병렬 실행) 거리 기준으로 합쳐 상위 k개를 반환
+#   여러 질의를 한 번에 받으면 샤드마다 해당 질의들을 묶어 search 한 번으로 처리 (retrieval_service의 SearchBatcher)
+# - 학습은 샤드별로 독립: 한 샤드에 추가하면 그 샤드의 인덱스/메타데이터만 다시 저장
+#   임베딩 전에 filter_duplicate_chunks로 샤드에 이미 있거나 문서 안에서 반복되는 청크를 건너뜀 (chunk_dedup)
+#   중복 확인용 MinHash 서명은 메타데이터 옆(dedup_signatures.npy)에 저장해 두고 다음 학습 때 새로 추가된 청크만 계산
+#   학습 한 건은 ingest_session() 안에서 중복 확인 -> 임베딩 -> add_and_save까지 이어서 처리 (같은 샤드의 다른 학습과 겹치지 않게)
+# - 임베딩 모델별 배치(VectorLayout): 현재 쓰는 배치는 vector_db/active.json에 기록 (없으면 기존 경로 vector_db/ + 앱 설정의 임베딩 모델)
+#   embedding_migration.py가 새 모델 배치(vector_db/models/<모델>/)를 만든 뒤 active.json을 바꾸면 각 프로세스가 refresh_layout으로 전환
+#   (전환 중에는 active.json의 ingest_paused로 학습만 잠시 막고 검색은 기존 인덱스로 계속 처리)
+import io
+import threading
+import time
+import traceback
+from collections import namedtuple
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+from azure.core.exceptions import ResourceNotFoundError
+
+from blob_io import download_json_blob, upload_json_blob
+
+COMMON_SHARD_NAME = "common" # 모든 사용자가 검색하는 샤드 (기존 전역 인덱스)
+LEGACY_VECTOR_DB_PREFIX = "vector_db/"
+ACTIVE_LAYOUT_BLOB_NAME = "vector_db/active.json"
+MODEL_LAYOUT_PREFIX = "vector_db/models/" # 전환한 임베딩 모델별 배치 (vector_db/models/<모델>/)
+MIGRATION_STATE_BLOB_NAME = "vector_db/migration/state.json" # embedding_migration.py 진행 상황
+SHARD_DIRECTORY_NAME = "shards"
+SHARD_INDEX_FILE_NAME = "vector.index"
+SHARD_METADATA_FILE_NAME = "metadata.json"
+SHARD_SIGNATURES_FILE_NAME = "dedup_signatures.npy" # 중복 청크 확인용 서명 (chunk_dedup.NearDuplicateIndex.to_rows)
+METADATA_COMPRESSION = "gzip" # app.py의 LARGE_JSON_COMPRESSION과 같게
+EMBEDDING_DIMENSION = 1536
+DEFAULT_FANOUT_WORKERS = 8
+
+# embedding_model이 None이면 앱 설정(AZURE_OPENAI_EMBEDDING_DEPLOYMENT)의 모델
+VectorLayout = namedtuple("VectorLayout", ["prefix", "embedding_model", "dimension", "ingest_paused"], defaults=[False])
+LEGACY_LAYOUT = VectorLayout(LEGACY_VECTOR_DB_PREFIX, None, EMBEDDING_DIMENSION)
+
+
+class VectorIngestPausedError(Exception):
+    # 임베딩 모델 전환 중이라 학습을 받지 않을 때
+    pass
+
+
+def normalize_shard_name(shard_name):
+    # Blob 경로에 쓸 수 있게 정리 (한글 부서명은 그대로). 비어 있으면 공통 샤드
+    cleaned_name = str(shard_name or "").strip().replace("/", "_").replace("\\", "_")
+    return cleaned_name or COMMON_SHARD_NAME
+
+
+def department_shard_name(department):
+    # 부서 전용 샤드 이름. 비어 있거나 공통 샤드와 같은 이름이 되는 부서(예: "common")는 None (부서 문서가 모든 사용자에게 보이지 않게)
+    if not str(department or "").strip():
+        return None
+    shard_name = normalize_shard_name(department)
+    return None if shard_name == COMMON_SHARD_NAME else shard_name
+
+
+def shard_blob_names(shard_name, prefix=LEGACY_VECTOR_DB_PREFIX):
+    # 반환: (인덱스 Blob 이름, 메타데이터 Blob 이름). 공통 샤드는 배치 경로 바로 아래, 그 외는 <배치 경로>shards/<샤드 이름>/
+    shard_name = normalize_shard_name(shard_name)
+    if shard_name == COMMON_SHARD_NAME:
+        return f"{prefix}{SHARD_INDEX_FILE_NAME}", f"{prefix}{SHARD_METADATA_FILE_NAME}"
+    shard_prefix = f"{prefix}{SHARD_DIRECTORY_NAME}/{shard_name}/"
+    return f"{shard_prefix}{SHARD_INDEX_FILE_NAME}", f"{shard_prefix}{SHARD_METADATA_FILE_NAME}"
+
+
+def list_shard_names(container_client, prefix=LEGACY_VECTOR_DB_PREFIX):
+    # 저장소에 인덱스가 있는 샤드 이름 (공통 샤드는 항상 포함)
+    shard_names = {COMMON_SHARD_NAME}
+    shards_prefix = f"{prefix}{SHARD_DIRECTORY_NAME}/"
+    for blob_item in container_client.list_blobs(name_starts_with=shards_prefix):
+        relative_name = blob_item.name[len(shards_prefix):]
+        shard_name, _, file_name = relative_name.partition("/")
+        if shard_name and file_name == SHARD_INDEX_FILE_NAME:
+            shard_names.add(shard_name)
+    return sorted(shard_names)
+
+
+def layout_from_dict(layout_dict):
+    return VectorLayout(layout_dict.get("prefix") or LEGACY_VECTOR_DB_PREFIX, layout_dict.get("embedding_model"),
+                        int(layout_dict.get("dimension") or EMBEDDING_DIMENSION), bool(layout_dict.get("ingest_paused")))
+
+
+def load_active_layout(container_client):
+    # active.json이 없으면 기존 배치. 읽기 실패는 예외 (호출하는 쪽에서 현재 배치를 유지)
+    try:
+        layout_dict = download_json_blob(container_client, ACTIVE_LAYOUT_BLOB_NAME, timeout=30)[0]
+    except ResourceNotFoundError:
+        return LEGACY_LAYOUT
+    return layout_from_dict(layout_dict or {})
+
+
+def write_active_layout(container_client, layout, **extra_fields):
+    upload_json_blob(container_client, ACTIVE_LAYOUT_BLOB_NAME, dict(layout._asdict(), updated_at=time.strftime("%Y-%m-%d %H:%M:%S"), **extra_fields), timeout=30)
+
+
+def load_migration_state(container_client):
+    # 반환: 임베딩 모델 전환 진행 상황 dict (전환한 적이 없으면 None)
+    try:
+        return download_json_blob(container_client, MIGRATION_STATE_BLOB_NAME, timeout=30)[0]
+    except ResourceNotFoundError:
+        return None
+
+
+def migration_progress(migration_state):
+    # 반환: (새 배치로 옮긴 청크 수, 전체 청크 수)
+    shard_states = (migration_state or {}).get("shards", {}).values()
+    return sum(shard_state.get("migrated", 0) for shard_state in shard_states), sum(shard_state.get("source_total", 0) for shard_state in shard_states)
+
+
+class VectorShard:
+    def __init__(self, shard_name, container_client, dimension=EMBEDDING_DIMENSION, prefix=LEGACY_VECTOR_DB_PREFIX):
+        import faiss, numpy # 검색 프로세스에서만 필요
+        self.faiss, self.np = faiss, numpy
+        self.name = shard_name
+        self.container_client = container_client
+        self.dimension = dimension
+        self.index_blob_name, self.metadata_blob_name = shard_blob_names(shard_name, prefix)
+        self.signatures_blob_name = self.metadata_blob_name[:-len(SHARD_METADATA_FILE_NAME)] + SHARD_SIGNATURES_FILE_NAME
+        self.index = faiss.IndexFlatL2(dimension)
+        self.metadata = []
+        self.index_etag = None # 불러오거나 저장한 인덱스 Blob의 ETag (reload_if_changed에서 비교)
+        self._lock = threading.Lock() # 검색/추가
+        self._ingest_lock = threading.RLock() # 이 샤드의 Blob 저장끼리만 직렬화 (add_and_save 안에서 save)
+        self._duplicate_index = None # 학습 시 중복 청크 확인용 (chunk_dedup.NearDuplicateIndex, 처음 학습할 때 저장된 서명으로 만듦)
+        self._duplicate_index_lock = threading.Lock()
+
+    def load(self, keep_current_on_error=False):
+        # 반환: 화면에 표시할 오류 목록. 읽을 수 없으면 빈 인덱스로 시작 (keep_current_on_error면 지금 인덱스를 유지)
+        index, metadata, index_etag, load_errors = self.faiss.IndexFlatL2(self.dimension), [], None, []
+        try:
+            index_downloader = self.container_client.get_blob_client(self.index_blob_name).download_blob(timeout=120)
+            index_bytes, index_etag = index_downloader.readall(), getattr(index_downloader.properties, "etag", None)
+            if index_bytes:
+                index = self.faiss.deserialize_index(self.np.frombuffer(index_bytes, dtype="uint8"))
+                metadata = download_json_blob(self.container_client, self.metadata_blob_name, timeout=120)[0] or []
+            else:
+                print(f"WARNING: '{self.index_blob_name}' is empty in storage. Using new index.")
+        except ResourceNotFoundError:
+            print(f"WARNING: '{self.index_blob_name}' not found in storage. New index will be used/created.")
+        except Exception as e_load:
+            load_errors.append(f"Error loading vector DB shard '{self.name}': {e_load}")
+            print(f"ERROR loading vector DB shard '{self.name}': {e_load}\n{traceback.format_exc()}")
+            if keep_current_on_error:
+                return load_errors
+            index, metadata, index_etag = self.faiss.IndexFlatL2(self.dimension), [], None
+        if index.d != self.dimension:
+            # 저장된 인덱스를 버리지 않음 (다른 모델의 벡터와 섞이지 않도록 add에서 거부). 모델을 바꾸려면 embedding_migration.py
+            load_errors.append(f"Vector DB shard '{self.name}' has dimension {index.d} but {self.dimension} was expected. Run embedding_migration.py to change the embedding model.")
+            print(f"WARNING: Shard '{self.name}' index dimension ({index.d}) does not match expected dimension ({self.dimension}). Keeping stored index; new documents will be rejected.")
+        if index.ntotal == 0 and metadata:
+            print(f"INFO: Shard '{self.name}' index is empty but metadata is not. Clearing metadata for consistency."); metadata = []
+        elif index.ntotal < len(metadata):
+            # 메타데이터를 먼저 저장하므로 인덱스 저장 전에 중단되면 메타데이터가 더 길 수 있음
+            print(f"WARNING: Shard '{self.name}' has {len(metadata) - index.ntotal} metadata entries without vectors. Truncating to {index.ntotal}.")
+            metadata = metadata[:index.ntotal]
+        elif index.ntotal != len(metadata):
+            print(f"CRITICAL WARNING: Shard '{self.name}' has {index.ntotal} vectors but {len(metadata)} metadata entries.")
+        with self._lock:
+            self.index, self.metadata, self.index_etag = index, metadata, index_etag
+        with self._duplicate_index_lock:
+            self._duplicate_index = None
+        print(f"Vector DB shard '{self.name}' loaded: {index.ntotal} vectors.")
+        return load_errors
+
+    def search(self, query_matrix, k, count_tokens_fn=None):
+        # 반환: 질의별 [(거리, 결과 dict)] (최대 k개)
+        with self._lock:
+            if self.index.ntotal == 0 or not self.metadata:
+                return [[] for _ in range(len(query_matrix))]
+            if query_matrix.shape[1] != self.index.d:
+                raise ValueError(f"Query dimension {query_matrix.shape[1]} does not match shard '{self.name}' dimension {self.index.d}.")
+            distances, indices_found = self.index.search(query_matrix, min(k, self.index.ntotal))
+            shard_results = []
+            for query_distances, query_indices in zip(distances, indices_found):
+                scored_items = []
+                for distance, idx_val in zip(query_distances, query_indices):
+                    if 0 <= idx_val < len(self.metadata) and isinstance(self.metadata[idx_val], dict):
+                        item = self.metadata[idx_val]
+                        if count_tokens_fn and not isinstance(item.get("token_count"), int):
+                            try: item["token_count"] = count_tokens_fn(item.get("content", "") or "") # 이전에 학습된 청크는 처음 검색될 때 한 번만 계산
+                            except Exception: pass # 토크나이저 준비 전이면 다음 검색 때 계산
+                        scored_items.append((float(distance), {
+                            "source": item.get("file_name", "Unknown Source"), "content": item.get("content", ""),
+                            "is_image_description": item.get("is_image_description", False),
+                            "original_file_extension": item.get("original_file_extension", ""), "token_count": item.get("token_count"),
+                            "shard": self.name
+                        }))
+                    elif idx_val >= 0:
+                        print(f"Warning: Invalid index {idx_val} from FAISS search in shard '{self.name}'. Metadata length: {len(self.metadata)}")
+                shard_results.append(scored_items)
+            return shard_results
+
+    def add(self, vectors, metadata_entries):
+        # 메모리에만 추가. 반환: 추가 후 벡터 수. 차원이 다르면 ValueError (기존 인덱스를 비우지 않음)
+        vector_matrix = self.np.array(vectors, dtype="float32")
+        with self._lock:
+            if vector_matrix.ndim != 2 or vector_matrix.shape[1] != self.index.d:
+                raise ValueError(f"Embedding dimension {vector_matrix.shape[-1]} does not match shard '{self.name}' dimension {self.index.d}. "
+                                 "Run embedding_migration.py to change the embedding model.")
+            self.index.add(vector_matrix)
+            self.metadata.extend(metadata_entries)
+            ntotal = self.index.ntotal
+        with self._duplicate_index_lock:
+            if self._duplicate_index is not None: self._duplicate_index.add_entries(metadata_entries)
+        return ntotal
+
+    @contextmanager
+    def ingest_session(self):
+        # 학습 한 건(filter_duplicate_chunks -> 임베딩 -> add_and_save) 동안 이 샤드의 다른 학습/다시 불러오기를 막음
+        # 시작할 때 다른 프로세스가 저장한 내용을 먼저 불러와 그 위에서 중복을 확인하고 저장
+        with self._ingest_lock:
+            try:
+                self.reload_if_changed()
+            except Exception as e_reload:
+                print(f"WARNING: Could not check shard '{self.name}' for changes before ingest: {e_reload}")
+            yield self
+
+    def filter_duplicate_chunks(self, chunks, file_name):
+        # 임베딩 전에 ingest_session 안에서 호출. 반환: (남길 청크 번호 목록, 통계 dict: 건너뛴 청크 수, 절약한 임베딩/인덱스 바이트)
+        from chunk_dedup import filter_near_duplicate_chunks
+        with self._duplicate_index_lock:
+            if self._duplicate_index is None: # 샤드의 기존 청크로 한 번만 만들고 이후에는 add에서 갱신
+                self._duplicate_index, signatures_changed = self._build_duplicate_index()
+            else:
+                signatures_changed = False
+            kept_positions, dedup_stats = filter_near_duplicate_chunks(chunks, file_name, self._duplicate_index, self.index.d)
+        if signatures_changed: self._save_signatures() # 모두 중복이라 저장(save)이 없어도 계산한 서명은 남김
+        return kept_positions, dedup_stats
+
+    def _build_duplicate_index(self):
+        # 저장된 서명을 다시 쓰고 그 뒤에 학습된 청크의 서명만 계산 (저장된 서명이 없는 기존 샤드는 한 번 전체 계산)
+        # 반환: (NearDuplicateIndex, 새로 계산한 서명이 있는지)
+        from chunk_dedup import NearDuplicateIndex
+        started_at = time.perf_counter()
+        stored_rows = None
+        try:
+            stored_bytes = self.container_client.get_blob_client(self.signatures_blob_name).download_blob(timeout=120).readall()
+            stored_rows = self.np.load(io.BytesIO(stored_bytes), allow_pickle=False)
+        except ResourceNotFoundError:
+            pass
+        except Exception as e_signatures:
+            print(f"WARNING: Could not read duplicate-chunk signatures for shard '{self.name}' (recomputing): {e_signatures}")
+        with self._lock:
+            metadata_snapshot = list(self.metadata)
+        duplicate_index = NearDuplicateIndex()
+        reused_count = duplicate_index.add_entries(metadata_snapshot, stored_rows)
+        print(f"Duplicate-chunk index for shard '{self.name}' built from {len(duplicate_index)} chunks "
+              f"({reused_count} stored signatures reused) in {time.perf_counter() - started_at:.2f}s.")
+        return duplicate_index, reused_count < len(duplicate_index)
+
+    def _save_signatures(self):
+        # 중복 청크 서명을 메타데이터 옆에 저장. 실패해도 학습은 계속 (다음에 만들 때 빠진 서명만 다시 계산)
+        with self._duplicate_index_lock:
+            signature_rows = self._duplicate_index.to_rows() if self._duplicate_index is not None else None
+        if signature_rows is None:
+            return
+        signatures_buffer = io.BytesIO()
+        self.np.save(signatures_buffer, signature_rows, allow_pickle=False)
+        try:
+            self.container_client.get_blob_client(self.signatures_blob_name).upload_blob(signatures_buffer.getvalue(), overwrite=True, timeout=120)
+        except Exception as e_signatures:
+            print(f"WARNING: Could not save duplicate-chunk signatures for shard '{self.name}': {e_signatures}")
+
+    def save(self):
+        # 메타데이터 -> 인덱스 순으로 저장 (중간에 실패해도 load에서 인덱스 길이에 맞춤). 반환: 저장한 벡터 수
+        with self._ingest_lock:
+            with self._lock:
+                index_bytes = self.faiss.serialize_index(self.index).tobytes()
+                metadata_snapshot = list(self.metadata)
+                ntotal = self.index.ntotal
+            upload_json_blob(self.container_client, self.metadata_blob_name, metadata_snapshot, compression=METADATA_COMPRESSION, timeout=120)
+            upload_result = self.container_client.get_blob_client(self.index_blob_name).upload_blob(index_bytes, overwrite=True, timeout=120)
+            self.index_etag = (upload_result or {}).get("etag") # 직접 저장한 내용은 reload_if_changed에서 다시 불러오지 않음
+            self._save_signatures() # 학습한 프로세스에만 중복 확인 인덱스가 있음 (임베딩 모델 전환 등은 건너뜀)
+            return ntotal
+
+    def add_and_save(self, vectors, metadata_entries):
+        # 반환: 추가 후 샤드의 벡터 수. Blob 저장에 실패하면 메모리에 추가한 벡터/메타데이터를 되돌리고 예외
+        # (저장되지 않은 벡터가 검색되거나 다음 저장에 섞여 들어가지 않게)
+        with self._ingest_lock:
+            with self._lock:
+                previous_ntotal = self.index.ntotal
+            self.add(vectors, metadata_entries)
+            try:
+                return self.save()
+            except Exception:
+                self._truncate(previous_ntotal)
+                raise
+
+    def _truncate(self, ntotal):
+        # 메모리의 인덱스/메타데이터를 앞의 ntotal개로 되돌림 (add_and_save 저장 실패 시)
+        with self._lock:
+            if self.index.ntotal > ntotal:
+                self.index.remove_ids(self.faiss.IDSelectorRange(ntotal, self.index.ntotal))
+            del self.metadata[ntotal:]
+        with self._duplicate_index_lock:
+            self._duplicate_index = None # 되돌린 청크가 들어 있으므로 다음 학습 때 다시 만듦
+        print(f"Shard '{self.name}' rolled back to {ntotal} vectors after a failed save.")
+
+    def reload_if_changed(self):
+        # 다른 프로세스가 이 샤드를 저장했으면(인덱스 Blob의 ETag가 다르면) 다시 불러옴. 반환: 다시 불러왔는지
+        with self._ingest_lock: # 이 프로세스의 저장과 겹치지 않게
+            try:
+                stored_etag = self.container_client.get_blob_client(self.index_blob_name).get_blob_properties(timeout=30).etag
+            except ResourceNotFoundError:
+                return False
+            if stored_etag == self.index_etag:
+                return False
+            return not self.load(keep_current_on_error=True)
+
+    def stats(self):
+        with self._lock:
+            return {"ntotal": self.index.ntotal, "dimension": self.index.d, "metadata_entries": len(self.metadata)}
+
+
+class ShardedVectorStore:
+    # count_tokens_fn: 결과 청크에 토큰 수가 없을 때 계산해 메타데이터에 저장 (없으면 계산하지 않음)
+    # layout: None이면 active.json에서 읽음
+    def __init__(self, container_client, layout=None, max_workers=DEFAULT_FANOUT_WORKERS, count_tokens_fn=None):
+        import numpy
+        self.np = numpy
+        self.container_client = container_client
+        self.layout = layout or LEGACY_LAYOUT
+        self.count_tokens_fn = count_tokens_fn
+        self._layout_checked_at = None
+        self._shard_refresh_running = False
+        self._known_shard_names = {COMMON_SHARD_NAME}
+        self._shards = {} # 이름 -> 불러온 VectorShard
+        self._load_errors = {}
+        self._lock = threading.Lock()
+        self._shard_locks = {} # 같은 샤드를 여러 스레드가 동시에 불러오지 않도록
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="shard-search")
+        if layout is None: self.refresh_layout()
+
+    @property
+    def dimension(self):
+        return self.layout.dimension
+
+    def embedding_model(self, default_model=None):
+        # 현재 배치의 임베딩 모델 (기존 배치는 앱 설정의 모델)
+        return self.layout.embedding_model or default_model
+
+    def refresh_layout(self):
+        # active.json을 다시 읽어 배치가 바뀌었으면 불러온 샤드를 버리고 새 배치로 전환. 반환: 배치가 바뀌었는지
+        self._layout_checked_at = time.monotonic()
+        try:
+            new_layout = load_active_layout(self.container_client)
+        except Exception as e_layout:
+            print(f"ERROR reading active vector DB layout (keeping current): {e_layout}"); return False
+        with self._lock:
+            previous_layout, self.layout = self.layout, new_layout
+            if new_layout.prefix == previous_layout.prefix:
+                return False
+            # 검색 중인 요청은 이미 잡은 이전 샤드로 끝까지 처리됨
+            self._shards, self._load_errors, self._shard_locks = {}, {}, {}
+            self._known_shard_names = {COMMON_SHARD_NAME}
+        print(f"Vector DB layout switched: '{previous_layout.prefix}' ({previous_layout.embedding_model or 'default model'}) -> "
+              f"'{new_layout.prefix}' ({new_layout.embedding_model or 'default model'}, dimension {new_layout.dimension}).")
+        self.discover()
+        return True
+
+    def maybe_refresh_layout(self, min_interval_seconds):
+        # 검색 경로에서 호출: 마지막 확인 후 min_interval_seconds가 지났을 때만 active.json을 읽음
+        # 배치가 그대로면 샤드 목록과 불러온 샤드의 변경 여부는 백그라운드에서 확인 (변경된 샤드를 내려받는 동안 검색을 막지 않음)
+        if self._layout_checked_at is not None and time.monotonic() - self._layout_checked_at < min_interval_seconds:
+            return False
+        if self.refresh_layout():
+            return True
+        with self._lock:
+            if self._shard_refresh_running:
+                return False
+            self._shard_refresh_running = True
+        threading.Thread(target=self._refresh_shards_in_background, name="vector-shard-refresh", daemon=True).start()
+        return False
+
+    def _refresh_shards_in_background(self):
+        try:
+            self.refresh_shards()
+        except Exception as e_refresh:
+            print(f"ERROR refreshing vector DB shards: {e_refresh}\n{traceback.format_exc()}")
+        finally:
+            with self._lock:
+                self._shard_refresh_running = False
+
+    def refresh_shards(self):
+        # 새 샤드를 목록에 추가하고, 불러온 샤드 중 다른 프로세스가 저장한 샤드를 다시 불러옴. 반환: 다시 불러온 샤드 이름 목록
+        self.discover()
+        with self._lock:
+            loaded_shards = dict(self._shards)
+        reloaded_shard_names = []
+        for shard_name, shard in loaded_shards.items():
+            try:
+                if shard.reload_if_changed(): reloaded_shard_names.append(shard_name)
+            except Exception as e_shard:
+                print(f"ERROR checking vector DB shard '{shard_name}' for changes: {e_shard}")
+        if reloaded_shard_names:
+            print(f"Vector DB shards changed by other processes reloaded: {', '.join(sorted(reloaded_shard_names))}")
+        return reloaded_shard_names
+
+    def check_ingest_allowed(self):
+        # 학습 직전에 호출: 최신 배치를 확인하고 전환 중이면 VectorIngestPausedError
+        self.refresh_layout()
+        if self.layout.ingest_paused:
+            raise VectorIngestPausedError("The vector DB is switching to a new embedding model. Please try again in a few minutes.")
+
+    def discover(self):
+        # 저장소의 샤드 목록만 확인 (불러오지 않음)
+        try:
+            shard_names = list_shard_names(self.container_client, self.layout.prefix)
+        except Exception as e_list:
+            print(f"ERROR listing vector DB shards: {e_list}"); return self.shard_names()
+        with self._lock:
+            self._known_shard_names.update(shard_names)
+        return self.shard_names()
+
+    def shard_names(self):
+        with self._lock:
+            return sorted(self._known_shard_names)
+
+    def get_shard(self, shard_name):
+        # 처음 사용할 때 불러옴
+        shard_name = normalize_shard_name(shard_name)
+        with self._lock:
+            if shard_name in self._shards:
+                return self._shards[shard_name]
+            shard_lock = self._shard_locks.setdefault(shard_name, threading.Lock())
+        with shard_lock:
+            with self._lock:
+                if shard_name in self._shards:
+                    return self._shards[shard_name]
+            layout = self.layout
+            shard = VectorShard(shard_name, self.container_client, layout.dimension, layout.prefix)
+            load_errors = shard.load()
+            with self._lock:
+                if layout.prefix != self.layout.prefix:
+                    return shard # 불러오는 동안 배치가 바뀜 (이번 요청에만 사용)
+                self._shards[shard_name] = shard
+                self._known_shard_names.add(shard_name)
+                self._load_errors[shard_name] = load_errors
+            return shard
+
+    def load_errors(self, shard_name=COMMON_SHARD_NAME):
+        with self._lock:
+            return list(self._load_errors.get(normalize_shard_name(shard_name), []))
+
+    def resolve_shard_names(self, shard_names=None):
+        # None이면 알려진 모든 샤드. 아직 없는 샤드(학습 전 부서)는 제외
+        known_shard_names = set(self.shard_names())
+        if shard_names is None:
+            return sorted(known_shard_names)
+        return [shard_name for shard_name in dict.fromkeys(normalize_shard_name(name) for name in shard_names) if shard_name in known_shard_names]
+
+    def search_batch(self, query_vectors, k_values, shard_name_lists=None):
+        # 반환: 질의별 결과 목록 (거리 순 상위 k). shard_name_lists: 질의별 검색할 샤드 이름 목록 (None이면 모든 샤드)
+        if not query_vectors:
+            return []
+        shard_name_lists = [self.resolve_shard_names(shard_names) for shard_names in (shard_name_lists or [None] * len(query_vectors))]
+        query_rows_by_shard = {}
+        for query_no, shard_names in enumerate(shard_name_lists):
+            for shard_name in shard_names: query_rows_by_shard.setdefault(shard_name, []).append(query_no)
+        query_matrix = self.np.array(query_vectors, dtype="float32")
+
+        def search_shard(shard_name):
+            query_rows = query_rows_by_shard[shard_name]
+            return self.get_shard(shard_name).search(query_matrix[query_rows], max(k_values[query_no] for query_no in query_rows), self.count_tokens_fn)
+        if len(query_rows_by_shard) > 1:
+            shard_futures = {shard_name: self._executor.submit(search_shard, shard_name) for shard_name in query_rows_by_shard}
+            get_shard_results = lambda shard_name: shard_futures[shard_name].result()
+        else: # 샤드가 하나면 스레드를 거치지 않음
+            get_shard_results = search_shard
+        scored_results = [[] for _ in query_vectors]
+        for shard_name, query_rows in query_rows_by_shard.items():
+            try:
+                shard_results = get_shard_results(shard_name)
+            except Exception as e_shard:
+                print(f"ERROR searching vector DB shard '{shard_name}': {e_shard}\n{traceback.format_exc()}"); continue # 다른 샤드 결과는 사용
+            for query_no, scored_items in zip(query_rows, shard_results):
+                scored_results[query_no].extend(scored_items)
+        return [[item for _, item in sorted(scored_items, key=lambda scored: scored[0])[:k_values[query_no]]] for query_no, scored_items in enumerate(scored_results)]
+
+    def add_and_save(self, shard_name, vectors, metadata_entries):
+        return self.get_shard(shard_name).add_and_save(vectors, metadata_entries)
+
+    def load_shards(self, shard_names=None):
+        # 샤드를 검색 없이 불러옴 (None이면 알려진 모든 샤드, 없는 샤드는 제외). 반환: stats() (불러온 샤드의 벡터 수 포함)
+        for shard_name in self.resolve_shard_names(shard_names):
+            self.get_shard(shard_name)
+        return self.stats()
+
+    def reload(self):
+        # 불러온 샤드를 버리고 목록을 다시 확인 (다른 노드가 학습한 내용 반영). 샤드는 다음 사용 시 다시 불러옴
+        if self.refresh_layout():
+            return self.shard_names()
+        with self._lock:
+            self._shards.clear(); self._load_errors.clear()
+        return self.discover()
+
+    def stats(self):
+        with self._lock:
+            loaded_shards = dict(self._shards)
+            known_shard_names = sorted(self._known_shard_names)
+        shard_stats = {shard_name: dict(loaded_shards[shard_name].stats(), loaded=True) if shard_name in loaded_shards else {"loaded": False}
+                       for shard_name in known_shard_names}
+        return {"ntotal": sum(stats.get("ntotal", 0) for stats in shard_stats.values()), "dimension": self.dimension,
+                "embedding_model": self.layout.embedding_model, "layout_prefix": self.layout.prefix, "ingest_paused": self.layout.ingest_paused, "shards": shard_stats}